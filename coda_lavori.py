@@ -0,0 +1,522 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Coda dei lavori in background (PDF e invio email degli ordini)
+
+Il salvataggio di un ordine termina al commit sul database: generazione del
+PDF e invio dell'email (il solo SMTP può bloccare fino a 25 secondi) avvengono
+nei thread worker. Il PDF è un lavoro della tabella lavori; le email sono
+righe di email_outbox, scritte da db.save_ordine nella stessa transazione
+dell'ordine e consegnate dagli stessi worker in blocchi di LIMITE_INVIO su una
+sola sessione SMTP (email_sender.send_batch).
+
+- un lavoro viene preso con un UPDATE condizionato (stato 'in_coda' ->
+  'in_corso'), quindi più worker, anche in processi diversi, non eseguono mai
+  lo stesso lavoro due volte
+- un lavoro fallito torna in coda con attesa esponenziale
+  (coda_backoff_secondi * 2^(tentativi-1), al massimo coda_backoff_max_secondi)
+  fino a coda_max_tentativi, poi resta 'fallito' finché non lo si riprova
+- un lavoro 'in_corso' da più di MINUTI_BLOCCO (processo terminato a metà,
+  esito non registrato) torna in coda: i worker lo controllano ogni
+  SECONDI_RECUPERO
+- il PDF generato è salvato in ordini_pdf, legato all'updated_at dell'ordine:
+  se l'ordine cambia, il PDF in cache non vale più
+- le email seguono le stesse regole (presa condizionata 'da_inviare' ->
+  'in_invio', backoff, 'fallita' dopo coda_max_tentativi). La consegna è
+  "almeno una volta": un processo che muore tra l'invio SMTP e la registrazione
+  dell'esito rimanda l'email dopo MINUTI_BLOCCO
+
+I worker partono con avvia_worker() (idempotente, la chiama l'app a ogni
+rerun). Per eseguirli in un processo separato: python coda_lavori.py
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+
+import db
+from email_sender import limite_al_minuto, send_batch
+from pdf_ordine import genera_pdf_ordine_download
+
+# Lavori 'in_corso' da più di tanto sono considerati abbandonati
+MINUTI_BLOCCO = 10
+# Attesa massima di un worker senza lavori prima di ricontrollare la coda
+SECONDI_ATTESA = 5.0
+# Email consegnate al massimo in un giro (una sessione SMTP)
+LIMITE_INVIO = 50
+# Ogni quanto i worker rimettono in coda i lavori bloccati
+SECONDI_RECUPERO = 60
+
+_DEFAULT = {
+    'coda_worker': '2',
+    'coda_max_tentativi': '5',
+    'coda_backoff_secondi': '30',
+    'coda_backoff_max_secondi': '3600',
+}
+
+_lock = threading.Lock()
+_worker: List[threading.Thread] = []
+_sveglia = threading.Event()
+_stop = threading.Event()
+_lock_recupero = threading.Lock()
+_ultimo_recupero = 0.0
+
+log = logging.getLogger(__name__)
+
+
+def _parametri(conn) -> Dict[str, int]:
+    """Numero di worker, tentativi e backoff dalla tabella impostazioni"""
+    rows = conn.execute(
+        f"SELECT chiave, valore FROM impostazioni WHERE chiave IN ({', '.join('?' for _ in _DEFAULT)})",
+        list(_DEFAULT),
+    ).fetchall()
+    valori = dict(_DEFAULT)
+    valori.update({r['chiave']: r['valore'] for r in rows if r['valore'] not in (None, '')})
+    return {
+        'worker': int(valori['coda_worker']),
+        'max_tentativi': int(valori['coda_max_tentativi']),
+        'backoff': int(valori['coda_backoff_secondi']),
+        'backoff_max': int(valori['coda_backoff_max_secondi']),
+    }
+
+
+# ============================================
+# ACCODAMENTO
+# ============================================
+
+def _accoda(conn, tipo: str, ordine_id: str = None, payload: Dict = None, max_tentativi: int = None) -> str:
+    """Inserisce un lavoro (senza commit)"""
+    lavoro_id = str(uuid.uuid4())
+    now = datetime.now().isoformat()
+    conn.execute("""
+        INSERT INTO lavori (id, tipo, ordine_id, payload, stato, tentativi, max_tentativi,
+                            prossimo_tentativo, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'in_coda', 0, ?, ?, ?, ?)
+    """, (lavoro_id, tipo, ordine_id, json.dumps(payload or {}),
+          max_tentativi or _parametri(conn)['max_tentativi'], now, now, now))
+    return lavoro_id
+
+
+def accoda_documenti_ordine(ordine_id: str) -> str:
+    """Accoda il PDF dell'ordine (la conferma email è già in outbox con l'ordine) e sveglia i worker.
+
+    Returns:
+        id del lavoro PDF
+    """
+    conn = db.get_connection()
+    try:
+        lavoro_id = _accoda(conn, 'pdf_ordine', ordine_id)
+        conn.commit()
+    finally:
+        conn.close()
+    _sveglia.set()
+    return lavoro_id
+
+
+def riprova_ordine(ordine_id: str) -> int:
+    """Rimette in coda subito i lavori e le email falliti di un ordine.
+
+    Returns:
+        numero di lavori ed email rimessi in coda
+    """
+    conn = db.get_connection()
+    try:
+        now = datetime.now().isoformat()
+        cur = conn.execute("""
+            UPDATE lavori SET stato = 'in_coda', tentativi = 0, prossimo_tentativo = ?, updated_at = ?
+            WHERE ordine_id = ? AND stato = 'fallito'
+        """, (now, now, ordine_id))
+        conn.commit()
+        n = cur.rowcount
+    finally:
+        conn.close()
+    n += db.riprova_email_ordine(ordine_id)
+    _sveglia.set()
+    return n
+
+
+# ============================================
+# ESECUZIONE
+# ============================================
+
+def _prendi_lavoro(conn, worker: str) -> Optional[Dict[str, Any]]:
+    """Assegna al worker il primo lavoro pronto (None se la coda è vuota)"""
+    now = datetime.now().isoformat()
+    token = f"{worker}:{uuid.uuid4().hex[:8]}"
+    cur = conn.execute("""
+        UPDATE lavori
+        SET stato = 'in_corso', worker = ?, tentativi = tentativi + 1, iniziato_at = ?, updated_at = ?
+        WHERE id = (
+            SELECT id FROM lavori
+            WHERE stato = 'in_coda' AND prossimo_tentativo <= ?
+            ORDER BY prossimo_tentativo
+            LIMIT 1
+        ) AND stato = 'in_coda'
+    """, (token, now, now, now))
+    conn.commit()
+    if not cur.rowcount:
+        return None
+    row = conn.execute("SELECT * FROM lavori WHERE worker = ? AND stato = 'in_corso'", (token,)).fetchone()
+    return dict(row) if row else None
+
+
+def _recupera_bloccati(conn) -> int:
+    """Rimette in coda lavori ed email rimasti in esecuzione oltre MINUTI_BLOCCO"""
+    limite = (datetime.now() - timedelta(minutes=MINUTI_BLOCCO)).isoformat()
+    now = datetime.now().isoformat()
+    n = conn.execute("""
+        UPDATE lavori SET stato = 'in_coda', worker = NULL, updated_at = ?
+        WHERE stato = 'in_corso' AND iniziato_at < ?
+    """, (now, limite)).rowcount
+    n += conn.execute("""
+        UPDATE email_outbox SET stato = 'da_inviare', worker = NULL, updated_at = ?
+        WHERE stato = 'in_invio' AND iniziato_at < ?
+    """, (now, limite)).rowcount
+    conn.commit()
+    return n
+
+
+def attesa_backoff(tentativi: int, base: int, massimo: int) -> float:
+    """Secondi prima del prossimo tentativo (esponenziale con 10% di jitter)"""
+    attesa = min(base * 2 ** max(tentativi - 1, 0), massimo)
+    return attesa * (1 + random.random() * 0.1)
+
+
+def _pdf_in_cache(conn, ordine_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+    row = conn.execute("""
+        SELECT p.contenuto, p.filename
+        FROM ordini_pdf p
+        JOIN ordini o ON o.id = p.ordine_id
+        WHERE p.ordine_id = ? AND p.ordine_updated_at = COALESCE(o.updated_at, '')
+    """, (ordine_id,)).fetchone()
+    if not row:
+        return None, None
+    return bytes(row['contenuto']), row['filename']
+
+
+def _genera_pdf(conn, ordine_id: str) -> Tuple[bytes, str]:
+    """Genera il PDF dell'ordine e lo salva in ordini_pdf (con commit)"""
+    versione = conn.execute("SELECT updated_at FROM ordini WHERE id = ?", (ordine_id,)).fetchone()
+    pdf_bytes, filename = genera_pdf_ordine_download(ordine_id)
+    if not versione or not pdf_bytes:
+        raise ValueError(f"Ordine {ordine_id} non trovato")
+    conn.execute("""
+        INSERT INTO ordini_pdf (ordine_id, filename, contenuto, ordine_updated_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(ordine_id) DO UPDATE SET
+            filename = excluded.filename,
+            contenuto = excluded.contenuto,
+            ordine_updated_at = excluded.ordine_updated_at,
+            created_at = excluded.created_at
+    """, (ordine_id, filename, pdf_bytes, versione['updated_at'] or '', datetime.now().isoformat()))
+    conn.commit()
+    return pdf_bytes, filename
+
+
+def _esegui_pdf_ordine(conn, lavoro: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    _genera_pdf(conn, lavoro['ordine_id'])
+
+
+GESTORI = {
+    'pdf_ordine': _esegui_pdf_ordine,
+}
+
+
+def esegui_prossimo(worker: str = 'main') -> Optional[Dict[str, Any]]:
+    """Esegue un lavoro pronto, se c'è.
+
+    Returns:
+        il lavoro con lo stato finale ('completato', 'in_coda' per un nuovo
+        tentativo, 'fallito'), oppure None se la coda è vuota
+    """
+    conn = db.get_connection()
+    try:
+        lavoro = _prendi_lavoro(conn, worker)
+        if not lavoro:
+            return None
+        try:
+            gestore = GESTORI.get(lavoro['tipo'])
+            if not gestore:
+                raise ValueError(f"Tipo di lavoro sconosciuto: {lavoro['tipo']}")
+            gestore(conn, lavoro, json.loads(lavoro['payload'] or '{}'))
+        except Exception as e:
+            conn.rollback()
+            par = _parametri(conn)
+            now = datetime.now()
+            if lavoro['tentativi'] >= (lavoro['max_tentativi'] or par['max_tentativi']):
+                lavoro['stato'] = 'fallito'
+                prossimo = lavoro['prossimo_tentativo']
+            else:
+                lavoro['stato'] = 'in_coda'
+                attesa = attesa_backoff(lavoro['tentativi'], par['backoff'], par['backoff_max'])
+                prossimo = (now + timedelta(seconds=attesa)).isoformat()
+            lavoro['errore'] = str(e)[:1000] or type(e).__name__
+            conn.execute("""
+                UPDATE lavori SET stato = ?, errore = ?, prossimo_tentativo = ?, worker = NULL, updated_at = ?
+                WHERE id = ?
+            """, (lavoro['stato'], lavoro['errore'], prossimo, now.isoformat(), lavoro['id']))
+            conn.commit()
+            return lavoro
+        now = datetime.now().isoformat()
+        conn.execute("""
+            UPDATE lavori SET stato = 'completato', errore = NULL, completato_at = ?, updated_at = ?
+            WHERE id = ?
+        """, (now, now, lavoro['id']))
+        conn.commit()
+        lavoro['stato'] = 'completato'
+        return lavoro
+    finally:
+        conn.close()
+
+
+# ============================================
+# CONSEGNA EMAIL (OUTBOX)
+# ============================================
+
+def _prendi_email(conn, worker: str, limite: int) -> List[Dict[str, Any]]:
+    """Assegna al worker fino a `limite` email pronte"""
+    now = datetime.now().isoformat()
+    token = f"{worker}:{uuid.uuid4().hex[:8]}"
+    cur = conn.execute("""
+        UPDATE email_outbox
+        SET stato = 'in_invio', worker = ?, tentativi = tentativi + 1, iniziato_at = ?, updated_at = ?
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE stato = 'da_inviare' AND prossimo_tentativo <= ?
+            ORDER BY prossimo_tentativo
+            LIMIT ?
+        ) AND stato = 'da_inviare'
+    """, (token, now, now, now, limite))
+    conn.commit()
+    if not cur.rowcount:
+        return []
+    return db.rows_to_list(conn.execute(
+        "SELECT * FROM email_outbox WHERE worker = ? AND stato = 'in_invio' ORDER BY prossimo_tentativo",
+        (token,),
+    ).fetchall())
+
+
+def _messaggio_outbox(conn, email: Dict[str, Any]) -> Dict[str, Any]:
+    """Argomenti di send_batch per una riga di outbox (allegato risolto dal riferimento)"""
+    messaggio = {'to_email': email['destinatario'], 'subject': email['oggetto'],
+                 'body': email['corpo'], 'cc': email['cc']}
+    if email['allegato'] == 'pdf_ordine':
+        ordine_id = email['ordine_id']
+        pdf_bytes, filename = _pdf_in_cache(conn, ordine_id)
+        if not pdf_bytes:
+            pdf_bytes, filename = _genera_pdf(conn, ordine_id)
+        ordine = conn.execute("""
+            SELECT o.numero, o.data_ordine, c.ragione_sociale
+            FROM ordini o LEFT JOIN clienti c ON c.id = o.cliente_id
+            WHERE o.id = ?
+        """, (ordine_id,)).fetchone()
+        numero = ordine['numero'] if ordine else ''
+        messaggio['subject'] = messaggio['subject'] or (
+            f"Conferma Ordine {numero} - {(ordine and ordine['ragione_sociale']) or 'Cliente'}")
+        messaggio['body'] = messaggio['body'] or (
+            f"Buongiorno,\n\n"
+            f"in allegato la conferma/proforma dell'ordine {numero} del {ordine['data_ordine'] if ordine else ''}.\n\n"
+            f"Cordiali saluti"
+        )
+        messaggio.update(attachment_bytes=pdf_bytes, attachment_filename=filename or "ordine.pdf",
+                         mime_type="application/pdf")
+    elif email['allegato']:
+        raise ValueError(f"Allegato sconosciuto: {email['allegato']}")
+    return messaggio
+
+
+def _esito_email(conn, email: Dict[str, Any], errore: Optional[str], par: Dict[str, int]) -> None:
+    now = datetime.now()
+    if errore is None:
+        conn.execute("""
+            UPDATE email_outbox SET stato = 'inviata', errore = NULL, worker = NULL, inviata_at = ?, updated_at = ?
+            WHERE id = ?
+        """, (now.isoformat(), now.isoformat(), email['id']))
+        return
+    if email['tentativi'] >= par['max_tentativi']:
+        stato, prossimo = 'fallita', email['prossimo_tentativo']
+    else:
+        attesa = attesa_backoff(email['tentativi'], par['backoff'], par['backoff_max'])
+        stato, prossimo = 'da_inviare', (now + timedelta(seconds=attesa)).isoformat()
+    conn.execute("""
+        UPDATE email_outbox SET stato = ?, errore = ?, prossimo_tentativo = ?, worker = NULL, updated_at = ?
+        WHERE id = ?
+    """, (stato, errore[:1000], prossimo, now.isoformat(), email['id']))
+
+
+def consegna_outbox(worker: str = 'main', limite: int = LIMITE_INVIO) -> int:
+    """Consegna le email pronte dell'outbox su una sola sessione SMTP.
+
+    Con SMTP_MAX_PER_MINUTO il blocco è ridotto a quanto si invia in metà di
+    MINUTI_BLOCCO: un blocco più lungo verrebbe rimesso in coda da
+    _recupera_bloccati mentre è ancora in invio (email doppie).
+
+    Returns:
+        numero di email elaborate (inviate o ripianificate)
+    """
+    al_minuto = limite_al_minuto()
+    if al_minuto > 0:
+        limite = max(1, min(limite, al_minuto * MINUTI_BLOCCO // 2))
+    conn = db.get_connection()
+    try:
+        email = _prendi_email(conn, worker, limite)
+        if not email:
+            return 0
+        par = _parametri(conn)
+        esiti: Dict[str, Optional[str]] = {}
+        messaggi, pronte = [], []
+        for e in email:
+            try:
+                messaggi.append(_messaggio_outbox(conn, e))
+                pronte.append(e)
+            except Exception as ex:
+                conn.rollback()
+                esiti[e['id']] = str(ex) or type(ex).__name__
+        if messaggi:
+            try:
+                for e, errore in zip(pronte, send_batch(messaggi)):
+                    esiti[e['id']] = errore
+            except Exception as ex:
+                # SMTP non configurato o non raggiungibile: nessuna email del blocco è partita
+                for e in pronte:
+                    esiti[e['id']] = str(ex) or type(ex).__name__
+        for e in email:
+            _esito_email(conn, e, esiti.get(e['id']), par)
+        conn.commit()
+        return len(email)
+    finally:
+        conn.close()
+
+
+def _recupero_periodico() -> int:
+    """_recupera_bloccati al massimo ogni SECONDI_RECUPERO (un solo worker alla volta).
+
+    Un lavoro resta 'in_corso' anche se il processo è vivo, quando fallisce
+    la registrazione dell'esito (es. database bloccato): senza questo giro
+    resterebbe fermo fino al riavvio.
+    """
+    global _ultimo_recupero
+    with _lock_recupero:
+        if time.monotonic() - _ultimo_recupero < SECONDI_RECUPERO:
+            return 0
+        _ultimo_recupero = time.monotonic()
+    conn = db.get_connection()
+    try:
+        return _recupera_bloccati(conn)
+    finally:
+        conn.close()
+
+
+def _ciclo(nome: str) -> None:
+    """Loop di un worker: esegue finché c'è lavoro, poi attende una sveglia"""
+    while not _stop.is_set():
+        try:
+            _recupero_periodico()
+            if esegui_prossimo(nome) or consegna_outbox(nome):
+                continue
+        except Exception:
+            # database momentaneamente non disponibile (lock, rete): si riprova al giro dopo
+            log.exception("Worker %s: errore nel giro della coda", nome)
+        _sveglia.wait(SECONDI_ATTESA)
+        _sveglia.clear()
+
+
+def avvia_worker(n: int = None) -> int:
+    """Avvia i thread worker se non sono già attivi (n default: impostazione coda_worker).
+
+    Returns:
+        numero di worker attivi
+    """
+    with _lock:
+        vivi = [t for t in _worker if t.is_alive()]
+        if vivi:
+            _worker[:] = vivi
+            return len(vivi)
+        conn = db.get_connection()
+        try:
+            _recupera_bloccati(conn)
+            n = n or _parametri(conn)['worker']
+        finally:
+            conn.close()
+        _stop.clear()
+        for i in range(max(n, 1)):
+            t = threading.Thread(target=_ciclo, args=(f"worker-{i + 1}",), name=f"coda-lavori-{i + 1}", daemon=True)
+            t.start()
+            _worker.append(t)
+        return len(_worker)
+
+
+def ferma_worker(timeout: float = None) -> None:
+    """Ferma i worker dopo il lavoro in corso"""
+    with _lock:
+        _stop.set()
+        _sveglia.set()
+        for t in _worker:
+            t.join(timeout)
+        _worker.clear()
+
+
+# ============================================
+# STATO PER L'INTERFACCIA
+# ============================================
+
+def get_stato_ordini(ordine_ids: List[str]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Ultimo lavoro di ogni tipo per ordine.
+
+    Returns:
+        {ordine_id: {'pdf_ordine': lavoro}} (solo ordini con lavori)
+    """
+    if not ordine_ids:
+        return {}
+    conn = db.get_connection()
+    try:
+        rows = conn.execute(f"""
+            SELECT id, tipo, ordine_id, payload, stato, tentativi, max_tentativi,
+                   prossimo_tentativo, errore, completato_at, created_at
+            FROM lavori
+            WHERE ordine_id IN ({', '.join('?' for _ in ordine_ids)})
+            ORDER BY created_at
+        """, list(ordine_ids)).fetchall()
+    finally:
+        conn.close()
+    stato: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for r in db.rows_to_list(rows):
+        stato.setdefault(r['ordine_id'], {})[r['tipo']] = r
+    return stato
+
+
+def get_pdf_ordine(ordine_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """PDF dell'ordine dalla cache, se generato sulla versione attuale dell'ordine"""
+    conn = db.get_connection()
+    try:
+        return _pdf_in_cache(conn, ordine_id)
+    finally:
+        conn.close()
+
+
+def get_riepilogo_coda() -> Dict[str, int]:
+    """Numero di lavori per stato (completati esclusi) e di email in outbox per stato (inviate escluse)"""
+    conn = db.get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT stato, COUNT(*) AS n FROM lavori WHERE stato != 'completato' GROUP BY stato
+            UNION ALL
+            SELECT 'email_' || stato, COUNT(*) FROM email_outbox WHERE stato != 'inviata' GROUP BY stato
+        """).fetchall()
+        return {r['stato']: r['n'] for r in rows}
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    db.init_db()
+    print(f"Worker avviati: {avvia_worker()}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        ferma_worker()
@@ -1,30 +1,45 @@
 """
 PORTALE AGENTE DI COMMERCIO
-Database Manager - Gestione completa SQLite
+Database Manager - Gestione completa (SQLite di default, PostgreSQL opzionale)
 """
 
 import sqlite3
 import os
-from datetime import datetime, date
-from typing import Optional, List, Dict, Any, Tuple
+import calendar
+from datetime import datetime, date, timedelta
+from typing import Optional, List, Dict, Any, Tuple, Set
 import uuid
+import math
 import json
 
+import storage
+
 # Path del database
 DB_PATH = os.path.join(os.path.dirname(__file__), 'portale_agente.db')
 SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'schema.sql')
+SCHEMA_PG_PATH = os.path.join(os.path.dirname(__file__), 'schema_postgres.sql')
+
 
+def get_connection(db_path: str = None) -> sqlite3.Connection:
+    """Ottiene una connessione al database con row_factory.
 
-def get_connection() -> sqlite3.Connection:
-    """Ottiene una connessione al database con row_factory"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+    La connessione arriva dal backend configurato (vedi storage.py).
+    db_path permette di aprire un database diverso da quello di default
+    (es. database di altri agenti per i report consolidati di agenzia);
+    con PostgreSQL è un DSN.
+    """
+    backend = storage.get_backend()
+    if backend.nome == 'sqlite':
+        return backend.connect(db_path or DB_PATH)
+    return backend.connect(db_path)
 
 
 def init_db():
     """Inizializza il database con lo schema"""
+    if not storage.is_sqlite():
+        _init_db_postgres()
+        return
+
     conn = get_connection()
     try:
         with open(SCHEMA_PATH, 'r', encoding='utf-8') as f:
@@ -87,6 +102,174 @@ def init_db():
         except Exception:
             pass
 
+        # C) Ordini: contatori righe denormalizzati (sostituiscono la subquery della vista)
+        try:
+            ord_cols = {r['name'] for r in conn.execute("PRAGMA table_info(ordini)").fetchall()}
+            contatori = {
+                'num_righe': "INTEGER DEFAULT 0",
+                'num_prodotti': "INTEGER DEFAULT 0",
+                'valore_listino': "REAL DEFAULT 0",
+                'valore_venduto': "REAL DEFAULT 0",
+            }
+            mancanti = [c for c in contatori if c not in ord_cols]
+            for col in mancanti:
+                conn.execute(f"ALTER TABLE ordini ADD COLUMN {col} {contatori[col]}")
+            if mancanti:
+                _ricalcola_contatori_ordini(conn)
+                # la vista vecchia calcolava num_righe con una subquery correlata
+                conn.execute("DROP VIEW IF EXISTS v_ordini_completi")
+                conn.execute("""
+                    CREATE VIEW v_ordini_completi AS
+                    SELECT o.*,
+                           a.nome AS azienda_nome,
+                           a.ragione_sociale AS azienda_ragione_sociale,
+                           c.ragione_sociale AS cliente_ragione_sociale,
+                           c.citta AS cliente_citta,
+                           c.provincia AS cliente_provincia
+                    FROM ordini o
+                    LEFT JOIN aziende a ON o.azienda_id = a.id
+                    LEFT JOIN clienti c ON o.cliente_id = c.id
+                """)
+        except Exception:
+            pass
+
+        # D) Storico prezzi: primo popolamento dagli ordini esistenti
+        try:
+            if (not conn.execute("SELECT 1 FROM storico_prezzi LIMIT 1").fetchone()
+                    and conn.execute("SELECT 1 FROM ordini LIMIT 1").fetchone()):
+                _ricostruisci_storico_prezzi(conn)
+        except Exception:
+            pass
+
+        # F) Prefill: frequenza/recency/affinità per l'ordinamento del catalogo per cliente
+        try:
+            pref_cols = {r['name'] for r in conn.execute("PRAGMA table_info(cliente_prodotto_pref)").fetchall()}
+            nuove = {'num_ordini': "INTEGER DEFAULT 0", 'ultimo_ordine': "TEXT", 'affinita': "REAL"}
+            mancanti = [c for c in nuove if c not in pref_cols]
+            for col in mancanti:
+                conn.execute(f"ALTER TABLE cliente_prodotto_pref ADD COLUMN {col} {nuove[col]}")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cliente_prodotto_pref_affinita "
+                "ON cliente_prodotto_pref(cliente_id, azienda_id, affinita DESC)"
+            )
+            if mancanti:
+                _ricostruisci_cliente_prodotto_pref(conn)
+        except Exception:
+            pass
+
+        # E) Indice co-acquisti: primo popolamento dagli ordini esistenti
+        try:
+            if (not conn.execute("SELECT 1 FROM coacquisti_aziende LIMIT 1").fetchone()
+                    and conn.execute("SELECT 1 FROM ordini LIMIT 1").fetchone()):
+                _ricostruisci_coacquisti(conn)
+        except Exception:
+            pass
+
+        # G) Cubo vendite: primo popolamento dagli ordini esistenti (una volta sola)
+        try:
+            _inizializza_cubo(conn)
+        except Exception:
+            pass
+
+        # H) Provvigioni: primo calcolo sugli ordini evasi esistenti
+        try:
+            if (not conn.execute("SELECT 1 FROM provvigioni_ordini LIMIT 1").fetchone()
+                    and conn.execute("SELECT 1 FROM ordini WHERE stato = 'evaso' LIMIT 1").fetchone()):
+                _calcola_provvigioni(conn)
+        except Exception:
+            pass
+
+        # I) Clienti: coordinate per i percorsi visite
+        try:
+            cli_cols = {r['name'] for r in conn.execute("PRAGMA table_info(clienti)").fetchall()}
+            for col in ('latitudine', 'longitudine'):
+                if col not in cli_cols:
+                    conn.execute(f"ALTER TABLE clienti ADD COLUMN {col} REAL")
+        except Exception:
+            pass
+
+        # J) Indice spaziale clienti: primo popolamento (DB con coordinate già inserite)
+        try:
+            if (not conn.execute("SELECT 1 FROM clienti_geo_id LIMIT 1").fetchone()
+                    and conn.execute("SELECT 1 FROM clienti WHERE latitudine IS NOT NULL LIMIT 1").fetchone()):
+                _ricostruisci_clienti_geo(conn)
+        except Exception:
+            pass
+
+        # K) Appuntamenti e promemoria ricorrenti
+        try:
+            for tabella in ('appuntamenti', 'promemoria'):
+                cols = {r['name'] for r in conn.execute(f"PRAGMA table_info({tabella})").fetchall()}
+                if 'ricorrenza' not in cols:
+                    conn.execute(f"ALTER TABLE {tabella} ADD COLUMN ricorrenza TEXT")
+                if 'ricorrenza_fine' not in cols:
+                    conn.execute(f"ALTER TABLE {tabella} ADD COLUMN ricorrenza_fine DATE")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_appuntamenti_ricorrenti "
+                "ON appuntamenti(data) WHERE ricorrenza IS NOT NULL"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_promemoria_ricorrenti "
+                "ON promemoria(data_scadenza) WHERE ricorrenza IS NOT NULL"
+            )
+        except Exception:
+            pass
+
+        # L) Appuntamenti: durata; indice degli intervalli per le sovrapposizioni
+        try:
+            app_cols = {r['name'] for r in conn.execute("PRAGMA table_info(appuntamenti)").fetchall()}
+            if 'durata_minuti' not in app_cols:
+                conn.execute("ALTER TABLE appuntamenti ADD COLUMN durata_minuti INTEGER")
+            if (not conn.execute("SELECT 1 FROM impegni_slot_id LIMIT 1").fetchone()
+                    and (conn.execute("SELECT 1 FROM appuntamenti WHERE ora IS NOT NULL LIMIT 1").fetchone()
+                         or conn.execute("SELECT 1 FROM visite_pianificate WHERE ora_inizio IS NOT NULL LIMIT 1").fetchone())):
+                _ricostruisci_slot(conn)
+        except Exception:
+            pass
+
+        # M) Ordini: categoria cliente fissata all'ordine (aliquote provvigioni)
+        try:
+            ord_cols = {r['name'] for r in conn.execute("PRAGMA table_info(ordini)").fetchall()}
+            if 'categoria_cliente' not in ord_cols:
+                conn.execute("ALTER TABLE ordini ADD COLUMN categoria_cliente TEXT")
+                _fissa_categoria_ordini(conn)
+        except Exception:
+            pass
+
+        # N) Change log clienti: la riclassificazione ABC non genera modifiche per i dispositivi
+        try:
+            trg = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_clienti_cdc_upd'"
+            ).fetchone()
+            if trg and 'WHEN' not in trg['sql'].upper():
+                conn.execute("DROP TRIGGER trg_clienti_cdc_upd")
+                conn.execute("""
+                    CREATE TRIGGER trg_clienti_cdc_upd AFTER UPDATE ON clienti
+                    WHEN NEW.updated_at IS NOT OLD.updated_at OR NEW.categoria IS OLD.categoria
+                    BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('clienti', NEW.id, 'U'); END
+                """)
+        except Exception:
+            pass
+
+        # O) Previsioni riordino: scadenza_max (limite inferiore delle letture per data);
+        #    quelle senza vengono ricalcolate da riordini.inizializza_previsioni
+        try:
+            prev_cols = {r['name'] for r in conn.execute("PRAGMA table_info(previsioni_riordino)").fetchall()}
+            if 'scadenza_max' not in prev_cols:
+                conn.execute("ALTER TABLE previsioni_riordino ADD COLUMN scadenza_max DATE")
+                conn.execute("DELETE FROM previsioni_riordino")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_previsioni_riordino_scadenza_max ON previsioni_riordino(scadenza_max)"
+            )
+        except Exception:
+            pass
+
+        # P) Promemoria: idx_promemoria_attivi_scadenza sostituisce l'indice su completato
+        try:
+            conn.execute("DROP INDEX IF EXISTS idx_promemoria_completato")
+        except Exception:
+            pass
+
         # --- MIGRAZIONI/REGOLA COMMERCIALE ---
         # Cartone fisso: 6 pezzi per tutti i prodotti.
         # (Serve anche per database già esistenti creati con default=1)
@@ -100,6 +283,50 @@ def init_db():
         conn.close()
 
 
+def _init_db_postgres():
+    """Schema PostgreSQL (lo script è idempotente e include le proprie migrazioni)"""
+    conn = get_connection()
+    try:
+        nuova_categoria = 'categoria_cliente' not in storage.get_backend().colonne(conn, 'ordini')
+        with open(SCHEMA_PG_PATH, 'r', encoding='utf-8') as f:
+            conn.executescript(f.read())
+        if nuova_categoria:
+            _fissa_categoria_ordini(conn)
+        # Storico prezzi: primo popolamento dagli ordini esistenti
+        if (not conn.execute("SELECT 1 FROM storico_prezzi LIMIT 1").fetchone()
+                and conn.execute("SELECT 1 FROM ordini LIMIT 1").fetchone()):
+            _ricostruisci_storico_prezzi(conn)
+        if (not conn.execute("SELECT 1 FROM coacquisti_aziende LIMIT 1").fetchone()
+                and conn.execute("SELECT 1 FROM ordini LIMIT 1").fetchone()):
+            _ricostruisci_coacquisti(conn)
+        _inizializza_cubo(conn)
+        if (not conn.execute("SELECT 1 FROM provvigioni_ordini LIMIT 1").fetchone()
+                and conn.execute("SELECT 1 FROM ordini WHERE stato = 'evaso' LIMIT 1").fetchone()):
+            _calcola_provvigioni(conn)
+        # Prefill senza affinità (database migrati)
+        if conn.execute("SELECT 1 FROM cliente_prodotto_pref WHERE ultimo_ordine IS NULL LIMIT 1").fetchone():
+            _ricostruisci_cliente_prodotto_pref(conn)
+        if (not conn.execute("SELECT 1 FROM impegni_slot_id LIMIT 1").fetchone()
+                and (conn.execute("SELECT 1 FROM appuntamenti WHERE ora IS NOT NULL LIMIT 1").fetchone()
+                     or conn.execute("SELECT 1 FROM visite_pianificate WHERE ora_inizio IS NOT NULL LIMIT 1").fetchone())):
+            _ricostruisci_slot(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _fissa_categoria_ordini(conn) -> None:
+    """Migrazione: categoria cliente sugli ordini esistenti (quella delle provvigioni già calcolate,
+    altrimenti l'attuale del cliente)"""
+    conn.execute("""
+        UPDATE ordini SET categoria_cliente = COALESCE(
+            (SELECT p.categoria_cliente FROM provvigioni_ordini p WHERE p.ordine_id = ordini.id),
+            (SELECT c.categoria FROM clienti c WHERE c.id = ordini.cliente_id)
+        )
+        WHERE categoria_cliente IS NULL
+    """)
+
+
 def generate_id() -> str:
     """Genera un ID univoco"""
     return str(uuid.uuid4())
@@ -117,6 +344,20 @@ def rows_to_list(rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
     return [row_to_dict(row) for row in rows]
 
 
+def _get_impostazione(conn, chiave: str, default: str = None) -> Optional[str]:
+    """Legge un valore dalla tabella impostazioni"""
+    row = conn.execute("SELECT valore FROM impostazioni WHERE chiave = ?", (chiave,)).fetchone()
+    return row['valore'] if row and row['valore'] is not None else default
+
+
+def _set_impostazione(conn, chiave: str, valore: str, tipo: str = 'string') -> None:
+    """Scrive un valore nella tabella impostazioni (senza commit)"""
+    conn.execute("""
+        INSERT INTO impostazioni (chiave, valore, tipo, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(chiave) DO UPDATE SET valore = excluded.valore, updated_at = excluded.updated_at
+    """, (chiave, valore, tipo, datetime.now().isoformat()))
+
+
 # ============================================
 # AZIENDE
 # ============================================
@@ -198,22 +439,45 @@ def delete_azienda(azienda_id: str) -> bool:
 # CLIENTI
 # ============================================
 
-def get_clienti(solo_attivi: bool = True, search: str = None) -> List[Dict]:
-    """Ottiene tutti i clienti"""
+# Ordinamenti ammessi per get_clienti
+_ORDINAMENTI_CLIENTI = {
+    'ragione_sociale': "c.ragione_sociale",
+    'categoria': "c.categoria, c.ragione_sociale",       # usa idx_clienti_categoria
+    'valore': "COALESCE(r.valore, 0) DESC, c.ragione_sociale",
+}
+
+
+def get_clienti(solo_attivi: bool = True, search: str = None, categoria: str = None,
+                ordina_per: str = 'ragione_sociale') -> List[Dict]:
+    """Ottiene tutti i clienti (con dati di segmentazione RFM se calcolati)
+
+    Args:
+        categoria: filtra per classe A/B/C
+        ordina_per: 'ragione_sociale', 'categoria' o 'valore' (fatturato RFM)
+    """
     conn = get_connection()
     try:
-        query = "SELECT * FROM clienti WHERE 1=1"
+        query = """
+            SELECT c.*, r.recency_giorni, r.frequenza AS rfm_frequenza, r.valore AS rfm_valore
+            FROM clienti c
+            LEFT JOIN clienti_rfm r ON r.cliente_id = c.id
+            WHERE 1=1
+        """
         params = []
         
         if solo_attivi:
-            query += " AND attivo = 1"
+            query += " AND c.attivo = 1"
+
+        if categoria:
+            query += " AND c.categoria = ?"
+            params.append(categoria)
         
         if search:
-            query += " AND (ragione_sociale LIKE ? OR codice LIKE ? OR citta LIKE ?)"
+            query += " AND (c.ragione_sociale LIKE ? OR c.codice LIKE ? OR c.citta LIKE ?)"
             search_param = f"%{search}%"
             params.extend([search_param, search_param, search_param])
         
-        query += " ORDER BY ragione_sociale"
+        query += f" ORDER BY {_ORDINAMENTI_CLIENTI.get(ordina_per, 'c.ragione_sociale')}"
         rows = conn.execute(query, params).fetchall()
         return rows_to_list(rows)
     finally:
@@ -249,6 +513,10 @@ def save_cliente(data: Dict) -> str:
             
             query = f"UPDATE clienti SET {', '.join(fields)} WHERE id = ?"
             conn.execute(query, values)
+            # coordinate cambiate: le distanze in cache non valgono più
+            if 'latitudine' in data or 'longitudine' in data:
+                conn.execute("DELETE FROM distanze_clienti WHERE cliente_a = ? OR cliente_b = ?",
+                             (cliente_id, cliente_id))
         else:
             # Insert
             cliente_id = generate_id()
@@ -279,37 +547,196 @@ def delete_cliente(cliente_id: str) -> bool:
         conn.close()
 
 
+# ============================================
+# CLIENTI VICINI (indice spaziale)
+# ============================================
+
+RAGGIO_TERRA_KM = 6371.0088
+KM_PER_GRADO_LAT = 111.195
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distanza in linea d'aria tra due punti (gradi decimali)"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RAGGIO_TERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _ricostruisci_clienti_geo(conn) -> None:
+    """Ricostruisce l'R*Tree dei clienti attivi con coordinate (senza commit)"""
+    conn.execute("DELETE FROM clienti_geo")
+    conn.execute("DELETE FROM clienti_geo_id")
+    conn.execute("""
+        INSERT INTO clienti_geo_id (cliente_id)
+        SELECT id FROM clienti WHERE attivo = 1 AND latitudine IS NOT NULL AND longitudine IS NOT NULL
+    """)
+    conn.execute("""
+        INSERT INTO clienti_geo (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT g.geo_id, c.latitudine, c.latitudine, c.longitudine, c.longitudine
+        FROM clienti_geo_id g
+        JOIN clienti c ON c.id = g.cliente_id
+    """)
+
+
+def _riquadro(lat: float, lon: float, raggio_km: float) -> Tuple[float, float, float, float]:
+    """Riquadro (min_lat, max_lat, min_lon, max_lon) che contiene il cerchio di raggio dato"""
+    dlat = raggio_km / KM_PER_GRADO_LAT
+    coslat = math.cos(math.radians(min(abs(lat) + dlat, 89.9)))
+    dlon = min(raggio_km / (KM_PER_GRADO_LAT * coslat), 180.0)
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def _ultimo_ordine_clienti(conn, src_o: str, ids: List[str]) -> Dict[str, str]:
+    """Data dell'ultimo ordine inviato/confermato/evaso per cliente"""
+    return {r['cliente_id']: r['ultimo_ordine'] for r in conn.execute(f"""
+        SELECT cliente_id, MAX(data_ordine) AS ultimo_ordine
+        FROM {src_o} o
+        WHERE cliente_id IN ({', '.join('?' for _ in ids)})
+          AND stato IN ('inviato', 'confermato', 'evaso')
+        GROUP BY cliente_id
+    """, ids).fetchall()}
+
+
+def get_clienti_vicini(lat: float, lon: float, raggio_km: float = 5.0, limit: int = 50,
+                       escludi_cliente: str = None) -> List[Dict]:
+    """Clienti attivi entro raggio_km dal punto, dal più vicino.
+
+    Su SQLite i candidati arrivano dall'R*Tree clienti_geo (riquadro attorno
+    al punto), poi si calcola la distanza esatta e si scartano gli angoli del
+    riquadro; su PostgreSQL il riquadro filtra direttamente clienti.
+
+    Returns:
+        clienti con 'distanza_km' e 'ultimo_ordine' (data dell'ultimo ordine
+        inviato/confermato/evaso, archivi compresi; None se mai ordinato)
+    """
+    min_lat, max_lat, min_lon, max_lon = _riquadro(lat, lon, raggio_km)
+    conn = get_connection()
+    try:
+        if storage.is_sqlite():
+            sorgente = """
+                FROM clienti_geo g
+                JOIN clienti_geo_id gi ON gi.geo_id = g.id
+                JOIN clienti c ON c.id = gi.cliente_id
+                WHERE g.max_lat >= ? AND g.min_lat <= ? AND g.max_lon >= ? AND g.min_lon <= ?
+                  AND c.attivo = 1
+            """
+        else:
+            sorgente = """
+                FROM clienti c
+                WHERE c.latitudine BETWEEN ? AND ? AND c.longitudine BETWEEN ? AND ?
+                  AND c.attivo = 1
+            """
+        rows = conn.execute(f"""
+            SELECT c.id, c.codice, c.ragione_sociale, c.indirizzo, c.citta, c.provincia,
+                   c.telefono, c.categoria, c.latitudine, c.longitudine
+            {sorgente}
+        """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+        vicini = []
+        for r in rows:
+            if r['id'] == escludi_cliente:
+                continue
+            d = haversine_km(lat, lon, r['latitudine'], r['longitudine'])
+            if d <= raggio_km:
+                vicini.append(dict(r, distanza_km=round(d, 2)))
+        vicini.sort(key=lambda c: (c['distanza_km'], c['ragione_sociale'] or ''))
+        if limit:
+            vicini = vicini[:limit]
+
+        # ultimo ordine solo per i clienti restituiti (indice ordini.cliente_id):
+        # gli archivi solo per chi non ha ordini caldi
+        ultimi: Dict[str, str] = {}
+        if vicini:
+            ids = [c['id'] for c in vicini]
+            ultimi = _ultimo_ordine_clienti(conn, 'ordini', ids)
+            senza = [i for i in ids if i not in ultimi]
+            if senza:
+                src_o, _ = _sorgente_ordini(conn, includi_archivio=True)
+                if src_o != 'ordini':
+                    ultimi.update(_ultimo_ordine_clienti(conn, src_o, senza))
+        for c in vicini:
+            c['ultimo_ordine'] = ultimi.get(c['id'])
+        return vicini
+    finally:
+        conn.close()
+
+
 # ============================================
 # PRODOTTI
 # ============================================
 
-def get_prodotti(azienda_id: str = None, search: str = None, solo_disponibili: bool = True) -> List[Dict]:
-    """Ottiene i prodotti, opzionalmente filtrati per azienda"""
+def get_prodotti(azienda_id: str = None, search: str = None, solo_disponibili: bool = True,
+                 cliente_id: str = None, limit: int = None, offset: int = 0) -> List[Dict]:
+    """Ottiene i prodotti, opzionalmente filtrati per azienda
+
+    Con cliente_id i prodotti abituali del cliente vengono prima, per affinità
+    (frequenza e recency d'acquisto), poi il resto del catalogo per nome.
+    limit/offset per la paginazione.
+    """
     conn = get_connection()
     try:
-        query = """
-            SELECT p.*, a.nome AS azienda_nome 
-            FROM prodotti p
-            LEFT JOIN aziende a ON p.azienda_id = a.id
-            WHERE 1=1
-        """
+        filtri = ""
         params = []
-        
-        if azienda_id:
-            query += " AND p.azienda_id = ?"
-            params.append(azienda_id)
-        
         if solo_disponibili:
-            query += " AND p.disponibile = 1"
+            filtri += " AND p.disponibile = 1"
         
         if search:
-            query += " AND (p.nome LIKE ? OR p.codice LIKE ? OR p.descrizione LIKE ?)"
+            filtri += " AND (p.nome LIKE ? OR p.codice LIKE ? OR p.descrizione LIKE ?)"
             search_param = f"%{search}%"
             params.extend([search_param, search_param, search_param])
-        
-        query += " ORDER BY p.nome"
-        rows = conn.execute(query, params).fetchall()
-        return rows_to_list(rows)
+
+        offset = int(offset or 0)
+        if not cliente_id:
+            query = f"""
+                SELECT p.*, a.nome AS azienda_nome 
+                FROM prodotti p
+                LEFT JOIN aziende a ON p.azienda_id = a.id
+                WHERE 1=1{filtri}
+            """
+            if azienda_id:
+                query += " AND p.azienda_id = ?"
+                params.append(azienda_id)
+            query += " ORDER BY p.nome"
+            if limit:
+                query += " LIMIT ? OFFSET ?"
+                params.extend([int(limit), offset])
+            return rows_to_list(conn.execute(query, params).fetchall())
+
+        # Prima gli abituali, letti dalle preferenze del cliente già in ordine di
+        # affinità (idx_cliente_prodotto_pref_affinita): pochi per cliente
+        per_azienda = " AND pr.azienda_id = ?" if azienda_id else ""
+        abituali = rows_to_list(conn.execute(f"""
+            SELECT p.*, a.nome AS azienda_nome,
+                   pr.num_ordini AS cliente_num_ordini, pr.ultimo_ordine AS cliente_ultimo_ordine
+            FROM cliente_prodotto_pref pr
+            JOIN prodotti p ON p.id = pr.prodotto_id AND p.azienda_id = pr.azienda_id
+            LEFT JOIN aziende a ON p.azienda_id = a.id
+            WHERE pr.cliente_id = ?{per_azienda}{filtri}
+            ORDER BY pr.affinita DESC, p.nome
+        """, [cliente_id] + ([azienda_id] if azienda_id else []) + params).fetchall())
+        pagina = abituali[offset:offset + int(limit)] if limit else abituali
+        if limit and len(pagina) >= limit:
+            return pagina
+
+        # Poi il resto del catalogo per nome, dalla posizione che resta dopo gli abituali
+        query = f"""
+            SELECT p.*, a.nome AS azienda_nome,
+                   NULL AS cliente_num_ordini, NULL AS cliente_ultimo_ordine
+            FROM prodotti p
+            LEFT JOIN aziende a ON p.azienda_id = a.id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM cliente_prodotto_pref pr
+                WHERE pr.cliente_id = ? AND pr.azienda_id = p.azienda_id AND pr.prodotto_id = p.id
+            ){filtri}{" AND p.azienda_id = ?" if azienda_id else ""}
+            ORDER BY p.nome
+        """
+        params = [cliente_id] + params + ([azienda_id] if azienda_id else [])
+        if limit:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([int(limit) - len(pagina), max(offset - len(abituali), 0)])
+        return pagina + rows_to_list(conn.execute(query, params).fetchall())
     finally:
         conn.close()
 
@@ -329,14 +756,36 @@ def get_prodotto(prodotto_id: str) -> Optional[Dict]:
         conn.close()
 
 
-def get_prodotti_acquistati_cliente(cliente_id: str, azienda_id: str = None) -> List[str]:
-    """Ottiene gli ID dei prodotti già acquistati da un cliente"""
+def conta_prodotti(azienda_id: str = None, search: str = None, solo_disponibili: bool = True) -> int:
+    """Numero di prodotti con gli stessi filtri di get_prodotti (per la paginazione)"""
     conn = get_connection()
     try:
-        query = """
+        query = "SELECT COUNT(*) AS n FROM prodotti p WHERE 1=1"
+        params = []
+        if azienda_id:
+            query += " AND p.azienda_id = ?"
+            params.append(azienda_id)
+        if solo_disponibili:
+            query += " AND p.disponibile = 1"
+        if search:
+            query += " AND (p.nome LIKE ? OR p.codice LIKE ? OR p.descrizione LIKE ?)"
+            search_param = f"%{search}%"
+            params.extend([search_param, search_param, search_param])
+        return conn.execute(query, params).fetchone()['n']
+    finally:
+        conn.close()
+
+
+def get_prodotti_acquistati_cliente(cliente_id: str, azienda_id: str = None,
+                                    includi_archivio: bool = False) -> List[str]:
+    """Ottiene gli ID dei prodotti già acquistati da un cliente (includi_archivio: anche storico archiviato)"""
+    conn = get_connection()
+    try:
+        src_o, src_r = _sorgente_ordini(conn, includi_archivio=includi_archivio)
+        query = f"""
             SELECT DISTINCT r.prodotto_id
-            FROM ordini_righe r
-            JOIN ordini o ON r.ordine_id = o.id
+            FROM {src_r} r
+            JOIN {src_o} o ON r.ordine_id = o.id
             WHERE o.cliente_id = ? AND o.stato IN ('inviato', 'confermato', 'evaso')
         """
         params = [cliente_id]
@@ -438,17 +887,19 @@ def get_prossimo_numero_ordine() -> str:
 
 
 def get_ordini(stato: str = None, azienda_id: str = None, cliente_id: str = None, 
-               data_da: str = None, data_a: str = None, limit: int = None) -> List[Dict]:
-    """Ottiene gli ordini con filtri"""
+               data_da: str = None, data_a: str = None, limit: int = None,
+               includi_archivio: Optional[bool] = None) -> List[Dict]:
+    """Ottiene gli ordini con filtri (gli archivi entrano solo se le date coprono anni archiviati)"""
     conn = get_connection()
     try:
-        query = """
+        src_o, _ = _sorgente_ordini(conn, data_da, data_a, includi_archivio)
+        query = f"""
             SELECT o.*, 
                    a.nome AS azienda_nome,
                    c.ragione_sociale AS cliente_ragione_sociale,
                    c.citta AS cliente_citta,
                    c.provincia AS cliente_provincia
-            FROM ordini o
+            FROM {src_o} o
             LEFT JOIN aziende a ON o.azienda_id = a.id
             LEFT JOIN clienti c ON o.cliente_id = c.id
             WHERE 1=1
@@ -490,8 +941,15 @@ def get_ordine(ordine_id: str) -> Optional[Dict]:
     """Ottiene un ordine con tutti i dettagli"""
     conn = get_connection()
     try:
-        # Testata
-        row = conn.execute("""
+        # Testata (prima negli ordini caldi, poi negli archivi)
+        src_o, src_r = 'ordini', 'ordini_righe'
+        if not conn.execute("SELECT 1 FROM ordini WHERE id = ?", (ordine_id,)).fetchone():
+            for schema in _attach_archivi(conn, _anni_archiviati(conn)):
+                if conn.execute(f"SELECT 1 FROM {schema}.ordini WHERE id = ?", (ordine_id,)).fetchone():
+                    src_o, src_r = f"{schema}.ordini", f"{schema}.ordini_righe"
+                    break
+
+        row = conn.execute(f"""
             SELECT o.*, 
                    a.nome AS azienda_nome,
                    a.ragione_sociale AS azienda_ragione_sociale,
@@ -511,7 +969,7 @@ def get_ordine(ordine_id: str) -> Optional[Dict]:
                    c.email AS cliente_email,
                    c.partita_iva AS cliente_piva,
                    c.codice_fiscale AS cliente_cf
-            FROM ordini o
+            FROM {src_o} o
             LEFT JOIN aziende a ON o.azienda_id = a.id
             LEFT JOIN clienti c ON o.cliente_id = c.id
             WHERE o.id = ?
@@ -523,10 +981,10 @@ def get_ordine(ordine_id: str) -> Optional[Dict]:
         ordine = row_to_dict(row)
         
         # Righe
-        righe = conn.execute("""
+        righe = conn.execute(f"""
             SELECT r.*, p.codice AS prodotto_codice, p.nome AS prodotto_nome,
                    p.unita_misura, p.pezzi_per_cartone
-            FROM ordini_righe r
+            FROM {src_r} r
             LEFT JOIN prodotti p ON r.prodotto_id = p.id
             WHERE r.ordine_id = ?
             ORDER BY r.posizione
@@ -539,31 +997,55 @@ def get_ordine(ordine_id: str) -> Optional[Dict]:
         conn.close()
 
 
-def save_ordine(testata: Dict, righe: List[Dict]) -> str:
+def save_ordine(testata: Dict, righe: List[Dict], email: Dict = None) -> str:
     """Salva un ordine completo (testata + righe).
 
     Fix importanti:
     - calcola automaticamente prezzo_finale/importo_riga se mancanti
     - filtra solo le colonne effettive della tabella (evita errori con campi UI)
     - aggiorna una tabella di prefill (cliente_prodotto_pref) per ricordare prezzo/quantità dell'ultimo ordine
+    - se testata['id'] non esiste ancora, l'ordine viene inserito con quell'ID
+      (ordini creati offline sui dispositivi: l'UUID locale resta quello definitivo)
+    - email ({'destinatario', 'oggetto', 'corpo'}): conferma con il PDF allegato,
+      scritta in email_outbox nella stessa transazione dell'ordine
+    - un ordine archiviato torna tra gli ordini caldi e viene aggiornato lì
     """
     conn = get_connection()
     try:
+        # prima della transazione: il ripristino collega gli archivi (ATTACH)
+        _ripristina_ordine(conn, testata.get('id'))
         conn.execute("BEGIN")
 
         # colonne ammesse per evitare mismatch
         allowed_testata = {
             'id','numero','data_ordine','azienda_id','cliente_id','pagamento','consegna_tipo',
             'totale_pezzi','totale_cartoni','imponibile','sconto_chiusura','totale_finale',
-            'stato','note','data_invio','data_conferma','data_evasione','created_at','updated_at'
+            'stato','note','data_invio','data_conferma','data_evasione','created_at','updated_at',
+            'categoria_cliente'
         }
         allowed_riga = {
             'id','ordine_id','prodotto_id','quantita_cartoni','quantita_pezzi','quantita_totale',
             'prezzo_unitario','sconto_riga','prezzo_finale','importo_riga','posizione','note','created_at'
         }
 
-        if 'id' in testata and testata['id']:
+        esistente = None
+        if testata.get('id'):
+            esistente = conn.execute("SELECT id, cliente_id FROM ordini WHERE id = ?", (testata['id'],)).fetchone()
+
+        # Categoria del cliente fissata all'ordine: le aliquote provvigioni non
+        # cambiano quando la segmentazione riclassifica il cliente
+        testata = {k: v for k, v in testata.items() if k != 'categoria_cliente'}
+        if testata.get('cliente_id') and (not esistente or testata['cliente_id'] != esistente['cliente_id']):
+            cat = conn.execute("SELECT categoria FROM clienti WHERE id = ?", (testata['cliente_id'],)).fetchone()
+            testata['categoria_cliente'] = cat['categoria'] if cat else None
+
+        if esistente:
             ordine_id = testata['id']
+            # Contributi agli indici letti prima di toccare testata e righe
+            coacquisti_prima = _contributo_coacquisti(conn, ordine_id)
+            cubo_prima = _contributo_cubo(conn, ordine_id)
+            pref_prima = _chiavi_pref_ordine(conn, ordine_id)
+
             # Update testata
             fields = []
             values = []
@@ -577,11 +1059,14 @@ def save_ordine(testata: Dict, righe: List[Dict]) -> str:
             query = f"UPDATE ordini SET {', '.join(fields)} WHERE id = ?"
             conn.execute(query, values)
 
+            # Coppie cliente/prodotto del vecchio contenuto
+            coppie_vecchie = _coppie_ordine(conn, ordine_id)
+
             # Elimina vecchie righe
             conn.execute("DELETE FROM ordini_righe WHERE ordine_id = ?", (ordine_id,))
         else:
             # Insert testata
-            ordine_id = generate_id()
+            ordine_id = testata.get('id') or generate_id()
             now = datetime.now().isoformat()
             testata = dict(testata)
             testata['id'] = ordine_id
@@ -594,7 +1079,13 @@ def save_ordine(testata: Dict, righe: List[Dict]) -> str:
             query = f"INSERT INTO ordini ({', '.join(fields)}) VALUES ({placeholders})"
             conn.execute(query, list(insert_data.values()))
 
-        # Insert righe
+        # Insert righe (accumulando i contatori della testata)
+        num_righe = 0
+        prodotti = set()
+        totale_pezzi = 0
+        totale_cartoni = 0
+        valore_listino = 0.0
+        valore_venduto = 0.0
         for i, riga in enumerate(righe):
             r = dict(riga)
             r['id'] = generate_id()
@@ -620,16 +1111,53 @@ def save_ordine(testata: Dict, righe: List[Dict]) -> str:
             query = f"INSERT INTO ordini_righe ({', '.join(fields)}) VALUES ({placeholders})"
             conn.execute(query, list(insert_riga.values()))
 
-        # Aggiorna prefill per ordine successivo
+            num_righe += 1
+            if r.get('prodotto_id'):
+                prodotti.add(r['prodotto_id'])
+            totale_pezzi += r['quantita_totale']
+            totale_cartoni += r['quantita_cartoni']
+            valore_listino += prezzo_unitario * r['quantita_totale']
+            valore_venduto += float(r['importo_riga'] or 0)
+
+        # Contatori nella stessa transazione delle righe
+        conn.execute("""
+            UPDATE ordini SET num_righe = ?, num_prodotti = ?, totale_pezzi = ?, totale_cartoni = ?,
+                              valore_listino = ?, valore_venduto = ?
+            WHERE id = ?
+        """, (num_righe, len(prodotti), totale_pezzi, totale_cartoni,
+              round(valore_listino, 2), round(valore_venduto, 2), ordine_id))
+
+        # Aggiorna prefill per ordine successivo: la frequenza cresce per i prodotti
+        # entrati nell'ordine e cala per quelli tolti (vecchio e nuovo contenuto a confronto)
         try:
-            cliente_id = testata.get('cliente_id')
-            azienda_id = testata.get('azienda_id')
-            if cliente_id and azienda_id:
-                _upsert_cliente_prodotto_pref(conn, cliente_id, azienda_id, righe)
+            _sposta_pref(conn, ordine_id, pref_prima if esistente else set())
         except Exception:
             # non blocchiamo il salvataggio ordine se fallisce il prefill
             pass
 
+        # Storico prezzi: append sul caso normale, ricostruzione mirata se l'ordine è modificato
+        if esistente:
+            _ricostruisci_storico_prezzi(conn, coppie_vecchie | _coppie_ordine(conn, ordine_id))
+        elif testata.get('stato') != 'annullato':
+            _registra_storico_prezzi(conn, ordine_id, testata, righe)
+
+        # Indice co-acquisti: toglie il vecchio contenuto e aggiunge il nuovo
+        _sposta_coacquisti(conn, coacquisti_prima if esistente else None,
+                           _contributo_coacquisti(conn, ordine_id))
+
+        # Cubo vendite: stesso schema (togli il vecchio contributo, aggiungi il nuovo)
+        _sposta_cubo(conn, cubo_prima if esistente else None, _contributo_cubo(conn, ordine_id))
+
+        # Provvigioni: solo se l'ordine era o è evaso
+        if esistente or testata.get('stato') in STATI_PROVVIGIONE:
+            _aggiorna_provvigioni_ordini(conn, [ordine_id])
+
+        # Conferma via email: parte solo se l'ordine è salvato
+        if email and email.get('destinatario'):
+            _accoda_email(conn, chiave_conferma_ordine(ordine_id, email['destinatario']),
+                          email['destinatario'], email.get('oggetto'), email.get('corpo'),
+                          ordine_id=ordine_id, allegato='pdf_ordine')
+
         conn.commit()
         return ordine_id
     except Exception:
@@ -642,32 +1170,229 @@ def save_ordine(testata: Dict, righe: List[Dict]) -> str:
         conn.close()
 
 
-def _upsert_cliente_prodotto_pref(conn: sqlite3.Connection, cliente_id: str, azienda_id: str, righe: List[Dict]) -> None:
-    """Upsert delle preferenze (ultimo prezzo/quantità) per ogni prodotto del cliente."""
+# Affinità cliente/prodotto: frequenza con decadimento esponenziale sulla recency.
+# Il punteggio exp(-(oggi - ultimo)/TAU) * (1 + n) ha lo stesso ordinamento di
+# log(1 + n) + ultimo/TAU, che non dipende da "oggi": si può salvare e indicizzare.
+AFFINITA_TAU_GIORNI = 60.0
+
+
+def _affinita(num_ordini: int, ultimo_ordine: Optional[str]) -> Optional[float]:
+    if not ultimo_ordine:
+        return None
+    try:
+        giorno = date.fromisoformat(str(ultimo_ordine)[:10]).toordinal()
+    except ValueError:
+        return None
+    return round(math.log1p(max(0, int(num_ordini or 0))) + giorno / AFFINITA_TAU_GIORNI, 6)
+
+
+def _upsert_cliente_prodotto_pref(conn: sqlite3.Connection, cliente_id: str, azienda_id: str, righe: List[Dict],
+                                  data_ordine: str = None, nuovi_prodotti: set = None) -> None:
+    """Upsert delle preferenze (ultimo prezzo/quantità) per ogni prodotto del cliente (un solo executemany).
+
+    Aggiorna anche frequenza, ultimo ordine e affinità del prodotto per il cliente:
+    la frequenza cresce solo per i prodotti in nuovi_prodotti (None: tutti, ordine
+    nuovo). Prezzo e quantità restano quelli dell'ordine più recente.
+    """
     now = datetime.now().isoformat()
+    data_ordine = str(data_ordine or date.today().isoformat())[:10]
+    prodotti = list(dict.fromkeys(r.get('prodotto_id') for r in righe if r.get('prodotto_id')))
+    if not prodotti:
+        return
+
+    esistenti = {
+        r['prodotto_id']: r for r in conn.execute(f"""
+            SELECT prodotto_id, prezzo_unitario, sconto_riga, quantita_cartoni, quantita_pezzi,
+                   num_ordini, ultimo_ordine
+            FROM cliente_prodotto_pref
+            WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id IN ({', '.join('?' for _ in prodotti)})
+        """, [cliente_id, azienda_id] + prodotti).fetchall()
+    }
+
+    params = []
+    contati = set()
     for r in righe:
         prodotto_id = r.get('prodotto_id')
         if not prodotto_id:
             continue
-        prezzo_unitario = float(r.get('prezzo_unitario') or 0)
-        sconto = float(r.get('sconto_riga') or 0)
-        qc = int(r.get('quantita_cartoni') or 0)
-        qp = int(r.get('quantita_pezzi') or 0)
+        prima = esistenti.get(prodotto_id)
+        num_ordini = int((prima['num_ordini'] if prima else 0) or 0)
+        if (nuovi_prodotti is None or prodotto_id in nuovi_prodotti) and prodotto_id not in contati:
+            num_ordini += 1
+            contati.add(prodotto_id)
+        ultimo = max(filter(None, [prima['ultimo_ordine'] if prima else None, data_ordine]))
+        # ordine più vecchio dell'ultimo (es. riattivato): il prefill resta quello dell'ultimo
+        vecchio = prima is not None and prima['ultimo_ordine'] and data_ordine < str(prima['ultimo_ordine'])[:10]
+        fonte = dict(prima) if vecchio else r
+        params.append((
+            cliente_id, azienda_id, prodotto_id,
+            float(fonte.get('prezzo_unitario') or 0),
+            float(fonte.get('sconto_riga') or 0),
+            int(fonte.get('quantita_cartoni') or 0),
+            int(fonte.get('quantita_pezzi') or 0),
+            num_ordini, ultimo, _affinita(num_ordini, ultimo),
+            now,
+        ))
 
-        conn.execute(
-            """
-            INSERT INTO cliente_prodotto_pref (cliente_id, azienda_id, prodotto_id, prezzo_unitario, sconto_riga, quantita_cartoni, quantita_pezzi, updated_at)
-            VALUES (?,?,?,?,?,?,?,?)
-            ON CONFLICT(cliente_id, azienda_id, prodotto_id)
-            DO UPDATE SET
-                prezzo_unitario=excluded.prezzo_unitario,
-                sconto_riga=excluded.sconto_riga,
-                quantita_cartoni=excluded.quantita_cartoni,
-                quantita_pezzi=excluded.quantita_pezzi,
-                updated_at=excluded.updated_at
-            """,
-            (cliente_id, azienda_id, prodotto_id, prezzo_unitario, sconto, qc, qp, now)
-        )
+    conn.executemany(
+        """
+        INSERT INTO cliente_prodotto_pref (cliente_id, azienda_id, prodotto_id, prezzo_unitario, sconto_riga, quantita_cartoni, quantita_pezzi,
+                                           num_ordini, ultimo_ordine, affinita, updated_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(cliente_id, azienda_id, prodotto_id)
+        DO UPDATE SET
+            prezzo_unitario=excluded.prezzo_unitario,
+            sconto_riga=excluded.sconto_riga,
+            quantita_cartoni=excluded.quantita_cartoni,
+            quantita_pezzi=excluded.quantita_pezzi,
+            num_ordini=excluded.num_ordini,
+            ultimo_ordine=excluded.ultimo_ordine,
+            affinita=excluded.affinita,
+            updated_at=excluded.updated_at
+        """,
+        params
+    )
+
+
+def _chiavi_pref_ordine(conn, ordine_id: str) -> set:
+    """Chiavi (cliente_id, azienda_id, prodotto_id) per cui l'ordine conta nel prefill (annullati esclusi)"""
+    rows = conn.execute("""
+        SELECT DISTINCT o.cliente_id, o.azienda_id, r.prodotto_id
+        FROM ordini o
+        JOIN ordini_righe r ON r.ordine_id = o.id
+        WHERE o.id = ? AND o.stato != 'annullato' AND r.prodotto_id IS NOT NULL
+    """, (ordine_id,)).fetchall()
+    return {(r['cliente_id'], r['azienda_id'], r['prodotto_id']) for r in rows}
+
+
+def _sposta_pref(conn, ordine_id: str, prima: set) -> None:
+    """Allinea il prefill al contenuto attuale dell'ordine, date le chiavi con cui contava prima (senza commit).
+
+    Le chiavi nuove contano un ordine in più (e aggiornano prezzo/quantità),
+    quelle sparite (prodotto tolto, ordine annullato o eliminato) uno in meno.
+    """
+    dopo = _chiavi_pref_ordine(conn, ordine_id)
+    if dopo:
+        o = conn.execute("SELECT cliente_id, azienda_id, data_ordine FROM ordini WHERE id = ?",
+                         (ordine_id,)).fetchone()
+        righe = rows_to_list(conn.execute(
+            "SELECT * FROM ordini_righe WHERE ordine_id = ? ORDER BY posizione", (ordine_id,)).fetchall())
+        _upsert_cliente_prodotto_pref(conn, o['cliente_id'], o['azienda_id'], righe, data_ordine=o['data_ordine'],
+                                      nuovi_prodotti={p for c, a, p in dopo - prima})
+    _togli_pref(conn, prima - dopo)
+
+
+def _togli_pref(conn, chiavi: set) -> None:
+    """Un ordine in meno per le chiavi date; a zero la preferenza sparisce (senza commit).
+
+    L'ultimo ordine si rilegge dagli ordini caldi (dentro la transazione gli
+    archivi non si possono collegare): se restano solo ordini archiviati resta
+    la data precedente.
+    """
+    chiavi = list(chiavi)
+    if not chiavi:
+        return
+    conn.executemany("""
+        UPDATE cliente_prodotto_pref SET num_ordini = num_ordini - 1, updated_at = ?
+        WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id = ?
+    """, [(datetime.now().isoformat(),) + k for k in chiavi])
+    conn.executemany("""
+        DELETE FROM cliente_prodotto_pref
+        WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id = ? AND num_ordini <= 0
+    """, chiavi)
+    aggiornate = []
+    for cliente_id, azienda_id, prodotto_id in chiavi:
+        pref = conn.execute("""
+            SELECT num_ordini, ultimo_ordine FROM cliente_prodotto_pref
+            WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id = ?
+        """, (cliente_id, azienda_id, prodotto_id)).fetchone()
+        if not pref:
+            continue
+        row = conn.execute("""
+            SELECT MAX(substr(o.data_ordine, 1, 10)) AS ultimo
+            FROM ordini o JOIN ordini_righe r ON r.ordine_id = o.id
+            WHERE o.cliente_id = ? AND o.azienda_id = ? AND r.prodotto_id = ? AND o.stato != 'annullato'
+        """, (cliente_id, azienda_id, prodotto_id)).fetchone()
+        ultimo = row['ultimo'] or pref['ultimo_ordine']
+        aggiornate.append((ultimo, _affinita(pref['num_ordini'], ultimo), cliente_id, azienda_id, prodotto_id))
+    conn.executemany("""
+        UPDATE cliente_prodotto_pref SET ultimo_ordine = ?, affinita = ?
+        WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id = ?
+    """, aggiornate)
+
+
+def _ricostruisci_cliente_prodotto_pref(conn, cliente_id: str = None) -> int:
+    """Ricalcola il prefill dallo storico ordini con una sola query a finestra (senza commit)"""
+    src_o, src_r = _sorgente_ordini(conn, includi_archivio=True)
+    filtro = ""
+    params: List[Any] = [datetime.now().isoformat()]
+    if cliente_id:
+        filtro = " AND o.cliente_id = ?"
+        params.append(cliente_id)
+        conn.execute("DELETE FROM cliente_prodotto_pref WHERE cliente_id = ?", (cliente_id,))
+    else:
+        conn.execute("DELETE FROM cliente_prodotto_pref")
+
+    cur = conn.execute(f"""
+        INSERT INTO cliente_prodotto_pref (cliente_id, azienda_id, prodotto_id, prezzo_unitario, sconto_riga, quantita_cartoni, quantita_pezzi,
+                                           num_ordini, ultimo_ordine, updated_at)
+        SELECT cliente_id, azienda_id, prodotto_id, prezzo_unitario, sconto_riga, quantita_cartoni, quantita_pezzi,
+               num_ordini, ultimo_ordine, ?
+        FROM (
+            SELECT o.cliente_id, o.azienda_id, r.prodotto_id,
+                   COALESCE(r.prezzo_unitario, 0) AS prezzo_unitario,
+                   COALESCE(r.sconto_riga, 0) AS sconto_riga,
+                   COALESCE(r.quantita_cartoni, 0) AS quantita_cartoni,
+                   COALESCE(r.quantita_pezzi, 0) AS quantita_pezzi,
+                   substr(o.data_ordine, 1, 10) AS ultimo_ordine,
+                   COUNT(*) OVER (PARTITION BY o.cliente_id, o.azienda_id, r.prodotto_id) AS num_ordini,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY o.cliente_id, o.azienda_id, r.prodotto_id
+                       ORDER BY o.data_ordine DESC, o.created_at DESC, r.posizione DESC
+                   ) AS rn
+            FROM {src_r} r
+            JOIN {src_o} o ON r.ordine_id = o.id
+            WHERE o.stato != 'annullato' AND r.prodotto_id IS NOT NULL{filtro}
+        ) ultimi
+        WHERE rn = 1
+    """, params)
+    scritte = cur.rowcount
+
+    # affinità calcolata in Python (log non disponibile in tutte le build SQLite)
+    query = "SELECT cliente_id, azienda_id, prodotto_id, num_ordini, ultimo_ordine FROM cliente_prodotto_pref"
+    rows = conn.execute(query + (" WHERE cliente_id = ?" if cliente_id else ""),
+                        (cliente_id,) if cliente_id else ()).fetchall()
+    conn.executemany(
+        "UPDATE cliente_prodotto_pref SET affinita = ? WHERE cliente_id = ? AND azienda_id = ? AND prodotto_id = ?",
+        [(_affinita(r['num_ordini'], r['ultimo_ordine']), r['cliente_id'], r['azienda_id'], r['prodotto_id']) for r in rows],
+    )
+    return scritte
+
+
+def ricostruisci_cliente_prodotto_pref(cliente_id: str = None) -> int:
+    """Ricalcola il prefill dallo storico ordini (archivi compresi) con una sola query a finestra.
+
+    Per ogni cliente/azienda/prodotto tiene la riga dell'ordine più recente
+    (ordini annullati esclusi), il numero di ordini e l'affinità. Utile dopo
+    import o archiviazioni.
+
+    Returns:
+        numero di preferenze scritte
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN")
+        n = _ricostruisci_cliente_prodotto_pref(conn, cliente_id)
+        conn.commit()
+        return n
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
 
 
 def get_cliente_prodotti_pref(cliente_id: str, azienda_id: str) -> Dict[str, Dict]:
@@ -691,9 +1416,10 @@ def get_cliente_prodotti_pref(cliente_id: str, azienda_id: str) -> Dict[str, Dic
 
 
 def update_stato_ordine(ordine_id: str, nuovo_stato: str) -> bool:
-    """Aggiorna lo stato di un ordine"""
+    """Aggiorna lo stato di un ordine (un ordine archiviato torna prima tra i caldi)"""
     conn = get_connection()
     try:
+        _ripristina_ordine(conn, ordine_id)
         now = datetime.now().isoformat()
         
         update_fields = ["stato = ?", "updated_at = ?"]
@@ -711,8 +1437,26 @@ def update_stato_ordine(ordine_id: str, nuovo_stato: str) -> bool:
         
         params.append(ordine_id)
         
+        prima = conn.execute("SELECT stato FROM ordini WHERE id = ?", (ordine_id,)).fetchone()
+        if not prima:
+            return False
+        coacquisti_prima = _contributo_coacquisti(conn, ordine_id)
+        cubo_prima = _contributo_cubo(conn, ordine_id)
+        pref_prima = _chiavi_pref_ordine(conn, ordine_id)
+
         query = f"UPDATE ordini SET {', '.join(update_fields)} WHERE id = ?"
         conn.execute(query, params)
+        # il cubo conta solo gli stati validi: anche bozza -> inviato lo sposta
+        _sposta_cubo(conn, cubo_prima, _contributo_cubo(conn, ordine_id))
+        # provvigioni: transizioni da/verso evaso
+        if (prima['stato'] in STATI_PROVVIGIONE) != (nuovo_stato in STATI_PROVVIGIONE):
+            _aggiorna_provvigioni_ordini(conn, [ordine_id])
+
+        # gli ordini annullati non contano nello storico prezzi né nel prefill
+        if (prima['stato'] == 'annullato') != (nuovo_stato == 'annullato'):
+            _ricostruisci_storico_prezzi(conn, _coppie_ordine(conn, ordine_id))
+            _sposta_coacquisti(conn, coacquisti_prima, _contributo_coacquisti(conn, ordine_id))
+            _sposta_pref(conn, ordine_id, pref_prima)
         conn.commit()
         return True
     finally:
@@ -720,38 +1464,1825 @@ def update_stato_ordine(ordine_id: str, nuovo_stato: str) -> bool:
 
 
 def delete_ordine(ordine_id: str) -> bool:
-    """Elimina un ordine"""
+    """Elimina un ordine (anche archiviato)"""
     conn = get_connection()
     try:
+        _ripristina_ordine(conn, ordine_id)
+        if not conn.execute("SELECT 1 FROM ordini WHERE id = ?", (ordine_id,)).fetchone():
+            return False
+        coppie = _coppie_ordine(conn, ordine_id)
+        coacquisti = _contributo_coacquisti(conn, ordine_id)
+        cubo = _contributo_cubo(conn, ordine_id)
+        pref = _chiavi_pref_ordine(conn, ordine_id)
         conn.execute("DELETE FROM ordini_righe WHERE ordine_id = ?", (ordine_id,))
+        conn.execute("DELETE FROM ordini_pdf WHERE ordine_id = ?", (ordine_id,))
+        conn.execute("DELETE FROM email_outbox WHERE ordine_id = ? AND stato != 'inviata'", (ordine_id,))
         conn.execute("DELETE FROM ordini WHERE id = ?", (ordine_id,))
+        _ricostruisci_storico_prezzi(conn, coppie)
+        _sposta_coacquisti(conn, coacquisti, None)
+        _sposta_cubo(conn, cubo, None)
+        _togli_pref(conn, pref)
+        _aggiorna_provvigioni_ordini(conn, [ordine_id])
         conn.commit()
         return True
     finally:
         conn.close()
 
 
-# ============================================
-# PROMEMORIA
-# ============================================
+# Contatori ricalcolati dalle righe (stesse regole di save_ordine)
+_SQL_CONTATORI_RIGHE = """
+    SELECT ordine_id,
+           COUNT(*) AS num_righe,
+           COUNT(DISTINCT prodotto_id) AS num_prodotti,
+           COALESCE(SUM(quantita_totale), 0) AS totale_pezzi,
+           COALESCE(SUM(quantita_cartoni), 0) AS totale_cartoni,
+           ROUND(COALESCE(SUM(prezzo_unitario * quantita_totale), 0), 2) AS valore_listino,
+           ROUND(COALESCE(SUM(importo_riga), 0), 2) AS valore_venduto
+    FROM ordini_righe
+    GROUP BY ordine_id
+"""
 
-# ============================================
-# APPUNTAMENTI (CALENDARIO)
-# ============================================
+_CAMPI_CONTATORI = ('num_righe', 'num_prodotti', 'totale_pezzi', 'totale_cartoni',
+                    'valore_listino', 'valore_venduto')
 
-def save_appuntamento(data: Dict) -> str:
-    """Salva o aggiorna un appuntamento."""
+
+def _ricalcola_contatori_ordini(conn, ordine_ids: List[str] = None) -> int:
+    """Riallinea i contatori della testata alle righe (senza commit). Ritorna gli ordini aggiornati."""
+    calcolati = {r['ordine_id']: r for r in conn.execute(_SQL_CONTATORI_RIGHE).fetchall()}
+    if ordine_ids is None:
+        ordine_ids = [r['id'] for r in conn.execute("SELECT id FROM ordini").fetchall()]
+    params = []
+    for oid in ordine_ids:
+        c = calcolati.get(oid)
+        params.append(tuple((c[k] if c else 0) for k in _CAMPI_CONTATORI) + (oid,))
+    if params:
+        conn.executemany(f"""
+            UPDATE ordini SET {', '.join(f'{k} = ?' for k in _CAMPI_CONTATORI)}
+            WHERE id = ?
+        """, params)
+    return len(params)
+
+
+def verifica_contatori_ordini(correggi: bool = False, tolleranza: float = 0.01) -> List[Dict]:
+    """Confronta i contatori della testata con le righe e segnala gli ordini disallineati.
+
+    Args:
+        correggi: se True riallinea gli ordini trovati
+        tolleranza: scarto ammesso sui valori in euro
+
+    Returns:
+        lista di {ordine_id, numero, campo, atteso, attuale}
+    """
     conn = get_connection()
     try:
-        if data.get('id'):
-            app_id = data['id']
-            fields = []
-            values = []
-            for k, v in data.items():
-                if k not in ('id', 'created_at'):
-                    fields.append(f"{k} = ?")
-                    values.append(v)
-            fields.append("updated_at = ?")
+        calcolati = {r['ordine_id']: r for r in conn.execute(_SQL_CONTATORI_RIGHE).fetchall()}
+        rows = conn.execute(
+            f"SELECT id, numero, {', '.join(_CAMPI_CONTATORI)} FROM ordini"
+        ).fetchall()
+
+        differenze = []
+        for o in rows:
+            c = calcolati.get(o['id'])
+            for campo in _CAMPI_CONTATORI:
+                atteso = (c[campo] if c else 0) or 0
+                attuale = o[campo] or 0
+                if abs(float(atteso) - float(attuale)) > tolleranza:
+                    differenze.append({'ordine_id': o['id'], 'numero': o['numero'],
+                                       'campo': campo, 'atteso': atteso, 'attuale': attuale})
+
+        if correggi and differenze:
+            _ricalcola_contatori_ordini(conn, sorted({d['ordine_id'] for d in differenze}))
+            conn.commit()
+        return differenze
+    finally:
+        conn.close()
+
+
+# ============================================
+# EMAIL OUTBOX
+# ============================================
+# Le email da inviare sono righe di email_outbox scritte nella stessa
+# transazione del dato che le origina (es. la conferma con l'ordine): se il
+# salvataggio va a buon fine l'email non si perde, se fallisce non parte.
+# La consegna (retry, backoff) è del dispatcher in coda_lavori.py. La chiave
+# del messaggio è unica: accodare due volte la stessa chiave non duplica
+# l'email.
+
+def chiave_conferma_ordine(ordine_id: str, destinatario: str) -> str:
+    """Chiave della conferma d'ordine (una sola per ordine e destinatario)"""
+    return f"ordine:{ordine_id}:conferma:{(destinatario or '').strip().lower()}"
+
+
+def _accoda_email(conn, chiave: str, destinatario: str, oggetto: str = None, corpo: str = None,
+                  ordine_id: str = None, allegato: str = None, cc: str = None) -> bool:
+    """Scrive un'email in outbox (senza commit). False se la chiave c'era già."""
+    destinatario = (destinatario or '').strip()
+    if not destinatario:
+        raise ValueError("Destinatario email mancante")
+    now = datetime.now().isoformat()
+    cur = conn.execute("""
+        INSERT INTO email_outbox (id, chiave, ordine_id, destinatario, cc, oggetto, corpo, allegato,
+                                  stato, tentativi, prossimo_tentativo, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'da_inviare', 0, ?, ?, ?)
+        ON CONFLICT(chiave) DO NOTHING
+    """, (generate_id(), chiave, ordine_id, destinatario, cc, oggetto, corpo, allegato, now, now, now))
+    return cur.rowcount > 0
+
+
+def accoda_email(chiave: str, destinatario: str, oggetto: str = None, corpo: str = None,
+                 ordine_id: str = None, allegato: str = None, cc: str = None) -> bool:
+    """Accoda un'email in outbox ('allegato': 'pdf_ordine' allega il PDF di ordine_id).
+
+    Returns:
+        False se un'email con la stessa chiave era già in outbox
+    """
+    conn = get_connection()
+    try:
+        nuova = _accoda_email(conn, chiave, destinatario, oggetto, corpo, ordine_id, allegato, cc)
+        conn.commit()
+        return nuova
+    finally:
+        conn.close()
+
+
+def get_email_ordini(ordine_ids: List[str]) -> Dict[str, List[Dict]]:
+    """Email in outbox degli ordini (stato di consegna, senza interrogare il server SMTP)"""
+    if not ordine_ids:
+        return {}
+    conn = get_connection()
+    try:
+        rows = conn.execute(f"""
+            SELECT id, ordine_id, destinatario, oggetto, stato, tentativi, prossimo_tentativo,
+                   errore, inviata_at, created_at
+            FROM email_outbox
+            WHERE ordine_id IN ({', '.join('?' for _ in ordine_ids)})
+            ORDER BY created_at
+        """, list(ordine_ids)).fetchall()
+        email: Dict[str, List[Dict]] = {}
+        for r in rows_to_list(rows):
+            email.setdefault(r['ordine_id'], []).append(r)
+        return email
+    finally:
+        conn.close()
+
+
+def riprova_email_ordine(ordine_id: str) -> int:
+    """Rimette in consegna subito le email fallite di un ordine"""
+    conn = get_connection()
+    try:
+        now = datetime.now().isoformat()
+        cur = conn.execute("""
+            UPDATE email_outbox SET stato = 'da_inviare', tentativi = 0, prossimo_tentativo = ?, updated_at = ?
+            WHERE ordine_id = ? AND stato = 'fallita'
+        """, (now, now, ordine_id))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+# ============================================
+# STORICO PREZZI
+# ============================================
+# storico_prezzi registra i prezzi praticati a ogni cliente per prodotto come
+# intervalli: una riga nuova solo quando il prezzo cambia. Le letture "al giorno
+# X" non toccano ordini/ordini_righe.
+
+def _stesso_prezzo(a_prezzo, a_sconto, b_prezzo, b_sconto) -> bool:
+    return (round(float(a_prezzo or 0), 4) == round(float(b_prezzo or 0), 4)
+            and round(float(a_sconto or 0), 4) == round(float(b_sconto or 0), 4))
+
+
+def _coppie_ordine(conn, ordine_id: str) -> set:
+    """Coppie (cliente_id, prodotto_id) presenti in un ordine"""
+    rows = conn.execute("""
+        SELECT DISTINCT o.cliente_id, r.prodotto_id
+        FROM ordini_righe r
+        JOIN ordini o ON r.ordine_id = o.id
+        WHERE o.id = ?
+    """, (ordine_id,)).fetchall()
+    return {(r['cliente_id'], r['prodotto_id']) for r in rows}
+
+
+def _registra_storico_prezzi(conn, ordine_id: str, testata: Dict, righe: List[Dict]) -> None:
+    """Aggiunge i prezzi di un nuovo ordine allo storico (senza commit).
+
+    Caso normale (ordine più recente dello storico): allunga l'intervallo se il
+    prezzo non è cambiato, altrimenti apre un nuovo intervallo. Un ordine
+    retrodatato dentro uno storico già esistente ricostruisce solo quella coppia.
+    """
+    cliente_id = testata.get('cliente_id')
+    azienda_id = testata.get('azienda_id')
+    data = str(testata.get('data_ordine') or date.today().isoformat())[:10]
+    if not cliente_id or not azienda_id:
+        return
+
+    da_ricostruire = set()
+    for r in righe:
+        prodotto_id = r.get('prodotto_id')
+        if not prodotto_id:
+            continue
+        prezzo = float(r.get('prezzo_unitario') or 0)
+        sconto = float(r.get('sconto_riga') or 0)
+
+        ultimo = conn.execute("""
+            SELECT id, prezzo_unitario, sconto_riga, valido_dal, ultimo_visto
+            FROM storico_prezzi
+            WHERE cliente_id = ? AND prodotto_id = ?
+            ORDER BY valido_dal DESC, id DESC
+            LIMIT 1
+        """, (cliente_id, prodotto_id)).fetchone()
+
+        if ultimo and data < ultimo['ultimo_visto']:
+            da_ricostruire.add((cliente_id, prodotto_id))
+        elif ultimo and _stesso_prezzo(ultimo['prezzo_unitario'], ultimo['sconto_riga'], prezzo, sconto):
+            conn.execute("UPDATE storico_prezzi SET ultimo_visto = ? WHERE id = ?", (data, ultimo['id']))
+        else:
+            conn.execute("""
+                INSERT INTO storico_prezzi (cliente_id, azienda_id, prodotto_id, prezzo_unitario,
+                                            sconto_riga, prezzo_finale, valido_dal, ultimo_visto, ordine_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (cliente_id, azienda_id, prodotto_id, prezzo, sconto,
+                  round(prezzo * (1 - sconto / 100), 4), data, data, ordine_id))
+
+    if da_ricostruire:
+        _ricostruisci_storico_prezzi(conn, da_ricostruire)
+
+
+def _ricostruisci_storico_prezzi(conn, coppie: set = None) -> int:
+    """Ricostruisce lo storico dagli ordini (tutte le coppie se None). Senza commit.
+
+    Returns:
+        numero di intervalli scritti
+    """
+    src_o, src_r = _sorgente_ordini(conn, includi_archivio=True)
+    query = f"""
+        SELECT o.id AS ordine_id, o.cliente_id, o.azienda_id, o.data_ordine,
+               r.prodotto_id, r.prezzo_unitario, r.sconto_riga
+        FROM {src_r} r
+        JOIN {src_o} o ON r.ordine_id = o.id
+        WHERE o.stato != 'annullato' AND r.prodotto_id IS NOT NULL
+    """
+    if coppie is None:
+        conn.execute("DELETE FROM storico_prezzi")
+        gruppi = [conn.execute(query + " ORDER BY o.cliente_id, r.prodotto_id, o.data_ordine, o.created_at").fetchall()]
+    else:
+        gruppi = []
+        for cliente_id, prodotto_id in coppie:
+            conn.execute("DELETE FROM storico_prezzi WHERE cliente_id = ? AND prodotto_id = ?",
+                         (cliente_id, prodotto_id))
+            gruppi.append(conn.execute(
+                query + " AND o.cliente_id = ? AND r.prodotto_id = ? ORDER BY o.data_ordine, o.created_at",
+                (cliente_id, prodotto_id)).fetchall())
+
+    intervalli = []
+    for rows in gruppi:
+        corrente = None
+        for r in rows:
+            data = str(r['data_ordine'])[:10]
+            stessa_coppia = corrente and (corrente[0], corrente[2]) == (r['cliente_id'], r['prodotto_id'])
+            if stessa_coppia and _stesso_prezzo(corrente[3], corrente[4], r['prezzo_unitario'], r['sconto_riga']):
+                corrente[7] = data
+                continue
+            prezzo = float(r['prezzo_unitario'] or 0)
+            sconto = float(r['sconto_riga'] or 0)
+            corrente = [r['cliente_id'], r['azienda_id'], r['prodotto_id'], prezzo, sconto,
+                        round(prezzo * (1 - sconto / 100), 4), data, data, r['ordine_id']]
+            intervalli.append(corrente)
+
+    if intervalli:
+        conn.executemany("""
+            INSERT INTO storico_prezzi (cliente_id, azienda_id, prodotto_id, prezzo_unitario,
+                                        sconto_riga, prezzo_finale, valido_dal, ultimo_visto, ordine_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [tuple(i) for i in intervalli])
+    return len(intervalli)
+
+
+def ricostruisci_storico_prezzi() -> int:
+    """Ricostruisce l'intero storico prezzi da ordini e archivi (manutenzione/primo avvio)"""
+    conn = get_connection()
+    try:
+        n = _ricostruisci_storico_prezzi(conn)
+        conn.commit()
+        return n
+    finally:
+        conn.close()
+
+
+def get_storico_prezzi(cliente_id: str, prodotto_id: str) -> List[Dict]:
+    """Intervalli di prezzo praticati a un cliente per un prodotto (dal più recente)"""
+    conn = get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT * FROM storico_prezzi
+            WHERE cliente_id = ? AND prodotto_id = ?
+            ORDER BY valido_dal DESC, id DESC
+        """, (cliente_id, prodotto_id)).fetchall()
+        return rows_to_list(rows)
+    finally:
+        conn.close()
+
+
+def get_prezzo_cliente(cliente_id: str, prodotto_id: str, alla_data: str = None) -> Optional[Dict]:
+    """Prezzo praticato al cliente per un prodotto alla data indicata (default: oggi)"""
+    alla_data = (alla_data or date.today().isoformat())[:10]
+    conn = get_connection()
+    try:
+        row = conn.execute("""
+            SELECT * FROM storico_prezzi
+            WHERE cliente_id = ? AND prodotto_id = ? AND valido_dal <= ?
+            ORDER BY valido_dal DESC, id DESC
+            LIMIT 1
+        """, (cliente_id, prodotto_id, alla_data)).fetchone()
+        return row_to_dict(row)
+    finally:
+        conn.close()
+
+
+def get_prezzi_cliente(cliente_id: str, azienda_id: str = None, alla_data: str = None) -> Dict[str, Dict]:
+    """Prezzi praticati al cliente alla data indicata, per tutti i prodotti: {prodotto_id: intervallo}"""
+    alla_data = (alla_data or date.today().isoformat())[:10]
+    conn = get_connection()
+    try:
+        query = """
+            SELECT * FROM (
+                SELECT s.*,
+                       ROW_NUMBER() OVER (PARTITION BY prodotto_id ORDER BY valido_dal DESC, id DESC) AS rn
+                FROM storico_prezzi s
+                WHERE cliente_id = ? AND valido_dal <= ?
+        """
+        params = [cliente_id, alla_data]
+        if azienda_id:
+            query += " AND azienda_id = ?"
+            params.append(azienda_id)
+        query += ") t WHERE rn = 1"
+        return {r['prodotto_id']: dict(r) for r in conn.execute(query, params).fetchall()}
+    finally:
+        conn.close()
+
+
+# ============================================
+# CO-ACQUISTI (suggerimenti cross-sell)
+# ============================================
+# Per ogni azienda l'indice conta in quanti ordini (non annullati) compare
+# ogni prodotto e ogni coppia di prodotti. Le coppie sono salvate nei due versi
+# (a, b) e (b, a): i suggerimenti per un carrello leggono solo il range di
+# chiave primaria (azienda_id, prodotto_a) dei prodotti già nel carrello.
+#   supporto(a, b) = ordini con a e b
+#   confidenza(a -> b) = supporto(a, b) / ordini(a)
+#   lift(a, b) = supporto(a, b) * ordini_azienda / (ordini(a) * ordini(b))
+
+# Ordini con più prodotti distinti non entrano nell'indice (listini interi,
+# ordini di apertura): genererebbero molte coppie senza significato
+COACQUISTI_MAX_PRODOTTI = 40
+
+
+def _contributo_coacquisti(conn, ordine_id: str) -> Optional[Tuple[str, frozenset]]:
+    """(azienda_id, prodotti distinti) con cui l'ordine entra nell'indice, None se non conta"""
+    row = conn.execute("SELECT azienda_id, stato FROM ordini WHERE id = ?", (ordine_id,)).fetchone()
+    if not row or row['stato'] == 'annullato':
+        return None
+    prodotti = frozenset(r['prodotto_id'] for r in conn.execute(
+        "SELECT DISTINCT prodotto_id FROM ordini_righe WHERE ordine_id = ? AND prodotto_id IS NOT NULL",
+        (ordine_id,)).fetchall())
+    if not prodotti or len(prodotti) > COACQUISTI_MAX_PRODOTTI:
+        return None
+    return row['azienda_id'], prodotti
+
+
+def _applica_coacquisti(conn, azienda_id: str, prodotti: frozenset, segno: int) -> None:
+    """Aggiunge (segno=1) o toglie (segno=-1) un ordine dall'indice, senza commit"""
+    conn.execute("""
+        INSERT INTO coacquisti_aziende (azienda_id, num_ordini) VALUES (?, ?)
+        ON CONFLICT(azienda_id) DO UPDATE SET num_ordini = coacquisti_aziende.num_ordini + excluded.num_ordini
+    """, (azienda_id, segno))
+    conn.executemany("""
+        INSERT INTO coacquisti_prodotti (azienda_id, prodotto_id, num_ordini) VALUES (?, ?, ?)
+        ON CONFLICT(azienda_id, prodotto_id) DO UPDATE SET num_ordini = coacquisti_prodotti.num_ordini + excluded.num_ordini
+    """, [(azienda_id, p, segno) for p in prodotti])
+    coppie = [(azienda_id, a, b, segno) for a in prodotti for b in prodotti if a != b]
+    if coppie:
+        conn.executemany("""
+            INSERT INTO coacquisti (azienda_id, prodotto_a, prodotto_b, num_ordini) VALUES (?, ?, ?, ?)
+            ON CONFLICT(azienda_id, prodotto_a, prodotto_b) DO UPDATE SET num_ordini = coacquisti.num_ordini + excluded.num_ordini
+        """, coppie)
+    if segno < 0:
+        conn.execute("DELETE FROM coacquisti WHERE azienda_id = ? AND num_ordini <= 0", (azienda_id,))
+        conn.execute("DELETE FROM coacquisti_prodotti WHERE azienda_id = ? AND num_ordini <= 0", (azienda_id,))
+
+
+def _sposta_coacquisti(conn, prima, dopo) -> None:
+    """Aggiorna l'indice passando dal contributo `prima` a `dopo` di un ordine"""
+    if prima == dopo:
+        return
+    if prima:
+        _applica_coacquisti(conn, prima[0], prima[1], -1)
+    if dopo:
+        _applica_coacquisti(conn, dopo[0], dopo[1], 1)
+
+
+def _ricostruisci_coacquisti(conn) -> int:
+    """Ricostruisce l'indice co-acquisti da ordini e archivi in una passata SQL (senza commit)"""
+    src_o, src_r = _sorgente_ordini(conn, includi_archivio=True)
+    # prodotti distinti per ordine valido, esclusi gli ordini troppo grandi
+    op = f"""
+        SELECT DISTINCT o.id AS ordine_id, o.azienda_id, r.prodotto_id
+        FROM {src_r} r
+        JOIN {src_o} o ON r.ordine_id = o.id
+        WHERE o.stato != 'annullato' AND r.prodotto_id IS NOT NULL
+          AND o.id IN (
+              SELECT ordine_id FROM {src_r} rr
+              WHERE prodotto_id IS NOT NULL
+              GROUP BY ordine_id
+              HAVING COUNT(DISTINCT prodotto_id) <= {int(COACQUISTI_MAX_PRODOTTI)}
+          )
+    """
+    conn.execute("DELETE FROM coacquisti")
+    conn.execute("DELETE FROM coacquisti_prodotti")
+    conn.execute("DELETE FROM coacquisti_aziende")
+    conn.execute(f"""
+        INSERT INTO coacquisti_aziende (azienda_id, num_ordini)
+        WITH op AS ({op})
+        SELECT azienda_id, COUNT(DISTINCT ordine_id) FROM op GROUP BY azienda_id
+    """)
+    conn.execute(f"""
+        INSERT INTO coacquisti_prodotti (azienda_id, prodotto_id, num_ordini)
+        WITH op AS ({op})
+        SELECT azienda_id, prodotto_id, COUNT(*) FROM op GROUP BY azienda_id, prodotto_id
+    """)
+    cur = conn.execute(f"""
+        INSERT INTO coacquisti (azienda_id, prodotto_a, prodotto_b, num_ordini)
+        WITH op AS ({op})
+        SELECT a.azienda_id, a.prodotto_id, b.prodotto_id, COUNT(*)
+        FROM op a
+        JOIN op b ON a.ordine_id = b.ordine_id AND a.prodotto_id != b.prodotto_id
+        GROUP BY a.azienda_id, a.prodotto_id, b.prodotto_id
+    """)
+    return cur.rowcount
+
+
+def ricostruisci_coacquisti() -> int:
+    """Ricostruisce l'intero indice co-acquisti (manutenzione). Ritorna il numero di coppie."""
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN")
+        n = _ricostruisci_coacquisti(conn)
+        conn.commit()
+        return n
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def get_suggerimenti_carrello(azienda_id: str, prodotti_ids: List[str], k: int = 5,
+                              min_supporto: int = 2, min_lift: float = 1.0) -> List[Dict]:
+    """Top-k prodotti spesso acquistati insieme a quelli nel carrello.
+
+    Per ogni candidato vale la regola migliore tra i prodotti del carrello
+    (lift più alto); a parità pesa il numero di ordini in comune.
+
+    Returns:
+        lista di prodotti (id, codice, nome, prezzo_listino, ...) con
+        supporto, confidenza, lift e 'perche' (prodotto del carrello che lo suggerisce)
+    """
+    prodotti_ids = [p for p in dict.fromkeys(prodotti_ids or []) if p]
+    if not azienda_id or not prodotti_ids:
+        return []
+    conn = get_connection()
+    try:
+        tot = conn.execute("SELECT num_ordini FROM coacquisti_aziende WHERE azienda_id = ?", (azienda_id,)).fetchone()
+        if not tot or not tot['num_ordini']:
+            return []
+        segnaposti = ', '.join('?' for _ in prodotti_ids)
+        rows = conn.execute(f"""
+            SELECT c.prodotto_a, c.prodotto_b, c.num_ordini AS supporto,
+                   pa.num_ordini AS ordini_a, pb.num_ordini AS ordini_b
+            FROM coacquisti c
+            JOIN coacquisti_prodotti pa ON pa.azienda_id = c.azienda_id AND pa.prodotto_id = c.prodotto_a
+            JOIN coacquisti_prodotti pb ON pb.azienda_id = c.azienda_id AND pb.prodotto_id = c.prodotto_b
+            WHERE c.azienda_id = ? AND c.prodotto_a IN ({segnaposti})
+              AND c.prodotto_b NOT IN ({segnaposti})
+              AND c.num_ordini >= ?
+        """, [azienda_id] + prodotti_ids + prodotti_ids + [min_supporto]).fetchall()
+
+        migliori: Dict[str, Dict] = {}
+        n = float(tot['num_ordini'])
+        for r in rows:
+            lift = r['supporto'] * n / (r['ordini_a'] * r['ordini_b'])
+            if lift < min_lift:
+                continue
+            att = migliori.get(r['prodotto_b'])
+            if att is None or (lift, r['supporto']) > (att['lift'], att['supporto']):
+                migliori[r['prodotto_b']] = {
+                    'prodotto_id': r['prodotto_b'], 'perche': r['prodotto_a'], 'supporto': r['supporto'],
+                    'confidenza': round(r['supporto'] / r['ordini_a'], 3), 'lift': round(lift, 2),
+                }
+        top = sorted(migliori.values(), key=lambda s: (s['lift'], s['supporto']), reverse=True)
+
+        # dettagli prodotto solo per i candidati disponibili, fino a k
+        out = []
+        for s in top:
+            p = conn.execute("SELECT * FROM prodotti WHERE id = ? AND disponibile = 1", (s['prodotto_id'],)).fetchone()
+            if p:
+                out.append({**dict(p), **s})
+                if len(out) >= k:
+                    break
+        return out
+    finally:
+        conn.close()
+
+
+# ============================================
+# CUBO VENDITE (analisi multidimensionale)
+# ============================================
+# Due aggregati additivi degli ordini validi, per mese:
+#   cubo_ordini   (mese, azienda, cliente)            fatturato, pezzi, cartoni, ordini
+#   cubo_vendite  (mese, azienda, cliente, prodotto)  fatturato, pezzi, cartoni, ordini con il prodotto
+# Le altre dimensioni (provincia, zona, canale del cliente; categoria del
+# prodotto; anno/trimestre) si ottengono unendo le anagrafiche agli aggregati,
+# quindi pivot e drill-down di query_cubo non rileggono mai le righe d'ordine.
+# Il numero ordini per prodotto non si somma tra prodotti diversi: raggruppando
+# per categoria indica le righe-ordine (ordini x prodotti) della categoria.
+
+STATI_CUBO = ('inviato', 'confermato', 'evaso')
+
+# dimensione -> (espressione chiave, colonne descrittive)
+_DIMENSIONI_CUBO = {
+    'azienda': ('f.azienda_id', [('a.nome', 'azienda_nome')]),
+    'cliente': ('f.cliente_id', [('c.ragione_sociale', 'cliente_nome')]),
+    'provincia': ('c.provincia', []),
+    'zona': ('c.zona', []),
+    'canale': ('c.canale', []),
+    'categoria': ('p.categoria', []),
+    'prodotto': ('f.prodotto_id', [('p.codice', 'prodotto_codice'), ('p.nome', 'prodotto_nome')]),
+    'periodo': (None, []),
+}
+DIMENSIONI_CUBO = list(_DIMENSIONI_CUBO)
+MISURE_CUBO = ['fatturato', 'pezzi', 'cartoni', 'num_ordini']
+
+_PERIODI_CUBO = {
+    'mese': "f.mese",
+    'trimestre': "substr(f.mese, 1, 4) || '-T' || CAST((CAST(substr(f.mese, 6, 2) AS INTEGER) + 2) / 3 AS TEXT)",
+    'anno': "substr(f.mese, 1, 4)",
+}
+
+
+def _contributo_cubo(conn, ordine_id: str) -> Optional[Tuple]:
+    """(mese, azienda, cliente, totali ordine, righe per prodotto) con cui l'ordine entra nel cubo"""
+    row = conn.execute(
+        "SELECT azienda_id, cliente_id, data_ordine, stato FROM ordini WHERE id = ?", (ordine_id,)
+    ).fetchone()
+    if not row or row['stato'] not in STATI_CUBO or not row['data_ordine'] or not row['cliente_id']:
+        return None
+    prodotti = tuple(
+        (r['prodotto_id'], float(r['fatturato'] or 0), int(r['pezzi'] or 0), int(r['cartoni'] or 0))
+        for r in conn.execute("""
+            SELECT prodotto_id, SUM(importo_riga) AS fatturato,
+                   SUM(quantita_totale) AS pezzi, SUM(quantita_cartoni) AS cartoni
+            FROM ordini_righe
+            WHERE ordine_id = ? AND prodotto_id IS NOT NULL
+            GROUP BY prodotto_id
+            ORDER BY prodotto_id
+        """, (ordine_id,)).fetchall()
+    )
+    totali = (sum(p[1] for p in prodotti), sum(p[2] for p in prodotti), sum(p[3] for p in prodotti))
+    return str(row['data_ordine'])[:7], row['azienda_id'], row['cliente_id'], totali, prodotti
+
+
+def _applica_cubo(conn, contributo: Tuple, segno: int) -> None:
+    """Aggiunge (segno=1) o toglie (segno=-1) un ordine dal cubo, senza commit"""
+    mese, azienda_id, cliente_id, (fatturato, pezzi, cartoni), prodotti = contributo
+    conn.execute("""
+        INSERT INTO cubo_ordini (mese, azienda_id, cliente_id, fatturato, pezzi, cartoni, num_ordini)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(mese, azienda_id, cliente_id) DO UPDATE SET
+            fatturato = cubo_ordini.fatturato + excluded.fatturato,
+            pezzi = cubo_ordini.pezzi + excluded.pezzi,
+            cartoni = cubo_ordini.cartoni + excluded.cartoni,
+            num_ordini = cubo_ordini.num_ordini + excluded.num_ordini
+    """, (mese, azienda_id, cliente_id, segno * fatturato, segno * pezzi, segno * cartoni, segno))
+    if prodotti:
+        conn.executemany("""
+            INSERT INTO cubo_vendite (mese, azienda_id, cliente_id, prodotto_id, fatturato, pezzi, cartoni, num_ordini)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(mese, azienda_id, cliente_id, prodotto_id) DO UPDATE SET
+                fatturato = cubo_vendite.fatturato + excluded.fatturato,
+                pezzi = cubo_vendite.pezzi + excluded.pezzi,
+                cartoni = cubo_vendite.cartoni + excluded.cartoni,
+                num_ordini = cubo_vendite.num_ordini + excluded.num_ordini
+        """, [(mese, azienda_id, cliente_id, p, segno * f, segno * pz, segno * ct, segno)
+              for p, f, pz, ct in prodotti])
+    if segno < 0:
+        chiave = (mese, azienda_id, cliente_id)
+        conn.execute("DELETE FROM cubo_ordini WHERE mese = ? AND azienda_id = ? AND cliente_id = ? AND num_ordini <= 0", chiave)
+        conn.execute("DELETE FROM cubo_vendite WHERE mese = ? AND azienda_id = ? AND cliente_id = ? AND num_ordini <= 0", chiave)
+
+
+def _sposta_cubo(conn, prima, dopo) -> None:
+    """Aggiorna il cubo passando dal contributo `prima` a `dopo` di un ordine"""
+    if prima == dopo:
+        return
+    if prima:
+        _applica_cubo(conn, prima, -1)
+    if dopo:
+        _applica_cubo(conn, dopo, 1)
+
+
+def _inizializza_cubo(conn) -> None:
+    """Migrazione: primo popolamento del cubo, registrato in impostazioni (senza commit).
+
+    Il cubo può restare vuoto anche con ordini (tutti bozza/annullati): il
+    controllo sul contenuto lo ricostruirebbe a ogni avvio.
+    """
+    if _get_impostazione(conn, 'cubo_inizializzato') is not None:
+        return
+    if not conn.execute("SELECT 1 FROM cubo_ordini LIMIT 1").fetchone():
+        _ricostruisci_cubo(conn)
+    _set_impostazione(conn, 'cubo_inizializzato', '1', 'bool')
+
+
+def _ricostruisci_cubo(conn) -> int:
+    """Ricostruisce il cubo da ordini e archivi in una passata SQL (senza commit)"""
+    src_o, src_r = _sorgente_ordini(conn, includi_archivio=True)
+    stati = ', '.join(f"'{s}'" for s in STATI_CUBO)
+    conn.execute("DELETE FROM cubo_vendite")
+    conn.execute("DELETE FROM cubo_ordini")
+    cur = conn.execute(f"""
+        INSERT INTO cubo_vendite (mese, azienda_id, cliente_id, prodotto_id, fatturato, pezzi, cartoni, num_ordini)
+        SELECT substr(o.data_ordine, 1, 7), o.azienda_id, o.cliente_id, r.prodotto_id,
+               COALESCE(SUM(r.importo_riga), 0), COALESCE(SUM(r.quantita_totale), 0),
+               COALESCE(SUM(r.quantita_cartoni), 0), COUNT(DISTINCT o.id)
+        FROM {src_r} r
+        JOIN {src_o} o ON r.ordine_id = o.id
+        WHERE o.stato IN ({stati}) AND o.data_ordine IS NOT NULL
+          AND o.cliente_id IS NOT NULL AND r.prodotto_id IS NOT NULL
+        GROUP BY substr(o.data_ordine, 1, 7), o.azienda_id, o.cliente_id, r.prodotto_id
+    """)
+    conn.execute(f"""
+        INSERT INTO cubo_ordini (mese, azienda_id, cliente_id, fatturato, pezzi, cartoni, num_ordini)
+        SELECT substr(o.data_ordine, 1, 7), o.azienda_id, o.cliente_id,
+               COALESCE(SUM(t.fatturato), 0), COALESCE(SUM(t.pezzi), 0), COALESCE(SUM(t.cartoni), 0), COUNT(*)
+        FROM {src_o} o
+        LEFT JOIN (
+            SELECT ordine_id, SUM(importo_riga) AS fatturato,
+                   SUM(quantita_totale) AS pezzi, SUM(quantita_cartoni) AS cartoni
+            FROM {src_r} r
+            WHERE prodotto_id IS NOT NULL
+            GROUP BY ordine_id
+        ) t ON t.ordine_id = o.id
+        WHERE o.stato IN ({stati}) AND o.data_ordine IS NOT NULL AND o.cliente_id IS NOT NULL
+        GROUP BY substr(o.data_ordine, 1, 7), o.azienda_id, o.cliente_id
+    """)
+    return cur.rowcount
+
+
+def ricostruisci_cubo() -> int:
+    """Ricostruisce l'intero cubo vendite (manutenzione). Ritorna le righe di cubo_vendite."""
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN")
+        n = _ricostruisci_cubo(conn)
+        conn.commit()
+        return n
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def query_cubo(dimensioni: List[str], filtri: Dict[str, Any] = None,
+               mese_da: str = None, mese_a: str = None, periodo: str = 'mese',
+               ordina_per: str = 'fatturato', limit: Optional[int] = None,
+               db_path: str = None) -> List[Dict]:
+    """Pivot sugli aggregati del cubo vendite.
+
+    Args:
+        dimensioni: raggruppamento, sottoinsieme di DIMENSIONI_CUBO (lista vuota = totale)
+        filtri: {dimensione: valore o lista di valori} per il drill-down
+                (azienda/cliente/prodotto per id, periodo nel formato di `periodo`)
+        mese_da, mese_a: intervallo YYYY-MM (estremi inclusi)
+        periodo: granularità della dimensione 'periodo': mese, trimestre, anno
+        ordina_per: una misura (decrescente) oppure una dimensione (crescente)
+
+    Returns:
+        una riga per combinazione: chiavi delle dimensioni, colonne descrittive
+        (azienda_nome, cliente_nome, prodotto_codice, prodotto_nome) e misure MISURE_CUBO
+    """
+    filtri = {k: v for k, v in (filtri or {}).items() if v not in (None, '', [])}
+    usate = list(dimensioni) + list(filtri)
+    sconosciute = [d for d in usate if d not in _DIMENSIONI_CUBO]
+    if sconosciute:
+        raise ValueError(f"Dimensioni non valide: {', '.join(sconosciute)}")
+    if periodo not in _PERIODI_CUBO:
+        raise ValueError(f"Periodo non valido: {periodo}")
+
+    def espressione(dim: str) -> str:
+        return _PERIODI_CUBO[periodo] if dim == 'periodo' else _DIMENSIONI_CUBO[dim][0]
+
+    # livello prodotto solo se serve: altrimenti l'aggregato per ordine (più piccolo)
+    per_prodotto = any(d in ('prodotto', 'categoria') for d in usate)
+    select, group = [], []
+    for dim in dimensioni:
+        select.append(f"{espressione(dim)} AS {dim}")
+        group.append(espressione(dim))
+        for col, alias in _DIMENSIONI_CUBO[dim][1]:
+            select.append(f"MAX({col}) AS {alias}")
+    select += [
+        "COALESCE(SUM(f.fatturato), 0) AS fatturato",
+        "COALESCE(SUM(f.pezzi), 0) AS pezzi",
+        "COALESCE(SUM(f.cartoni), 0) AS cartoni",
+        "COALESCE(SUM(f.num_ordini), 0) AS num_ordini",
+    ]
+
+    joins = []
+    if 'azienda' in dimensioni:
+        joins.append("LEFT JOIN aziende a ON a.id = f.azienda_id")
+    if any(d in ('cliente', 'provincia', 'zona', 'canale') for d in usate):
+        joins.append("LEFT JOIN clienti c ON c.id = f.cliente_id")
+    if per_prodotto:
+        joins.append("LEFT JOIN prodotti p ON p.id = f.prodotto_id")
+
+    where, params = [], []
+    if mese_da:
+        where.append("f.mese >= ?")
+        params.append(mese_da[:7])
+    if mese_a:
+        where.append("f.mese <= ?")
+        params.append(mese_a[:7])
+    for dim, valore in filtri.items():
+        valori = list(valore) if isinstance(valore, (list, tuple, set)) else [valore]
+        where.append(f"{espressione(dim)} IN ({', '.join('?' for _ in valori)})")
+        params += valori
+
+    query = f"SELECT {', '.join(select)} FROM {'cubo_vendite' if per_prodotto else 'cubo_ordini'} f"
+    if joins:
+        query += " " + " ".join(joins)
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    if group:
+        query += " GROUP BY " + ", ".join(group)
+    if ordina_per in MISURE_CUBO:
+        query += f" ORDER BY {ordina_per} DESC"
+    elif ordina_per in dimensioni:
+        query += f" ORDER BY {ordina_per}"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+
+    conn = get_connection(db_path)
+    try:
+        return [
+            {**dict(r), 'fatturato': round(float(r['fatturato'] or 0), 2)}
+            for r in conn.execute(query, params).fetchall()
+        ]
+    finally:
+        conn.close()
+
+
+# ============================================
+# PROVVIGIONI
+# ============================================
+# La provvigione matura sugli ordini evasi: per ogni riga si applica
+# l'aliquota più specifica valida alla data dell'ordine (prodotto + categoria
+# cliente > prodotto > categoria cliente > base azienda) all'importo di riga
+# al netto dello sconto di chiusura. Il risultato per ordine è materializzato
+# in provvigioni_ordini e sommato per mandante e mese in provvigioni_estratti:
+# estratti conto ed export leggono solo queste tabelle, anche su anni di ordini.
+# I cambi di stato, le modifiche e le cancellazioni ricalcolano il solo ordine
+# toccato; una modifica alle aliquote ricalcola il periodo che copre. La
+# categoria cliente è quella fissata sull'ordine al salvataggio
+# (ordini.categoria_cliente), non quella attuale riscritta dalla segmentazione.
+
+STATI_PROVVIGIONE = ('evaso',)
+
+
+def _carica_aliquote(conn, azienda_id: str = None) -> Dict[str, List[Dict]]:
+    """Aliquote per azienda"""
+    query = "SELECT azienda_id, prodotto_id, categoria_cliente, aliquota, valido_dal, valido_al FROM provvigioni_aliquote"
+    params = []
+    if azienda_id:
+        query += " WHERE azienda_id = ?"
+        params.append(azienda_id)
+    out: Dict[str, List[Dict]] = {}
+    for r in conn.execute(query, params).fetchall():
+        out.setdefault(r['azienda_id'], []).append(dict(r))
+    return out
+
+
+def _aliquota(aliquote: List[Dict], prodotto_id: Optional[str], categoria: Optional[str], data: str) -> float:
+    """Aliquota (%) più specifica valida alla data; a parità vince quella con decorrenza più recente"""
+    migliore, rango = 0.0, None
+    for a in aliquote:
+        if a['valido_dal'] and data < str(a['valido_dal'])[:10]:
+            continue
+        if a['valido_al'] and data > str(a['valido_al'])[:10]:
+            continue
+        if a['prodotto_id'] and a['prodotto_id'] != prodotto_id:
+            continue
+        if a['categoria_cliente'] and a['categoria_cliente'] != categoria:
+            continue
+        r = (2 * bool(a['prodotto_id']) + bool(a['categoria_cliente']), str(a['valido_dal'] or ''))
+        if rango is None or r > rango:
+            migliore, rango = float(a['aliquota'] or 0), r
+    return migliore
+
+
+def _righe_provvigioni(ordini: List[Dict], righe: Dict[str, List], aliquote: Dict[str, List[Dict]]) -> List[Tuple]:
+    """Righe di provvigioni_ordini per gli ordini dati (righe: ordine_id -> [(prodotto_id, importo)])"""
+    now = datetime.now().isoformat()
+    out = []
+    for o in ordini:
+        data = str(o['data_ordine'])[:10]
+        netto = 1 - float(o['sconto_chiusura'] or 0) / 100
+        imponibile = provvigione = 0.0
+        for prodotto_id, importo in righe.get(o['id'], []):
+            importo = float(importo or 0) * netto
+            imponibile += importo
+            provvigione += importo * _aliquota(aliquote.get(o['azienda_id'], []), prodotto_id, o['categoria'], data) / 100
+        out.append((o['id'], o['azienda_id'], o['cliente_id'], o['numero'], data, data[:7], o['categoria'],
+                    round(imponibile, 2), round(provvigione, 2), now))
+    return out
+
+
+def _scrivi_provvigioni(conn, righe: List[Tuple]) -> None:
+    if righe:
+        conn.executemany("""
+            INSERT INTO provvigioni_ordini
+                (ordine_id, azienda_id, cliente_id, numero, data_ordine, mese, categoria_cliente,
+                 imponibile, provvigione, calcolato_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, righe)
+
+
+def _aggiorna_estratti(conn, chiavi) -> None:
+    """Ricalcola gli estratti (azienda_id, mese) indicati da provvigioni_ordini (senza commit)"""
+    now = datetime.now().isoformat()
+    for azienda_id, mese in chiavi:
+        conn.execute("DELETE FROM provvigioni_estratti WHERE azienda_id = ? AND mese = ?", (azienda_id, mese))
+        conn.execute("""
+            INSERT INTO provvigioni_estratti (azienda_id, mese, num_ordini, imponibile, provvigione, updated_at)
+            SELECT azienda_id, mese, COUNT(*), SUM(imponibile), SUM(provvigione), ?
+            FROM provvigioni_ordini
+            WHERE azienda_id = ? AND mese = ?
+            GROUP BY azienda_id, mese
+        """, (now, azienda_id, mese))
+
+
+def _aggiorna_provvigioni_ordini(conn, ordine_ids: List[str]) -> None:
+    """Ricalcolo incrementale delle provvigioni di alcuni ordini (senza commit)"""
+    ordine_ids = [i for i in dict.fromkeys(ordine_ids) if i]
+    if not ordine_ids:
+        return
+    ph = ', '.join('?' for _ in ordine_ids)
+    chiavi = {(r['azienda_id'], r['mese']) for r in conn.execute(
+        f"SELECT azienda_id, mese FROM provvigioni_ordini WHERE ordine_id IN ({ph})", ordine_ids).fetchall()}
+    conn.execute(f"DELETE FROM provvigioni_ordini WHERE ordine_id IN ({ph})", ordine_ids)
+
+    stati = ', '.join('?' for _ in STATI_PROVVIGIONE)
+    ordini = rows_to_list(conn.execute(f"""
+        SELECT o.id, o.azienda_id, o.cliente_id, o.numero, o.data_ordine, o.sconto_chiusura,
+               COALESCE(o.categoria_cliente, c.categoria) AS categoria
+        FROM ordini o LEFT JOIN clienti c ON c.id = o.cliente_id
+        WHERE o.id IN ({ph}) AND o.stato IN ({stati}) AND o.data_ordine IS NOT NULL
+    """, ordine_ids + list(STATI_PROVVIGIONE)).fetchall())
+    if ordini:
+        righe: Dict[str, List] = {}
+        for r in conn.execute(f"""
+            SELECT ordine_id, prodotto_id, SUM(importo_riga) AS importo
+            FROM ordini_righe WHERE ordine_id IN ({', '.join('?' for _ in ordini)})
+            GROUP BY ordine_id, prodotto_id
+        """, [o['id'] for o in ordini]).fetchall():
+            righe.setdefault(r['ordine_id'], []).append((r['prodotto_id'], r['importo']))
+        nuove = _righe_provvigioni(ordini, righe, _carica_aliquote(conn))
+        _scrivi_provvigioni(conn, nuove)
+        chiavi |= {(r[1], r[5]) for r in nuove}
+    _aggiorna_estratti(conn, chiavi)
+
+
+def _calcola_provvigioni(conn, data_da: str = None, data_a: str = None, azienda_id: str = None) -> int:
+    """Calcolo batch del periodo (archivi compresi) in poche query (senza commit)"""
+    src_o, src_r = _sorgente_ordini(conn, data_da, data_a, includi_archivio=True)
+    filtro, params = [f"o.stato IN ({', '.join('?' for _ in STATI_PROVVIGIONE)})", "o.data_ordine IS NOT NULL"], list(STATI_PROVVIGIONE)
+    filtro_pr, params_pr = [], []
+    if data_da:
+        filtro.append("o.data_ordine >= ?")
+        params.append(data_da)
+        filtro_pr.append("data_ordine >= ?")
+        params_pr.append(data_da[:10])
+    if data_a:
+        filtro.append("o.data_ordine <= ?")
+        params.append(f"{data_a[:10]}T99")  # comprende gli ordini con data e ora
+        filtro_pr.append("data_ordine <= ?")
+        params_pr.append(data_a[:10])
+    if azienda_id:
+        filtro.append("o.azienda_id = ?")
+        params.append(azienda_id)
+        filtro_pr.append("azienda_id = ?")
+        params_pr.append(azienda_id)
+    where = " AND ".join(filtro)
+
+    # archivi precedenti alla colonna categoria_cliente: vale la categoria dell'ultimo calcolo
+    ordini = rows_to_list(conn.execute(f"""
+        SELECT o.id, o.azienda_id, o.cliente_id, o.numero, o.data_ordine, o.sconto_chiusura,
+               COALESCE(o.categoria_cliente, p.categoria_cliente, c.categoria) AS categoria
+        FROM {src_o} o
+        LEFT JOIN provvigioni_ordini p ON p.ordine_id = o.id
+        LEFT JOIN clienti c ON c.id = o.cliente_id
+        WHERE {where}
+    """, params).fetchall())
+    righe: Dict[str, List] = {}
+    for r in conn.execute(f"""
+        SELECT r.ordine_id, r.prodotto_id, SUM(r.importo_riga) AS importo
+        FROM {src_r} r JOIN {src_o} o ON o.id = r.ordine_id
+        WHERE {where}
+        GROUP BY r.ordine_id, r.prodotto_id
+    """, params).fetchall():
+        righe.setdefault(r['ordine_id'], []).append((r['prodotto_id'], r['importo']))
+
+    where_pr = " WHERE " + " AND ".join(filtro_pr) if filtro_pr else ""
+    chiavi = {(r['azienda_id'], r['mese']) for r in conn.execute(
+        f"SELECT DISTINCT azienda_id, mese FROM provvigioni_ordini{where_pr}", params_pr).fetchall()}
+    conn.execute(f"DELETE FROM provvigioni_ordini{where_pr}", params_pr)
+    nuove = _righe_provvigioni(ordini, righe, _carica_aliquote(conn, azienda_id))
+    _scrivi_provvigioni(conn, nuove)
+    _aggiorna_estratti(conn, chiavi | {(r[1], r[5]) for r in nuove})
+    return len(nuove)
+
+
+def calcola_provvigioni(data_da: str = None, data_a: str = None, azienda_id: str = None) -> int:
+    """Ricalcola provvigioni ed estratti conto di un periodo (default: tutto lo storico).
+
+    Returns:
+        numero di ordini con provvigione calcolata
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN")
+        n = _calcola_provvigioni(conn, data_da, data_a, azienda_id)
+        conn.commit()
+        return n
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def get_aliquote_provvigione(azienda_id: str) -> List[Dict]:
+    """Aliquote di un'azienda con codice/nome del prodotto"""
+    conn = get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT a.*, p.codice AS prodotto_codice, p.nome AS prodotto_nome
+            FROM provvigioni_aliquote a
+            LEFT JOIN prodotti p ON p.id = a.prodotto_id
+            WHERE a.azienda_id = ?
+            ORDER BY (a.prodotto_id IS NOT NULL), (a.categoria_cliente IS NOT NULL), p.codice, a.valido_dal
+        """, (azienda_id,)).fetchall()
+        return rows_to_list(rows)
+    finally:
+        conn.close()
+
+
+def _periodo_aliquota(a: Optional[Dict]) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """Periodo di validità (dal, al) di un'aliquota (estremi None = aperto); None se l'aliquota non c'è"""
+    return (a.get('valido_dal') or None, a.get('valido_al') or None) if a else None
+
+
+def _ricalcola_periodo_aliquota(azienda_id: str, *periodi) -> None:
+    """Dopo una modifica alle aliquote: ricalcolo dell'intervallo che copre i periodi indicati"""
+    periodi = [p for p in periodi if p is not None]
+    if not azienda_id or not periodi:
+        return
+    dal = [p[0] for p in periodi]
+    al = [p[1] for p in periodi]
+    calcola_provvigioni(
+        data_da=None if None in dal else min(dal),
+        data_a=None if None in al else max(al),
+        azienda_id=azienda_id,
+    )
+
+
+def save_aliquota_provvigione(data: Dict) -> str:
+    """Salva o aggiorna un'aliquota e ricalcola le provvigioni del periodo interessato"""
+    campi = ('azienda_id', 'prodotto_id', 'categoria_cliente', 'aliquota', 'valido_dal', 'valido_al', 'note')
+    valori = {k: (data.get(k) or None) if k != 'aliquota' else float(data.get(k) or 0) for k in campi}
+    conn = get_connection()
+    try:
+        now = datetime.now().isoformat()
+        precedente = None
+        if data.get('id'):
+            precedente = row_to_dict(conn.execute(
+                "SELECT * FROM provvigioni_aliquote WHERE id = ?", (data['id'],)).fetchone())
+        if precedente:
+            aliquota_id = data['id']
+            conn.execute(
+                f"UPDATE provvigioni_aliquote SET {', '.join(f'{k} = ?' for k in campi)}, updated_at = ? WHERE id = ?",
+                list(valori.values()) + [now, aliquota_id],
+            )
+        else:
+            aliquota_id = data.get('id') or generate_id()
+            conn.execute(f"""
+                INSERT INTO provvigioni_aliquote (id, {', '.join(campi)}, created_at, updated_at)
+                VALUES (?, {', '.join('?' for _ in campi)}, ?, ?)
+            """, [aliquota_id] + list(valori.values()) + [now, now])
+        conn.commit()
+    finally:
+        conn.close()
+    if precedente and precedente['azienda_id'] != valori['azienda_id']:
+        # aliquota spostata a un'altra azienda: anche la vecchia perde la sua aliquota
+        _ricalcola_periodo_aliquota(precedente['azienda_id'], _periodo_aliquota(precedente))
+        _ricalcola_periodo_aliquota(valori['azienda_id'], _periodo_aliquota(valori))
+    else:
+        _ricalcola_periodo_aliquota(valori['azienda_id'], _periodo_aliquota(valori), _periodo_aliquota(precedente))
+    return aliquota_id
+
+
+def delete_aliquota_provvigione(aliquota_id: str) -> bool:
+    """Elimina un'aliquota e ricalcola le provvigioni del suo periodo"""
+    conn = get_connection()
+    try:
+        a = row_to_dict(conn.execute("SELECT * FROM provvigioni_aliquote WHERE id = ?", (aliquota_id,)).fetchone())
+        if not a:
+            return False
+        conn.execute("DELETE FROM provvigioni_aliquote WHERE id = ?", (aliquota_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    _ricalcola_periodo_aliquota(a['azienda_id'], _periodo_aliquota(a))
+    return True
+
+
+def get_estratti_provvigioni(azienda_id: str = None, anno: int = None) -> List[Dict]:
+    """Estratti conto mensili per mandante (dal materializzato), dal mese più recente"""
+    conn = get_connection()
+    try:
+        query = """
+            SELECT e.*, a.nome AS azienda_nome
+            FROM provvigioni_estratti e
+            LEFT JOIN aziende a ON a.id = e.azienda_id
+            WHERE 1 = 1
+        """
+        params = []
+        if azienda_id:
+            query += " AND e.azienda_id = ?"
+            params.append(azienda_id)
+        if anno:
+            query += " AND e.mese BETWEEN ? AND ?"
+            params += [f"{int(anno)}-01", f"{int(anno)}-12"]
+        query += " ORDER BY e.mese DESC, a.nome"
+        return rows_to_list(conn.execute(query, params).fetchall())
+    finally:
+        conn.close()
+
+
+def get_provvigioni_ordini(azienda_id: str = None, mese_da: str = None, mese_a: str = None) -> List[Dict]:
+    """Dettaglio per ordine delle provvigioni maturate (archiviati compresi)"""
+    conn = get_connection()
+    try:
+        query = """
+            SELECT p.*, c.ragione_sociale AS cliente_ragione_sociale, a.nome AS azienda_nome
+            FROM provvigioni_ordini p
+            LEFT JOIN clienti c ON c.id = p.cliente_id
+            LEFT JOIN aziende a ON a.id = p.azienda_id
+            WHERE 1 = 1
+        """
+        params = []
+        if azienda_id:
+            query += " AND p.azienda_id = ?"
+            params.append(azienda_id)
+        if mese_da:
+            query += " AND p.mese >= ?"
+            params.append(mese_da[:7])
+        if mese_a:
+            query += " AND p.mese <= ?"
+            params.append(mese_a[:7])
+        query += " ORDER BY p.data_ordine, p.numero"
+        return rows_to_list(conn.execute(query, params).fetchall())
+    finally:
+        conn.close()
+
+
+def esporta_provvigioni_csv(azienda_id: str = None, mese_da: str = None, mese_a: str = None) -> str:
+    """Estratto conto provvigioni in CSV (separatore ';' e virgola decimale, per Excel italiano)"""
+    import csv
+    import io
+
+    def num(v) -> str:
+        return f"{float(v or 0):.2f}".replace('.', ',')
+
+    out = io.StringIO()
+    w = csv.writer(out, delimiter=';')
+    w.writerow(['Mandante', 'Mese', 'Data ordine', 'Numero', 'Cliente', 'Categoria', 'Imponibile', 'Provvigione'])
+    for r in get_provvigioni_ordini(azienda_id, mese_da, mese_a):
+        w.writerow([r.get('azienda_nome') or '', r['mese'], r['data_ordine'], r.get('numero') or '',
+                    r.get('cliente_ragione_sociale') or '', r.get('categoria_cliente') or '',
+                    num(r['imponibile']), num(r['provvigione'])])
+    return out.getvalue()
+
+
+# ============================================
+# ARCHIVIO ORDINI (hot/cold)
+# ============================================
+# Gli ordini chiusi (evaso/annullato) più vecchi dell'orizzonte configurato
+# vengono spostati in un file SQLite per anno (<nome db>_archivio_AAAA.db, nella
+# cartella del database). I file sono registrati in archivi_ordini e collegati
+# (ATTACH) solo quando una query copre un anno archiviato: le query quotidiane
+# lavorano solo sugli ordini "caldi".
+
+STATI_ARCHIVIABILI = ('evaso', 'annullato')
+# SQLite collega al massimo 10 database (SQLITE_MAX_ATTACHED): gli anni più
+# vecchi degli ultimi ARCHIVI_MAX_FILE - 1 finiscono in un unico file storico
+ARCHIVI_MAX_FILE = 8
+
+
+def _file_archivio(conn, anno) -> str:
+    """Percorso dell'archivio di un anno: quello registrato in archivi_ordini,
+    altrimenti <nome db>_archivio_AAAA.db accanto al database principale
+    (anno='storico': il file unico degli anni più vecchi)"""
+    main = DB_PATH
+    for r in conn.execute("PRAGMA database_list").fetchall():
+        if r['name'] == 'main' and r['file']:
+            main = r['file']
+            break
+    if anno != 'storico':
+        reg = conn.execute("SELECT file FROM archivi_ordini WHERE anno = ?", (int(anno),)).fetchone()
+        if reg and reg['file']:
+            return os.path.join(os.path.dirname(main), reg['file'])
+        anno = int(anno)
+    base = os.path.splitext(main)[0]
+    return f"{base}_archivio_{anno}.db"
+
+
+def _schema_archivio(path: str) -> str:
+    """Nome schema dell'ATTACH di un file archivio (arch_AAAA, arch_storico)"""
+    return "arch_" + os.path.splitext(os.path.basename(path))[0].rsplit('_archivio_', 1)[-1]
+
+
+def _anni_archiviati(conn, data_da: str = None, data_a: str = None) -> List[int]:
+    """Anni archiviati che intersecano l'intervallo [data_da, data_a] (estremi opzionali)"""
+    if not storage.is_sqlite():
+        return []
+    query = "SELECT anno FROM archivi_ordini WHERE 1=1"
+    params = []
+    if data_da:
+        query += " AND anno >= ?"
+        params.append(int(str(data_da)[:4]))
+    if data_a:
+        query += " AND anno <= ?"
+        params.append(int(str(data_a)[:4]))
+    return [r['anno'] for r in conn.execute(query + " ORDER BY anno", params).fetchall()]
+
+
+def _attach_archivi(conn, anni: List, crea: bool = False) -> List[str]:
+    """Collega (ATTACH) i file archivio degli anni indicati; ritorna i nomi schema (uno per file)"""
+    collegati = {r['name'] for r in conn.execute("PRAGMA database_list").fetchall()}
+    schemi = []
+    for anno in anni:
+        path = _file_archivio(conn, anno)
+        schema = _schema_archivio(path)
+        if schema in schemi:
+            continue
+        if schema not in collegati:
+            if not crea and not os.path.exists(path):
+                continue
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+            collegati.add(schema)
+        schemi.append(schema)
+    return schemi
+
+
+def _colonne(conn, schema: str, tabella: str) -> List[str]:
+    return [r['name'] for r in conn.execute(f"PRAGMA {schema}.table_info({tabella})").fetchall()]
+
+
+def _union_archivi(conn, tabella: str, schemi: List[str]) -> str:
+    """Sottoquery UNION ALL di tabella calda + archivi (colonne mancanti negli archivi -> NULL)"""
+    colonne = _colonne(conn, 'main', tabella)
+    parti = [f"SELECT {', '.join(colonne)} FROM main.{tabella}"]
+    for schema in schemi:
+        presenti = set(_colonne(conn, schema, tabella))
+        sel = [c if c in presenti else f"NULL AS {c}" for c in colonne]
+        parti.append(f"SELECT {', '.join(sel)} FROM {schema}.{tabella}")
+    return "(" + " UNION ALL ".join(parti) + ")"
+
+
+def _sorgente_ordini(conn, data_da: str = None, data_a: str = None,
+                     includi_archivio: Optional[bool] = None) -> Tuple[str, str]:
+    """Sorgenti (ordini, ordini_righe) da usare nel FROM di una query.
+
+    includi_archivio=None: automatico, gli archivi entrano solo se l'intervallo
+    di date (almeno un estremo) copre un anno archiviato. True: tutti gli
+    archivi dell'intervallo. False: solo ordini caldi.
+    """
+    if includi_archivio is False:
+        return 'ordini', 'ordini_righe'
+    if includi_archivio is None and not data_da and not data_a:
+        return 'ordini', 'ordini_righe'
+    anni = _anni_archiviati(conn, data_da, data_a)
+    schemi = _attach_archivi(conn, anni) if anni else []
+    if not schemi:
+        return 'ordini', 'ordini_righe'
+    return _union_archivi(conn, 'ordini', schemi), _union_archivi(conn, 'ordini_righe', schemi)
+
+
+def _prepara_archivio(conn, schema: str) -> None:
+    """Crea/allinea le tabelle di un file archivio alle colonne correnti"""
+    for tabella in ('ordini', 'ordini_righe'):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{tabella} AS SELECT * FROM main.{tabella} WHERE 0")
+        presenti = set(_colonne(conn, schema, tabella))
+        for c in _colonne(conn, 'main', tabella):
+            if c not in presenti:
+                conn.execute(f"ALTER TABLE {schema}.{tabella} ADD COLUMN {c}")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.idx_arch_ordini_id ON ordini(id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_arch_ordini_data ON ordini(data_ordine)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_arch_ordini_cliente ON ordini(cliente_id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_arch_righe_ordine ON ordini_righe(ordine_id)")
+
+
+def _copia_ordini(conn, da: str, a: str, ids: List[str] = None) -> None:
+    """Copia ordini e righe tra due schemi collegati (tutti, o solo gli ids), sulle colonne comuni"""
+    for tabella, chiave in (('ordini', 'id'), ('ordini_righe', 'ordine_id')):
+        presenti = set(_colonne(conn, da, tabella))
+        col = ', '.join(c for c in _colonne(conn, a, tabella) if c in presenti)
+        if ids is None:
+            conn.execute(f"INSERT INTO {a}.{tabella} ({col}) SELECT {col} FROM {da}.{tabella}")
+            continue
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            ph = ', '.join(['?' for _ in chunk])
+            conn.execute(f"INSERT INTO {a}.{tabella} ({col}) SELECT {col} FROM {da}.{tabella} WHERE {chiave} IN ({ph})", chunk)
+
+
+def archivia_ordini(orizzonte_giorni: int = None) -> Dict[int, int]:
+    """Sposta negli archivi annuali gli ordini chiusi più vecchi dell'orizzonte.
+
+    Archivia solo ordini evasi/annullati non referenziati da promemoria o visite.
+    L'orizzonte di default è l'impostazione archivio_orizzonte_giorni.
+    Le cancellazioni dagli ordini caldi non finiscono nel change_log (l'ordine
+    non è stato eliminato: i dispositivi lo tengono). Oltre ARCHIVI_MAX_FILE
+    file gli anni più vecchi vengono uniti nell'archivio storico.
+
+    Returns:
+        dict {anno: numero ordini archiviati}
+    """
+    if not storage.is_sqlite():
+        raise RuntimeError("Archiviazione ordini disponibile solo con il backend SQLite")
+
+    conn = get_connection()
+    da_rimuovere = []
+    try:
+        if orizzonte_giorni is None:
+            orizzonte_giorni = int(_get_impostazione(conn, 'archivio_orizzonte_giorni', '730'))
+        soglia = (date.today() - timedelta(days=orizzonte_giorni)).isoformat()
+        placeholders = ', '.join(['?' for _ in STATI_ARCHIVIABILI])
+
+        rows = conn.execute(f"""
+            SELECT id, substr(data_ordine, 1, 4) AS anno
+            FROM ordini o
+            WHERE o.stato IN ({placeholders})
+              AND o.data_ordine < ?
+              AND NOT EXISTS (SELECT 1 FROM promemoria p WHERE p.ordine_id = o.id)
+              AND NOT EXISTS (SELECT 1 FROM visite v WHERE v.ordine_id = o.id)
+        """, list(STATI_ARCHIVIABILI) + [soglia]).fetchall()
+
+        per_anno: Dict[int, List[str]] = {}
+        for r in rows:
+            per_anno.setdefault(int(r['anno']), []).append(r['id'])
+        if not per_anno:
+            return {}
+
+        # Anni con un file proprio: gli ultimi ARCHIVI_MAX_FILE - 1, gli altri nello storico
+        registrati = {r['anno']: r['file'] for r in conn.execute("SELECT anno, file FROM archivi_ordini").fetchall()}
+        anni = sorted(set(registrati) | set(per_anno))
+        propri = set(anni[-(ARCHIVI_MAX_FILE - 1):])
+        storico = os.path.basename(_file_archivio(conn, 'storico'))
+        da_unire = [anno for anno in anni
+                    if anno not in propri and anno in registrati and registrati[anno] != storico]
+
+        # ATTACH non è ammesso dentro una transazione
+        collegati = {r['name'] for r in conn.execute("PRAGMA database_list").fetchall()}
+        sorgenti = {}
+        for anno in da_unire:
+            path = _file_archivio(conn, anno)
+            sorgenti[anno] = _schema_archivio(path)
+            if sorgenti[anno] not in collegati and os.path.exists(path):
+                conn.execute(f"ATTACH DATABASE ? AS {sorgenti[anno]}", (path,))
+                collegati.add(sorgenti[anno])
+            da_rimuovere.append((sorgenti[anno], path))
+        schemi = {}
+        for anno in per_anno:
+            path = _file_archivio(conn, anno if anno in propri else 'storico')
+            schemi[anno] = _schema_archivio(path)
+            if schemi[anno] not in collegati:
+                conn.execute(f"ATTACH DATABASE ? AS {schemi[anno]}", (path,))
+                collegati.add(schemi[anno])
+        if da_unire and 'arch_storico' not in collegati:
+            conn.execute("ATTACH DATABASE ? AS arch_storico", (_file_archivio(conn, 'storico'),))
+
+        conn.execute("BEGIN")
+        seq_prima = conn.execute("SELECT COALESCE(MAX(seq), 0) AS s FROM change_log").fetchone()['s']
+
+        # Anni usciti dagli ultimi ARCHIVI_MAX_FILE - 1: il loro file confluisce nello storico
+        if da_unire:
+            _prepara_archivio(conn, 'arch_storico')
+            for anno in da_unire:
+                if sorgenti[anno] in collegati:
+                    _copia_ordini(conn, sorgenti[anno], 'arch_storico')
+                conn.execute("UPDATE archivi_ordini SET file = ?, updated_at = ? WHERE anno = ?",
+                             (storico, datetime.now().isoformat(), anno))
+
+        for anno, ids in per_anno.items():
+            schema = schemi[anno]
+            _prepara_archivio(conn, schema)
+            _copia_ordini(conn, 'main', schema, ids)
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                ph = ', '.join(['?' for _ in chunk])
+                conn.execute(f"DELETE FROM main.ordini_righe WHERE ordine_id IN ({ph})", chunk)
+                conn.execute(f"DELETE FROM main.ordini WHERE id IN ({ph})", chunk)
+
+            conn.execute("""
+                INSERT INTO archivi_ordini (anno, file, num_ordini, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(anno) DO UPDATE SET
+                    num_ordini = archivi_ordini.num_ordini + excluded.num_ordini,
+                    updated_at = excluded.updated_at
+            """, (anno, os.path.basename(_file_archivio(conn, anno if anno in propri else 'storico')),
+                  len(ids), datetime.now().isoformat()))
+
+        # niente 'D' ai dispositivi per gli ordini spostati in archivio
+        conn.execute("""
+            DELETE FROM change_log
+            WHERE seq > ? AND operazione = 'D' AND tabella IN ('ordini', 'ordini_righe')
+        """, (seq_prima,))
+
+        conn.commit()
+        for schema, path in da_rimuovere:
+            if schema in collegati:
+                conn.execute(f"DETACH DATABASE {schema}")
+            if os.path.exists(path):
+                os.remove(path)
+        return {anno: len(ids) for anno, ids in per_anno.items()}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _ripristina_ordine(conn, ordine_id: str) -> bool:
+    """Riporta tra gli ordini caldi un ordine archiviato (da chiamare fuori transazione).
+
+    Modifiche, cambi di stato ed eliminazioni lavorano sugli ordini caldi: un
+    ordine archiviato torna caldo prima (e sarà riarchiviato se resta chiuso).
+    Returns:
+        True se l'ordine era in archivio ed è stato ripristinato
+    """
+    if not ordine_id or not storage.is_sqlite():
+        return False
+    if conn.execute("SELECT 1 FROM ordini WHERE id = ?", (ordine_id,)).fetchone():
+        return False
+    for schema in _attach_archivi(conn, _anni_archiviati(conn)):
+        row = conn.execute(f"SELECT substr(data_ordine, 1, 4) AS anno FROM {schema}.ordini WHERE id = ?",
+                           (ordine_id,)).fetchone()
+        if not row:
+            continue
+        try:
+            conn.execute("BEGIN")
+            _copia_ordini(conn, schema, 'main', [ordine_id])
+            conn.execute(f"DELETE FROM {schema}.ordini_righe WHERE ordine_id = ?", (ordine_id,))
+            conn.execute(f"DELETE FROM {schema}.ordini WHERE id = ?", (ordine_id,))
+            conn.execute("UPDATE archivi_ordini SET num_ordini = num_ordini - 1, updated_at = ? WHERE anno = ?",
+                         (datetime.now().isoformat(), int(row['anno'])))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return True
+    return False
+
+
+def get_archivi_ordini() -> List[Dict]:
+    """Elenco degli archivi annuali registrati"""
+    if not storage.is_sqlite():
+        return []
+    conn = get_connection()
+    try:
+        return rows_to_list(conn.execute("SELECT * FROM archivi_ordini ORDER BY anno DESC").fetchall())
+    finally:
+        conn.close()
+
+
+# ============================================
+# PROMEMORIA
+# ============================================
+
+# ============================================
+# RICORRENZE (appuntamenti e promemoria)
+# ============================================
+
+# Sottoinsieme di RRULE (RFC 5545) gestito: FREQ, INTERVAL, COUNT, UNTIL,
+# BYDAY (con FREQ=WEEKLY) e BYMONTHDAY (con FREQ=MONTHLY)
+_FREQUENZE_RICORRENZA = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+_GIORNI_RRULE = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# tipo -> (tabella, colonna data di inizio, colonna ora, colonna note)
+_SERIE_RICORRENTI = {
+    'appuntamento': ('appuntamenti', 'data', 'ora', 'note'),
+    'promemoria': ('promemoria', 'data_scadenza', 'ora_scadenza', 'descrizione'),
+}
+
+# Ricerca della prossima occorrenza aperta di un promemoria: blocchi di un anno
+_ANNI_RICERCA_OCCORRENZA = 20
+
+
+def parse_ricorrenza(regola: str) -> Dict[str, Any]:
+    """Interpreta una regola tipo 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;UNTIL=20271231'.
+
+    Raises:
+        ValueError: regola non valida o con parti non gestite
+    """
+    testo = (regola or '').strip().upper()
+    if testo.startswith('RRULE:'):
+        testo = testo[len('RRULE:'):]
+    parti = {}
+    for pezzo in testo.split(';'):
+        if pezzo.strip():
+            chiave, _, valore = pezzo.partition('=')
+            parti[chiave.strip()] = valore.strip()
+    non_gestite = set(parti) - {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'BYDAY', 'BYMONTHDAY'}
+    if non_gestite:
+        raise ValueError(f"Ricorrenza: parti non gestite {', '.join(sorted(non_gestite))}")
+    freq = parti.get('FREQ')
+    if freq not in _FREQUENZE_RICORRENZA:
+        raise ValueError(f"Ricorrenza: FREQ non valida ({freq})")
+    r = {
+        'freq': freq,
+        'intervallo': max(int(parti.get('INTERVAL') or 1), 1),
+        'count': int(parti['COUNT']) if parti.get('COUNT') else None,
+        'until': datetime.strptime(parti['UNTIL'][:8], '%Y%m%d').date() if parti.get('UNTIL') else None,
+        'byday': None,
+        'bymonthday': None,
+    }
+    if parti.get('BYDAY'):
+        if freq != 'WEEKLY':
+            raise ValueError("Ricorrenza: BYDAY è gestito solo con FREQ=WEEKLY")
+        r['byday'] = sorted({_GIORNI_RRULE.index(g.strip()) for g in parti['BYDAY'].split(',')})
+    if parti.get('BYMONTHDAY'):
+        if freq != 'MONTHLY':
+            raise ValueError("Ricorrenza: BYMONTHDAY è gestito solo con FREQ=MONTHLY")
+        r['bymonthday'] = sorted({int(g) for g in parti['BYMONTHDAY'].split(',')})
+        if not all(1 <= g <= 31 for g in r['bymonthday']):
+            raise ValueError("Ricorrenza: BYMONTHDAY fuori da 1-31")
+    return r
+
+
+def regola_ricorrenza(freq: str, intervallo: int = 1, fino_al: str = None, count: int = None,
+                      giorni_settimana: List[int] = None) -> str:
+    """Compone una regola RRULE (giorni_settimana: 0 = lunedì)"""
+    parti = [f"FREQ={freq}"]
+    if intervallo and intervallo > 1:
+        parti.append(f"INTERVAL={intervallo}")
+    if giorni_settimana:
+        parti.append("BYDAY=" + ','.join(_GIORNI_RRULE[g] for g in sorted(giorni_settimana)))
+    if count:
+        parti.append(f"COUNT={count}")
+    if fino_al:
+        parti.append("UNTIL=" + str(fino_al)[:10].replace('-', ''))
+    regola = ';'.join(parti)
+    parse_ricorrenza(regola)
+    return regola
+
+
+def _genera_occorrenze(r: Dict[str, Any], inizio: date, da: date, a: date):
+    """Occorrenze >= inizio in ordine, dal periodo che contiene `da` fino a `a` (COUNT/UNTIL esclusi)"""
+    k = r['intervallo']
+    if r['freq'] == 'DAILY':
+        p = max(0, -(-(da - inizio).days // k))
+        d = inizio + timedelta(days=p * k)
+        while d <= a:
+            yield d
+            d += timedelta(days=k)
+    elif r['freq'] == 'WEEKLY':
+        giorni = r['byday'] or [inizio.weekday()]
+        lunedi0 = inizio - timedelta(days=inizio.weekday())
+        p = max(0, (da - lunedi0).days // 7)
+        p -= p % k
+        while lunedi0 + timedelta(weeks=p) <= a:
+            for g in giorni:
+                d = lunedi0 + timedelta(weeks=p, days=g)
+                if d >= inizio:
+                    yield d
+            p += k
+    else:
+        passo = k if r['freq'] == 'MONTHLY' else 12 * k
+        giorni = r['bymonthday'] or [inizio.day]
+        m0 = inizio.year * 12 + inizio.month - 1
+        p = max(0, da.year * 12 + da.month - 1 - m0)
+        p -= p % passo
+        while True:
+            anno, mese = divmod(m0 + p, 12)
+            if anno > 9999 or date(anno, mese + 1, 1) > a:
+                return
+            ultimo = calendar.monthrange(anno, mese + 1)[1]
+            # giorni inesistenti nel mese (31, 29 febbraio) saltati, come da RFC 5545
+            for g in giorni:
+                if g <= ultimo and date(anno, mese + 1, g) >= inizio:
+                    yield date(anno, mese + 1, g)
+            p += passo
+
+
+def occorrenze_ricorrenza(regola: str, inizio: date, da: date, a: date) -> List[date]:
+    """Date della serie (regola + data di inizio) comprese in [da, a]"""
+    r = parse_ricorrenza(regola)
+    if r['until'] and r['until'] < a:
+        a = r['until']
+    if a < max(da, inizio):
+        return []
+    if not r['count']:
+        return [d for d in _genera_occorrenze(r, inizio, max(da, inizio), a) if da <= d <= a]
+    # con COUNT serve la posizione nella serie: si conta dall'inizio
+    out = []
+    for n, d in enumerate(_genera_occorrenze(r, inizio, inizio, a), start=1):
+        if n > r['count'] or d > a:
+            break
+        if d >= da:
+            out.append(d)
+    return out
+
+
+def fine_ricorrenza(regola: str, inizio: date) -> Optional[date]:
+    """Ultima data possibile della serie (None se illimitata)"""
+    r = parse_ricorrenza(regola)
+    if r['count']:
+        occ = occorrenze_ricorrenza(regola, inizio, inizio, r['until'] or date(9999, 12, 31))
+        return occ[-1] if occ else inizio
+    return r['until']
+
+
+def _come_data(valore) -> date:
+    return valore if isinstance(valore, date) else date.fromisoformat(str(valore)[:10])
+
+
+def _mesi_tra(da: date, a: date) -> List[str]:
+    mesi = []
+    anno, mese = da.year, da.month
+    while (anno, mese) <= (a.year, a.month):
+        mesi.append(f"{anno:04d}-{mese:02d}")
+        anno, mese = (anno + 1, 1) if mese == 12 else (anno, mese + 1)
+    return mesi
+
+
+def _occorrenze_in_cache(conn, tipo: str, serie: List[Dict], da: date, a: date) -> Dict[str, List[date]]:
+    """Occorrenze da regola (senza eccezioni) per serie in [da, a].
+
+    Le espansioni sono salvate per mese in ricorrenze_cache: i mesi mancanti
+    vengono calcolati e scritti (senza commit).
+    """
+    col_data = _SERIE_RICORRENTI[tipo][1]
+    mesi = _mesi_tra(da, a)
+    ids = [s['id'] for s in serie]
+    cache = {(r['serie_id'], r['mese']): r['giorni'] for r in conn.execute(f"""
+        SELECT serie_id, mese, giorni FROM ricorrenze_cache
+        WHERE tipo = ? AND serie_id IN ({', '.join('?' for _ in ids)}) AND mese IN ({', '.join('?' for _ in mesi)})
+    """, [tipo] + ids + mesi).fetchall()}
+    nuove = []
+    out: Dict[str, List[date]] = {}
+    for s in serie:
+        inizio = _come_data(s[col_data])
+        date_serie = []
+        for mese in mesi:
+            testo = cache.get((s['id'], mese))
+            if testo is None:
+                primo = date(int(mese[:4]), int(mese[5:7]), 1)
+                ultimo = primo.replace(day=calendar.monthrange(primo.year, primo.month)[1])
+                testo = ','.join(d.isoformat() for d in occorrenze_ricorrenza(s['ricorrenza'], inizio, primo, ultimo))
+                nuove.append((tipo, s['id'], mese, testo))
+            date_serie.extend(d for d in (date.fromisoformat(x) for x in testo.split(',') if x) if da <= d <= a)
+        out[s['id']] = date_serie
+    if nuove:
+        conn.executemany("""
+            INSERT INTO ricorrenze_cache (tipo, serie_id, mese, giorni) VALUES (?, ?, ?, ?)
+            ON CONFLICT(tipo, serie_id, mese) DO NOTHING
+        """, nuove)
+    return out
+
+
+def _istanze_ricorrenti(conn, tipo: str, data_da: str, data_a: str) -> List[Dict]:
+    """Occorrenze delle serie ricorrenti in [data_da, data_a] con eccezioni applicate.
+
+    Ogni istanza è la riga della serie con la data dell'occorrenza, più
+    'data_originale' (chiave dell'occorrenza nella serie) e 'ricorrente' = 1.
+    Le occorrenze annullate non compaiono; quelle spostate compaiono alla
+    nuova data (anche se l'originale cade fuori dal range).
+    """
+    tabella, col_data, col_ora, col_note = _SERIE_RICORRENTI[tipo]
+    select = f"""
+        SELECT t.*, c.ragione_sociale AS cliente_nome,
+               c.latitudine AS cliente_latitudine, c.longitudine AS cliente_longitudine
+        FROM {tabella} t
+        LEFT JOIN clienti c ON c.id = t.cliente_id
+    """
+    # serie attive nel range (indice parziale sulle sole righe ricorrenti)
+    serie = rows_to_list(conn.execute(f"""
+        {select}
+        WHERE t.ricorrenza IS NOT NULL AND t.{col_data} <= ?
+          AND (t.ricorrenza_fine IS NULL OR t.ricorrenza_fine >= ?)
+    """, (data_a, data_da)).fetchall())
+    # serie con un'occorrenza spostata nel range da fuori
+    caricate = {s['id'] for s in serie}
+    spostate = [r['serie_id'] for r in conn.execute(
+        "SELECT DISTINCT serie_id FROM ricorrenze_eccezioni WHERE tipo = ? AND nuova_data BETWEEN ? AND ?",
+        (tipo, data_da, data_a),
+    ).fetchall() if r['serie_id'] not in caricate]
+    if spostate:
+        serie += rows_to_list(conn.execute(f"""
+            {select}
+            WHERE t.ricorrenza IS NOT NULL AND t.id IN ({', '.join('?' for _ in spostate)})
+        """, spostate).fetchall())
+    if not serie:
+        return []
+    da, a = _come_data(data_da), _come_data(data_a)
+    occorrenze = _occorrenze_in_cache(conn, tipo, serie, da, a)
+    ids = [s['id'] for s in serie]
+    eccezioni: Dict[str, Dict[str, Dict]] = {}
+    for e in conn.execute(f"""
+        SELECT * FROM ricorrenze_eccezioni
+        WHERE tipo = ? AND serie_id IN ({', '.join('?' for _ in ids)})
+          AND (data_originale BETWEEN ? AND ? OR nuova_data BETWEEN ? AND ?)
+    """, [tipo] + ids + [data_da, data_a, data_da, data_a]).fetchall():
+        eccezioni.setdefault(e['serie_id'], {})[str(e['data_originale'])[:10]] = dict(e)
+
+    istanze = []
+    for s in serie:
+        ecc = eccezioni.get(s['id'], {})
+        valide = {d.isoformat() for d in occorrenze[s['id']]}
+        for giorno in sorted(valide - set(ecc)):
+            istanze.append(dict(s, **{col_data: giorno, 'data_originale': giorno, 'ricorrente': 1}))
+        for originale, e in ecc.items():
+            if e['annullata']:
+                continue
+            # eccezioni rimaste da una regola precedente non valgono più
+            if originale not in valide and not occorrenze_ricorrenza(
+                    s['ricorrenza'], _come_data(s[col_data]), _come_data(originale), _come_data(originale)):
+                continue
+            giorno = str(e['nuova_data'] or originale)[:10]
+            if not (data_da <= giorno <= data_a):
+                continue
+            istanza = dict(s, **{col_data: giorno, 'data_originale': originale, 'ricorrente': 1})
+            if e['nuova_ora']:
+                istanza[col_ora] = e['nuova_ora']
+            if e['titolo']:
+                istanza['titolo'] = e['titolo']
+            if e['note']:
+                istanza[col_note] = e['note']
+            if tipo == 'promemoria':
+                istanza['completato'] = e['completata'] or 0
+                istanza['data_completamento'] = e['data_completamento']
+            istanze.append(istanza)
+    return istanze
+
+
+def _aggiorna_serie(conn, tipo: str, serie_id: str) -> None:
+    """Dopo il salvataggio di una serie: ricalcola ricorrenza_fine e svuota la cache (senza commit)"""
+    tabella, col_data = _SERIE_RICORRENTI[tipo][:2]
+    conn.execute("DELETE FROM ricorrenze_cache WHERE tipo = ? AND serie_id = ?", (tipo, serie_id))
+    row = conn.execute(f"SELECT {col_data} AS inizio, ricorrenza FROM {tabella} WHERE id = ?", (serie_id,)).fetchone()
+    if row and row['ricorrenza']:
+        fine = fine_ricorrenza(row['ricorrenza'], _come_data(row['inizio']))
+        conn.execute(f"UPDATE {tabella} SET ricorrenza_fine = ? WHERE id = ?",
+                     (fine.isoformat() if fine else None, serie_id))
+    elif row:
+        conn.execute(f"UPDATE {tabella} SET ricorrenza_fine = NULL WHERE id = ?", (serie_id,))
+
+
+def _elimina_serie(conn, tipo: str, serie_id: str) -> None:
+    """Eccezioni e cache di una serie eliminata (senza commit)"""
+    conn.execute("DELETE FROM ricorrenze_eccezioni WHERE tipo = ? AND serie_id = ?", (tipo, serie_id))
+    conn.execute("DELETE FROM ricorrenze_cache WHERE tipo = ? AND serie_id = ?", (tipo, serie_id))
+
+
+def _salva_eccezione(conn, tipo: str, serie_id: str, data_originale: str, **campi) -> None:
+    """Crea o aggiorna l'eccezione di un'occorrenza (senza commit)"""
+    if tipo not in _SERIE_RICORRENTI:
+        raise ValueError(f"Tipo di serie non valido: {tipo}")
+    campi['updated_at'] = datetime.now().isoformat()
+    colonne = ['tipo', 'serie_id', 'data_originale'] + list(campi)
+    conn.execute(f"""
+        INSERT INTO ricorrenze_eccezioni ({', '.join(colonne)}) VALUES ({', '.join('?' for _ in colonne)})
+        ON CONFLICT(tipo, serie_id, data_originale) DO UPDATE SET
+            {', '.join(f"{c} = excluded.{c}" for c in campi)}
+    """, [tipo, serie_id, str(data_originale)[:10]] + list(campi.values()))
+
+
+def annulla_occorrenza(tipo: str, serie_id: str, data_originale: str) -> None:
+    """Elimina una sola occorrenza di una serie (tipo: 'appuntamento' o 'promemoria')"""
+    conn = get_connection()
+    try:
+        _salva_eccezione(conn, tipo, serie_id, data_originale, annullata=1)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def modifica_occorrenza(tipo: str, serie_id: str, data_originale: str, nuova_data: str = None,
+                        nuova_ora: str = None, titolo: str = None, note: str = None) -> None:
+    """Sposta o modifica una sola occorrenza di una serie (i campi None restano quelli della serie)"""
+    conn = get_connection()
+    try:
+        _salva_eccezione(conn, tipo, serie_id, data_originale, annullata=0,
+                         nuova_data=nuova_data, nuova_ora=nuova_ora, titolo=titolo, note=note)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _occorrenze_chiuse(conn, serie_ids: List[str], fino_al: str = None) -> Dict[str, Set[str]]:
+    """Date originali completate o annullate dei promemoria ricorrenti indicati, in una query"""
+    if not serie_ids:
+        return {}
+    query = f"""
+        SELECT serie_id, data_originale FROM ricorrenze_eccezioni
+        WHERE tipo = 'promemoria' AND serie_id IN ({', '.join('?' for _ in serie_ids)})
+          AND (annullata = 1 OR completata = 1)
+    """
+    params = list(serie_ids)
+    if fino_al:
+        query += " AND data_originale <= ?"
+        params.append(fino_al[:10])
+    chiuse: Dict[str, Set[str]] = {}
+    for r in conn.execute(query, params).fetchall():
+        chiuse.setdefault(r['serie_id'], set()).add(str(r['data_originale'])[:10])
+    return chiuse
+
+
+def _prossima_occorrenza_aperta(conn, serie: Dict, chiuse: Set[str] = None, fino_al: str = None) -> Optional[str]:
+    """Prima occorrenza di un promemoria ricorrente non completata né annullata.
+
+    chiuse: date già chiuse della serie (default: lette con _occorrenze_chiuse);
+    con fino_al la ricerca si ferma a quella data (None se non c'è
+    un'occorrenza aperta entro).
+    """
+    if chiuse is None:
+        chiuse = _occorrenze_chiuse(conn, [serie['id']], fino_al).get(serie['id'], set())
+    inizio = _come_data(serie['data_scadenza'])
+    limite = _come_data(fino_al) if fino_al else None
+    da = inizio
+    for _ in range(_ANNI_RICERCA_OCCORRENZA):
+        a = da + timedelta(days=365)
+        if limite and a >= limite:
+            a = limite
+        for d in occorrenze_ricorrenza(serie['ricorrenza'], inizio, da, a):
+            if d.isoformat() not in chiuse:
+                return d.isoformat()
+        if (limite and a >= limite) or (serie.get('ricorrenza_fine') and a >= _come_data(serie['ricorrenza_fine'])):
+            return None
+        da = a + timedelta(days=1)
+    return None
+
+
+# ============================================
+# APPUNTAMENTI (CALENDARIO)
+# ============================================
+
+def save_appuntamento(data: Dict, consenti_conflitti: bool = True) -> str:
+    """Salva o aggiorna un appuntamento.
+
+    Con 'ricorrenza' (regola RRULE, vedi parse_ricorrenza) l'appuntamento è
+    una serie che parte da 'data'. Con consenti_conflitti=False rifiuta
+    (ValueError) un appuntamento che si sovrappone ad altri impegni; per
+    una serie si verificano le occorrenze dei prossimi
+    GIORNI_VERIFICA_RICORRENZA giorni.
+    """
+    if 'ricorrenza' in data:
+        data = dict(data, ricorrenza=data['ricorrenza'] or None)
+        if data['ricorrenza']:
+            parse_ricorrenza(data['ricorrenza'])
+    conn = get_connection()
+    try:
+        if not consenti_conflitti:
+            _verifica_conflitti(conn, 'appuntamento', data)
+        if data.get('id'):
+            app_id = data['id']
+            fields = []
+            values = []
+            for k, v in data.items():
+                if k not in ('id', 'created_at'):
+                    fields.append(f"{k} = ?")
+                    values.append(v)
+            fields.append("updated_at = ?")
             values.append(datetime.now().isoformat())
             values.append(app_id)
             conn.execute(f"UPDATE appuntamenti SET {', '.join(fields)} WHERE id = ?", values)
@@ -764,6 +3295,8 @@ def save_appuntamento(data: Dict) -> str:
             fields = list(data.keys())
             placeholders = ', '.join(['?' for _ in fields])
             conn.execute(f"INSERT INTO appuntamenti ({', '.join(fields)}) VALUES ({placeholders})", list(data.values()))
+        _aggiorna_serie(conn, 'appuntamento', app_id)
+        _aggiorna_slot(conn, 'appuntamento', app_id)
         conn.commit()
         return app_id
     finally:
@@ -771,29 +3304,39 @@ def save_appuntamento(data: Dict) -> str:
 
 
 def delete_appuntamento(app_id: str) -> None:
+    """Elimina un appuntamento (una serie ricorrente per intero: per una sola occorrenza annulla_occorrenza)"""
     conn = get_connection()
     try:
         conn.execute("DELETE FROM appuntamenti WHERE id = ?", (app_id,))
+        _elimina_serie(conn, 'appuntamento', app_id)
+        _aggiorna_slot(conn, 'appuntamento', app_id)
         conn.commit()
     finally:
         conn.close()
 
 
 def get_appuntamenti_range(date_from: str, date_to: str) -> List[Dict]:
-    """Ritorna appuntamenti in un range [date_from, date_to] (YYYY-MM-DD)."""
+    """Ritorna appuntamenti in un range [date_from, date_to] (YYYY-MM-DD).
+
+    Le serie ricorrenti sono espanse solo nel range (istanze con
+    'data_originale' e 'ricorrente' = 1).
+    """
     conn = get_connection()
     try:
         rows = conn.execute(
             """
-            SELECT a.*, c.ragione_sociale AS cliente_nome
+            SELECT a.*, c.ragione_sociale AS cliente_nome,
+                   c.latitudine AS cliente_latitudine, c.longitudine AS cliente_longitudine
             FROM appuntamenti a
             LEFT JOIN clienti c ON a.cliente_id = c.id
-            WHERE a.data BETWEEN ? AND ?
-            ORDER BY a.data ASC, COALESCE(a.ora,'') ASC
+            WHERE a.data BETWEEN ? AND ? AND a.ricorrenza IS NULL
             """,
             (date_from, date_to),
         ).fetchall()
-        return rows_to_list(rows)
+        appuntamenti = rows_to_list(rows) + _istanze_ricorrenti(conn, 'appuntamento', date_from, date_to)
+        conn.commit()
+        appuntamenti.sort(key=lambda a: (str(a['data'])[:10], a.get('ora') or ''))
+        return appuntamenti
     finally:
         conn.close()
 
@@ -801,15 +3344,114 @@ def get_appuntamenti_range(date_from: str, date_to: str) -> List[Dict]:
 def get_appuntamenti_by_date(date_iso: str) -> List[Dict]:
     return get_appuntamenti_range(date_iso, date_iso)
 
-def get_promemoria(solo_attivi: bool = True, cliente_id: str = None) -> List[Dict]:
-    """Ottiene i promemoria"""
+
+# Ordine degli eventi a parità di giorno e ora
+_ORDINE_AGENDA = {'appuntamento': 0, 'visita': 1, 'promemoria': 2}
+
+
+def get_agenda(data_da: str, data_a: str, includi_completati: bool = False,
+               includi_scaduti: bool = False) -> Dict[str, List[Dict]]:
+    """Agenda unificata (appuntamenti, visite pianificate, promemoria) per giorno.
+
+    Un'unica query UNION ALL: ogni ramo legge la propria tabella sull'indice
+    della data nel range [data_da, data_a] (YYYY-MM-DD).
+
+    Args:
+        includi_completati: anche visite completate e promemoria completati
+        includi_scaduti: anche i promemoria non completati scaduti prima di
+                         data_da (restano nel giorno di scadenza; per i
+                         ricorrenti solo le occorrenze dell'ultimo mese)
+
+    Returns:
+        {giorno: [eventi in ordine di ora]} solo per i giorni con eventi; ogni
+        evento ha 'tipo' (appuntamento/visita/promemoria), 'id', 'giorno',
+        'ora', 'ora_fine', 'titolo', 'dettaglio', 'cliente_id', 'cliente_nome',
+        'priorita', 'completato'; le occorrenze di serie ricorrenti hanno
+        anche 'data_originale'
+    """
+    filtro_visite = "" if includi_completati else " AND vp.completata = 0"
+    filtro_promemoria = "" if includi_completati else " AND p.completato = 0"
+    params: List[Any] = [data_da, data_a, data_da, data_a]
+    if includi_scaduti:
+        filtro_promemoria += " AND (p.data_scadenza BETWEEN ? AND ? OR (p.data_scadenza < ? AND p.completato = 0))"
+        params += [data_da, data_a, data_da]
+    else:
+        filtro_promemoria += " AND p.data_scadenza BETWEEN ? AND ?"
+        params += [data_da, data_a]
+    conn = get_connection()
+    try:
+        rows = conn.execute(f"""
+            SELECT e.*, c.ragione_sociale AS cliente_nome
+            FROM (
+                SELECT 'appuntamento' AS tipo, a.id, a.data AS giorno, a.ora, NULL AS ora_fine,
+                       a.titolo, a.luogo AS dettaglio, a.cliente_id, NULL AS priorita, 0 AS completato
+                FROM appuntamenti a
+                WHERE a.data BETWEEN ? AND ? AND a.ricorrenza IS NULL
+                UNION ALL
+                SELECT 'visita', vp.id, vp.data_pianificata, vp.ora_inizio, vp.ora_fine,
+                       COALESCE(NULLIF(vp.note, ''), vp.tipo, 'visita'), vp.tipo, vp.cliente_id,
+                       vp.priorita, vp.completata
+                FROM visite_pianificate vp
+                WHERE vp.data_pianificata BETWEEN ? AND ?{filtro_visite}
+                UNION ALL
+                SELECT 'promemoria', p.id, p.data_scadenza, p.ora_scadenza, NULL,
+                       p.titolo, p.descrizione, p.cliente_id, p.priorita, p.completato
+                FROM promemoria p
+                WHERE p.ricorrenza IS NULL{filtro_promemoria}
+            ) e
+            LEFT JOIN clienti c ON c.id = e.cliente_id
+        """, params).fetchall()
+        eventi = rows_to_list(rows)
+
+        # serie ricorrenti espanse solo nel range (scadute: solo l'ultimo mese)
+        for a in _istanze_ricorrenti(conn, 'appuntamento', data_da, data_a):
+            eventi.append({'tipo': 'appuntamento', 'id': a['id'], 'giorno': a['data'], 'ora': a['ora'],
+                           'ora_fine': None, 'titolo': a['titolo'], 'dettaglio': a['luogo'],
+                           'cliente_id': a['cliente_id'], 'cliente_nome': a['cliente_nome'],
+                           'priorita': None, 'completato': 0, 'data_originale': a['data_originale']})
+        da_promemoria = (_come_data(data_da) - timedelta(days=31)).isoformat() if includi_scaduti else data_da
+        for p in _istanze_ricorrenti(conn, 'promemoria', da_promemoria, data_a):
+            if p['completato'] and not includi_completati:
+                continue
+            if p['data_scadenza'] < data_da and p['completato']:
+                continue
+            eventi.append({'tipo': 'promemoria', 'id': p['id'], 'giorno': p['data_scadenza'],
+                           'ora': p['ora_scadenza'], 'ora_fine': None, 'titolo': p['titolo'],
+                           'dettaglio': p['descrizione'], 'cliente_id': p['cliente_id'],
+                           'cliente_nome': p['cliente_nome'], 'priorita': p['priorita'],
+                           'completato': p['completato'], 'data_originale': p['data_originale']})
+        conn.commit()
+    finally:
+        conn.close()
+
+    eventi.sort(key=lambda e: (str(e['giorno'])[:10], e['ora'] or '', _ORDINE_AGENDA[e['tipo']]))
+    agenda: Dict[str, List[Dict]] = {}
+    for e in eventi:
+        e['giorno'] = str(e['giorno'])[:10]
+        agenda.setdefault(e['giorno'], []).append(e)
+    return agenda
+
+def get_promemoria(solo_attivi: bool = True, cliente_id: str = None,
+                   data_da: str = None, data_a: str = None,
+                   priorita: str = None, tipo: str = None,
+                   limit: int = None) -> List[Dict]:
+    """Ottiene i promemoria, ordinati per scadenza
+
+    Un promemoria ricorrente compare una volta, con data_scadenza (e
+    data_originale) della prima occorrenza non ancora completata; serie
+    esaurite escluse con solo_attivi. La finestra [data_da, data_a] (estremi
+    inclusi, ciascuno opzionale) si applica a questa data; priorita, tipo e
+    limit filtrano in SQL, così il costo segue la finestra e non l'arretrato:
+    le serie si espandono solo fino a data_a (o all'ultima scadenza entro
+    limit) e le loro eccezioni si leggono con una sola query.
+    """
     conn = get_connection()
     try:
         query = """
             SELECT p.*, c.ragione_sociale AS cliente_nome
             FROM promemoria p
             LEFT JOIN clienti c ON p.cliente_id = c.id
-            WHERE 1=1
+            WHERE {serie}
         """
         params = []
         
@@ -820,16 +3462,120 @@ def get_promemoria(solo_attivi: bool = True, cliente_id: str = None) -> List[Dic
             query += " AND p.cliente_id = ?"
             params.append(cliente_id)
         
+        if priorita:
+            query += " AND p.priorita = ?"
+            params.append(priorita)
+        
+        if tipo:
+            query += " AND p.tipo = ?"
+            params.append(tipo)
+        
+        # le serie iniziano entro la finestra e non finiscono prima
+        query_serie = query.format(serie="p.ricorrenza IS NOT NULL")
+        params_serie = list(params)
+        if data_a:
+            query_serie += " AND p.data_scadenza <= ?"
+            params_serie.append(data_a)
+        if data_da:
+            query_serie += " AND (p.ricorrenza_fine IS NULL OR p.ricorrenza_fine >= ?)"
+            params_serie.append(data_da)
+        
+        query = query.format(serie="p.ricorrenza IS NULL")
+        if data_da:
+            query += " AND p.data_scadenza >= ?"
+            params.append(data_da)
+        if data_a:
+            # data_scadenza può avere anche l'ora: confronto col giorno dopo
+            query += " AND p.data_scadenza < ?"
+            params.append((_come_data(data_a) + timedelta(days=1)).isoformat())
         query += " ORDER BY p.data_scadenza ASC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
         
-        rows = conn.execute(query, params).fetchall()
-        return rows_to_list(rows)
+        promemoria = rows_to_list(conn.execute(query, params).fetchall())
+        # con limit raggiunto contano solo le serie con un'occorrenza entro l'ultima scadenza letta
+        fino_al = data_a[:10] if data_a else None
+        if limit and len(promemoria) >= int(limit):
+            ultima = str(promemoria[-1]['data_scadenza'])[:10]
+            fino_al = min(fino_al, ultima) if fino_al else ultima
+            query_serie += " AND p.data_scadenza <= ?"
+            params_serie.append(fino_al)
+        serie = rows_to_list(conn.execute(query_serie, params_serie).fetchall())
+        chiuse = _occorrenze_chiuse(conn, [p['id'] for p in serie], fino_al)
+        for p in serie:
+            prossima = _prossima_occorrenza_aperta(conn, p, chiuse.get(p['id'], set()), fino_al)
+            if prossima is None and (solo_attivi or fino_al):
+                continue
+            if prossima:
+                if data_da and prossima < data_da:
+                    continue
+                p['data_scadenza'] = p['data_originale'] = prossima
+            p['ricorrente'] = 1
+            promemoria.append(p)
+        promemoria.sort(key=lambda p: str(p['data_scadenza'])[:10])
+        return promemoria[:limit] if limit else promemoria
+    finally:
+        conn.close()
+
+
+def _conteggi_promemoria(conn, oggi: date = None) -> Dict[str, int]:
+    """Promemoria aperti scaduti, in scadenza oggi e nei 7 giorni successivi.
+
+    Una sola query raggruppata sull'indice (completato, data_scadenza); le
+    serie ricorrenti contano alla loro prima occorrenza aperta.
+    """
+    oggi = oggi or date.today()
+    domani = (oggi + timedelta(days=1)).isoformat()
+    fine = (oggi + timedelta(days=8)).isoformat()
+    conteggi = {'scaduti': 0, 'oggi': 0, 'prossimi_7': 0}
+    rows = conn.execute("""
+        SELECT CASE
+                   WHEN data_scadenza < ? THEN 'scaduti'
+                   WHEN data_scadenza < ? THEN 'oggi'
+                   ELSE 'prossimi_7'
+               END AS gruppo,
+               COUNT(*) AS cnt
+        FROM promemoria
+        WHERE completato = 0 AND data_scadenza < ? AND ricorrenza IS NULL
+        GROUP BY 1
+    """, (oggi.isoformat(), domani, fine)).fetchall()
+    for r in rows:
+        conteggi[r['gruppo']] = r['cnt']
+    ultimo = (oggi + timedelta(days=7)).isoformat()
+    serie = rows_to_list(conn.execute("""
+        SELECT id, data_scadenza, ricorrenza, ricorrenza_fine FROM promemoria
+        WHERE ricorrenza IS NOT NULL AND completato = 0 AND data_scadenza < ?
+    """, (fine,)).fetchall())
+    chiuse = _occorrenze_chiuse(conn, [s['id'] for s in serie], ultimo)
+    for s in serie:
+        prossima = _prossima_occorrenza_aperta(conn, s, chiuse.get(s['id'], set()), ultimo)
+        if prossima is None:
+            continue
+        if prossima < oggi.isoformat():
+            conteggi['scaduti'] += 1
+        elif prossima < domani:
+            conteggi['oggi'] += 1
+        else:
+            conteggi['prossimi_7'] += 1
+    return conteggi
+
+
+def get_conteggi_promemoria(oggi: date = None) -> Dict[str, int]:
+    """Conteggi per i badge dei promemoria: {'scaduti', 'oggi', 'prossimi_7'}"""
+    conn = get_connection()
+    try:
+        return _conteggi_promemoria(conn, oggi)
     finally:
         conn.close()
 
 
 def save_promemoria(data: Dict) -> str:
-    """Salva o aggiorna un promemoria"""
+    """Salva o aggiorna un promemoria ('ricorrenza': regola RRULE dalla data_scadenza)"""
+    if 'ricorrenza' in data:
+        data = dict(data, ricorrenza=data['ricorrenza'] or None)
+        if data['ricorrenza']:
+            parse_ricorrenza(data['ricorrenza'])
     conn = get_connection()
     try:
         if 'id' in data and data['id']:
@@ -855,6 +3601,7 @@ def save_promemoria(data: Dict) -> str:
             placeholders = ', '.join(['?' for _ in fields])
             query = f"INSERT INTO promemoria ({', '.join(fields)}) VALUES ({placeholders})"
             conn.execute(query, list(insert_data.values()))
+        _aggiorna_serie(conn, 'promemoria', promemoria_id)
         
         conn.commit()
         return promemoria_id
@@ -862,10 +3609,23 @@ def save_promemoria(data: Dict) -> str:
         conn.close()
 
 
-def completa_promemoria(promemoria_id: str) -> bool:
-    """Segna un promemoria come completato"""
+def completa_promemoria(promemoria_id: str, data_originale: str = None) -> bool:
+    """Segna un promemoria come completato
+
+    Per un promemoria ricorrente si completa una sola occorrenza:
+    data_originale, o in mancanza la prima ancora aperta.
+    """
     conn = get_connection()
     try:
+        serie = conn.execute("SELECT * FROM promemoria WHERE id = ?", (promemoria_id,)).fetchone()
+        if serie and serie['ricorrenza']:
+            data_originale = data_originale or _prossima_occorrenza_aperta(conn, dict(serie))
+            if not data_originale:
+                return False
+            _salva_eccezione(conn, 'promemoria', promemoria_id, data_originale,
+                             completata=1, data_completamento=datetime.now().isoformat())
+            conn.commit()
+            return True
         conn.execute("""
             UPDATE promemoria 
             SET completato = 1, data_completamento = ? 
@@ -882,6 +3642,7 @@ def delete_promemoria(promemoria_id: str) -> bool:
     conn = get_connection()
     try:
         conn.execute("DELETE FROM promemoria WHERE id = ?", (promemoria_id,))
+        _elimina_serie(conn, 'promemoria', promemoria_id)
         conn.commit()
         return True
     finally:
@@ -898,7 +3659,8 @@ def get_visite_pianificate(data_da: str = None, data_a: str = None, solo_non_com
     try:
         query = """
             SELECT vp.*, c.ragione_sociale AS cliente_nome, c.indirizzo AS cliente_indirizzo,
-                   c.citta AS cliente_citta, c.provincia AS cliente_provincia, c.telefono AS cliente_telefono
+                   c.citta AS cliente_citta, c.provincia AS cliente_provincia, c.telefono AS cliente_telefono,
+                   c.latitudine AS cliente_latitudine, c.longitudine AS cliente_longitudine
             FROM visite_pianificate vp
             LEFT JOIN clienti c ON vp.cliente_id = c.id
             WHERE 1=1
@@ -924,16 +3686,23 @@ def get_visite_pianificate(data_da: str = None, data_a: str = None, solo_non_com
         conn.close()
 
 
-def save_visita_pianificata(data: Dict) -> str:
-    """Salva una visita pianificata"""
+def save_visita_pianificata(data: Dict, consenti_conflitti: bool = True) -> str:
+    """Salva una visita pianificata
+
+    Con consenti_conflitti=False rifiuta (ValueError) una visita che si
+    sovrappone ad altri impegni del giorno.
+    """
     conn = get_connection()
     try:
+        if not consenti_conflitti:
+            _verifica_conflitti(conn, 'visita', data)
         if 'id' in data and data['id']:
             visita_id = data['id']
             fields = []
             values = []
             for key, value in data.items():
-                if key != 'id' and key != 'created_at' and not key.startswith('cliente_'):
+                # i campi cliente_* diversi da cliente_id arrivano dalla join con clienti
+                if key != 'id' and key != 'created_at' and (key == 'cliente_id' or not key.startswith('cliente_')):
                     fields.append(f"{key} = ?")
                     values.append(value)
             values.append(visita_id)
@@ -945,12 +3714,13 @@ def save_visita_pianificata(data: Dict) -> str:
             data['id'] = visita_id
             data['created_at'] = datetime.now().isoformat()
             
-            insert_data = {k: v for k, v in data.items() if not k.startswith('cliente_')}
+            insert_data = {k: v for k, v in data.items() if k == 'cliente_id' or not k.startswith('cliente_')}
             
             fields = list(insert_data.keys())
             placeholders = ', '.join(['?' for _ in fields])
             query = f"INSERT INTO visite_pianificate ({', '.join(fields)}) VALUES ({placeholders})"
             conn.execute(query, list(insert_data.values()))
+        _aggiorna_slot(conn, 'visita', visita_id)
         
         conn.commit()
         return visita_id
@@ -958,6 +3728,275 @@ def save_visita_pianificata(data: Dict) -> str:
         conn.close()
 
 
+# ============================================
+# SLOT AGENDA (sovrapposizioni e orari liberi)
+# ============================================
+
+# Impegni con orario (appuntamenti singoli, visite pianificate) indicizzati
+# come intervalli [inizio, fine) in minuti dal 1970-01-01: su SQLite un
+# R*Tree a interi (impegni_slot), su PostgreSQL una tabella con indici.
+# Le serie ricorrenti non sono nell'indice: si espandono sul giorno cercato.
+_EPOCA_SLOT = date(1970, 1, 1)
+_MINUTI_GIORNO = 1440
+
+_TABELLE_IMPEGNI = {
+    'appuntamento': 'appuntamenti',
+    'visita': 'visite_pianificate',
+}
+
+# Orizzonte (giorni) su cui si verificano le sovrapposizioni di una serie ricorrente
+GIORNI_VERIFICA_RICORRENZA = 365
+# Distanza (minuti) tra le proposte di suggerisci_slot dentro la stessa fascia libera
+_PASSO_SLOT = 30
+
+
+def _minuto_assoluto(giorno, minuti: int) -> int:
+    return (_come_data(giorno) - _EPOCA_SLOT).days * _MINUTI_GIORNO + minuti
+
+
+def minuti_ora(ora) -> Optional[int]:
+    """'HH:MM' (o 'HH:MM:SS') -> minuti dalla mezzanotte; None se assente o non valida"""
+    if not ora:
+        return None
+    try:
+        hh, mm = str(ora).split(':')[:2]
+        return int(hh) * 60 + int(mm)
+    except ValueError:
+        return None
+
+
+def _ora_da_minuti(minuti: int) -> str:
+    minuti %= _MINUTI_GIORNO
+    return f"{minuti // 60:02d}:{minuti % 60:02d}"
+
+
+def _durate_default(conn) -> Dict[str, int]:
+    return {
+        'appuntamento': int(_get_impostazione(conn, 'agenda_durata_appuntamento', '60') or 60),
+        'visita': int(_get_impostazione(conn, 'percorso_durata_visita', '30') or 30),
+    }
+
+
+def _intervallo_impegno(tipo: str, row: Dict, durate: Dict[str, int]) -> Optional[Tuple[int, int]]:
+    """[inizio, fine) in minuti assoluti; None per impegni senza orario o ricorrenti"""
+    if tipo == 'appuntamento':
+        inizio = minuti_ora(row.get('ora'))
+        if inizio is None or row.get('ricorrenza') or not row.get('data'):
+            return None
+        fine = inizio + (row.get('durata_minuti') or durate['appuntamento'])
+        giorno = row['data']
+    else:
+        inizio = minuti_ora(row.get('ora_inizio'))
+        if inizio is None or not row.get('data_pianificata'):
+            return None
+        fine = minuti_ora(row.get('ora_fine'))
+        if fine is None or fine <= inizio:
+            fine = inizio + durate['visita']
+        giorno = row['data_pianificata']
+    return _minuto_assoluto(giorno, inizio), _minuto_assoluto(giorno, fine)
+
+
+def _scrivi_slot(conn, tipo: str, rif_id: str, intervallo: Optional[Tuple[int, int]]) -> None:
+    conn.execute("""
+        DELETE FROM impegni_slot
+        WHERE id = (SELECT slot_id FROM impegni_slot_id WHERE tipo = ? AND rif_id = ?)
+    """, (tipo, rif_id))
+    if intervallo is None:
+        conn.execute("DELETE FROM impegni_slot_id WHERE tipo = ? AND rif_id = ?", (tipo, rif_id))
+        return
+    conn.execute("""
+        INSERT INTO impegni_slot_id (tipo, rif_id) VALUES (?, ?)
+        ON CONFLICT(tipo, rif_id) DO NOTHING
+    """, (tipo, rif_id))
+    slot_id = conn.execute("SELECT slot_id FROM impegni_slot_id WHERE tipo = ? AND rif_id = ?",
+                           (tipo, rif_id)).fetchone()['slot_id']
+    conn.execute("INSERT INTO impegni_slot (id, inizio, fine) VALUES (?, ?, ?)", (slot_id, *intervallo))
+
+
+def _aggiorna_slot(conn, tipo: str, rif_id: str) -> None:
+    """Riallinea l'intervallo di un impegno dopo salvataggio o eliminazione (senza commit)"""
+    row = conn.execute(f"SELECT * FROM {_TABELLE_IMPEGNI[tipo]} WHERE id = ?", (rif_id,)).fetchone()
+    _scrivi_slot(conn, tipo, rif_id, _intervallo_impegno(tipo, dict(row), _durate_default(conn)) if row else None)
+
+
+def _ricostruisci_slot(conn) -> None:
+    """Ricostruisce l'indice degli intervalli da appuntamenti e visite (senza commit)"""
+    conn.execute("DELETE FROM impegni_slot")
+    conn.execute("DELETE FROM impegni_slot_id")
+    durate = _durate_default(conn)
+    intervalli = {}
+    for tipo, tabella in _TABELLE_IMPEGNI.items():
+        for row in conn.execute(f"SELECT * FROM {tabella}").fetchall():
+            intervallo = _intervallo_impegno(tipo, dict(row), durate)
+            if intervallo:
+                intervalli[(tipo, row['id'])] = intervallo
+    conn.executemany("INSERT INTO impegni_slot_id (tipo, rif_id) VALUES (?, ?)", list(intervalli))
+    conn.executemany("INSERT INTO impegni_slot (id, inizio, fine) VALUES (?, ?, ?)", [
+        (r['slot_id'], *intervalli[(r['tipo'], r['rif_id'])])
+        for r in conn.execute("SELECT slot_id, tipo, rif_id FROM impegni_slot_id").fetchall()
+    ])
+
+
+def _impegni_tra(conn, inizio: int, fine: int, escludi: Tuple[str, str] = None) -> List[Dict]:
+    """Impegni che si sovrappongono a [inizio, fine) (minuti assoluti), in ordine di inizio"""
+    impegni = [dict(r) for r in conn.execute("""
+        SELECT si.tipo, si.rif_id AS id, s.inizio, s.fine
+        FROM impegni_slot s
+        JOIN impegni_slot_id si ON si.slot_id = s.id
+        WHERE s.inizio < ? AND s.fine > ?
+    """, (fine, inizio)).fetchall()]
+
+    # serie ricorrenti: istanze dei soli giorni coinvolti
+    durate = _durate_default(conn)
+    giorno_da = _EPOCA_SLOT + timedelta(days=inizio // _MINUTI_GIORNO)
+    giorno_a = _EPOCA_SLOT + timedelta(days=(fine - 1) // _MINUTI_GIORNO)
+    titoli = {}
+    for a in _istanze_ricorrenti(conn, 'appuntamento', giorno_da.isoformat(), giorno_a.isoformat()):
+        intervallo = _intervallo_impegno('appuntamento', dict(a, ricorrenza=None), durate)
+        if intervallo and intervallo[0] < fine and intervallo[1] > inizio:
+            impegni.append({'tipo': 'appuntamento', 'id': a['id'], 'inizio': intervallo[0], 'fine': intervallo[1]})
+            titoli[('appuntamento', a['id'])] = (a['titolo'], a['cliente_nome'])
+
+    if escludi:
+        impegni = [i for i in impegni if (i['tipo'], i['id']) != tuple(escludi)]
+    ids_app = [i['id'] for i in impegni if i['tipo'] == 'appuntamento' and ('appuntamento', i['id']) not in titoli]
+    ids_vis = [i['id'] for i in impegni if i['tipo'] == 'visita']
+    if ids_app:
+        for r in conn.execute(f"""
+            SELECT a.id, a.titolo, c.ragione_sociale AS cliente_nome FROM appuntamenti a
+            LEFT JOIN clienti c ON c.id = a.cliente_id WHERE a.id IN ({', '.join('?' for _ in ids_app)})
+        """, ids_app).fetchall():
+            titoli[('appuntamento', r['id'])] = (r['titolo'], r['cliente_nome'])
+    if ids_vis:
+        for r in conn.execute(f"""
+            SELECT vp.id, COALESCE(NULLIF(vp.note, ''), vp.tipo, 'visita') AS titolo, c.ragione_sociale AS cliente_nome
+            FROM visite_pianificate vp
+            LEFT JOIN clienti c ON c.id = vp.cliente_id WHERE vp.id IN ({', '.join('?' for _ in ids_vis)})
+        """, ids_vis).fetchall():
+            titoli[('visita', r['id'])] = (r['titolo'], r['cliente_nome'])
+    for i in impegni:
+        i['titolo'], i['cliente_nome'] = titoli.get((i['tipo'], i['id']), (None, None))
+        i['giorno'] = (_EPOCA_SLOT + timedelta(days=i['inizio'] // _MINUTI_GIORNO)).isoformat()
+        i['ora_inizio'] = _ora_da_minuti(i['inizio'])
+        i['ora_fine'] = _ora_da_minuti(i['fine'])
+    impegni.sort(key=lambda i: (i['inizio'], i['fine']))
+    return impegni
+
+
+def _verifica_conflitti(conn, tipo: str, data: Dict) -> None:
+    """ValueError se l'impegno (nuovo o modificato, anche parzialmente) si sovrappone ad altri"""
+    row = dict(data)
+    if data.get('id'):
+        esistente = conn.execute(f"SELECT * FROM {_TABELLE_IMPEGNI[tipo]} WHERE id = ?", (data['id'],)).fetchone()
+        if esistente:
+            row = dict(dict(esistente), **data)
+    durate = _durate_default(conn)
+    if tipo == 'appuntamento' and row.get('ricorrenza'):
+        # serie: si controllano le occorrenze dei prossimi GIORNI_VERIFICA_RICORRENZA giorni
+        if minuti_ora(row.get('ora')) is None or not row.get('data'):
+            return
+        inizio = _come_data(row['data'])
+        da = max(inizio, date.today())
+        intervalli = [_intervallo_impegno(tipo, dict(row, ricorrenza=None, data=g.isoformat()), durate)
+                      for g in occorrenze_ricorrenza(row['ricorrenza'], inizio, da,
+                                                     da + timedelta(days=GIORNI_VERIFICA_RICORRENZA - 1))]
+    else:
+        intervalli = [_intervallo_impegno(tipo, row, durate)]
+    intervalli = [i for i in intervalli if i]
+    if not intervalli:
+        return
+    candidati = _impegni_tra(conn, intervalli[0][0], max(f for _, f in intervalli), escludi=(tipo, data.get('id')))
+    conflitti = [c for c in candidati if any(c['inizio'] < f and c['fine'] > i for i, f in intervalli)]
+    if conflitti:
+        giorno = len(intervalli) > 1
+        elenco = ', '.join(f"{c['giorno'] + ' ' if giorno else ''}{c['ora_inizio']}-{c['ora_fine']} "
+                           f"{c['cliente_nome'] or c['titolo'] or c['tipo']}" for c in conflitti[:5])
+        if len(conflitti) > 5:
+            elenco += f" e altri {len(conflitti) - 5}"
+        raise ValueError(f"Sovrapposizione con: {elenco}")
+
+
+def get_conflitti(giorno: str, ora_inizio: str, ora_fine: str = None, durata_minuti: int = None,
+                  escludi_tipo: str = None, escludi_id: str = None) -> List[Dict]:
+    """Impegni (appuntamenti e visite) che si sovrappongono alla fascia indicata.
+
+    Args:
+        ora_fine / durata_minuti: fine della fascia (default: durata appuntamento da impostazioni)
+        escludi_tipo, escludi_id: l'impegno che si sta modificando
+
+    Returns:
+        [{tipo, id, titolo, cliente_nome, giorno, ora_inizio, ora_fine}] in ordine di inizio
+    """
+    conn = get_connection()
+    try:
+        inizio = minuti_ora(ora_inizio)
+        if inizio is None:
+            return []
+        fine = minuti_ora(ora_fine)
+        if fine is None or fine <= inizio:
+            fine = inizio + (durata_minuti or _durate_default(conn)['appuntamento'])
+        escludi = (escludi_tipo, escludi_id) if escludi_id else None
+        conflitti = _impegni_tra(conn, _minuto_assoluto(giorno, inizio), _minuto_assoluto(giorno, fine), escludi)
+        conn.commit()
+        return conflitti
+    finally:
+        conn.close()
+
+
+def suggerisci_slot(giorno: str, durata_minuti: int = None, ora_preferita: str = None, giorni: int = 1,
+                    solo_feriali: bool = True, max_risultati: int = 5) -> List[Dict]:
+    """Fasce libere di durata_minuti più vicine all'ora preferita.
+
+    Cerca nel giorno indicato (giorni=1) o nei `giorni` successivi (es. 7 per
+    la settimana), dentro l'orario di lavoro (impostazioni agenda_ora_inizio
+    e agenda_ora_fine). Le fasce sono ordinate per distanza dall'ora
+    preferita, a partire dal giorno indicato.
+
+    Returns:
+        [{giorno, ora_inizio, ora_fine}]
+    """
+    conn = get_connection()
+    try:
+        apertura = minuti_ora(_get_impostazione(conn, 'agenda_ora_inizio', '08:30')) or 0
+        chiusura = minuti_ora(_get_impostazione(conn, 'agenda_ora_fine', '19:00')) or _MINUTI_GIORNO
+        durata = durata_minuti or _durate_default(conn)['appuntamento']
+        preferita = minuti_ora(ora_preferita)
+        preferita = apertura if preferita is None else preferita
+        primo = _come_data(giorno)
+        impegni = _impegni_tra(conn, _minuto_assoluto(primo, 0), _minuto_assoluto(primo, giorni * _MINUTI_GIORNO))
+        conn.commit()
+    finally:
+        conn.close()
+
+    candidati = []
+    for n in range(giorni):
+        d = primo + timedelta(days=n)
+        if solo_feriali and d.weekday() >= 5:
+            continue
+        base = _minuto_assoluto(d, 0)
+        occupati = sorted((i['inizio'] - base, i['fine'] - base) for i in impegni
+                          if i['inizio'] < base + _MINUTI_GIORNO and i['fine'] > base)
+        libero_da = apertura
+        for inizio, fine in occupati + [(chiusura, chiusura)]:
+            fine_buco = min(inizio, chiusura)
+            # inizio arrotondato ai 5 minuti
+            libero_da = -(-libero_da // 5) * 5
+            if fine_buco - libero_da >= durata:
+                ultimo = fine_buco - durata
+                ultimo -= ultimo % 5  # libero_da è multiplo di 5: si resta nella fascia
+                vicino = min(max(preferita - preferita % 5, libero_da), ultimo)
+                # più proposte per fascia: bordi e una ogni _PASSO_SLOT minuti attorno all'ora preferita
+                starts = {libero_da, ultimo}
+                starts.update(range(vicino, libero_da - 1, -_PASSO_SLOT))
+                starts.update(range(vicino, ultimo + 1, _PASSO_SLOT))
+                candidati.extend((n * _MINUTI_GIORNO + abs(start - preferita), d.isoformat(), start)
+                                 for start in starts)
+            libero_da = max(libero_da, fine)
+    candidati.sort()
+    return [{'giorno': g, 'ora_inizio': _ora_da_minuti(m), 'ora_fine': _ora_da_minuti(m + durata)}
+            for _, g, m in candidati[:max_risultati]]
+
+
 # ============================================
 # AGENTE
 # ============================================
@@ -1010,6 +4049,173 @@ def save_agente(data: Dict) -> str:
         conn.close()
 
 
+# ============================================
+# CHANGE LOG (CDC)
+# ============================================
+
+# Tabelle tracciate dai trigger di schema.sql
+# (cliente_prodotto_pref ha row_id composto: cliente_id|azienda_id|prodotto_id)
+CHANGE_LOG_TABELLE = ('aziende', 'clienti', 'prodotti', 'ordini', 'ordini_righe', 'promemoria', 'appuntamenti',
+                      'cliente_prodotto_pref')
+
+
+# Chiave dell'advisory lock che serializza l'assegnazione delle seq (PostgreSQL)
+_LOCK_CHANGE_LOG = 7213001
+
+
+def _sigilla_change_log() -> None:
+    """PostgreSQL: assegna seq alle modifiche già confermate, in ordine di commit.
+
+    Le righe di transazioni ancora in corso non sono visibili e restano NULL:
+    riceveranno una seq più alta quando saranno confermate, quindi nessun
+    consumatore può superarle con il proprio checkpoint. Su SQLite le scritture
+    sono serializzate e seq (assegnata all'inserimento) segue già l'ordine di commit.
+    """
+    if storage.is_sqlite():
+        return
+    conn = get_connection()
+    try:
+        if not conn.execute("SELECT 1 FROM change_log WHERE seq IS NULL LIMIT 1").fetchone():
+            return
+        # un'assegnazione alla volta: quella successiva vede le seq già confermate
+        conn.execute("SELECT pg_advisory_xact_lock(?)", (_LOCK_CHANGE_LOG,))
+        conn.execute("""
+            UPDATE change_log c SET seq = n.seq
+            FROM (SELECT id, nextval('change_log_commit_seq') AS seq
+                  FROM (SELECT id FROM change_log WHERE seq IS NULL ORDER BY id) d) n
+            WHERE c.id = n.id
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_ultima_seq() -> int:
+    """Ultima sequenza assegnata nel change log (checkpoint iniziale per un export completo)"""
+    _sigilla_change_log()
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM change_log").fetchone()
+        return int(row['seq'])
+    finally:
+        conn.close()
+
+
+def get_changes_since(seq: int = 0, tabelle: List[str] = None, limit: int = None) -> Dict[str, Any]:
+    """Modifiche successive alla sequenza seq (esclusa), in ordine di sequenza.
+
+    Per ogni riga restituisce solo l'ultima operazione (I/U/D): il consumatore
+    rilegge lo stato attuale delle righe I/U e rimuove le righe D.
+
+    Returns:
+        dict con:
+        - 'changes': lista di {seq, tabella, row_id, operazione, changed_at}
+        - 'seq': nuovo checkpoint da passare alla chiamata successiva
+        - 'altre': True se limit ha troncato il risultato (richiamare subito)
+        - 'resync': True se seq è anteriore alle modifiche conservate
+          (checkpoint 0 o change log compattato): serve un export completo
+    """
+    tabelle = [t for t in (tabelle or CHANGE_LOG_TABELLE) if t in CHANGE_LOG_TABELLE]
+    if not tabelle:
+        return {'changes': [], 'seq': seq, 'altre': False, 'resync': False}
+
+    _sigilla_change_log()
+    conn = get_connection()
+    try:
+        watermark = int(_get_impostazione(conn, 'change_log_watermark', '0') or 0)
+        ultima = int(conn.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM change_log").fetchone()['seq'])
+
+        placeholders = ', '.join(['?' for _ in tabelle])
+        query = f"""
+            SELECT c.seq, c.tabella, c.row_id, c.operazione, c.changed_at
+            FROM change_log c
+            WHERE c.seq > ?
+              AND c.tabella IN ({placeholders})
+              AND NOT EXISTS (
+                  SELECT 1 FROM change_log c2
+                  WHERE c2.tabella = c.tabella AND c2.row_id = c.row_id AND c2.seq > c.seq
+              )
+            ORDER BY c.seq
+        """
+        params: List[Any] = [seq] + tabelle
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit) + 1)
+
+        changes = rows_to_list(conn.execute(query, params).fetchall())
+        altre = bool(limit) and len(changes) > int(limit)
+        if altre:
+            changes = changes[:int(limit)]
+            nuovo_seq = changes[-1]['seq']
+        else:
+            nuovo_seq = max(ultima, seq)
+
+        return {
+            'changes': changes,
+            'seq': nuovo_seq,
+            'altre': altre,
+            'resync': seq <= 0 or seq < watermark,
+        }
+    finally:
+        conn.close()
+
+
+def compatta_change_log(giorni_compattazione: int = None, giorni_cancellazioni: int = None) -> Dict[str, int]:
+    """Compattazione del change log.
+
+    1. Per le modifiche più vecchie di giorni_compattazione tiene solo l'ultima
+       operazione per riga (per i consumatori non cambia nulla: leggono comunque
+       solo l'ultima operazione).
+    2. Elimina le cancellazioni (D) più vecchie di giorni_cancellazioni e alza il
+       watermark: chi ha un checkpoint inferiore riceverà resync=True.
+
+    I default arrivano da impostazioni (change_log_giorni_*).
+    """
+    _sigilla_change_log()
+    conn = get_connection()
+    try:
+        if giorni_compattazione is None:
+            giorni_compattazione = int(_get_impostazione(conn, 'change_log_giorni_compattazione', '7'))
+        if giorni_cancellazioni is None:
+            giorni_cancellazioni = int(_get_impostazione(conn, 'change_log_giorni_cancellazioni', '90'))
+
+        # changed_at è CURRENT_TIMESTAMP (UTC, 'YYYY-MM-DD HH:MM:SS')
+        adesso = datetime.utcnow()
+        soglia_comp = (adesso - timedelta(days=giorni_compattazione)).strftime('%Y-%m-%d %H:%M:%S')
+        soglia_canc = (adesso - timedelta(days=giorni_cancellazioni)).strftime('%Y-%m-%d %H:%M:%S')
+
+        conn.execute("BEGIN")
+        cur = conn.execute("""
+            DELETE FROM change_log
+            WHERE changed_at < ?
+              AND EXISTS (
+                  SELECT 1 FROM change_log c2
+                  WHERE c2.tabella = change_log.tabella
+                    AND c2.row_id = change_log.row_id
+                    AND c2.seq > change_log.seq
+              )
+        """, (soglia_comp,))
+        compattate = cur.rowcount
+
+        row = conn.execute("""
+            SELECT MAX(seq) AS seq FROM change_log WHERE operazione = 'D' AND changed_at < ?
+        """, (soglia_canc,)).fetchone()
+        cancellate = 0
+        if row and row['seq'] is not None:
+            cur = conn.execute("DELETE FROM change_log WHERE operazione = 'D' AND changed_at < ?", (soglia_canc,))
+            cancellate = cur.rowcount
+            watermark = int(_get_impostazione(conn, 'change_log_watermark', '0') or 0)
+            _set_impostazione(conn, 'change_log_watermark', str(max(watermark, int(row['seq']))), 'int')
+
+        conn.commit()
+        return {'compattate': compattate, 'cancellazioni_rimosse': cancellate}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
 # ============================================
 # STATISTICHE E REPORT
 # ============================================
@@ -1052,20 +4258,12 @@ def get_statistiche_dashboard() -> Dict:
         stats['ordini_anno'] = row['cnt']
         stats['fatturato_anno'] = row['totale']
         
-        # Promemoria scaduti
+        # Promemoria scaduti / oggi (una sola query raggruppata)
         oggi = date.today().isoformat()
-        row = conn.execute("""
-            SELECT COUNT(*) as cnt FROM promemoria 
-            WHERE completato = 0 AND data_scadenza < ?
-        """, (oggi,)).fetchone()
-        stats['promemoria_scaduti'] = row['cnt']
-        
-        # Promemoria oggi
-        row = conn.execute("""
-            SELECT COUNT(*) as cnt FROM promemoria 
-            WHERE completato = 0 AND data_scadenza = ?
-        """, (oggi,)).fetchone()
-        stats['promemoria_oggi'] = row['cnt']
+        conteggi = _conteggi_promemoria(conn)
+        stats['promemoria_scaduti'] = conteggi['scaduti']
+        stats['promemoria_oggi'] = conteggi['oggi']
+        stats['promemoria_settimana'] = conteggi['prossimi_7']
         
         # Visite oggi
         row = conn.execute("""
@@ -1079,26 +4277,27 @@ def get_statistiche_dashboard() -> Dict:
         conn.close()
 
 
-def get_fatturato_per_azienda(anno: int = None) -> List[Dict]:
+def get_fatturato_per_azienda(anno: int = None, db_path: str = None) -> List[Dict]:
     """Ottiene il fatturato raggruppato per azienda"""
-    conn = get_connection()
+    conn = get_connection(db_path)
     try:
         if anno is None:
             anno = date.today().year
         
         primo_anno = f"{anno}-01-01"
         ultimo_anno = f"{anno}-12-31"
+        src_o, _ = _sorgente_ordini(conn, primo_anno, ultimo_anno)
         
-        rows = conn.execute("""
-            SELECT a.id, a.nome,
+        rows = conn.execute(f"""
+            SELECT a.id, a.nome, a.partita_iva,
                    COUNT(DISTINCT o.id) as num_ordini,
                    COALESCE(SUM(o.totale_finale), 0) as fatturato
             FROM aziende a
-            LEFT JOIN ordini o ON a.id = o.azienda_id 
+            LEFT JOIN {src_o} o ON a.id = o.azienda_id 
                 AND o.data_ordine BETWEEN ? AND ?
                 AND o.stato IN ('inviato', 'confermato', 'evaso')
             WHERE a.attivo = 1
-            GROUP BY a.id, a.nome
+            GROUP BY a.id, a.nome, a.partita_iva
             ORDER BY fatturato DESC
         """, (primo_anno, ultimo_anno)).fetchall()
         
@@ -1127,12 +4326,13 @@ def get_fatturato_mensile_series(mesi: int = 12) -> List[Dict]:
             months.append(f"{yy:04d}-{mm:02d}")
 
         start = f"{months[0]}-01"
+        src_o, _ = _sorgente_ordini(conn, start, None)
 
         rows = conn.execute(
-            """
+            f"""
             SELECT substr(data_ordine, 1, 7) AS ym,
                    COALESCE(SUM(totale_finale), 0) AS fatturato
-            FROM ordini
+            FROM {src_o} o
             WHERE data_ordine >= ?
               AND stato != 'annullato'
             GROUP BY ym
@@ -1150,6 +4350,34 @@ def get_fatturato_mensile_series(mesi: int = 12) -> List[Dict]:
         conn.close()
 
 
+def get_fatturato_mensile_per_azienda(data_da: str = None, data_a: str = None) -> List[Dict]:
+    """Fatturato per azienda e mese (stesso criterio di get_fatturato_mensile_series), archivi compresi.
+
+    Returns:
+        lista di {azienda_id, mese (YYYY-MM), fatturato} ordinata per azienda e mese
+    """
+    conn = get_connection()
+    try:
+        src_o, _ = _sorgente_ordini(conn, data_da, data_a, includi_archivio=None if data_da else True)
+        query = f"""
+            SELECT azienda_id, substr(data_ordine, 1, 7) AS mese,
+                   COALESCE(SUM(totale_finale), 0) AS fatturato
+            FROM {src_o} o
+            WHERE stato != 'annullato'
+        """
+        params = []
+        if data_da:
+            query += " AND data_ordine >= ?"
+            params.append(data_da)
+        if data_a:
+            query += " AND data_ordine <= ?"
+            params.append(data_a)
+        query += " GROUP BY azienda_id, substr(data_ordine, 1, 7) ORDER BY azienda_id, mese"
+        return rows_to_list(conn.execute(query, params).fetchall())
+    finally:
+        conn.close()
+
+
 def get_ordini_stato_counts_current_month() -> List[Dict]:
     """Conteggio ordini per stato nel mese corrente."""
     conn = get_connection()
@@ -1171,94 +4399,270 @@ def get_ordini_stato_counts_current_month() -> List[Dict]:
         conn.close()
 
 
-def get_fatturato_per_cliente(anno: int = None, limit: int = 20) -> List[Dict]:
-    """Ottiene il fatturato raggruppato per cliente"""
-    conn = get_connection()
+def get_fatturato_per_cliente(anno: int = None, limit: Optional[int] = 20, db_path: str = None) -> List[Dict]:
+    """Ottiene il fatturato raggruppato per cliente (limit=None: tutti i clienti)"""
+    conn = get_connection(db_path)
     try:
         if anno is None:
             anno = date.today().year
         
         primo_anno = f"{anno}-01-01"
         ultimo_anno = f"{anno}-12-31"
+        src_o, _ = _sorgente_ordini(conn, primo_anno, ultimo_anno)
         
-        rows = conn.execute(f"""
-            SELECT c.id, c.ragione_sociale, c.citta, c.provincia,
+        query = f"""
+            SELECT c.id, c.ragione_sociale, c.citta, c.provincia, c.partita_iva,
                    COUNT(DISTINCT o.id) as num_ordini,
                    COALESCE(SUM(o.totale_finale), 0) as fatturato,
                    MAX(o.data_ordine) as ultimo_ordine
             FROM clienti c
-            LEFT JOIN ordini o ON c.id = o.cliente_id 
+            LEFT JOIN {src_o} o ON c.id = o.cliente_id 
                 AND o.data_ordine BETWEEN ? AND ?
                 AND o.stato IN ('inviato', 'confermato', 'evaso')
             WHERE c.attivo = 1
-            GROUP BY c.id, c.ragione_sociale, c.citta, c.provincia
-            HAVING fatturato > 0
+            GROUP BY c.id, c.ragione_sociale, c.citta, c.provincia, c.partita_iva
+            HAVING COALESCE(SUM(o.totale_finale), 0) > 0
             ORDER BY fatturato DESC
-            LIMIT {limit}
-        """, (primo_anno, ultimo_anno)).fetchall()
+        """
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        rows = conn.execute(query, (primo_anno, ultimo_anno)).fetchall()
         
         return rows_to_list(rows)
     finally:
         conn.close()
 
 
-def get_fatturato_per_mese(anno: int = None) -> List[Dict]:
+def get_fatturato_per_mese(anno: int = None, db_path: str = None) -> List[Dict]:
     """Ottiene il fatturato mensile"""
-    conn = get_connection()
+    conn = get_connection(db_path)
     try:
         if anno is None:
             anno = date.today().year
         
-        rows = conn.execute("""
-            SELECT strftime('%m', data_ordine) as mese,
+        primo_anno = f"{anno}-01-01"
+        ultimo_anno = f"{anno}-12-31"
+        src_o, _ = _sorgente_ordini(conn, primo_anno, ultimo_anno)
+        
+        rows = conn.execute(f"""
+            SELECT substr(data_ordine, 6, 2) as mese,
                    COUNT(*) as num_ordini,
                    SUM(totale_finale) as fatturato
-            FROM ordini
-            WHERE strftime('%Y', data_ordine) = ?
+            FROM {src_o} o
+            WHERE data_ordine BETWEEN ? AND ?
                 AND stato IN ('inviato', 'confermato', 'evaso')
-            GROUP BY strftime('%m', data_ordine)
+            GROUP BY substr(data_ordine, 6, 2)
             ORDER BY mese
-        """, (str(anno),)).fetchall()
+        """, (primo_anno, ultimo_anno)).fetchall()
         
         return rows_to_list(rows)
     finally:
         conn.close()
 
 
-def get_top_prodotti(anno: int = None, limit: int = 10) -> List[Dict]:
-    """Ottiene i prodotti più venduti"""
-    conn = get_connection()
+def get_top_prodotti(anno: int = None, limit: Optional[int] = 10, db_path: str = None) -> List[Dict]:
+    """Ottiene i prodotti più venduti (limit=None: tutti i prodotti venduti)"""
+    conn = get_connection(db_path)
     try:
         if anno is None:
             anno = date.today().year
         
         primo_anno = f"{anno}-01-01"
         ultimo_anno = f"{anno}-12-31"
+        src_o, src_r = _sorgente_ordini(conn, primo_anno, ultimo_anno)
         
-        rows = conn.execute(f"""
-            SELECT p.id, p.codice, p.nome, a.nome as azienda_nome,
+        query = f"""
+            SELECT p.id, p.codice, p.nome, a.nome as azienda_nome, a.partita_iva as azienda_partita_iva,
                    SUM(r.quantita_totale) as quantita_venduta,
                    SUM(r.importo_riga) as fatturato
-            FROM ordini_righe r
-            JOIN ordini o ON r.ordine_id = o.id
+            FROM {src_r} r
+            JOIN {src_o} o ON r.ordine_id = o.id
             JOIN prodotti p ON r.prodotto_id = p.id
             JOIN aziende a ON p.azienda_id = a.id
             WHERE o.data_ordine BETWEEN ? AND ?
                 AND o.stato IN ('inviato', 'confermato', 'evaso')
-            GROUP BY p.id, p.codice, p.nome, a.nome
+            GROUP BY p.id, p.codice, p.nome, a.nome, a.partita_iva
             ORDER BY fatturato DESC
-            LIMIT {limit}
-        """, (primo_anno, ultimo_anno)).fetchall()
+        """
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        rows = conn.execute(query, (primo_anno, ultimo_anno)).fetchall()
         
         return rows_to_list(rows)
     finally:
         conn.close()
 
 
+# Report comparativi: periodo corrente e periodo di confronto in un'unica
+# scansione (aggregazione condizionale sull'indice idx_ordini_stato_data (stato, data_ordine)).
+# Il periodo di confronto è lo stesso intervallo dell'anno prima oppure
+# l'intervallo di pari durata immediatamente precedente.
+
+_ORDINAMENTI_CONFRONTO = {
+    'corrente': "corrente DESC",
+    'crescita': "delta DESC, corrente DESC",
+    'calo': "delta ASC, precedente DESC",
+}
+# stesso ordinamento in Python (per fondere righe calcolate a parte)
+_CHIAVI_CONFRONTO = {
+    'corrente': lambda r: -r['corrente'],
+    'crescita': lambda r: (-r['delta'], -r['corrente']),
+    'calo': lambda r: (r['delta'], -r['precedente']),
+}
+
+
+def _anno_prima(d: date) -> date:
+    try:
+        return d.replace(year=d.year - 1)
+    except ValueError:  # 29 febbraio
+        return d.replace(year=d.year - 1, day=28)
+
+
+def periodo_confronto(data_da: str, data_a: str, confronto: str = 'anno_precedente') -> Tuple[str, str]:
+    """Intervallo di confronto (estremi inclusi, YYYY-MM-DD) per [data_da, data_a].
+
+    confronto: 'anno_precedente' (stesse date un anno prima, es. progressivo
+    anno su progressivo anno scorso) o 'periodo_precedente' (stessa durata,
+    subito prima di data_da).
+    """
+    da = date.fromisoformat(str(data_da)[:10])
+    a = date.fromisoformat(str(data_a)[:10])
+    if confronto == 'anno_precedente':
+        return _anno_prima(da).isoformat(), _anno_prima(a).isoformat()
+    if confronto == 'periodo_precedente':
+        durata = a - da
+        fine = da - timedelta(days=1)
+        return (fine - durata).isoformat(), fine.isoformat()
+    raise ValueError(f"Confronto non valido: {confronto}")
+
+
+def _report_confronto(select: str, from_: str, group_by: str, importo: str, data_da: str, data_a: str,
+                      confronto: str, ordina_per: str, limit: Optional[int], db_path: str,
+                      quantita: str = None) -> List[Dict]:
+    """Esegue un report comparativo: `from_` contiene {src_o}/{src_r} e {periodi} (condizione sulle date)"""
+    if ordina_per not in _ORDINAMENTI_CONFRONTO:
+        raise ValueError(f"Ordinamento non valido: {ordina_per}")
+    data_a = data_a or date.today().isoformat()
+    data_da = data_da or f"{str(data_a)[:4]}-01-01"
+    prec_da, prec_a = periodo_confronto(data_da, data_a, confronto)
+    conn = get_connection(db_path)
+    try:
+        src_o, src_r = _sorgente_ordini(conn, prec_da, data_a)
+        cur = "o.data_ordine BETWEEN ? AND ?"
+        misure = [
+            (f"COUNT(DISTINCT CASE WHEN {cur} THEN o.id END) AS num_ordini", [data_da, data_a]),
+            (f"COUNT(DISTINCT CASE WHEN {cur} THEN o.id END) AS num_ordini_precedente", [prec_da, prec_a]),
+            (f"COALESCE(SUM(CASE WHEN {cur} THEN {importo} ELSE 0 END), 0) AS corrente", [data_da, data_a]),
+            (f"COALESCE(SUM(CASE WHEN {cur} THEN {importo} ELSE 0 END), 0) AS precedente", [prec_da, prec_a]),
+        ]
+        if quantita:
+            misure += [
+                (f"COALESCE(SUM(CASE WHEN {cur} THEN {quantita} ELSE 0 END), 0) AS quantita", [data_da, data_a]),
+                (f"COALESCE(SUM(CASE WHEN {cur} THEN {quantita} ELSE 0 END), 0) AS quantita_precedente", [prec_da, prec_a]),
+            ]
+        periodi = f"({cur} OR {cur})"
+        params = [p for _, ps in misure for p in ps] + [prec_da, prec_a, data_da, data_a]
+        query = f"""
+            SELECT t.*, t.corrente - t.precedente AS delta
+            FROM (
+                SELECT {select}, {', '.join(m for m, _ in misure)}
+                FROM {from_.format(src_o=src_o, src_r=src_r, periodi=periodi)}
+                GROUP BY {group_by}
+            ) t
+            ORDER BY {_ORDINAMENTI_CONFRONTO[ordina_per]}
+        """
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        out = []
+        for r in conn.execute(query, params).fetchall():
+            riga = dict(r)
+            riga['delta_pct'] = round(riga['delta'] / riga['precedente'] * 100, 1) if riga['precedente'] else None
+            out.append(riga)
+        return out
+    finally:
+        conn.close()
+
+
+def get_confronto_fatturato_per_azienda(data_da: str = None, data_a: str = None,
+                                        confronto: str = 'anno_precedente', ordina_per: str = 'corrente',
+                                        db_path: str = None) -> List[Dict]:
+    """Fatturato per azienda nel periodo e nel periodo di confronto (default: da inizio anno a oggi).
+
+    Returns:
+        per azienda attiva: corrente, precedente, delta, delta_pct (None se
+        precedente = 0), num_ordini, num_ordini_precedente
+    """
+    righe = _report_confronto(
+        select="a.id, a.nome, a.partita_iva",
+        from_="""{src_o} o
+                JOIN aziende a ON a.id = o.azienda_id
+                WHERE {periodi}
+                    AND o.stato IN ('inviato', 'confermato', 'evaso')
+                    AND a.attivo = 1""",
+        group_by="a.id, a.nome, a.partita_iva",
+        importo="o.totale_finale",
+        data_da=data_da, data_a=data_a, confronto=confronto, ordina_per=ordina_per,
+        limit=None, db_path=db_path,
+    )
+    # aziende senza ordini in entrambi i periodi (come get_fatturato_per_azienda)
+    presenti = {r['id'] for r in righe}
+    conn = get_connection(db_path)
+    try:
+        vuote = [dict(r) for r in conn.execute(
+            "SELECT id, nome, partita_iva FROM aziende WHERE attivo = 1 ORDER BY nome").fetchall()
+            if r['id'] not in presenti]
+    finally:
+        conn.close()
+    zero = {'num_ordini': 0, 'num_ordini_precedente': 0, 'corrente': 0, 'precedente': 0, 'delta': 0, 'delta_pct': None}
+    return sorted(righe + [{**a, **zero} for a in vuote], key=_CHIAVI_CONFRONTO[ordina_per])
+
+
+def get_confronto_fatturato_per_cliente(data_da: str = None, data_a: str = None,
+                                        confronto: str = 'anno_precedente', ordina_per: str = 'corrente',
+                                        limit: Optional[int] = 20, db_path: str = None) -> List[Dict]:
+    """Fatturato per cliente nei due periodi.
+
+    ordina_per: 'corrente' (fatturato del periodo), 'crescita' (delta maggiore),
+    'calo' (delta minore: clienti in calo o persi)
+    """
+    return _report_confronto(
+        select="c.id, c.ragione_sociale, c.citta, c.provincia, c.partita_iva, MAX(o.data_ordine) AS ultimo_ordine",
+        from_="""{src_o} o
+                JOIN clienti c ON c.id = o.cliente_id
+                WHERE {periodi}
+                    AND o.stato IN ('inviato', 'confermato', 'evaso')
+                    AND c.attivo = 1""",
+        group_by="c.id, c.ragione_sociale, c.citta, c.provincia, c.partita_iva",
+        importo="o.totale_finale",
+        data_da=data_da, data_a=data_a, confronto=confronto, ordina_per=ordina_per,
+        limit=limit, db_path=db_path,
+    )
+
+
+def get_confronto_top_prodotti(data_da: str = None, data_a: str = None,
+                               confronto: str = 'anno_precedente', ordina_per: str = 'corrente',
+                               limit: Optional[int] = 10, db_path: str = None) -> List[Dict]:
+    """Prodotti venduti nei due periodi (fatturato righe e quantità), con classifiche di crescita/calo"""
+    return _report_confronto(
+        select="p.id, p.codice, p.nome, a.nome AS azienda_nome, a.partita_iva AS azienda_partita_iva",
+        from_="""{src_r} r
+                JOIN {src_o} o ON r.ordine_id = o.id
+                JOIN prodotti p ON r.prodotto_id = p.id
+                JOIN aziende a ON p.azienda_id = a.id
+                WHERE {periodi}
+                    AND o.stato IN ('inviato', 'confermato', 'evaso')""",
+        group_by="p.id, p.codice, p.nome, a.nome, a.partita_iva",
+        importo="r.importo_riga",
+        quantita="r.quantita_totale",
+        data_da=data_da, data_a=data_a, confronto=confronto, ordina_per=ordina_per,
+        limit=limit, db_path=db_path,
+    )
+
+
 # ============================================
 # INIZIALIZZAZIONE
 # ============================================
 
 # Inizializza il database all'import del modulo
-if not os.path.exists(DB_PATH):
+if storage.is_sqlite() and not os.path.exists(DB_PATH):
     init_db()
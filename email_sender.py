@@ -11,6 +11,16 @@ Opzionali:
 - SMTP_FROM (default: SMTP_USER)
 - SMTP_SSL ("1" per SSL, default: 1 se porta 465)
 - SMTP_TLS ("1" per STARTTLS, default: 1 se porta 587)
+- SMTP_POOL_MAX (sessioni aperte al massimo, default 2)
+- SMTP_MAX_PER_MINUTO (limite di invio del provider, default 0 = nessun limite)
+- SMTP_MAX_PER_SESSIONE (messaggi prima di riaprire la sessione, default 100)
+
+Le sessioni SMTP (connessione + login) restano aperte in un pool e vengono
+riusate dagli invii successivi: una sessione ferma da più di SECONDI_NOOP
+viene verificata con NOOP prima dell'uso, una ferma da più di
+SECONDI_INATTIVITA viene chiusa (i server la chiuderebbero comunque). Se la
+connessione cade durante l'invio si riconnette e riprova una volta.
+send_batch invia molti messaggi su una sola sessione.
 """
 
 from __future__ import annotations
@@ -18,8 +28,18 @@ from __future__ import annotations
 import os
 import smtplib
 import ssl
+import threading
+import time
+from contextlib import contextmanager
 from email.message import EmailMessage
 
+# Sessione inattiva da più di tanto: NOOP prima di riusarla
+SECONDI_NOOP = 30
+# Sessione inattiva da più di tanto: chiusa e riaperta
+SECONDI_INATTIVITA = 240
+TIMEOUT = 25
+
+
 
 def _env_bool(name: str, default: bool = False) -> bool:
     v = os.getenv(name)
@@ -28,17 +48,27 @@ def _env_bool(name: str, default: bool = False) -> bool:
     return v.strip().lower() not in ("0", "false", "no", "off")
 
 
-def send_email_with_attachment(
-    *,
-    to_email: str,
-    subject: str,
-    body: str,
-    attachment_bytes: bytes,
-    attachment_filename: str,
-    mime_type: str = "application/pdf",
-    cc: str | None = None,
-    bcc: str | None = None,
-) -> None:
+def _env_int(name: str, default: int) -> int:
+    v = (os.getenv(name) or "").strip()
+    return int(v) if v else default
+
+
+def limite_al_minuto() -> int:
+    """Invii al minuto concessi dal provider (SMTP_MAX_PER_MINUTO, 0 = nessun limite)"""
+    return _env_int("SMTP_MAX_PER_MINUTO", 0)
+
+
+def _errore_connessione(e: BaseException) -> bool:
+    """Connessione persa (la sessione va riaperta, il messaggio si può ritentare).
+
+    Le SMTPException sono OSError: un destinatario rifiutato non è un errore di connessione.
+    """
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+
+def _config() -> dict:
     host = os.getenv("SMTP_HOST", "").strip()
     port = int(os.getenv("SMTP_PORT", "587").strip() or "587")
     user = os.getenv("SMTP_USER", "").strip()
@@ -48,14 +78,38 @@ def send_email_with_attachment(
     if not host or not user or not password or not from_addr:
         raise RuntimeError("SMTP non configurato: imposta SMTP_HOST/SMTP_PORT/SMTP_USER/SMTP_PASS (e opzionale SMTP_FROM)")
 
+    # Heuristics SSL/TLS
+    return {
+        "host": host,
+        "port": port,
+        "user": user,
+        "password": password,
+        "from_addr": from_addr,
+        "use_ssl": _env_bool("SMTP_SSL", default=(port == 465)),
+        "use_tls": _env_bool("SMTP_TLS", default=(port == 587)),
+        "pool_max": max(_env_int("SMTP_POOL_MAX", 2), 1),
+        "max_per_minuto": limite_al_minuto(),
+        "max_per_sessione": _env_int("SMTP_MAX_PER_SESSIONE", 100),
+    }
+
+
+def _build_message(
+    *,
+    from_addr: str,
+    to_email: str,
+    subject: str,
+    body: str,
+    attachment_bytes: bytes | None = None,
+    attachment_filename: str | None = None,
+    mime_type: str = "application/pdf",
+    cc: str | None = None,
+    bcc: str | None = None,
+) -> tuple[EmailMessage, list[str]]:
+    """Messaggio e lista completa dei destinatari (To + Cc + Bcc)"""
     to_email = (to_email or "").strip()
     if not to_email:
         raise RuntimeError("Destinatario email mancante")
 
-    # Heuristics SSL/TLS
-    use_ssl = _env_bool("SMTP_SSL", default=(port == 465))
-    use_tls = _env_bool("SMTP_TLS", default=(port == 587))
-
     msg = EmailMessage()
     msg["From"] = from_addr
     msg["To"] = to_email
@@ -64,31 +118,243 @@ def send_email_with_attachment(
     msg["Subject"] = subject or "Conferma Ordine"
     msg.set_content(body or "Buongiorno,\n\nin allegato la conferma d'ordine.\n\nCordiali saluti")
 
-    maintype, subtype = (mime_type.split("/", 1) + ["octet-stream"])[:2]
-    msg.add_attachment(
-        attachment_bytes,
-        maintype=maintype,
-        subtype=subtype,
-        filename=attachment_filename or "ordine.pdf",
-    )
+    if attachment_bytes:
+        maintype, subtype = (mime_type.split("/", 1) + ["octet-stream"])[:2]
+        msg.add_attachment(
+            attachment_bytes,
+            maintype=maintype,
+            subtype=subtype,
+            filename=attachment_filename or "ordine.pdf",
+        )
 
     recipients = [to_email]
     if cc:
         recipients += [x.strip() for x in cc.split(",") if x.strip()]
     if bcc:
         recipients += [x.strip() for x in bcc.split(",") if x.strip()]
+    return msg, recipients
+
+
+class _Sessione:
+    """Connessione SMTP autenticata con i contatori per keep-alive e limiti"""
+
+    def __init__(self, cfg: dict, context: ssl.SSLContext, chiave: tuple):
+        self.server = None
+        self.rotta = False
+        self.chiave = chiave
+        self.connetti(cfg, context)
+
+    def connetti(self, cfg: dict, context: ssl.SSLContext) -> None:
+        """(Ri)apre connessione e login"""
+        if self.server is not None:
+            self.chiudi()
+        if cfg["use_ssl"]:
+            self.server = smtplib.SMTP_SSL(cfg["host"], cfg["port"], context=context, timeout=TIMEOUT)
+        else:
+            self.server = smtplib.SMTP(cfg["host"], cfg["port"], timeout=TIMEOUT)
+            self.server.ehlo()
+            if cfg["use_tls"]:
+                self.server.starttls(context=context)
+                self.server.ehlo()
+        try:
+            self.server.login(cfg["user"], cfg["password"])
+        except Exception:
+            self.chiudi()
+            raise
+        self.ultimo_uso = time.monotonic()
+        self.inviati = 0
+
+    def viva(self) -> bool:
+        """NOOP se la sessione è ferma da un po' (una risposta 250 = connessione ok)"""
+        inattiva = time.monotonic() - self.ultimo_uso
+        if inattiva > SECONDI_INATTIVITA:
+            return False
+        if inattiva <= SECONDI_NOOP:
+            return True
+        try:
+            return self.server.noop()[0] == 250
+        except OSError:
+            return False
+
+    def chiudi(self) -> None:
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPPool:
+    """Pool di sessioni SMTP autenticate, condiviso tra i thread.
+
+    Una sessione è usata da un solo thread alla volta; al massimo pool_max
+    sessioni aperte insieme (gli altri attendono). Il pool si svuota da solo se
+    cambia la configurazione SMTP.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._libere: list[_Sessione] = []
+        self._aperte = 0
+        self._chiave = None
+        self._context: ssl.SSLContext | None = None
+        # istanti degli ultimi invii, per SMTP_MAX_PER_MINUTO
+        self._invii: list[float] = []
+
+    def _allinea(self, cfg: dict) -> None:
+        chiave = (cfg["host"], cfg["port"], cfg["user"], cfg["password"], cfg["use_ssl"], cfg["use_tls"])
+        if chiave != self._chiave:
+            for s in self._libere:
+                s.chiudi()
+            self._aperte -= len(self._libere)
+            self._libere = []
+            self._chiave = chiave
+            self._context = ssl.create_default_context()
+
+    def _prendi(self, cfg: dict) -> _Sessione:
+        with self._cond:
+            self._allinea(cfg)
+            while not self._libere and self._aperte >= cfg["pool_max"]:
+                self._cond.wait()
+            if self._libere:
+                sessione = self._libere.pop()
+            else:
+                sessione = None
+                self._aperte += 1
+            context, chiave = self._context, self._chiave
+        try:
+            if sessione is None:
+                return _Sessione(cfg, context, chiave)
+            if not sessione.viva() or sessione.inviati >= cfg["max_per_sessione"]:
+                sessione.connetti(cfg, context)
+            return sessione
+        except Exception:
+            self._rilascia(None)
+            raise
+
+    def _rilascia(self, sessione: _Sessione | None) -> None:
+        """Restituisce la sessione al pool (None, rotta o di una vecchia configurazione: libera il posto)"""
+        with self._cond:
+            if sessione is None or sessione.rotta or sessione.chiave != self._chiave:
+                if sessione is not None:
+                    sessione.chiudi()
+                self._aperte -= 1
+            else:
+                sessione.ultimo_uso = time.monotonic()
+                self._libere.append(sessione)
+            self._cond.notify()
+
+    @contextmanager
+    def sessione(self, cfg: dict | None = None):
+        """Sessione del pool per la durata del blocco (scartata se la connessione cade)"""
+        cfg = cfg or _config()
+        s = self._prendi(cfg)
+        try:
+            yield s
+        except Exception as e:
+            s.rotta = s.rotta or _errore_connessione(e)
+            raise
+        finally:
+            self._rilascia(s)
+
+    def _attendi_limite(self, max_per_minuto: int) -> None:
+        """Rallenta gli invii per restare entro il limite al minuto del provider"""
+        if max_per_minuto <= 0:
+            return
+        while True:
+            with self._cond:
+                ora = time.monotonic()
+                self._invii = [t for t in self._invii if ora - t < 60]
+                if len(self._invii) < max_per_minuto:
+                    self._invii.append(ora)
+                    return
+                attesa = 60 - (ora - self._invii[0])
+            time.sleep(max(attesa, 0.01))
+
+    def invia(self, s: _Sessione, cfg: dict, msg: EmailMessage, recipients: list[str]) -> None:
+        """Invia su una sessione del pool; se la connessione è caduta riconnette e riprova una volta"""
+        self._attendi_limite(cfg["max_per_minuto"])
+        if s.inviati >= cfg["max_per_sessione"]:
+            s.connetti(cfg, self._context)
+        try:
+            s.server.send_message(msg, from_addr=cfg["from_addr"], to_addrs=recipients)
+        except Exception as e:
+            if not _errore_connessione(e):
+                raise
+            s.connetti(cfg, self._context)
+            s.server.send_message(msg, from_addr=cfg["from_addr"], to_addrs=recipients)
+        s.inviati += 1
+        s.ultimo_uso = time.monotonic()
+
+    def chiudi(self) -> None:
+        """Chiude le sessioni libere (quelle in uso si chiudono al rilascio)"""
+        with self._cond:
+            for s in self._libere:
+                s.chiudi()
+            self._aperte -= len(self._libere)
+            self._libere = []
+
+
+_pool = SMTPPool()
+
+
+def send_email_with_attachment(
+    *,
+    to_email: str,
+    subject: str,
+    body: str,
+    attachment_bytes: bytes,
+    attachment_filename: str,
+    mime_type: str = "application/pdf",
+    cc: str | None = None,
+    bcc: str | None = None,
+) -> None:
+    cfg = _config()
+    msg, recipients = _build_message(
+        from_addr=cfg["from_addr"],
+        to_email=to_email,
+        subject=subject,
+        body=body,
+        attachment_bytes=attachment_bytes,
+        attachment_filename=attachment_filename,
+        mime_type=mime_type,
+        cc=cc,
+        bcc=bcc,
+    )
+    with _pool.sessione(cfg) as s:
+        _pool.invia(s, cfg, msg, recipients)
+
+
+def send_batch(messages: list[dict]) -> list[str | None]:
+    """Invia molti messaggi su una sola sessione SMTP, rispettando SMTP_MAX_PER_MINUTO.
+
+    Ogni messaggio è un dict con gli stessi argomenti di send_email_with_attachment
+    (to_email, subject, body, e opzionali attachment_bytes, attachment_filename,
+    mime_type, cc, bcc). Un messaggio rifiutato non ferma gli altri; se la
+    connessione cade anche dopo la riconnessione, i messaggi rimasti risultano
+    non inviati.
 
-    context = ssl.create_default_context()
-
-    if use_ssl:
-        with smtplib.SMTP_SSL(host, port, context=context, timeout=25) as server:
-            server.login(user, password)
-            server.send_message(msg, from_addr=from_addr, to_addrs=recipients)
-    else:
-        with smtplib.SMTP(host, port, timeout=25) as server:
-            server.ehlo()
-            if use_tls:
-                server.starttls(context=context)
-                server.ehlo()
-            server.login(user, password)
-            server.send_message(msg, from_addr=from_addr, to_addrs=recipients)
+    Returns:
+        per ogni messaggio None se inviato, altrimenti il testo dell'errore
+    """
+    if not messages:
+        return []
+    cfg = _config()
+    esiti: list[str | None] = []
+    with _pool.sessione(cfg) as s:
+        for m in messages:
+            try:
+                msg, recipients = _build_message(from_addr=cfg["from_addr"], **m)
+                _pool.invia(s, cfg, msg, recipients)
+                esiti.append(None)
+            except Exception as e:
+                errore = str(e) or type(e).__name__
+                if not _errore_connessione(e):
+                    esiti.append(errore)
+                    continue
+                s.rotta = True
+                esiti += [errore] * (len(messages) - len(esiti))
+                break
+    return esiti
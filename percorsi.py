@@ -0,0 +1,341 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Ottimizzazione del giro visite del giorno
+
+Le tappe sono le visite pianificate e gli appuntamenti del giorno con un
+cliente dotato di coordinate (clienti.latitudine/longitudine). L'ordine
+delle tappe si calcola in locale, senza servizi esterni:
+- matrice delle distanze in linea d'aria (haversine) tra i clienti, con le
+  coppie già calcolate lette dalla cache distanze_clienti
+- giro iniziale "nearest neighbour": si va alla tappa che si può iniziare
+  prima (arrivo + eventuale attesa dell'apertura della finestra)
+- miglioramento 2-opt (inversione di tratti) che accetta una mossa solo se
+  non aumenta i ritardi sulle finestre orarie e accorcia il giro
+
+Finestre orarie: visite da ora_inizio a ora_fine (la visita deve finire entro
+ora_fine), appuntamenti all'ora fissata. Tempi di viaggio stimati dalla
+distanza × fattore strada alla velocità media configurata (impostazioni
+percorso_*).
+"""
+
+import math
+from datetime import date
+from typing import Optional, List, Dict, Any, Tuple
+
+import db
+
+_DEFAULT = {
+    'percorso_ora_partenza': '08:30',
+    'percorso_durata_visita': '30',
+    'percorso_velocita_kmh': '45',
+    'percorso_fattore_strada': '1.3',
+    'percorso_partenza_lat': '',
+    'percorso_partenza_lon': '',
+}
+
+# Passate massime di 2-opt (di norma converge in poche passate)
+MAX_PASSATE = 50
+
+
+def formatta_ora(minuti: float) -> str:
+    m = int(round(minuti))
+    return f"{(m // 60) % 24:02d}:{m % 60:02d}"
+
+
+def _parametri(conn) -> Dict[str, str]:
+    rows = conn.execute(
+        f"SELECT chiave, valore FROM impostazioni WHERE chiave IN ({', '.join('?' for _ in _DEFAULT)})",
+        list(_DEFAULT),
+    ).fetchall()
+    valori = dict(_DEFAULT)
+    valori.update({r['chiave']: r['valore'] for r in rows if r['valore'] not in (None,)})
+    return valori
+
+
+# ============================================
+# DISTANZE (cache per coppia di clienti)
+# ============================================
+
+def matrice_distanze(conn, punti: List[Dict]) -> List[List[float]]:
+    """Matrice simmetrica delle distanze (km) tra punti {cliente_id, lat, lon}.
+
+    Le coppie di clienti mancanti in distanze_clienti vengono calcolate e
+    salvate (senza commit); i punti senza cliente_id non entrano in cache.
+    """
+    n = len(punti)
+    dist = [[0.0] * n for _ in range(n)]
+    ids = sorted({p['cliente_id'] for p in punti if p.get('cliente_id')})
+    cache: Dict[Tuple[str, str], float] = {}
+    if len(ids) > 1:
+        ph = ', '.join('?' for _ in ids)
+        cache = {(r['cliente_a'], r['cliente_b']): r['km'] for r in conn.execute(
+            f"SELECT cliente_a, cliente_b, km FROM distanze_clienti WHERE cliente_a IN ({ph}) AND cliente_b IN ({ph})",
+            ids + ids,
+        ).fetchall()}
+    nuove = {}
+    for i in range(n):
+        for j in range(i + 1, n):
+            a, b = punti[i].get('cliente_id'), punti[j].get('cliente_id')
+            chiave = (min(a, b), max(a, b)) if a and b and a != b else None
+            km = cache.get(chiave) if chiave else None
+            if km is None:
+                km = db.haversine_km(punti[i]['lat'], punti[i]['lon'], punti[j]['lat'], punti[j]['lon'])
+                if chiave:
+                    nuove[chiave] = km
+            dist[i][j] = dist[j][i] = km
+    if nuove:
+        conn.executemany("""
+            INSERT INTO distanze_clienti (cliente_a, cliente_b, km) VALUES (?, ?, ?)
+            ON CONFLICT(cliente_a, cliente_b) DO NOTHING
+        """, [(a, b, km) for (a, b), km in nuove.items()])
+    return dist
+
+
+# ============================================
+# OTTIMIZZAZIONE
+# ============================================
+
+def _simula(giro: List[int], dist: List[List[float]], tappe: List[Dict], origine: int,
+            t0: float, min_per_km: float) -> Tuple[float, float, List[Tuple[float, float, float]]]:
+    """Percorre il giro: (km, minuti di ritardo totali, [(arrivo, inizio, fine) per tappa])"""
+    km = ritardo = 0.0
+    t, pos = t0, origine
+    orari = []
+    for i in giro:
+        km += dist[pos][i]
+        arrivo = t + dist[pos][i] * min_per_km
+        s = tappe[i]
+        inizio = max(arrivo, s['inizio']) if s['inizio'] is not None else arrivo
+        if s['ultimo_inizio'] is not None and inizio > s['ultimo_inizio']:
+            ritardo += inizio - s['ultimo_inizio']
+        t = inizio + s['durata']
+        orari.append((arrivo, inizio, t))
+        pos = i
+    return km, ritardo, orari
+
+
+def _nearest_neighbour(dist, tappe, origine, t0, min_per_km) -> List[int]:
+    da_visitare = set(range(len(tappe)))
+    giro = []
+    t, pos = t0, origine
+    while da_visitare:
+        migliore, chiave_migliore = None, None
+        for j in da_visitare:
+            s = tappe[j]
+            arrivo = t + dist[pos][j] * min_per_km
+            inizio = max(arrivo, s['inizio']) if s['inizio'] is not None else arrivo
+            in_ritardo = s['ultimo_inizio'] is not None and inizio > s['ultimo_inizio']
+            # prima le tappe ancora in tempo; tra le ritardatarie quella che scade prima
+            chiave = (in_ritardo, s['ultimo_inizio'] if in_ritardo else inizio, dist[pos][j])
+            if chiave_migliore is None or chiave < chiave_migliore:
+                migliore, chiave_migliore = j, chiave
+        s = tappe[migliore]
+        arrivo = t + dist[pos][migliore] * min_per_km
+        t = (max(arrivo, s['inizio']) if s['inizio'] is not None else arrivo) + s['durata']
+        pos = migliore
+        giro.append(migliore)
+        da_visitare.remove(migliore)
+    return giro
+
+
+def _prefissi(giro, dist, tappe, origine, t0, min_per_km) -> List[Tuple[float, int, float, float]]:
+    """Stato (ora, posizione, km, ritardo) prima di ogni tappa del giro"""
+    stati = []
+    t, pos, km, ritardo = t0, origine, 0.0, 0.0
+    for i in giro:
+        stati.append((t, pos, km, ritardo))
+        arrivo = t + dist[pos][i] * min_per_km
+        s = tappe[i]
+        inizio = max(arrivo, s['inizio']) if s['inizio'] is not None else arrivo
+        if s['ultimo_inizio'] is not None and inizio > s['ultimo_inizio']:
+            ritardo += inizio - s['ultimo_inizio']
+        km += dist[pos][i]
+        t, pos = inizio + s['durata'], i
+    return stati
+
+
+def _costo_da(giro, da: int, stato, dist, tappe, min_per_km, ritorno_a: Optional[int],
+              limite_ritardo: float) -> Optional[Tuple[float, float]]:
+    """(km, ritardo) del giro ripartendo dallo stato prima della tappa `da`; None oltre il limite"""
+    t, pos, km, ritardo = stato
+    for i in giro[da:]:
+        km += dist[pos][i]
+        arrivo = t + dist[pos][i] * min_per_km
+        s = tappe[i]
+        inizio = max(arrivo, s['inizio']) if s['inizio'] is not None else arrivo
+        if s['ultimo_inizio'] is not None and inizio > s['ultimo_inizio']:
+            ritardo += inizio - s['ultimo_inizio']
+            if ritardo > limite_ritardo:
+                return None
+        t, pos = inizio + s['durata'], i
+    if ritorno_a is not None:
+        km += dist[pos][ritorno_a]
+    return km, ritardo
+
+
+def _due_opt(giro, dist, tappe, origine, t0, min_per_km, ritorno: bool) -> List[int]:
+    """2-opt su percorso aperto (o chiuso sull'origine con ritorno=True).
+
+    Con finestre orarie una mossa vale se riduce il ritardo totale, oppure se
+    a pari ritardo accorcia il giro; il ricalcolo riparte dalla prima tappa
+    spostata e si interrompe appena il ritardo supera quello attuale.
+    """
+    n = len(giro)
+    vincoli = any(s['inizio'] is not None or s['ultimo_inizio'] is not None for s in tappe)
+    ritorno_a = origine if ritorno else None
+    km, ritardo = _costo_da(giro, 0, (t0, origine, 0.0, 0.0), dist, tappe, min_per_km, ritorno_a, math.inf)
+    for _ in range(MAX_PASSATE):
+        migliorato = False
+        stati = _prefissi(giro, dist, tappe, origine, t0, min_per_km) if vincoli else None
+        for i in range(n - 1):
+            prec = giro[i - 1] if i > 0 else origine
+            for j in range(i + 1, n):
+                succ = giro[j + 1] if j + 1 < n else ritorno_a
+                delta = dist[prec][giro[j]] - dist[prec][giro[i]]
+                if succ is not None:
+                    delta += dist[giro[i]][succ] - dist[giro[j]][succ]
+                # senza ritardi da recuperare conviene solo una mossa che accorcia
+                if delta >= -1e-9 and not ritardo:
+                    continue
+                nuovo = giro[:i] + giro[i:j + 1][::-1] + giro[j + 1:]
+                if not vincoli:
+                    giro, km, migliorato = nuovo, km + delta, True
+                    continue
+                costo = _costo_da(nuovo, i, stati[i], dist, tappe, min_per_km, ritorno_a, ritardo + 1e-9)
+                if costo is None:
+                    continue
+                nkm, nrit = costo
+                if nrit < ritardo - 1e-9 or nkm < km - 1e-9:
+                    giro, km, ritardo, migliorato = nuovo, nkm, nrit, True
+                    stati = _prefissi(giro, dist, tappe, origine, t0, min_per_km)
+        if not migliorato:
+            break
+    return giro
+
+
+def ottimizza_percorso(tappe: List[Dict], dist: List[List[float]], ora_partenza: str = '08:30',
+                       velocita_kmh: float = 45.0, fattore_strada: float = 1.3,
+                       ritorno: bool = False) -> Dict[str, Any]:
+    """Ordina le tappe (l'ultima riga/colonna di `dist` è il punto di partenza).
+
+    Args:
+        tappe: dict con 'inizio' e 'ultimo_inizio' (minuti o None) e 'durata' (minuti)
+        dist: matrice (n+1)x(n+1) in km; distanze nulle dall'origine = partenza dalla prima tappa
+        ritorno: il giro torna al punto di partenza
+
+    Returns:
+        dict con 'ordine' (indici delle tappe), 'orari' [(arrivo, inizio, fine)],
+        'km', 'ritardo_minuti', 'fine_giro' (minuti)
+    """
+    n = len(tappe)
+    if not n:
+        return {'ordine': [], 'orari': [], 'km': 0.0, 'ritardo_minuti': 0.0, 'fine_giro': db.minuti_ora(ora_partenza)}
+    origine = n
+    t0 = float(db.minuti_ora(ora_partenza) or 0)
+    min_per_km = 60.0 * fattore_strada / max(velocita_kmh, 1e-6)
+    giro = _nearest_neighbour(dist, tappe, origine, t0, min_per_km)
+    giro = _due_opt(giro, dist, tappe, origine, t0, min_per_km, ritorno)
+    km, ritardo, orari = _simula(giro, dist, tappe, origine, t0, min_per_km)
+    fine = orari[-1][2]
+    if ritorno:
+        km += dist[giro[-1]][origine]
+        fine += dist[giro[-1]][origine] * min_per_km
+    return {'ordine': giro, 'orari': orari, 'km': km * fattore_strada,
+            'ritardo_minuti': ritardo, 'fine_giro': fine}
+
+
+# ============================================
+# GIRO DEL GIORNO
+# ============================================
+
+def tappe_del_giorno(giorno: str, durata_visita: int = 30) -> List[Dict]:
+    """Visite pianificate non completate e appuntamenti con cliente del giorno"""
+    tappe = []
+    for v in db.get_visite_pianificate(giorno, giorno):
+        inizio, fine = db.minuti_ora(v.get('ora_inizio')), db.minuti_ora(v.get('ora_fine'))
+        tappe.append({
+            'tipo': 'visita', 'id': v['id'], 'cliente_id': v['cliente_id'],
+            'cliente_nome': v.get('cliente_nome'), 'indirizzo': v.get('cliente_indirizzo'),
+            'citta': v.get('cliente_citta'), 'titolo': v.get('note') or v.get('tipo') or 'Visita',
+            'lat': v.get('cliente_latitudine'), 'lon': v.get('cliente_longitudine'),
+            'inizio': inizio, 'durata': durata_visita,
+            # la visita deve finire entro ora_fine
+            'ultimo_inizio': fine - durata_visita if fine is not None else None,
+        })
+    for a in db.get_appuntamenti_by_date(giorno):
+        if not a.get('cliente_id'):
+            continue
+        ora = db.minuti_ora(a.get('ora'))
+        tappe.append({
+            'tipo': 'appuntamento', 'id': a['id'], 'cliente_id': a['cliente_id'],
+            'cliente_nome': a.get('cliente_nome'), 'indirizzo': a.get('luogo'), 'citta': None,
+            'titolo': a.get('titolo'), 'lat': a.get('cliente_latitudine'), 'lon': a.get('cliente_longitudine'),
+            'inizio': ora, 'ultimo_inizio': ora, 'durata': durata_visita,
+        })
+    return tappe
+
+
+def pianifica_giorno(giorno: str = None, partenza: Tuple[float, float] = None,
+                     ritorno: bool = False) -> Dict[str, Any]:
+    """Giro ottimizzato del giorno.
+
+    Args:
+        giorno: YYYY-MM-DD (default oggi)
+        partenza: (lat, lon) di partenza; default da impostazioni, altrimenti
+                  si parte dalla prima tappa del giro
+
+    Returns:
+        dict con 'tappe' (in ordine di visita, con arrivo/inizio/fine HH:MM,
+        km_da_precedente e in_ritardo), 'non_localizzate' (clienti senza
+        coordinate), 'km_totali', 'ritardo_minuti', 'fine_giro' (HH:MM)
+    """
+    giorno = giorno or date.today().isoformat()
+    conn = db.get_connection()
+    try:
+        par = _parametri(conn)
+        durata = int(float(par['percorso_durata_visita'] or 30))
+        tappe = tappe_del_giorno(giorno, durata)
+        localizzate = [t for t in tappe if t['lat'] is not None and t['lon'] is not None]
+        non_localizzate = [t for t in tappe if t['lat'] is None or t['lon'] is None]
+        if partenza is None and par['percorso_partenza_lat'] and par['percorso_partenza_lon']:
+            partenza = (float(par['percorso_partenza_lat']), float(par['percorso_partenza_lon']))
+
+        punti = [{'cliente_id': t['cliente_id'], 'lat': float(t['lat']), 'lon': float(t['lon'])} for t in localizzate]
+        dist = matrice_distanze(conn, punti)
+        # origine in coda: distanze reali dalla partenza, oppure nulle (si parte dalla prima tappa)
+        dall_origine = [db.haversine_km(partenza[0], partenza[1], p['lat'], p['lon']) if partenza else 0.0
+                        for p in punti]
+        for riga, d in zip(dist, dall_origine):
+            riga.append(d)
+        dist.append(dall_origine + [0.0])
+        conn.commit()
+    finally:
+        conn.close()
+
+    fattore = float(par['percorso_fattore_strada'] or 1.3)
+    ris = ottimizza_percorso(
+        localizzate, dist,
+        ora_partenza=par['percorso_ora_partenza'] or '08:30',
+        velocita_kmh=float(par['percorso_velocita_kmh'] or 45),
+        fattore_strada=fattore,
+        ritorno=ritorno and partenza is not None,
+    )
+    ordinate = []
+    prec = len(localizzate)
+    for i, (arrivo, inizio, fine) in zip(ris['ordine'], ris['orari']):
+        t = localizzate[i]
+        ordinate.append({
+            **t,
+            'arrivo': formatta_ora(arrivo), 'inizio_visita': formatta_ora(inizio), 'fine_visita': formatta_ora(fine),
+            'km_da_precedente': round(dist[prec][i] * fattore, 1),
+            'in_ritardo': t['ultimo_inizio'] is not None and inizio > t['ultimo_inizio'] + 1e-9,
+        })
+        prec = i
+    return {
+        'giorno': giorno,
+        'tappe': ordinate,
+        'non_localizzate': non_localizzate,
+        'km_totali': round(ris['km'], 1),
+        'ritardo_minuti': round(ris['ritardo_minuti']),
+        'fine_giro': formatta_ora(ris['fine_giro']) if ordinate else None,
+    }
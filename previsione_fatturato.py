@@ -0,0 +1,291 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Previsione del fatturato mensile (totale e per azienda)
+
+Sui fatturati mensili (stesso criterio del grafico in dashboard: ordini non
+annullati, archivi compresi) adatta un modello leggero, solo NumPy:
+- Holt-Winters additivo (livello, trend, stagionalità di 12 mesi) con almeno
+  due anni di storia
+- Holt lineare (livello + trend) con almeno MIN_MESI_TREND mesi
+- media degli ultimi mesi con meno storia
+
+I parametri di smorzamento sono scelti su una griglia valutata in blocco
+(tutte le combinazioni avanzano insieme, mese per mese) minimizzando l'errore
+a un passo. Si usano solo i mesi chiusi: il mese corrente, parziale,
+abbasserebbe la stima.
+
+Parametri e proiezioni sono salvati in previsioni_fatturato. Il modello si
+riadatta solo quando chiude un nuovo mese o cambia la serie storica (ordini
+modificati a posteriori, rilevati dall'impronta della serie). La serie stessa
+si rilegge solo una volta al giorno o dopo modifiche agli ordini (change log):
+ai rerun della dashboard resta la sola lettura della cache.
+"""
+
+import hashlib
+import json
+from datetime import date, datetime
+from typing import Optional, List, Dict, Any, Tuple
+
+import numpy as np
+
+import db
+
+STAGIONE = 12
+# Mesi di storia usati per il fit
+MESI_STORIA = 48
+# Sotto questa soglia niente trend: media degli ultimi mesi
+MIN_MESI_TREND = 6
+# Mesi proiettati e salvati in cache (la dashboard ne mostra 3-6)
+ORIZZONTE_MAX = 12
+CHIAVE_TOTALE = 'totale'
+
+_GRIGLIA_ALPHA = (0.1, 0.3, 0.5, 0.7, 0.9)
+_GRIGLIA_BETA = (0.0, 0.05, 0.15, 0.3)
+_GRIGLIA_GAMMA = (0.05, 0.15, 0.3, 0.5)
+
+
+# ============================================
+# SERIE MENSILI
+# ============================================
+
+def _mese(anno: int, mese: int) -> str:
+    while mese <= 0:
+        mese += 12
+        anno -= 1
+    while mese > 12:
+        mese -= 12
+        anno += 1
+    return f"{anno:04d}-{mese:02d}"
+
+
+def _sposta_mese(ym: str, n: int) -> str:
+    return _mese(int(ym[:4]), int(ym[5:7]) + n)
+
+
+def ultimo_mese_chiuso(oggi: date = None) -> str:
+    oggi = oggi or date.today()
+    return _mese(oggi.year, oggi.month - 1)
+
+
+def _carica_serie(oggi: date = None) -> Tuple[str, Dict[str, Dict[str, float]]]:
+    """Fatturati dei mesi chiusi: (ultimo mese chiuso, {chiave: {YYYY-MM: fatturato}})"""
+    fine = ultimo_mese_chiuso(oggi)
+    inizio = _sposta_mese(fine, -(MESI_STORIA - 1))
+    rows = db.get_fatturato_mensile_per_azienda(data_da=f"{inizio}-01", data_a=f"{fine}-31")
+    serie: Dict[str, Dict[str, float]] = {CHIAVE_TOTALE: {}}
+    for r in rows:
+        valore = float(r['fatturato'] or 0)
+        serie.setdefault(r['azienda_id'], {})[r['mese']] = valore
+        serie[CHIAVE_TOTALE][r['mese']] = serie[CHIAVE_TOTALE].get(r['mese'], 0.0) + valore
+    return fine, serie
+
+
+def _vettore(mappa: Dict[str, float], fine: str) -> Tuple[str, np.ndarray]:
+    """Serie continua dal primo mese con fatturato a `fine` (mesi vuoti = 0)"""
+    mesi = sorted(m for m, v in mappa.items() if v)
+    if not mesi:
+        return fine, np.zeros(0)
+    inizio = mesi[0]
+    n = (int(fine[:4]) - int(inizio[:4])) * 12 + int(fine[5:7]) - int(inizio[5:7]) + 1
+    return inizio, np.array([mappa.get(_sposta_mese(inizio, i), 0.0) for i in range(n)])
+
+
+def _impronta(inizio: str, y: np.ndarray) -> str:
+    testo = inizio + ':' + ','.join(f"{v:.2f}" for v in y)
+    return hashlib.sha1(testo.encode()).hexdigest()
+
+
+# ============================================
+# MODELLI
+# ============================================
+
+def _smoothing(y: np.ndarray, alpha: np.ndarray, beta: np.ndarray, gamma: Optional[np.ndarray]):
+    """Holt (gamma None) o Holt-Winters additivo per P combinazioni di parametri in parallelo.
+
+    Returns:
+        (sse a un passo [P], livello [P], trend [P], stagionalità [P, STAGIONE])
+    """
+    p = len(alpha)
+    if gamma is None:
+        livello = np.full(p, y[0])
+        trend = np.full(p, y[1] - y[0] if len(y) > 1 else 0.0)
+        stagioni = np.zeros((p, STAGIONE))
+        inizio = 1
+    else:
+        # la media del primo anno vale a metà anno (t = 5.5): livello e
+        # stagionalità iniziali vanno riportati lungo il trend
+        primo = y[:STAGIONE].mean()
+        tr0 = (y[STAGIONE:2 * STAGIONE].mean() - primo) / STAGIONE
+        meta = (STAGIONE - 1) / 2
+        livello = np.full(p, primo + tr0 * meta)
+        trend = np.full(p, tr0)
+        stagioni = np.tile(y[:STAGIONE] - (primo + tr0 * (np.arange(STAGIONE) - meta)), (p, 1))
+        inizio = STAGIONE
+    sse = np.zeros(p)
+    for t in range(inizio, len(y)):
+        s = t % STAGIONE
+        errore = y[t] - (livello + trend + stagioni[:, s])
+        sse += errore ** 2
+        nuovo = alpha * (y[t] - stagioni[:, s]) + (1 - alpha) * (livello + trend)
+        trend = beta * (nuovo - livello) + (1 - beta) * trend
+        if gamma is not None:
+            stagioni[:, s] = gamma * (y[t] - nuovo) + (1 - gamma) * stagioni[:, s]
+        livello = nuovo
+    return sse / max(len(y) - inizio, 1), livello, trend, stagioni
+
+
+def adatta_modello(y: np.ndarray, orizzonte: int = ORIZZONTE_MAX) -> Dict[str, Any]:
+    """Sceglie e adatta il modello sulla serie mensile y (mesi chiusi, dal più vecchio).
+
+    Returns:
+        dict con 'modello', 'parametri' e 'valori' (proiezione dei prossimi `orizzonte` mesi)
+    """
+    n = len(y)
+    h = np.arange(1, orizzonte + 1)
+    if n < MIN_MESI_TREND:
+        media = float(y[-3:].mean()) if n else 0.0
+        rmse = float(y[-3:].std()) if n > 1 else 0.0
+        return {'modello': 'media', 'parametri': {'rmse': rmse, 'mesi': n},
+                'valori': np.full(orizzonte, media), 'rmse': rmse}
+
+    stagionale = n >= 2 * STAGIONE
+    if stagionale:
+        a, b, g = np.meshgrid(_GRIGLIA_ALPHA, _GRIGLIA_BETA, _GRIGLIA_GAMMA, indexing='ij')
+        a, b, g = a.ravel(), b.ravel(), g.ravel()
+    else:
+        a, b = np.meshgrid(_GRIGLIA_ALPHA, _GRIGLIA_BETA, indexing='ij')
+        a, b, g = a.ravel(), b.ravel(), None
+    mse, livello, trend, stagioni = _smoothing(y, a, b, g)
+    i = int(np.argmin(mse))
+    valori = livello[i] + h * trend[i] + stagioni[i, (n - 1 + h) % STAGIONE]
+    parametri = {'alpha': float(a[i]), 'beta': float(b[i]), 'rmse': float(np.sqrt(mse[i])), 'mesi': n}
+    if stagionale:
+        parametri['gamma'] = float(g[i])
+    return {'modello': 'holt_winters' if stagionale else 'holt', 'parametri': parametri,
+            'valori': valori, 'rmse': parametri['rmse']}
+
+
+def _proiezione(fine: str, fit: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Proiezione mese per mese con intervallo approssimato al 95% (si allarga con l'orizzonte)"""
+    out = []
+    for i, v in enumerate(fit['valori'], start=1):
+        margine = 1.96 * fit['rmse'] * np.sqrt(i)
+        out.append({
+            'mese': _sposta_mese(fine, i),
+            'fatturato': round(max(float(v), 0.0), 2),
+            'min': round(max(float(v - margine), 0.0), 2),
+            'max': round(max(float(v + margine), 0.0), 2),
+        })
+    return out
+
+
+# ============================================
+# CACHE
+# ============================================
+
+def _leggi_cache(conn) -> Dict[str, Dict[str, Any]]:
+    return {r['chiave']: dict(r) for r in conn.execute(
+        "SELECT chiave, ultimo_mese_chiuso, impronta, modello, parametri, previsione FROM previsioni_fatturato"
+    ).fetchall()}
+
+
+def _da_verificare(conn, oggi: date) -> bool:
+    """True se la serie va riletta: nuovo giorno (e quindi mese) o ordini modificati dall'ultima verifica"""
+    valori = {r['chiave']: r['valore'] for r in conn.execute(
+        "SELECT chiave, valore FROM impostazioni WHERE chiave IN ('previsioni_fatturato_verifica', 'previsioni_fatturato_seq')"
+    ).fetchall()}
+    if valori.get('previsioni_fatturato_verifica') != oggi.isoformat():
+        return True
+    seq = int(valori.get('previsioni_fatturato_seq') or 0)
+    return bool(db.get_changes_since(seq, tabelle=['ordini', 'ordini_righe'], limit=1)['changes'])
+
+
+def aggiorna_previsioni(forza: bool = False, oggi: date = None) -> Dict[str, int]:
+    """Riadatta i modelli la cui serie è cambiata (o tutti con forza=True).
+
+    Returns:
+        dict con 'adattati' (modelli rifatti) e 'invariati' (letti dalla cache)
+    """
+    # seq letta PRIMA della serie: le modifiche concorrenti resteranno da verificare
+    seq = db.get_ultima_seq()
+    fine, serie = _carica_serie(oggi)
+    conn = db.get_connection()
+    try:
+        cache = _leggi_cache(conn)
+        now = datetime.now().isoformat()
+        righe = []
+        for chiave, mappa in serie.items():
+            inizio, y = _vettore(mappa, fine)
+            impronta = _impronta(inizio, y)
+            vecchia = cache.get(chiave)
+            if not forza and vecchia and vecchia['ultimo_mese_chiuso'] == fine and vecchia['impronta'] == impronta:
+                continue
+            fit = adatta_modello(y)
+            righe.append((chiave, fine, impronta, fit['modello'], json.dumps(fit['parametri']),
+                          json.dumps(_proiezione(fine, fit)), now))
+        if righe:
+            conn.executemany("""
+                INSERT INTO previsioni_fatturato
+                    (chiave, ultimo_mese_chiuso, impronta, modello, parametri, previsione, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chiave) DO UPDATE SET
+                    ultimo_mese_chiuso = excluded.ultimo_mese_chiuso,
+                    impronta = excluded.impronta,
+                    modello = excluded.modello,
+                    parametri = excluded.parametri,
+                    previsione = excluded.previsione,
+                    updated_at = excluded.updated_at
+            """, righe)
+        # aziende senza più fatturato nella finestra
+        obsolete = [(k,) for k in cache if k not in serie]
+        if obsolete:
+            conn.executemany("DELETE FROM previsioni_fatturato WHERE chiave = ?", obsolete)
+        conn.executemany("""
+            INSERT INTO impostazioni (chiave, valore, tipo, updated_at) VALUES (?, ?, 'string', ?)
+            ON CONFLICT(chiave) DO UPDATE SET valore = excluded.valore, updated_at = excluded.updated_at
+        """, [('previsioni_fatturato_verifica', (oggi or date.today()).isoformat(), now),
+              ('previsioni_fatturato_seq', str(seq), now)])
+        conn.commit()
+        return {'adattati': len(righe), 'invariati': len(serie) - len(righe)}
+    finally:
+        conn.close()
+
+
+def get_previsione(azienda_id: str = None, orizzonte: int = 6) -> Dict[str, Any]:
+    """Proiezione dei prossimi `orizzonte` mesi (totale o di un'azienda), dalla cache.
+
+    La serie viene riletta solo al primo accesso del giorno o se gli ordini sono
+    cambiati dall'ultima verifica (change log); il modello viene riadattato solo
+    se è chiuso un nuovo mese o la serie è cambiata.
+
+    Returns:
+        dict con 'modello', 'parametri', 'ultimo_mese_chiuso' e 'mesi'
+        ([{mese, fatturato, min, max}]); 'mesi' vuoto se non c'è storia
+    """
+    chiave = azienda_id or CHIAVE_TOTALE
+    conn = db.get_connection()
+    try:
+        da_verificare = _da_verificare(conn, date.today())
+    finally:
+        conn.close()
+    if da_verificare:
+        aggiorna_previsioni()
+    conn = db.get_connection()
+    try:
+        row = conn.execute(
+            "SELECT ultimo_mese_chiuso, modello, parametri, previsione FROM previsioni_fatturato WHERE chiave = ?",
+            (chiave,),
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return {'modello': None, 'parametri': {}, 'ultimo_mese_chiuso': ultimo_mese_chiuso(), 'mesi': []}
+    mesi = json.loads(row['previsione'] or '[]')
+    if not any(m['fatturato'] for m in mesi):
+        mesi = []
+    return {
+        'modello': row['modello'],
+        'parametri': json.loads(row['parametri'] or '{}'),
+        'ultimo_mese_chiuso': row['ultimo_mese_chiuso'],
+        'mesi': mesi[:min(orizzonte, ORIZZONTE_MAX)],
+    }
@@ -0,0 +1,187 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Report consolidati di agenzia (federazione dei database agente)
+
+Ogni agente lavora sul proprio database SQLite. I report di agenzia eseguono
+le stesse query di report di db.py su tutti i database agente in parallelo
+(un processo per database) e poi fondono i parziali:
+- somme e conteggi si sommano
+- le date "ultimo ordine" si fondono con il massimo
+- i top-N si calcolano DOPO la fusione (ogni agente restituisce tutti i parziali,
+  altrimenti un cliente/prodotto fuori dal top-N di ogni agente ma primo
+  a livello di agenzia andrebbe perso)
+"""
+
+import os
+import re
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Optional, List, Dict, Any
+
+import db
+
+# Cartella con i database degli agenti (un file .db per agente)
+AGENTI_DB_DIR = os.getenv('AGENTI_DB_DIR', os.path.join(os.path.dirname(__file__), 'agenti'))
+
+
+def trova_db_agenti(cartella: str = None) -> List[str]:
+    """Elenca i database agente presenti nella cartella (ordinati per nome file)"""
+    cartella = cartella or AGENTI_DB_DIR
+    # gli archivi ordini (<agente>_archivio_AAAA.db) sono letti dal database agente
+    return sorted(p for p in glob.glob(os.path.join(cartella, '*.db'))
+                  if not re.search(r'_archivio_\d{4}\.db$', p))
+
+
+def _chiave(*valori) -> str:
+    """Chiave naturale per riconoscere la stessa entità su database diversi.
+
+    Gli ID sono UUID locali a ogni database: usiamo la partita IVA se presente,
+    altrimenti il nome normalizzato.
+    """
+    for v in valori:
+        v = (v or '').strip().upper()
+        if v:
+            return v
+    return ''
+
+
+def _report_agente(db_path: str, anno: int) -> Dict[str, Any]:
+    """Parziali di un singolo database agente (eseguito nel processo worker)"""
+    return {
+        'db_path': db_path,
+        'aziende': db.get_fatturato_per_azienda(anno, db_path=db_path),
+        'clienti': db.get_fatturato_per_cliente(anno, limit=None, db_path=db_path),
+        'mesi': db.get_fatturato_per_mese(anno, db_path=db_path),
+        'prodotti': db.get_top_prodotti(anno, limit=None, db_path=db_path),
+    }
+
+
+def _esegui_parallelo(db_paths: List[str], anno: int, max_workers: int = None) -> List[Dict[str, Any]]:
+    """Esegue i report su tutti i database, in parallelo su più processi"""
+    if not db_paths:
+        return []
+    if len(db_paths) == 1:
+        # Un solo database: inutile pagare l'avvio di un processo
+        return [_report_agente(db_paths[0], anno)]
+
+    workers = max_workers or min(len(db_paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_report_agente, db_paths, [anno] * len(db_paths)))
+
+
+# ============================================
+# FUSIONE PARZIALI
+# ============================================
+
+def _fondi_aziende(parziali: List[Dict]) -> List[Dict]:
+    out: Dict[str, Dict] = {}
+    for p in parziali:
+        for r in p['aziende']:
+            k = _chiave(r.get('partita_iva'), r.get('nome'))
+            tot = out.setdefault(k, {'nome': r['nome'], 'partita_iva': r.get('partita_iva'),
+                                     'num_ordini': 0, 'fatturato': 0.0, 'num_agenti': 0})
+            tot['num_ordini'] += r['num_ordini'] or 0
+            tot['fatturato'] += float(r['fatturato'] or 0)
+            if r['num_ordini']:
+                tot['num_agenti'] += 1
+    return sorted(out.values(), key=lambda r: r['fatturato'], reverse=True)
+
+
+def _fondi_clienti(parziali: List[Dict], limit: Optional[int]) -> List[Dict]:
+    out: Dict[str, Dict] = {}
+    for p in parziali:
+        for r in p['clienti']:
+            k = _chiave(r.get('partita_iva'), r.get('ragione_sociale'))
+            tot = out.setdefault(k, {'ragione_sociale': r['ragione_sociale'], 'citta': r.get('citta'),
+                                     'provincia': r.get('provincia'), 'partita_iva': r.get('partita_iva'),
+                                     'num_ordini': 0, 'fatturato': 0.0, 'ultimo_ordine': None, 'num_agenti': 0})
+            tot['num_ordini'] += r['num_ordini'] or 0
+            tot['fatturato'] += float(r['fatturato'] or 0)
+            tot['num_agenti'] += 1
+            if r.get('ultimo_ordine') and (tot['ultimo_ordine'] is None or r['ultimo_ordine'] > tot['ultimo_ordine']):
+                tot['ultimo_ordine'] = r['ultimo_ordine']
+    rows = sorted(out.values(), key=lambda r: r['fatturato'], reverse=True)
+    return rows[:limit] if limit else rows
+
+
+def _fondi_mesi(parziali: List[Dict]) -> List[Dict]:
+    out: Dict[str, Dict] = {}
+    for p in parziali:
+        for r in p['mesi']:
+            tot = out.setdefault(r['mese'], {'mese': r['mese'], 'num_ordini': 0, 'fatturato': 0.0})
+            tot['num_ordini'] += r['num_ordini'] or 0
+            tot['fatturato'] += float(r['fatturato'] or 0)
+    return [out[m] for m in sorted(out)]
+
+
+def _fondi_prodotti(parziali: List[Dict], limit: Optional[int]) -> List[Dict]:
+    out: Dict[tuple, Dict] = {}
+    for p in parziali:
+        for r in p['prodotti']:
+            k = (_chiave(r.get('azienda_partita_iva'), r.get('azienda_nome')), _chiave(r.get('codice')))
+            tot = out.setdefault(k, {'codice': r['codice'], 'nome': r['nome'], 'azienda_nome': r['azienda_nome'],
+                                     'quantita_venduta': 0, 'fatturato': 0.0})
+            tot['quantita_venduta'] += r['quantita_venduta'] or 0
+            tot['fatturato'] += float(r['fatturato'] or 0)
+    rows = sorted(out.values(), key=lambda r: r['fatturato'], reverse=True)
+    return rows[:limit] if limit else rows
+
+
+# ============================================
+# API REPORT DI AGENZIA
+# ============================================
+
+def get_report_agenzia(anno: int = None, db_paths: List[str] = None,
+                       limit_clienti: int = 20, limit_prodotti: int = 10,
+                       max_workers: int = None) -> Dict[str, Any]:
+    """Report consolidato di agenzia: una sola passata parallela su tutti i database.
+
+    Returns:
+        dict con 'aziende', 'clienti' (top N), 'prodotti' (top N), 'mesi',
+        'agenti' (totali per database) e 'totale'.
+    """
+    if anno is None:
+        anno = date.today().year
+    if db_paths is None:
+        db_paths = trova_db_agenti()
+
+    parziali = _esegui_parallelo(db_paths, anno, max_workers=max_workers)
+
+    agenti = []
+    for p in parziali:
+        agenti.append({
+            'db_path': p['db_path'],
+            'agente': os.path.splitext(os.path.basename(p['db_path']))[0],
+            'num_ordini': sum(r['num_ordini'] or 0 for r in p['aziende']),
+            'fatturato': sum(float(r['fatturato'] or 0) for r in p['aziende']),
+        })
+    agenti.sort(key=lambda r: r['fatturato'], reverse=True)
+
+    return {
+        'anno': anno,
+        'aziende': _fondi_aziende(parziali),
+        'clienti': _fondi_clienti(parziali, limit_clienti),
+        'mesi': _fondi_mesi(parziali),
+        'prodotti': _fondi_prodotti(parziali, limit_prodotti),
+        'agenti': agenti,
+        'totale': {
+            'num_ordini': sum(a['num_ordini'] for a in agenti),
+            'fatturato': sum(a['fatturato'] for a in agenti),
+        },
+    }
+
+
+def get_fatturato_agenzia_per_azienda(anno: int = None, db_paths: List[str] = None) -> List[Dict]:
+    """Fatturato per azienda su tutti gli agenti"""
+    return get_report_agenzia(anno, db_paths)['aziende']
+
+
+def get_fatturato_agenzia_per_cliente(anno: int = None, limit: int = 20, db_paths: List[str] = None) -> List[Dict]:
+    """Top clienti di agenzia (top-N calcolato dopo la fusione)"""
+    return get_report_agenzia(anno, db_paths, limit_clienti=limit)['clienti']
+
+
+def get_top_prodotti_agenzia(anno: int = None, limit: int = 10, db_paths: List[str] = None) -> List[Dict]:
+    """Prodotti più venduti a livello di agenzia"""
+    return get_report_agenzia(anno, db_paths, limit_prodotti=limit)['prodotti']
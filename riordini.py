@@ -0,0 +1,335 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Previsione riordini per cliente e prodotto
+
+Per ogni coppia cliente/prodotto calcola dallo storico ordini (ordini_righe):
+- intervallo tipico tra un ordine e il successivo (mediana dei giorni)
+- quantità tipica per ordine (mediana dei pezzi)
+- data prevista del prossimo ordine e affidabilità della previsione
+
+Il calcolo è vettoriale (pandas/NumPy) su tutto lo storico e il risultato è
+salvato in previsioni_riordino: dashboard e carrello suggerito leggono solo
+quella tabella. Dopo ogni ordine salvato si ricalcolano solo le coppie del
+cliente/azienda dell'ordine (aggiorna_dopo_ordine).
+
+Lo storico considerato è quello degli ordini confermati (non bozza né
+annullati) ancora nelle tabelle operative (gli archivi annuali contengono
+solo ordini vecchi). Annullamenti, cambi di stato ed eliminazioni arrivano
+dal change log: le letture ricalcolano prima i clienti toccati
+(_allinea_modifiche).
+"""
+
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any
+
+import numpy as np
+import pandas as pd
+
+import db
+
+# Servono almeno due ordini per stimare un intervallo
+MIN_ORDINI = 2
+# Numero di intervalli oltre il quale la storia è considerata "piena"
+INTERVALLI_PIENI = 5
+# Un prodotto in ritardo di più di un intervallo non è più "da riordinare" (cliente perso)
+CICLI_RITARDO_MAX = 1.0
+# Regola fissa dell'app: 1 cartone = 6 pezzi
+PEZZI_PER_CARTONE = 6
+
+_CHIAVE = ['cliente_id', 'azienda_id', 'prodotto_id']
+
+
+def _carica_storico(conn, cliente_id: str = None, azienda_id: str = None) -> pd.DataFrame:
+    """Quantità per coppia e giorno d'ordine (più righe dello stesso giorno sommate)"""
+    query = """
+        SELECT o.cliente_id, o.azienda_id, r.prodotto_id,
+               substr(o.data_ordine, 1, 10) AS data,
+               SUM(r.quantita_totale) AS quantita
+        FROM ordini_righe r
+        JOIN ordini o ON r.ordine_id = o.id
+        WHERE o.stato NOT IN ('bozza', 'annullato') AND r.prodotto_id IS NOT NULL
+    """
+    params: List[Any] = []
+    if cliente_id:
+        query += " AND o.cliente_id = ?"
+        params.append(cliente_id)
+    if azienda_id:
+        query += " AND o.azienda_id = ?"
+        params.append(azienda_id)
+    query += " GROUP BY o.cliente_id, o.azienda_id, r.prodotto_id, substr(o.data_ordine, 1, 10)"
+
+    rows = conn.execute(query, params).fetchall()
+    df = pd.DataFrame([dict(r) for r in rows], columns=_CHIAVE + ['data', 'quantita'])
+    df['data'] = pd.to_datetime(df['data'], errors='coerce')
+    df['quantita'] = pd.to_numeric(df['quantita'], errors='coerce').fillna(0)
+    return df.dropna(subset=['data'])
+
+
+def calcola_previsioni(storico: pd.DataFrame) -> pd.DataFrame:
+    """Intervallo, quantità tipica e prossimo ordine per ogni coppia dello storico.
+
+    Args:
+        storico: DataFrame con cliente_id, azienda_id, prodotto_id, data, quantita
+
+    Returns:
+        DataFrame con una riga per coppia con almeno MIN_ORDINI ordini
+    """
+    if storico.empty:
+        return pd.DataFrame(columns=_CHIAVE + ['num_ordini', 'intervallo_giorni', 'intervallo_std',
+                                               'quantita_tipica', 'ultimo_ordine', 'prossimo_ordine',
+                                               'scadenza_max', 'affidabilita'])
+
+    df = storico.sort_values(_CHIAVE + ['data'])
+    df['gap'] = df.groupby(_CHIAVE, sort=False)['data'].diff().dt.days
+
+    agg = df.groupby(_CHIAVE, sort=False).agg(
+        num_ordini=('data', 'size'),
+        ultimo_ordine=('data', 'max'),
+        quantita_tipica=('quantita', 'median'),
+        intervallo_giorni=('gap', 'median'),
+        intervallo_medio=('gap', 'mean'),
+        intervallo_std=('gap', 'std'),
+    ).reset_index()
+    agg = agg[(agg['num_ordini'] >= MIN_ORDINI) & (agg['intervallo_giorni'] > 0)].copy()
+
+    # Affidabilità: regolarità degli intervalli (1 - coefficiente di variazione)
+    # pesata per la lunghezza della storia
+    cv = (agg['intervallo_std'].fillna(0) / agg['intervallo_medio']).to_numpy()
+    regolarita = np.clip(1.0 - cv, 0.0, 1.0)
+    peso = np.minimum(1.0, (agg['num_ordini'].to_numpy() - 1) / INTERVALLI_PIENI)
+    agg['affidabilita'] = np.round(regolarita * peso, 2)
+
+    agg['intervallo_giorni'] = np.round(agg['intervallo_giorni'], 1)
+    agg['intervallo_std'] = np.round(agg['intervallo_std'].fillna(0), 1)
+    agg['quantita_tipica'] = np.maximum(1, np.round(agg['quantita_tipica'])).astype(int)
+    agg['prossimo_ordine'] = agg['ultimo_ordine'] + pd.to_timedelta(np.round(agg['intervallo_giorni']), unit='D')
+    # oltre CICLI_RITARDO_MAX intervalli di ritardo il prodotto non è più da riordinare
+    agg['scadenza_max'] = agg['prossimo_ordine'] + pd.to_timedelta(
+        np.floor(CICLI_RITARDO_MAX * agg['intervallo_giorni']), unit='D')
+    return agg.drop(columns=['intervallo_medio'])
+
+
+def _salva_previsioni(conn, prev: pd.DataFrame, cliente_id: str = None, azienda_id: str = None) -> int:
+    """Sostituisce le previsioni dell'ambito ricalcolato (senza commit)"""
+    query = "DELETE FROM previsioni_riordino WHERE 1=1"
+    params: List[Any] = []
+    if cliente_id:
+        query += " AND cliente_id = ?"
+        params.append(cliente_id)
+    if azienda_id:
+        query += " AND azienda_id = ?"
+        params.append(azienda_id)
+    conn.execute(query, params)
+
+    if prev.empty:
+        return 0
+    now = datetime.now().isoformat()
+    righe = [
+        (r.cliente_id, r.azienda_id, r.prodotto_id, int(r.num_ordini), float(r.intervallo_giorni),
+         float(r.intervallo_std), int(r.quantita_tipica), r.ultimo_ordine.date().isoformat(),
+         r.prossimo_ordine.date().isoformat(), r.scadenza_max.date().isoformat(), float(r.affidabilita), now)
+        for r in prev.itertuples(index=False)
+    ]
+    conn.executemany("""
+        INSERT INTO previsioni_riordino (cliente_id, azienda_id, prodotto_id, num_ordini, intervallo_giorni,
+                                         intervallo_std, quantita_tipica, ultimo_ordine, prossimo_ordine,
+                                         scadenza_max, affidabilita, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, righe)
+    return len(righe)
+
+
+def ricalcola_previsioni(cliente_id: str = None, azienda_id: str = None) -> int:
+    """Ricalcola le previsioni (tutte, o solo quelle di un cliente/azienda).
+
+    Returns:
+        numero di coppie cliente/prodotto con previsione
+    """
+    conn = db.get_connection()
+    try:
+        prev = calcola_previsioni(_carica_storico(conn, cliente_id, azienda_id))
+        n = _salva_previsioni(conn, prev, cliente_id, azienda_id)
+        conn.commit()
+        return n
+    finally:
+        conn.close()
+
+
+def aggiorna_dopo_ordine(ordine_id: str) -> int:
+    """Aggiornamento incrementale dopo il salvataggio di un ordine (solo cliente/azienda dell'ordine)"""
+    conn = db.get_connection()
+    try:
+        row = conn.execute("SELECT cliente_id, azienda_id FROM ordini WHERE id = ?", (ordine_id,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return 0
+    return ricalcola_previsioni(row['cliente_id'], row['azienda_id'])
+
+
+def _allinea_modifiche() -> int:
+    """Ricalcola i clienti/aziende degli ordini cambiati dall'ultimo allineamento.
+
+    Copre ciò che aggiorna_dopo_ordine non vede: cambi di stato (bozza inviata,
+    annullamento) ed eliminazioni. Un ordine eliminato non dice più di quale
+    cliente fosse: in quel caso (raro) si ricalcola tutto.
+
+    Returns:
+        numero di coppie cliente/prodotto ricalcolate
+    """
+    conn = db.get_connection()
+    try:
+        row = conn.execute("SELECT valore FROM impostazioni WHERE chiave = 'previsioni_riordino_seq'").fetchone()
+    finally:
+        conn.close()
+    seq = int(row['valore'] or 0) if row else 0
+
+    n = 0
+    if not seq:
+        nuovo_seq = db.get_ultima_seq()
+    else:
+        mod = db.get_changes_since(seq, tabelle=['ordini'])
+        nuovo_seq = mod['seq']
+        if not mod['changes']:
+            pass
+        elif mod['resync'] or any(c['operazione'] == 'D' for c in mod['changes']):
+            n = ricalcola_previsioni()
+        else:
+            ids = [c['row_id'] for c in mod['changes']]
+            conn = db.get_connection()
+            try:
+                coppie = set()
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    ph = ', '.join(['?' for _ in chunk])
+                    coppie.update((r['cliente_id'], r['azienda_id']) for r in conn.execute(
+                        f"SELECT DISTINCT cliente_id, azienda_id FROM ordini WHERE id IN ({ph})", chunk).fetchall())
+            finally:
+                conn.close()
+            for cliente_id, azienda_id in coppie:
+                n += ricalcola_previsioni(cliente_id, azienda_id)
+
+    conn = db.get_connection()
+    try:
+        conn.execute("""
+            INSERT INTO impostazioni (chiave, valore, tipo, updated_at) VALUES ('previsioni_riordino_seq', ?, 'int', ?)
+            ON CONFLICT(chiave) DO UPDATE SET valore = excluded.valore, updated_at = excluded.updated_at
+        """, (str(nuovo_seq), datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+    return n
+
+
+def inizializza_previsioni() -> int:
+    """Calcolo completo al primo utilizzo (tabella vuota ma ordini presenti)"""
+    conn = db.get_connection()
+    try:
+        vuota = not conn.execute("SELECT 1 FROM previsioni_riordino LIMIT 1").fetchone()
+        ha_ordini = bool(conn.execute("SELECT 1 FROM ordini LIMIT 1").fetchone())
+    finally:
+        conn.close()
+    return ricalcola_previsioni() if vuota and ha_ordini else 0
+
+
+# ============================================
+# LETTURE (dashboard / nuovo ordine)
+# ============================================
+
+def _finestra(giorni: int):
+    oggi = date.today()
+    return oggi.isoformat(), (oggi + timedelta(days=giorni)).isoformat()
+
+
+def _prodotti_in_scadenza(cliente_id: str = None, azienda_id: str = None, giorni: int = 7) -> List[Dict]:
+    """Coppie da riordinare entro `giorni`, con prezzo dal prefill (o dal listino).
+
+    Sono escluse le coppie in ritardo di oltre CICLI_RITARDO_MAX intervalli
+    (scadenza_max passata): il cliente ha smesso di comprare quel prodotto.
+    """
+    _allinea_modifiche()
+    oggi, fine = _finestra(giorni)
+    conn = db.get_connection()
+    try:
+        query = """
+            SELECT p.*, c.ragione_sociale, c.citta,
+                   prod.codice, prod.nome, prod.prezzo_listino,
+                   pr.prezzo_unitario AS prezzo_pref, pr.sconto_riga AS sconto_pref
+            FROM previsioni_riordino p
+            JOIN clienti c ON c.id = p.cliente_id AND c.attivo = 1
+            JOIN prodotti prod ON prod.id = p.prodotto_id AND prod.disponibile = 1
+            LEFT JOIN cliente_prodotto_pref pr
+                   ON pr.cliente_id = p.cliente_id AND pr.azienda_id = p.azienda_id AND pr.prodotto_id = p.prodotto_id
+            WHERE p.prossimo_ordine <= ? AND p.scadenza_max >= ?
+        """
+        params: List[Any] = [fine, oggi]
+        if cliente_id:
+            query += " AND p.cliente_id = ?"
+            params.append(cliente_id)
+        if azienda_id:
+            query += " AND p.azienda_id = ?"
+            params.append(azienda_id)
+        query += " ORDER BY p.prossimo_ordine, prod.nome"
+        rows = db.rows_to_list(conn.execute(query, params).fetchall())
+    finally:
+        conn.close()
+
+    out = []
+    oggi_d = date.fromisoformat(oggi)
+    for r in rows:
+        ritardo = (oggi_d - date.fromisoformat(str(r['prossimo_ordine'])[:10])).days
+        prezzo = float(r['prezzo_pref'] if r['prezzo_pref'] is not None else r['prezzo_listino'] or 0)
+        sconto = float(r['sconto_pref'] or 0)
+        r['prezzo_unitario'] = prezzo
+        r['sconto_riga'] = sconto
+        r['valore_stimato'] = r['quantita_tipica'] * prezzo * (1 - sconto / 100)
+        r['giorni_ritardo'] = max(0, ritardo)
+        out.append(r)
+    return out
+
+
+def get_clienti_in_scadenza(giorni: int = 7, azienda_id: str = None, limit: int = None) -> List[Dict]:
+    """Clienti con almeno un prodotto da riordinare entro `giorni` (ritardi recenti compresi).
+
+    Returns:
+        lista di {cliente_id, ragione_sociale, citta, num_prodotti, prima_scadenza,
+        valore_stimato, in_ritardo} ordinata per prima scadenza
+    """
+    oggi, _ = _finestra(giorni)
+    clienti: Dict[str, Dict] = {}
+    for p in _prodotti_in_scadenza(None, azienda_id, giorni):
+        c = clienti.setdefault(p['cliente_id'], {
+            'cliente_id': p['cliente_id'], 'ragione_sociale': p['ragione_sociale'], 'citta': p['citta'],
+            'num_prodotti': 0, 'prima_scadenza': p['prossimo_ordine'], 'valore_stimato': 0.0,
+        })
+        c['num_prodotti'] += 1
+        c['prima_scadenza'] = min(c['prima_scadenza'], p['prossimo_ordine'])
+        c['valore_stimato'] += p['valore_stimato']
+
+    out = sorted(clienti.values(), key=lambda c: (c['prima_scadenza'], -c['valore_stimato']))
+    for c in out:
+        c['valore_stimato'] = round(c['valore_stimato'], 2)
+        c['in_ritardo'] = c['prima_scadenza'] < oggi
+    return out[:limit] if limit else out
+
+
+def get_carrello_suggerito(cliente_id: str, azienda_id: str, giorni: int = 7) -> List[Dict]:
+    """Righe d'ordine precompilate (stesso formato del carrello in sessione) con i prodotti in scadenza"""
+    righe = []
+    for p in _prodotti_in_scadenza(cliente_id, azienda_id, giorni):
+        qta = int(p['quantita_tipica'])
+        prezzo_finale = p['prezzo_unitario'] * (1 - p['sconto_riga'] / 100)
+        righe.append({
+            'prodotto_id': p['prodotto_id'],
+            'prodotto_codice': p['codice'],
+            'prodotto_nome': p['nome'],
+            'pezzi_per_cartone': PEZZI_PER_CARTONE,
+            'quantita_cartoni': qta // PEZZI_PER_CARTONE,
+            'quantita_pezzi': qta % PEZZI_PER_CARTONE,
+            'quantita_totale': qta,
+            'prezzo_unitario': p['prezzo_unitario'],
+            'sconto_riga': p['sconto_riga'],
+            'prezzo_finale': prezzo_finale,
+            'importo_riga': qta * prezzo_finale,
+        })
+    return righe
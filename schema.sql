@@ -39,6 +39,9 @@ CREATE TABLE IF NOT EXISTS appuntamenti (
     cliente_id TEXT,
     luogo TEXT,
     note TEXT,
+    durata_minuti INTEGER,  -- NULL = impostazione agenda_durata_appuntamento
+    ricorrenza TEXT,  -- regola RRULE (es. FREQ=WEEKLY;BYDAY=MO); NULL = appuntamento singolo
+    ricorrenza_fine DATE,  -- ultima data possibile della serie (NULL = illimitata)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE SET NULL
@@ -83,6 +86,9 @@ CREATE TABLE IF NOT EXISTS clienti (
     categoria TEXT DEFAULT 'C',  -- A, B, C
     zona TEXT,
     canale TEXT,  -- GDO, HORECA, DETTAGLIO, etc.
+    -- Posizione (gradi decimali WGS84, opzionale: percorsi visite)
+    latitudine REAL,
+    longitudine REAL,
     note TEXT,
     attivo INTEGER DEFAULT 1,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -143,6 +149,13 @@ CREATE TABLE IF NOT EXISTS ordini (
     imponibile REAL DEFAULT 0,
     sconto_chiusura REAL DEFAULT 0,
     totale_finale REAL DEFAULT 0,
+    -- Contatori righe (mantenuti da save_ordine, verificati da verifica_contatori_ordini)
+    num_righe INTEGER DEFAULT 0,
+    num_prodotti INTEGER DEFAULT 0,
+    valore_listino REAL DEFAULT 0,  -- Σ prezzo_unitario × quantità (prima degli sconti)
+    valore_venduto REAL DEFAULT 0,  -- Σ importo_riga
+    -- Categoria del cliente (A/B/C) alla data dell'ordine: aliquote provvigioni
+    categoria_cliente TEXT,
     -- Stato
     stato TEXT DEFAULT 'bozza',  -- bozza, inviato, confermato, evaso, annullato
     -- Note
@@ -192,6 +205,9 @@ CREATE TABLE IF NOT EXISTS cliente_prodotto_pref (
     sconto_riga REAL DEFAULT 0,
     quantita_cartoni INTEGER DEFAULT 0,
     quantita_pezzi INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,  -- ordini del cliente con il prodotto
+    ultimo_ordine TEXT,            -- data dell'ultimo ordine con il prodotto
+    affinita REAL,               -- log(1 + num_ordini) + giorno(ultimo_ordine) / 60
     updated_at TEXT,
     PRIMARY KEY (cliente_id, azienda_id, prodotto_id),
     FOREIGN KEY (cliente_id) REFERENCES clienti(id),
@@ -199,6 +215,182 @@ CREATE TABLE IF NOT EXISTS cliente_prodotto_pref (
     FOREIGN KEY (prodotto_id) REFERENCES prodotti(id)
 );
 
+-- Tabella STORICO_PREZZI (prezzi praticati per cliente/prodotto nel tempo)
+-- Append-only a intervalli: una riga per ogni CAMBIO di prezzo; gli ordini
+-- successivi allo stesso prezzo allungano solo ultimo_visto.
+-- Prezzo alla data D = riga con il valido_dal più recente <= D.
+CREATE TABLE IF NOT EXISTS storico_prezzi (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cliente_id TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    prezzo_unitario REAL NOT NULL,
+    sconto_riga REAL DEFAULT 0,
+    prezzo_finale REAL NOT NULL,
+    valido_dal DATE NOT NULL,    -- data del primo ordine con questo prezzo
+    ultimo_visto DATE NOT NULL,  -- data dell'ultimo ordine con questo prezzo
+    ordine_id TEXT,               -- primo ordine dell'intervallo
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE CASCADE,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE
+);
+
+-- Tabella PREVISIONI_RIORDINO (calcolata da riordini.py sullo storico ordini)
+CREATE TABLE IF NOT EXISTS previsioni_riordino (
+    cliente_id TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,
+    intervallo_giorni REAL,  -- mediana dei giorni tra due ordini
+    intervallo_std REAL,
+    quantita_tipica INTEGER,  -- mediana dei pezzi per ordine
+    ultimo_ordine DATE,
+    prossimo_ordine DATE,
+    scadenza_max DATE,  -- oltre questa data il cliente ha smesso di comprare il prodotto
+    affidabilita REAL,  -- 0..1 (regolarità × lunghezza storia)
+    updated_at TEXT,
+    PRIMARY KEY (cliente_id, azienda_id, prodotto_id)
+);
+
+-- Tabella CLIENTI_RFM (cache della segmentazione, calcolata da segmentazione.py)
+CREATE TABLE IF NOT EXISTS clienti_rfm (
+    cliente_id TEXT PRIMARY KEY,
+    recency_giorni INTEGER,  -- giorni dall'ultimo ordine
+    frequenza INTEGER,       -- ordini nella finestra
+    valore REAL,            -- fatturato nella finestra
+    ultimo_ordine DATE,
+    quota_cumulata REAL,    -- quota Pareto cumulata del fatturato
+    categoria TEXT,          -- A, B, C
+    updated_at TEXT,
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE CASCADE
+);
+
+-- Tabella PREVISIONI_FATTURATO (cache dei modelli di previsione_fatturato.py)
+-- chiave: 'totale' oppure l'id dell'azienda; il modello si riadatta solo
+-- quando chiude un nuovo mese o cambia la serie storica (impronta).
+CREATE TABLE IF NOT EXISTS previsioni_fatturato (
+    chiave TEXT PRIMARY KEY,
+    ultimo_mese_chiuso TEXT,  -- YYYY-MM dell'ultimo mese usato nel fit
+    impronta TEXT,            -- hash della serie mensile usata nel fit
+    modello TEXT,             -- holt_winters, holt, media
+    parametri TEXT,           -- JSON (alpha, beta, gamma, rmse, ...)
+    previsione TEXT,          -- JSON [{mese, fatturato, min, max}]
+    updated_at TEXT
+);
+
+-- Tabelle COACQUISTI (indice prodotti acquistati insieme, per azienda)
+-- Mantenute da save_ordine/update_stato_ordine/delete_ordine; ordini annullati esclusi.
+CREATE TABLE IF NOT EXISTS coacquisti_aziende (
+    azienda_id TEXT PRIMARY KEY,
+    num_ordini INTEGER DEFAULT 0  -- ordini indicizzati dell'azienda
+);
+
+CREATE TABLE IF NOT EXISTS coacquisti_prodotti (
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono il prodotto
+    PRIMARY KEY (azienda_id, prodotto_id)
+);
+
+CREATE TABLE IF NOT EXISTS coacquisti (
+    azienda_id TEXT NOT NULL,
+    prodotto_a TEXT NOT NULL,
+    prodotto_b TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono entrambi (salvata nei due versi)
+    PRIMARY KEY (azienda_id, prodotto_a, prodotto_b)
+);
+
+-- Tabelle CUBO VENDITE (aggregati per analisi pivot/drill-down, vedi query_cubo)
+-- Ordini validi (inviato, confermato, evaso) per mese; mantenute da
+-- save_ordine/update_stato_ordine/delete_ordine. Fatturato = importi riga.
+CREATE TABLE IF NOT EXISTS cubo_vendite (
+    mese TEXT NOT NULL,  -- YYYY-MM
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    fatturato REAL DEFAULT 0,
+    pezzi INTEGER DEFAULT 0,
+    cartoni INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono il prodotto
+    PRIMARY KEY (mese, azienda_id, cliente_id, prodotto_id)
+);
+
+CREATE TABLE IF NOT EXISTS cubo_ordini (
+    mese TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT NOT NULL,
+    fatturato REAL DEFAULT 0,
+    pezzi INTEGER DEFAULT 0,
+    cartoni INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,
+    PRIMARY KEY (mese, azienda_id, cliente_id)
+);
+
+-- Tabella PROVVIGIONI_ALIQUOTE (aliquote per mandante)
+-- Vince la regola più specifica: prodotto + categoria cliente, prodotto,
+-- categoria cliente, aliquota base dell'azienda (prodotto e categoria vuoti).
+CREATE TABLE IF NOT EXISTS provvigioni_aliquote (
+    id TEXT PRIMARY KEY,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT,
+    categoria_cliente TEXT,  -- A, B, C
+    aliquota REAL NOT NULL,  -- percentuale sull'imponibile di riga
+    valido_dal DATE,
+    valido_al DATE,
+    note TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (azienda_id) REFERENCES aziende(id) ON DELETE CASCADE,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE
+);
+
+-- Tabelle PROVVIGIONI (provvigione maturata per ordine evaso ed estratto conto mensile per mandante)
+-- Restano anche dopo l'archiviazione degli ordini.
+CREATE TABLE IF NOT EXISTS provvigioni_ordini (
+    ordine_id TEXT PRIMARY KEY,
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT,
+    numero TEXT,
+    data_ordine DATE,
+    mese TEXT NOT NULL,  -- YYYY-MM
+    categoria_cliente TEXT,  -- categoria usata per le aliquote
+    imponibile REAL DEFAULT 0,
+    provvigione REAL DEFAULT 0,
+    calcolato_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS provvigioni_estratti (
+    azienda_id TEXT NOT NULL,
+    mese TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,
+    imponibile REAL DEFAULT 0,
+    provvigione REAL DEFAULT 0,
+    updated_at TEXT,
+    PRIMARY KEY (azienda_id, mese)
+);
+
+-- Tabella DISTANZE_CLIENTI (cache delle distanze tra clienti per i percorsi)
+-- Coppie con cliente_a < cliente_b; svuotata per un cliente quando cambiano le coordinate.
+CREATE TABLE IF NOT EXISTS distanze_clienti (
+    cliente_a TEXT NOT NULL,
+    cliente_b TEXT NOT NULL,
+    km REAL NOT NULL,
+    PRIMARY KEY (cliente_a, cliente_b)
+);
+
+-- Indice spaziale dei clienti attivi con coordinate ("clienti vicini")
+-- R*Tree con un punto per cliente; l'id intero dell'R*Tree è mappato sull'id del cliente.
+-- Mantenuto dai trigger trg_clienti_geo_* (fine file).
+CREATE TABLE IF NOT EXISTS clienti_geo_id (
+    geo_id INTEGER PRIMARY KEY,
+    cliente_id TEXT NOT NULL UNIQUE
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS clienti_geo USING rtree(
+    id,
+    min_lat, max_lat,
+    min_lon, max_lon
+);
+
 -- Tabella VISITE (Storico visite clienti)
 CREATE TABLE IF NOT EXISTS visite (
     id TEXT PRIMARY KEY,
@@ -248,11 +440,106 @@ CREATE TABLE IF NOT EXISTS promemoria (
     priorita TEXT DEFAULT 'media',  -- alta, media, bassa
     completato INTEGER DEFAULT 0,
     data_completamento TIMESTAMP,
+    ricorrenza TEXT,
+    ricorrenza_fine DATE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (cliente_id) REFERENCES clienti(id),
     FOREIGN KEY (ordine_id) REFERENCES ordini(id)
 );
 
+-- Tabella RICORRENZE_ECCEZIONI (occorrenze annullate, spostate, modificate o completate)
+-- tipo: appuntamento, promemoria; data_originale identifica l'occorrenza nella serie.
+CREATE TABLE IF NOT EXISTS ricorrenze_eccezioni (
+    tipo TEXT NOT NULL,
+    serie_id TEXT NOT NULL,
+    data_originale DATE NOT NULL,
+    annullata INTEGER DEFAULT 0,
+    completata INTEGER DEFAULT 0,
+    data_completamento TIMESTAMP,
+    nuova_data DATE,
+    nuova_ora TEXT,
+    titolo TEXT,
+    note TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tipo, serie_id, data_originale)
+);
+
+-- Tabella RICORRENZE_CACHE (date delle serie espanse per mese, eccezioni escluse)
+-- Svuotata per una serie quando la serie viene salvata.
+CREATE TABLE IF NOT EXISTS ricorrenze_cache (
+    tipo TEXT NOT NULL,
+    serie_id TEXT NOT NULL,
+    mese TEXT NOT NULL,  -- YYYY-MM
+    giorni TEXT NOT NULL,  -- YYYY-MM-DD separate da virgola (vuoto: nessuna occorrenza)
+    PRIMARY KEY (tipo, serie_id, mese)
+);
+
+-- Indice degli impegni con orario (appuntamenti singoli, visite pianificate)
+-- R*Tree a interi: intervalli [inizio, fine) in minuti dal 1970-01-01 per le sovrapposizioni.
+CREATE TABLE IF NOT EXISTS impegni_slot_id (
+    slot_id INTEGER PRIMARY KEY,
+    tipo TEXT NOT NULL,  -- appuntamento, visita
+    rif_id TEXT NOT NULL,
+    UNIQUE (tipo, rif_id)
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS impegni_slot USING rtree_i32(
+    id,
+    inizio, fine
+);
+
+-- Coda dei lavori in background (vedi coda_lavori.py)
+-- stato: in_coda, in_corso, completato, fallito. Un lavoro in errore torna in_coda
+-- con prossimo_tentativo ritardato (backoff esponenziale) fino a max_tentativi.
+CREATE TABLE IF NOT EXISTS lavori (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,  -- pdf_ordine
+    ordine_id TEXT,
+    payload TEXT,  -- JSON
+    stato TEXT NOT NULL DEFAULT 'in_coda',
+    tentativi INTEGER DEFAULT 0,
+    max_tentativi INTEGER DEFAULT 5,
+    prossimo_tentativo TIMESTAMP NOT NULL,
+    errore TEXT,
+    worker TEXT,
+    iniziato_at TIMESTAMP,
+    completato_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- PDF degli ordini generati in background (validi finché ordini.updated_at non cambia)
+CREATE TABLE IF NOT EXISTS ordini_pdf (
+    ordine_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    contenuto BLOB NOT NULL,
+    ordine_updated_at TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Outbox delle email (scritte nella stessa transazione del dato che le origina)
+-- chiave: identifica il messaggio, una chiave già presente non viene riaccodata.
+-- stato: da_inviare, in_invio, inviata, fallita (dopo coda_max_tentativi).
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id TEXT PRIMARY KEY,
+    chiave TEXT NOT NULL UNIQUE,
+    ordine_id TEXT,
+    destinatario TEXT NOT NULL,
+    cc TEXT,
+    oggetto TEXT,
+    corpo TEXT,
+    allegato TEXT,  -- riferimento: pdf_ordine (PDF di ordine_id) o NULL
+    stato TEXT NOT NULL DEFAULT 'da_inviare',
+    tentativi INTEGER DEFAULT 0,
+    prossimo_tentativo TIMESTAMP NOT NULL,
+    errore TEXT,
+    worker TEXT,
+    iniziato_at TIMESTAMP,
+    inviata_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Tabella AGENTE (Dati agente per documenti)
 CREATE TABLE IF NOT EXISTS agente (
     id TEXT PRIMARY KEY,
@@ -288,6 +575,50 @@ CREATE TABLE IF NOT EXISTS impostazioni (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Tabella CHANGE_LOG (Change Data Capture)
+-- Ogni modifica alle tabelle principali viene registrata dai trigger con una
+-- sequenza monotona (AUTOINCREMENT: mai riutilizzata, anche dopo la compattazione).
+-- I consumatori (export, integrazioni, sync) leggono solo le modifiche dopo
+-- l'ultima sequenza vista: vedi get_changes_since() in db.py.
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tabella TEXT NOT NULL,
+    row_id TEXT NOT NULL,
+    operazione TEXT NOT NULL,  -- I (insert), U (update), D (delete)
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Tabella SYNC_DISPOSITIVI (dispositivi offline degli agenti)
+CREATE TABLE IF NOT EXISTS sync_dispositivi (
+    device_id TEXT PRIMARY KEY,
+    nome TEXT,
+    ultimo_checkpoint INTEGER DEFAULT 0,  -- seq del change_log già ricevuta
+    ultimo_pull TIMESTAMP,
+    ultimo_push TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Tabella SYNC_ID_MAP (ID/numeri creati offline -> ID/numeri definitivi sul server)
+CREATE TABLE IF NOT EXISTS sync_id_map (
+    device_id TEXT NOT NULL,
+    tipo TEXT NOT NULL,  -- cliente, ordine
+    id_locale TEXT NOT NULL,
+    id_server TEXT NOT NULL,
+    numero_locale TEXT,
+    numero_server TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (device_id, tipo, id_locale),
+    FOREIGN KEY (device_id) REFERENCES sync_dispositivi(device_id) ON DELETE CASCADE
+);
+
+-- Tabella ARCHIVI_ORDINI (registro archivi annuali: <nome db>_archivio_AAAA.db)
+CREATE TABLE IF NOT EXISTS archivi_ordini (
+    anno INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,  -- nome file, nella stessa cartella del database
+    num_ordini INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- ============================================
 -- INDICI PER PERFORMANCE
 -- ============================================
@@ -297,12 +628,28 @@ CREATE INDEX IF NOT EXISTS idx_ordini_azienda ON ordini(azienda_id);
 CREATE INDEX IF NOT EXISTS idx_ordini_cliente ON ordini(cliente_id);
 CREATE INDEX IF NOT EXISTS idx_ordini_stato ON ordini(stato);
 CREATE INDEX IF NOT EXISTS idx_ordini_data ON ordini(data_ordine);
+CREATE INDEX IF NOT EXISTS idx_ordini_stato_data ON ordini(stato, data_ordine);
 CREATE INDEX IF NOT EXISTS idx_ordini_righe_ordine ON ordini_righe(ordine_id);
 CREATE INDEX IF NOT EXISTS idx_visite_cliente ON visite(cliente_id);
 CREATE INDEX IF NOT EXISTS idx_visite_data ON visite(data_visita);
+CREATE INDEX IF NOT EXISTS idx_appuntamenti_data ON appuntamenti(data, ora);
 CREATE INDEX IF NOT EXISTS idx_visite_pianificate_data ON visite_pianificate(data_pianificata);
 CREATE INDEX IF NOT EXISTS idx_promemoria_scadenza ON promemoria(data_scadenza);
-CREATE INDEX IF NOT EXISTS idx_promemoria_completato ON promemoria(completato);
+CREATE INDEX IF NOT EXISTS idx_promemoria_attivi_scadenza ON promemoria(completato, data_scadenza);
+CREATE INDEX IF NOT EXISTS idx_ricorrenze_eccezioni_nuova_data ON ricorrenze_eccezioni(tipo, nuova_data);
+CREATE INDEX IF NOT EXISTS idx_storico_prezzi ON storico_prezzi(cliente_id, prodotto_id, valido_dal);
+CREATE INDEX IF NOT EXISTS idx_previsioni_riordino_prossimo ON previsioni_riordino(prossimo_ordine);
+CREATE INDEX IF NOT EXISTS idx_cubo_vendite_prodotto ON cubo_vendite(prodotto_id, mese);
+CREATE INDEX IF NOT EXISTS idx_cubo_ordini_cliente ON cubo_ordini(cliente_id, mese);
+CREATE INDEX IF NOT EXISTS idx_provvigioni_aliquote_azienda ON provvigioni_aliquote(azienda_id);
+CREATE INDEX IF NOT EXISTS idx_provvigioni_ordini_azienda ON provvigioni_ordini(azienda_id, mese);
+CREATE INDEX IF NOT EXISTS idx_clienti_categoria ON clienti(categoria, ragione_sociale);
+CREATE INDEX IF NOT EXISTS idx_change_log_riga ON change_log(tabella, row_id, seq);
+CREATE INDEX IF NOT EXISTS idx_change_log_data ON change_log(changed_at);
+CREATE INDEX IF NOT EXISTS idx_lavori_coda ON lavori(stato, prossimo_tentativo);
+CREATE INDEX IF NOT EXISTS idx_lavori_ordine ON lavori(ordine_id);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_coda ON email_outbox(stato, prossimo_tentativo);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_ordine ON email_outbox(ordine_id);
 
 -- ============================================
 -- IMPOSTAZIONI DEFAULT
@@ -318,7 +665,27 @@ INSERT OR IGNORE INTO impostazioni (chiave, valore, tipo, descrizione) VALUES
     ('iva_default', '22', 'float', 'Aliquota IVA default (non usata per imponibile)'),
     ('pagamento_default', 'Bonifico 30gg', 'string', 'Pagamento predefinito'),
     ('consegna_default', 'Franco destino', 'string', 'Tipo consegna predefinito'),
-    ('tema', 'light', 'string', 'Tema interfaccia');
+    ('tema', 'light', 'string', 'Tema interfaccia'),
+    ('change_log_giorni_compattazione', '7', 'int', 'Change log: dopo quanti giorni tenere solo l''ultima modifica per riga'),
+    ('change_log_giorni_cancellazioni', '90', 'int', 'Change log: dopo quanti giorni eliminare le cancellazioni (richiede resync)'),
+    ('change_log_watermark', '0', 'int', 'Change log: sequenza sotto la quale serve un resync completo'),
+    ('archivio_orizzonte_giorni', '730', 'int', 'Archivio: età minima (giorni) degli ordini evasi/annullati da archiviare'),
+    ('segmentazione_soglia_a', '0.80', 'float', 'Segmentazione: quota cumulata di fatturato dei clienti A'),
+    ('segmentazione_soglia_b', '0.95', 'float', 'Segmentazione: quota cumulata di fatturato dei clienti A+B'),
+    ('segmentazione_mesi', '12', 'int', 'Segmentazione: mesi di storico ordini considerati'),
+    ('percorso_ora_partenza', '08:30', 'string', 'Percorsi: ora di partenza del giro visite'),
+    ('percorso_durata_visita', '30', 'int', 'Percorsi: durata media di una visita (minuti)'),
+    ('percorso_velocita_kmh', '45', 'float', 'Percorsi: velocità media di spostamento (km/h)'),
+    ('percorso_fattore_strada', '1.3', 'float', 'Percorsi: rapporto tra distanza stradale e in linea d''aria'),
+    ('percorso_partenza_lat', '', 'float', 'Percorsi: latitudine del punto di partenza (vuoto: prima tappa)'),
+    ('percorso_partenza_lon', '', 'float', 'Percorsi: longitudine del punto di partenza'),
+    ('agenda_ora_inizio', '08:30', 'string', 'Agenda: inizio orario di lavoro per le fasce libere'),
+    ('agenda_ora_fine', '19:00', 'string', 'Agenda: fine orario di lavoro per le fasce libere'),
+    ('agenda_durata_appuntamento', '60', 'int', 'Agenda: durata in minuti degli appuntamenti senza durata'),
+    ('coda_worker', '2', 'int', 'Coda lavori: numero di thread worker per PDF ed email'),
+    ('coda_max_tentativi', '5', 'int', 'Coda lavori: tentativi prima di segnare un lavoro come fallito'),
+    ('coda_backoff_secondi', '30', 'int', 'Coda lavori: attesa prima del secondo tentativo (raddoppia a ogni errore)'),
+    ('coda_backoff_max_secondi', '3600', 'int', 'Coda lavori: attesa massima tra due tentativi');
 
 -- ============================================
 -- VISTE UTILI
@@ -332,8 +699,7 @@ SELECT
     a.ragione_sociale AS azienda_ragione_sociale,
     c.ragione_sociale AS cliente_ragione_sociale,
     c.citta AS cliente_citta,
-    c.provincia AS cliente_provincia,
-    (SELECT COUNT(*) FROM ordini_righe WHERE ordine_id = o.id) AS num_righe
+    c.provincia AS cliente_provincia
 FROM ordini o
 LEFT JOIN aziende a ON o.azienda_id = a.id
 LEFT JOIN clienti c ON o.cliente_id = c.id;
@@ -373,3 +739,99 @@ FROM promemoria p
 LEFT JOIN clienti c ON p.cliente_id = c.id
 WHERE p.completato = 0
 ORDER BY p.data_scadenza ASC, p.priorita DESC;
+
+-- ============================================
+-- TRIGGER CHANGE DATA CAPTURE
+-- ============================================
+
+CREATE TRIGGER IF NOT EXISTS trg_aziende_cdc_ins AFTER INSERT ON aziende
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('aziende', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_aziende_cdc_upd AFTER UPDATE ON aziende
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('aziende', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_aziende_cdc_del AFTER DELETE ON aziende
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('aziende', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_clienti_cdc_ins AFTER INSERT ON clienti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('clienti', NEW.id, 'I'); END;
+-- la sola riclassificazione ABC (categoria senza updated_at) non va ai dispositivi
+CREATE TRIGGER IF NOT EXISTS trg_clienti_cdc_upd AFTER UPDATE ON clienti
+WHEN NEW.updated_at IS NOT OLD.updated_at OR NEW.categoria IS OLD.categoria
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('clienti', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_clienti_cdc_del AFTER DELETE ON clienti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('clienti', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_prodotti_cdc_ins AFTER INSERT ON prodotti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('prodotti', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_prodotti_cdc_upd AFTER UPDATE ON prodotti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('prodotti', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_prodotti_cdc_del AFTER DELETE ON prodotti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('prodotti', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_ordini_cdc_ins AFTER INSERT ON ordini
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_ordini_cdc_upd AFTER UPDATE ON ordini
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_ordini_cdc_del AFTER DELETE ON ordini
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_ordini_righe_cdc_ins AFTER INSERT ON ordini_righe
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini_righe', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_ordini_righe_cdc_upd AFTER UPDATE ON ordini_righe
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini_righe', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_ordini_righe_cdc_del AFTER DELETE ON ordini_righe
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('ordini_righe', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_promemoria_cdc_ins AFTER INSERT ON promemoria
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('promemoria', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_promemoria_cdc_upd AFTER UPDATE ON promemoria
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('promemoria', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_promemoria_cdc_del AFTER DELETE ON promemoria
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('promemoria', OLD.id, 'D'); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_appuntamenti_cdc_ins AFTER INSERT ON appuntamenti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('appuntamenti', NEW.id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_appuntamenti_cdc_upd AFTER UPDATE ON appuntamenti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('appuntamenti', NEW.id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_appuntamenti_cdc_del AFTER DELETE ON appuntamenti
+BEGIN INSERT INTO change_log (tabella, row_id, operazione) VALUES ('appuntamenti', OLD.id, 'D'); END;
+
+-- cliente_prodotto_pref ha chiave composta: row_id = cliente_id|azienda_id|prodotto_id
+CREATE TRIGGER IF NOT EXISTS trg_cliente_prodotto_pref_cdc_ins AFTER INSERT ON cliente_prodotto_pref
+BEGIN INSERT INTO change_log (tabella, row_id, operazione)
+      VALUES ('cliente_prodotto_pref', NEW.cliente_id || '|' || NEW.azienda_id || '|' || NEW.prodotto_id, 'I'); END;
+CREATE TRIGGER IF NOT EXISTS trg_cliente_prodotto_pref_cdc_upd AFTER UPDATE ON cliente_prodotto_pref
+BEGIN INSERT INTO change_log (tabella, row_id, operazione)
+      VALUES ('cliente_prodotto_pref', NEW.cliente_id || '|' || NEW.azienda_id || '|' || NEW.prodotto_id, 'U'); END;
+CREATE TRIGGER IF NOT EXISTS trg_cliente_prodotto_pref_cdc_del AFTER DELETE ON cliente_prodotto_pref
+BEGIN INSERT INTO change_log (tabella, row_id, operazione)
+      VALUES ('cliente_prodotto_pref', OLD.cliente_id || '|' || OLD.azienda_id || '|' || OLD.prodotto_id, 'D'); END;
+
+-- ============================================
+-- TRIGGER INDICE SPAZIALE CLIENTI
+-- ============================================
+
+CREATE TRIGGER IF NOT EXISTS trg_clienti_geo_ins AFTER INSERT ON clienti
+WHEN NEW.attivo = 1 AND NEW.latitudine IS NOT NULL AND NEW.longitudine IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO clienti_geo_id (cliente_id) VALUES (NEW.id);
+    INSERT OR REPLACE INTO clienti_geo (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT geo_id, NEW.latitudine, NEW.latitudine, NEW.longitudine, NEW.longitudine
+    FROM clienti_geo_id WHERE cliente_id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_clienti_geo_upd AFTER UPDATE OF latitudine, longitudine, attivo ON clienti
+BEGIN
+    DELETE FROM clienti_geo WHERE id = (SELECT geo_id FROM clienti_geo_id WHERE cliente_id = OLD.id);
+    INSERT OR IGNORE INTO clienti_geo_id (cliente_id)
+    SELECT NEW.id WHERE NEW.attivo = 1 AND NEW.latitudine IS NOT NULL AND NEW.longitudine IS NOT NULL;
+    INSERT INTO clienti_geo (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT geo_id, NEW.latitudine, NEW.latitudine, NEW.longitudine, NEW.longitudine
+    FROM clienti_geo_id
+    WHERE cliente_id = NEW.id AND NEW.attivo = 1 AND NEW.latitudine IS NOT NULL AND NEW.longitudine IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_clienti_geo_del AFTER DELETE ON clienti
+BEGIN
+    DELETE FROM clienti_geo WHERE id = (SELECT geo_id FROM clienti_geo_id WHERE cliente_id = OLD.id);
+    DELETE FROM clienti_geo_id WHERE cliente_id = OLD.id;
+END;
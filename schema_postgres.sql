@@ -0,0 +1,850 @@
+-- ============================================
+-- PORTALE AGENTE DI COMMERCIO
+-- Schema Database PostgreSQL (DB_BACKEND=postgres)
+-- ============================================
+-- Stesse tabelle di schema.sql. Date e timestamp restano TEXT in formato ISO
+-- (come in SQLite), così confronti, ordinamenti e formattazione nella UI
+-- funzionano allo stesso modo su entrambi i backend.
+-- Lo script è idempotente: viene eseguito a ogni init_db().
+
+-- Tabella AZIENDE (Fornitori/Mandanti)
+CREATE TABLE IF NOT EXISTS aziende (
+    id TEXT PRIMARY KEY,
+    codice TEXT UNIQUE,
+    nome TEXT NOT NULL,
+    ragione_sociale TEXT,
+    indirizzo TEXT,
+    citta TEXT,
+    provincia TEXT,
+    cap TEXT,
+    telefono TEXT,
+    email TEXT,
+    pec TEXT,
+    partita_iva TEXT,
+    codice_fiscale TEXT,
+    iban TEXT,
+    banca TEXT,
+    note TEXT,
+    logo_path TEXT,
+    -- Logo embedded (per Streamlit Cloud: salviamo base64 nel DB)
+    logo_b64 TEXT,
+    logo_mime TEXT,
+    attivo INTEGER DEFAULT 1,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Tabella CLIENTI (Committenti/Acquirenti)
+CREATE TABLE IF NOT EXISTS clienti (
+    id TEXT PRIMARY KEY,
+    codice TEXT,
+    ragione_sociale TEXT NOT NULL,
+    nome_commerciale TEXT,
+    indirizzo TEXT,
+    citta TEXT,
+    provincia TEXT,
+    cap TEXT,
+    telefono TEXT,
+    cellulare TEXT,
+    email TEXT,
+    pec TEXT,
+    partita_iva TEXT,
+    codice_fiscale TEXT,
+    codice_sdi TEXT,
+    iban TEXT,
+    banca TEXT,
+    -- Sede di consegna alternativa
+    sede_consegna_indirizzo TEXT,
+    sede_consegna_citta TEXT,
+    sede_consegna_provincia TEXT,
+    sede_consegna_cap TEXT,
+    sede_consegna_note TEXT,
+    -- Condizioni commerciali
+    pagamento_default TEXT,
+    sconto_default DOUBLE PRECISION DEFAULT 0,
+    listino TEXT,
+    fido DOUBLE PRECISION,
+    -- Referente
+    referente_nome TEXT,
+    referente_ruolo TEXT,
+    referente_telefono TEXT,
+    referente_email TEXT,
+    -- Classificazione
+    categoria TEXT DEFAULT 'C',  -- A, B, C
+    zona TEXT,
+    canale TEXT,  -- GDO, HORECA, DETTAGLIO, etc.
+    -- Posizione (gradi decimali WGS84, opzionale: percorsi visite)
+    latitudine DOUBLE PRECISION,
+    longitudine DOUBLE PRECISION,
+    note TEXT,
+    attivo INTEGER DEFAULT 1,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+ALTER TABLE clienti ADD COLUMN IF NOT EXISTS latitudine DOUBLE PRECISION;
+ALTER TABLE clienti ADD COLUMN IF NOT EXISTS longitudine DOUBLE PRECISION;
+
+-- Tabella APPUNTAMENTI (Calendario)
+CREATE TABLE IF NOT EXISTS appuntamenti (
+    id TEXT PRIMARY KEY,
+    titolo TEXT NOT NULL,
+    data TEXT NOT NULL,
+    ora TEXT,
+    cliente_id TEXT,
+    luogo TEXT,
+    note TEXT,
+    durata_minuti INTEGER,  -- NULL = impostazione agenda_durata_appuntamento
+    ricorrenza TEXT,  -- regola RRULE (es. FREQ=WEEKLY;BYDAY=MO); NULL = appuntamento singolo
+    ricorrenza_fine TEXT,  -- ultima data possibile della serie (NULL = illimitata)
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE SET NULL
+);
+ALTER TABLE appuntamenti ADD COLUMN IF NOT EXISTS ricorrenza TEXT;
+ALTER TABLE appuntamenti ADD COLUMN IF NOT EXISTS ricorrenza_fine TEXT;
+ALTER TABLE appuntamenti ADD COLUMN IF NOT EXISTS durata_minuti INTEGER;
+
+-- Tabella PRODOTTI (Catalogo per azienda)
+CREATE TABLE IF NOT EXISTS prodotti (
+    id TEXT PRIMARY KEY,
+    azienda_id TEXT NOT NULL,
+    codice TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    descrizione TEXT,
+    categoria TEXT,
+    sottocategoria TEXT,
+    -- Unità e confezioni
+    unita_misura TEXT DEFAULT 'PZ',  -- PZ, KG, LT, etc.
+    -- In questa app: 1 cartone = 6 pezzi (regola fissa)
+    pezzi_per_cartone INTEGER DEFAULT 6,
+    peso_unitario DOUBLE PRECISION,
+    volume_unitario DOUBLE PRECISION,
+    -- Prezzi
+    prezzo_listino DOUBLE PRECISION NOT NULL,
+    prezzo_minimo DOUBLE PRECISION,
+    -- Stato
+    disponibile INTEGER DEFAULT 1,
+    in_promozione INTEGER DEFAULT 0,
+    note TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (azienda_id) REFERENCES aziende(id) ON DELETE CASCADE,
+    UNIQUE(azienda_id, codice)
+);
+
+-- Tabella ORDINI (Testata)
+CREATE TABLE IF NOT EXISTS ordini (
+    id TEXT PRIMARY KEY,
+    numero TEXT UNIQUE NOT NULL,
+    data_ordine TEXT NOT NULL,
+    -- Riferimenti
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT NOT NULL,
+    -- Sede consegna (può essere diversa da sede cliente)
+    consegna_indirizzo TEXT,
+    consegna_citta TEXT,
+    consegna_provincia TEXT,
+    consegna_cap TEXT,
+    consegna_note TEXT,
+    -- Condizioni
+    pagamento TEXT,
+    consegna_tipo TEXT,  -- Franco, Assegnato, etc.
+    resa TEXT,
+    spedizione TEXT,
+    banca TEXT,
+    -- Totali
+    totale_pezzi INTEGER DEFAULT 0,
+    totale_cartoni DOUBLE PRECISION DEFAULT 0,
+    imponibile DOUBLE PRECISION DEFAULT 0,
+    sconto_chiusura DOUBLE PRECISION DEFAULT 0,
+    totale_finale DOUBLE PRECISION DEFAULT 0,
+    -- Contatori righe (mantenuti da save_ordine, verificati da verifica_contatori_ordini)
+    num_righe INTEGER DEFAULT 0,
+    num_prodotti INTEGER DEFAULT 0,
+    valore_listino DOUBLE PRECISION DEFAULT 0,  -- Σ prezzo_unitario × quantità (prima degli sconti)
+    valore_venduto DOUBLE PRECISION DEFAULT 0,  -- Σ importo_riga
+    -- Categoria del cliente (A/B/C) alla data dell'ordine: aliquote provvigioni
+    categoria_cliente TEXT,
+    -- Stato
+    stato TEXT DEFAULT 'bozza',  -- bozza, inviato, confermato, evaso, annullato
+    -- Note
+    note TEXT,
+    note_interne TEXT,
+    -- Tracking
+    data_invio TEXT,
+    data_conferma TEXT,
+    data_evasione TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (azienda_id) REFERENCES aziende(id),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id)
+);
+
+-- Migrazione: contatori righe su database creati prima della loro introduzione
+ALTER TABLE ordini ADD COLUMN IF NOT EXISTS num_righe INTEGER DEFAULT 0;
+ALTER TABLE ordini ADD COLUMN IF NOT EXISTS num_prodotti INTEGER DEFAULT 0;
+ALTER TABLE ordini ADD COLUMN IF NOT EXISTS valore_listino DOUBLE PRECISION DEFAULT 0;
+ALTER TABLE ordini ADD COLUMN IF NOT EXISTS valore_venduto DOUBLE PRECISION DEFAULT 0;
+-- Migrazione: categoria cliente fissata all'ordine (valorizzata da _init_db_postgres)
+ALTER TABLE ordini ADD COLUMN IF NOT EXISTS categoria_cliente TEXT;
+
+-- Tabella ORDINI_RIGHE (Dettaglio articoli)
+CREATE TABLE IF NOT EXISTS ordini_righe (
+    id TEXT PRIMARY KEY,
+    ordine_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    -- Quantità
+    quantita_cartoni INTEGER DEFAULT 0,
+    quantita_pezzi INTEGER DEFAULT 0,
+    quantita_totale INTEGER DEFAULT 0,
+    -- Prezzi
+    prezzo_unitario DOUBLE PRECISION NOT NULL,
+    sconto_riga DOUBLE PRECISION DEFAULT 0,
+    prezzo_finale DOUBLE PRECISION NOT NULL,
+    importo_riga DOUBLE PRECISION NOT NULL,
+    -- Ordinamento
+    posizione INTEGER DEFAULT 0,
+    note TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (ordine_id) REFERENCES ordini(id) ON DELETE CASCADE,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id)
+);
+
+-- ============================================================
+-- PREFILL: ultimi prezzi/quantità usati dal cliente per prodotto
+-- (per precompilare l'ordine successivo, sempre modificabile)
+-- ============================================================
+CREATE TABLE IF NOT EXISTS cliente_prodotto_pref (
+    cliente_id TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    prezzo_unitario DOUBLE PRECISION NOT NULL,
+    sconto_riga DOUBLE PRECISION DEFAULT 0,
+    quantita_cartoni INTEGER DEFAULT 0,
+    quantita_pezzi INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,  -- ordini del cliente con il prodotto
+    ultimo_ordine TEXT,            -- data dell'ultimo ordine con il prodotto
+    affinita DOUBLE PRECISION,     -- log(1 + num_ordini) + giorno(ultimo_ordine) / 60
+    updated_at TEXT,
+    PRIMARY KEY (cliente_id, azienda_id, prodotto_id),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id),
+    FOREIGN KEY (azienda_id) REFERENCES aziende(id),
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id)
+);
+
+-- Migrazione: affinità prefill su database creati prima della sua introduzione
+ALTER TABLE cliente_prodotto_pref ADD COLUMN IF NOT EXISTS num_ordini INTEGER DEFAULT 0;
+ALTER TABLE cliente_prodotto_pref ADD COLUMN IF NOT EXISTS ultimo_ordine TEXT;
+ALTER TABLE cliente_prodotto_pref ADD COLUMN IF NOT EXISTS affinita DOUBLE PRECISION;
+
+-- Tabella STORICO_PREZZI (prezzi praticati per cliente/prodotto nel tempo)
+-- Append-only a intervalli: una riga per ogni CAMBIO di prezzo; gli ordini
+-- successivi allo stesso prezzo allungano solo ultimo_visto.
+-- Prezzo alla data D = riga con il valido_dal più recente <= D.
+CREATE TABLE IF NOT EXISTS storico_prezzi (
+    id BIGSERIAL PRIMARY KEY,
+    cliente_id TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    prezzo_unitario DOUBLE PRECISION NOT NULL,
+    sconto_riga DOUBLE PRECISION DEFAULT 0,
+    prezzo_finale DOUBLE PRECISION NOT NULL,
+    valido_dal TEXT NOT NULL,    -- data del primo ordine con questo prezzo
+    ultimo_visto TEXT NOT NULL,  -- data dell'ultimo ordine con questo prezzo
+    ordine_id TEXT,               -- primo ordine dell'intervallo
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE CASCADE,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE
+);
+
+-- Tabella PREVISIONI_RIORDINO (calcolata da riordini.py sullo storico ordini)
+CREATE TABLE IF NOT EXISTS previsioni_riordino (
+    cliente_id TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,
+    intervallo_giorni DOUBLE PRECISION,  -- mediana dei giorni tra due ordini
+    intervallo_std DOUBLE PRECISION,
+    quantita_tipica INTEGER,  -- mediana dei pezzi per ordine
+    ultimo_ordine TEXT,
+    prossimo_ordine TEXT,
+    scadenza_max TEXT,  -- oltre questa data il cliente ha smesso di comprare il prodotto
+    affidabilita DOUBLE PRECISION,  -- 0..1 (regolarità × lunghezza storia)
+    updated_at TEXT,
+    PRIMARY KEY (cliente_id, azienda_id, prodotto_id)
+);
+-- Migrazione: previsioni senza scadenza_max ricalcolate da riordini.inizializza_previsioni
+ALTER TABLE previsioni_riordino ADD COLUMN IF NOT EXISTS scadenza_max TEXT;
+DELETE FROM previsioni_riordino WHERE scadenza_max IS NULL;
+
+-- Tabella CLIENTI_RFM (cache della segmentazione, calcolata da segmentazione.py)
+CREATE TABLE IF NOT EXISTS clienti_rfm (
+    cliente_id TEXT PRIMARY KEY,
+    recency_giorni INTEGER,  -- giorni dall'ultimo ordine
+    frequenza INTEGER,       -- ordini nella finestra
+    valore DOUBLE PRECISION,            -- fatturato nella finestra
+    ultimo_ordine TEXT,
+    quota_cumulata DOUBLE PRECISION,    -- quota Pareto cumulata del fatturato
+    categoria TEXT,          -- A, B, C
+    updated_at TEXT,
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id) ON DELETE CASCADE
+);
+
+-- Tabella PREVISIONI_FATTURATO (cache dei modelli di previsione_fatturato.py)
+-- chiave: 'totale' oppure l'id dell'azienda; il modello si riadatta solo
+-- quando chiude un nuovo mese o cambia la serie storica (impronta).
+CREATE TABLE IF NOT EXISTS previsioni_fatturato (
+    chiave TEXT PRIMARY KEY,
+    ultimo_mese_chiuso TEXT,  -- YYYY-MM dell'ultimo mese usato nel fit
+    impronta TEXT,            -- hash della serie mensile usata nel fit
+    modello TEXT,             -- holt_winters, holt, media
+    parametri TEXT,           -- JSON (alpha, beta, gamma, rmse, ...)
+    previsione TEXT,          -- JSON [{mese, fatturato, min, max}]
+    updated_at TEXT
+);
+
+-- Tabelle COACQUISTI (indice prodotti acquistati insieme, per azienda)
+-- Mantenute da save_ordine/update_stato_ordine/delete_ordine; ordini annullati esclusi.
+CREATE TABLE IF NOT EXISTS coacquisti_aziende (
+    azienda_id TEXT PRIMARY KEY,
+    num_ordini INTEGER DEFAULT 0  -- ordini indicizzati dell'azienda
+);
+
+CREATE TABLE IF NOT EXISTS coacquisti_prodotti (
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono il prodotto
+    PRIMARY KEY (azienda_id, prodotto_id)
+);
+
+CREATE TABLE IF NOT EXISTS coacquisti (
+    azienda_id TEXT NOT NULL,
+    prodotto_a TEXT NOT NULL,
+    prodotto_b TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono entrambi (salvata nei due versi)
+    PRIMARY KEY (azienda_id, prodotto_a, prodotto_b)
+);
+
+-- Tabelle CUBO VENDITE (aggregati per analisi pivot/drill-down, vedi query_cubo)
+-- Ordini validi (inviato, confermato, evaso) per mese; mantenute da
+-- save_ordine/update_stato_ordine/delete_ordine. Fatturato = importi riga.
+CREATE TABLE IF NOT EXISTS cubo_vendite (
+    mese TEXT NOT NULL,  -- YYYY-MM
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT NOT NULL,
+    prodotto_id TEXT NOT NULL,
+    fatturato DOUBLE PRECISION DEFAULT 0,
+    pezzi INTEGER DEFAULT 0,
+    cartoni INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,  -- ordini che contengono il prodotto
+    PRIMARY KEY (mese, azienda_id, cliente_id, prodotto_id)
+);
+
+CREATE TABLE IF NOT EXISTS cubo_ordini (
+    mese TEXT NOT NULL,
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT NOT NULL,
+    fatturato DOUBLE PRECISION DEFAULT 0,
+    pezzi INTEGER DEFAULT 0,
+    cartoni INTEGER DEFAULT 0,
+    num_ordini INTEGER DEFAULT 0,
+    PRIMARY KEY (mese, azienda_id, cliente_id)
+);
+
+-- Tabella PROVVIGIONI_ALIQUOTE (aliquote per mandante)
+-- Vince la regola più specifica: prodotto + categoria cliente, prodotto,
+-- categoria cliente, aliquota base dell'azienda (prodotto e categoria vuoti).
+CREATE TABLE IF NOT EXISTS provvigioni_aliquote (
+    id TEXT PRIMARY KEY,
+    azienda_id TEXT NOT NULL,
+    prodotto_id TEXT,
+    categoria_cliente TEXT,  -- A, B, C
+    aliquota DOUBLE PRECISION NOT NULL,  -- percentuale sull'imponibile di riga
+    valido_dal TEXT,
+    valido_al TEXT,
+    note TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (azienda_id) REFERENCES aziende(id) ON DELETE CASCADE,
+    FOREIGN KEY (prodotto_id) REFERENCES prodotti(id) ON DELETE CASCADE
+);
+
+-- Tabelle PROVVIGIONI (provvigione maturata per ordine evaso ed estratto conto mensile per mandante)
+-- Restano anche dopo l'archiviazione degli ordini.
+CREATE TABLE IF NOT EXISTS provvigioni_ordini (
+    ordine_id TEXT PRIMARY KEY,
+    azienda_id TEXT NOT NULL,
+    cliente_id TEXT,
+    numero TEXT,
+    data_ordine TEXT,
+    mese TEXT NOT NULL,  -- YYYY-MM
+    categoria_cliente TEXT,  -- categoria usata per le aliquote
+    imponibile DOUBLE PRECISION DEFAULT 0,
+    provvigione DOUBLE PRECISION DEFAULT 0,
+    calcolato_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS provvigioni_estratti (
+    azienda_id TEXT NOT NULL,
+    mese TEXT NOT NULL,
+    num_ordini INTEGER DEFAULT 0,
+    imponibile DOUBLE PRECISION DEFAULT 0,
+    provvigione DOUBLE PRECISION DEFAULT 0,
+    updated_at TEXT,
+    PRIMARY KEY (azienda_id, mese)
+);
+
+-- Tabella DISTANZE_CLIENTI (cache delle distanze tra clienti per i percorsi)
+-- Coppie con cliente_a < cliente_b; svuotata per un cliente quando cambiano le coordinate.
+CREATE TABLE IF NOT EXISTS distanze_clienti (
+    cliente_a TEXT NOT NULL,
+    cliente_b TEXT NOT NULL,
+    km DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (cliente_a, cliente_b)
+);
+
+-- Tabella VISITE (Storico visite clienti)
+CREATE TABLE IF NOT EXISTS visite (
+    id TEXT PRIMARY KEY,
+    cliente_id TEXT NOT NULL,
+    data_visita TEXT NOT NULL,
+    ora_visita TEXT,
+    -- Esito
+    esito TEXT,  -- positivo, negativo, ricontattare
+    ordine_effettuato INTEGER DEFAULT 0,
+    ordine_id TEXT,
+    importo_ordine DOUBLE PRECISION,
+    -- Note
+    note TEXT,
+    prossima_azione TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id),
+    FOREIGN KEY (ordine_id) REFERENCES ordini(id)
+);
+
+-- Tabella VISITE_PIANIFICATE (Calendario visite)
+CREATE TABLE IF NOT EXISTS visite_pianificate (
+    id TEXT PRIMARY KEY,
+    cliente_id TEXT NOT NULL,
+    data_pianificata TEXT NOT NULL,
+    ora_inizio TEXT,
+    ora_fine TEXT,
+    tipo TEXT DEFAULT 'visita',  -- visita, telefonata, altro
+    priorita TEXT DEFAULT 'normale',  -- alta, normale, bassa
+    note TEXT,
+    completata INTEGER DEFAULT 0,
+    visita_id TEXT,  -- collegamento a visita effettuata
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id),
+    FOREIGN KEY (visita_id) REFERENCES visite(id)
+);
+
+-- Tabella PROMEMORIA
+CREATE TABLE IF NOT EXISTS promemoria (
+    id TEXT PRIMARY KEY,
+    titolo TEXT NOT NULL,
+    descrizione TEXT,
+    cliente_id TEXT,
+    ordine_id TEXT,
+    tipo TEXT DEFAULT 'generico',  -- chiamata, preventivo, sollecito, ricontatto, scadenza, generico
+    data_scadenza TEXT NOT NULL,
+    ora_scadenza TEXT,
+    priorita TEXT DEFAULT 'media',  -- alta, media, bassa
+    completato INTEGER DEFAULT 0,
+    data_completamento TEXT,
+    ricorrenza TEXT,
+    ricorrenza_fine TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    FOREIGN KEY (cliente_id) REFERENCES clienti(id),
+    FOREIGN KEY (ordine_id) REFERENCES ordini(id)
+);
+
+-- Tabella RICORRENZE_ECCEZIONI (occorrenze annullate, spostate, modificate o completate)
+-- tipo: appuntamento, promemoria; data_originale identifica l'occorrenza nella serie.
+CREATE TABLE IF NOT EXISTS ricorrenze_eccezioni (
+    tipo TEXT NOT NULL,
+    serie_id TEXT NOT NULL,
+    data_originale TEXT NOT NULL,
+    annullata INTEGER DEFAULT 0,
+    completata INTEGER DEFAULT 0,
+    data_completamento TEXT,
+    nuova_data TEXT,
+    nuova_ora TEXT,
+    titolo TEXT,
+    note TEXT,
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    PRIMARY KEY (tipo, serie_id, data_originale)
+);
+
+-- Tabella RICORRENZE_CACHE (date delle serie espanse per mese, eccezioni escluse)
+-- Svuotata per una serie quando la serie viene salvata.
+CREATE TABLE IF NOT EXISTS ricorrenze_cache (
+    tipo TEXT NOT NULL,
+    serie_id TEXT NOT NULL,
+    mese TEXT NOT NULL,  -- YYYY-MM
+    giorni TEXT NOT NULL,  -- YYYY-MM-DD separate da virgola (vuoto: nessuna occorrenza)
+    PRIMARY KEY (tipo, serie_id, mese)
+);
+
+-- Indice degli impegni con orario (appuntamenti singoli, visite pianificate)
+-- Intervalli [inizio, fine) in minuti dal 1970-01-01 per le sovrapposizioni.
+CREATE TABLE IF NOT EXISTS impegni_slot_id (
+    slot_id BIGSERIAL PRIMARY KEY,
+    tipo TEXT NOT NULL,  -- appuntamento, visita
+    rif_id TEXT NOT NULL,
+    UNIQUE (tipo, rif_id)
+);
+
+CREATE TABLE IF NOT EXISTS impegni_slot (
+    id BIGINT PRIMARY KEY,
+    inizio INTEGER NOT NULL,
+    fine INTEGER NOT NULL
+);
+
+-- Coda dei lavori in background (vedi coda_lavori.py)
+-- stato: in_coda, in_corso, completato, fallito. Un lavoro in errore torna in_coda
+-- con prossimo_tentativo ritardato (backoff esponenziale) fino a max_tentativi.
+CREATE TABLE IF NOT EXISTS lavori (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,  -- pdf_ordine
+    ordine_id TEXT,
+    payload TEXT,  -- JSON
+    stato TEXT NOT NULL DEFAULT 'in_coda',
+    tentativi INTEGER DEFAULT 0,
+    max_tentativi INTEGER DEFAULT 5,
+    prossimo_tentativo TEXT NOT NULL,
+    errore TEXT,
+    worker TEXT,
+    iniziato_at TEXT,
+    completato_at TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- PDF degli ordini generati in background (validi finché ordini.updated_at non cambia)
+CREATE TABLE IF NOT EXISTS ordini_pdf (
+    ordine_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    contenuto BYTEA NOT NULL,
+    ordine_updated_at TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Outbox delle email (scritte nella stessa transazione del dato che le origina)
+-- chiave: identifica il messaggio, una chiave già presente non viene riaccodata.
+-- stato: da_inviare, in_invio, inviata, fallita (dopo coda_max_tentativi).
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id TEXT PRIMARY KEY,
+    chiave TEXT NOT NULL UNIQUE,
+    ordine_id TEXT,
+    destinatario TEXT NOT NULL,
+    cc TEXT,
+    oggetto TEXT,
+    corpo TEXT,
+    allegato TEXT,  -- riferimento: pdf_ordine (PDF di ordine_id) o NULL
+    stato TEXT NOT NULL DEFAULT 'da_inviare',
+    tentativi INTEGER DEFAULT 0,
+    prossimo_tentativo TEXT NOT NULL,
+    errore TEXT,
+    worker TEXT,
+    iniziato_at TEXT,
+    inviata_at TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Tabella AGENTE (Dati agente per documenti)
+CREATE TABLE IF NOT EXISTS agente (
+    id TEXT PRIMARY KEY,
+    nome TEXT NOT NULL,
+    cognome TEXT NOT NULL,
+    ragione_sociale TEXT,
+    indirizzo TEXT,
+    citta TEXT,
+    provincia TEXT,
+    cap TEXT,
+    telefono TEXT,
+    cellulare TEXT,
+    email TEXT,
+    pec TEXT,
+    partita_iva TEXT,
+    codice_fiscale TEXT,
+    codice_enasarco TEXT,
+    iban TEXT,
+    banca TEXT,
+    logo_path TEXT,
+    firma_path TEXT,
+    note TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Tabella IMPOSTAZIONI
+CREATE TABLE IF NOT EXISTS impostazioni (
+    chiave TEXT PRIMARY KEY,
+    valore TEXT,
+    tipo TEXT DEFAULT 'string',  -- string, int, float, bool, json
+    descrizione TEXT,
+    updated_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Tabella CHANGE_LOG (Change Data Capture)
+-- Ogni modifica alle tabelle principali viene registrata dai trigger.
+-- I consumatori (export, integrazioni, sync) leggono solo le modifiche dopo
+-- l'ultima sequenza vista: vedi get_changes_since() in db.py.
+-- Con più transazioni concorrenti una sequenza presa all'inserimento può
+-- diventare visibile dopo una più alta (ordine di commit diverso) e un
+-- consumatore la salterebbe: qui seq resta NULL fino a quando la riga è
+-- confermata e viene assegnata dopo, in ordine di commit, da
+-- _sigilla_change_log() in db.py (change_log_commit_seq: mai riutilizzata).
+CREATE SEQUENCE IF NOT EXISTS change_log_commit_seq;
+CREATE TABLE IF NOT EXISTS change_log (
+    id BIGSERIAL PRIMARY KEY,  -- ordine di inserimento
+    seq BIGINT,                -- ordine di commit (NULL: non ancora assegnata)
+    tabella TEXT NOT NULL,
+    row_id TEXT NOT NULL,
+    operazione TEXT NOT NULL,  -- I (insert), U (update), D (delete)
+    changed_at TEXT DEFAULT (to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Migrazione: database creati con seq BIGSERIAL (assegnata all'inserimento)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'change_log' AND column_name = 'id') THEN
+        ALTER TABLE change_log DROP CONSTRAINT change_log_pkey;
+        ALTER TABLE change_log ALTER COLUMN seq DROP DEFAULT;
+        ALTER TABLE change_log ALTER COLUMN seq DROP NOT NULL;
+        DROP SEQUENCE IF EXISTS change_log_seq_seq;
+        ALTER TABLE change_log ADD COLUMN id BIGSERIAL PRIMARY KEY;
+        PERFORM setval('change_log_commit_seq', COALESCE((SELECT MAX(seq) FROM change_log), 0) + 1, false);
+    END IF;
+END $$;
+
+-- Tabella SYNC_DISPOSITIVI (dispositivi offline degli agenti)
+CREATE TABLE IF NOT EXISTS sync_dispositivi (
+    device_id TEXT PRIMARY KEY,
+    nome TEXT,
+    ultimo_checkpoint BIGINT DEFAULT 0,  -- seq del change_log già ricevuta
+    ultimo_pull TEXT,
+    ultimo_push TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS'))
+);
+
+-- Tabella SYNC_ID_MAP (ID/numeri creati offline -> ID/numeri definitivi sul server)
+CREATE TABLE IF NOT EXISTS sync_id_map (
+    device_id TEXT NOT NULL,
+    tipo TEXT NOT NULL,  -- cliente, ordine
+    id_locale TEXT NOT NULL,
+    id_server TEXT NOT NULL,
+    numero_locale TEXT,
+    numero_server TEXT,
+    created_at TEXT DEFAULT (to_char(now(), 'YYYY-MM-DD HH24:MI:SS')),
+    PRIMARY KEY (device_id, tipo, id_locale),
+    FOREIGN KEY (device_id) REFERENCES sync_dispositivi(device_id) ON DELETE CASCADE
+);
+
+-- ============================================
+-- INDICI PER PERFORMANCE
+-- ============================================
+
+CREATE INDEX IF NOT EXISTS idx_prodotti_azienda ON prodotti(azienda_id);
+CREATE INDEX IF NOT EXISTS idx_ordini_azienda ON ordini(azienda_id);
+CREATE INDEX IF NOT EXISTS idx_ordini_cliente ON ordini(cliente_id);
+CREATE INDEX IF NOT EXISTS idx_ordini_stato ON ordini(stato);
+CREATE INDEX IF NOT EXISTS idx_ordini_data ON ordini(data_ordine);
+CREATE INDEX IF NOT EXISTS idx_ordini_stato_data ON ordini(stato, data_ordine);
+CREATE INDEX IF NOT EXISTS idx_ordini_righe_ordine ON ordini_righe(ordine_id);
+CREATE INDEX IF NOT EXISTS idx_visite_cliente ON visite(cliente_id);
+CREATE INDEX IF NOT EXISTS idx_visite_data ON visite(data_visita);
+CREATE INDEX IF NOT EXISTS idx_appuntamenti_data ON appuntamenti(data, ora);
+CREATE INDEX IF NOT EXISTS idx_visite_pianificate_data ON visite_pianificate(data_pianificata);
+CREATE INDEX IF NOT EXISTS idx_promemoria_scadenza ON promemoria(data_scadenza);
+CREATE INDEX IF NOT EXISTS idx_promemoria_attivi_scadenza ON promemoria(completato, data_scadenza);
+-- Migrazione: sostituito da idx_promemoria_attivi_scadenza
+DROP INDEX IF EXISTS idx_promemoria_completato;
+CREATE INDEX IF NOT EXISTS idx_appuntamenti_ricorrenti ON appuntamenti(data) WHERE ricorrenza IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_promemoria_ricorrenti ON promemoria(data_scadenza) WHERE ricorrenza IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_ricorrenze_eccezioni_nuova_data ON ricorrenze_eccezioni(tipo, nuova_data);
+CREATE INDEX IF NOT EXISTS idx_impegni_slot ON impegni_slot(inizio, fine);
+CREATE INDEX IF NOT EXISTS idx_storico_prezzi ON storico_prezzi(cliente_id, prodotto_id, valido_dal);
+CREATE INDEX IF NOT EXISTS idx_previsioni_riordino_prossimo ON previsioni_riordino(prossimo_ordine);
+CREATE INDEX IF NOT EXISTS idx_previsioni_riordino_scadenza_max ON previsioni_riordino(scadenza_max);
+CREATE INDEX IF NOT EXISTS idx_cubo_vendite_prodotto ON cubo_vendite(prodotto_id, mese);
+CREATE INDEX IF NOT EXISTS idx_cubo_ordini_cliente ON cubo_ordini(cliente_id, mese);
+CREATE INDEX IF NOT EXISTS idx_provvigioni_aliquote_azienda ON provvigioni_aliquote(azienda_id);
+CREATE INDEX IF NOT EXISTS idx_provvigioni_ordini_azienda ON provvigioni_ordini(azienda_id, mese);
+CREATE INDEX IF NOT EXISTS idx_clienti_categoria ON clienti(categoria, ragione_sociale);
+-- Clienti vicini: su PostgreSQL filtro a riquadro sulle coordinate (niente R*Tree)
+CREATE INDEX IF NOT EXISTS idx_clienti_coordinate ON clienti(latitudine, longitudine) WHERE attivo = 1;
+CREATE INDEX IF NOT EXISTS idx_cliente_prodotto_pref_affinita ON cliente_prodotto_pref(cliente_id, azienda_id, affinita DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_seq ON change_log(seq);
+CREATE INDEX IF NOT EXISTS idx_change_log_da_sigillare ON change_log(id) WHERE seq IS NULL;
+CREATE INDEX IF NOT EXISTS idx_change_log_riga ON change_log(tabella, row_id, seq);
+CREATE INDEX IF NOT EXISTS idx_change_log_data ON change_log(changed_at);
+CREATE INDEX IF NOT EXISTS idx_lavori_coda ON lavori(stato, prossimo_tentativo);
+CREATE INDEX IF NOT EXISTS idx_lavori_ordine ON lavori(ordine_id);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_coda ON email_outbox(stato, prossimo_tentativo);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_ordine ON email_outbox(ordine_id);
+
+-- ============================================
+-- IMPOSTAZIONI DEFAULT
+-- ============================================
+
+INSERT INTO impostazioni (chiave, valore, tipo, descrizione) VALUES
+    ('numero_ordine_prefisso', 'ORD', 'string', 'Prefisso numero ordine'),
+    ('numero_ordine_anno', '1', 'bool', 'Includere anno nel numero ordine'),
+    ('numero_ordine_progressivo', '1', 'int', 'Ultimo progressivo ordine'),
+    ('valuta', 'EUR', 'string', 'Valuta predefinita'),
+    ('decimali_prezzi', '2', 'int', 'Decimali per i prezzi'),
+    ('decimali_quantita', '0', 'int', 'Decimali per le quantità'),
+    ('iva_default', '22', 'float', 'Aliquota IVA default (non usata per imponibile)'),
+    ('pagamento_default', 'Bonifico 30gg', 'string', 'Pagamento predefinito'),
+    ('consegna_default', 'Franco destino', 'string', 'Tipo consegna predefinito'),
+    ('tema', 'light', 'string', 'Tema interfaccia'),
+    ('change_log_giorni_compattazione', '7', 'int', 'Change log: dopo quanti giorni tenere solo l''ultima modifica per riga'),
+    ('change_log_giorni_cancellazioni', '90', 'int', 'Change log: dopo quanti giorni eliminare le cancellazioni (richiede resync)'),
+    ('change_log_watermark', '0', 'int', 'Change log: sequenza sotto la quale serve un resync completo'),
+    ('segmentazione_soglia_a', '0.80', 'float', 'Segmentazione: quota cumulata di fatturato dei clienti A'),
+    ('segmentazione_soglia_b', '0.95', 'float', 'Segmentazione: quota cumulata di fatturato dei clienti A+B'),
+    ('segmentazione_mesi', '12', 'int', 'Segmentazione: mesi di storico ordini considerati'),
+    ('percorso_ora_partenza', '08:30', 'string', 'Percorsi: ora di partenza del giro visite'),
+    ('percorso_durata_visita', '30', 'int', 'Percorsi: durata media di una visita (minuti)'),
+    ('percorso_velocita_kmh', '45', 'float', 'Percorsi: velocità media di spostamento (km/h)'),
+    ('percorso_fattore_strada', '1.3', 'float', 'Percorsi: rapporto tra distanza stradale e in linea d''aria'),
+    ('percorso_partenza_lat', '', 'float', 'Percorsi: latitudine del punto di partenza (vuoto: prima tappa)'),
+    ('percorso_partenza_lon', '', 'float', 'Percorsi: longitudine del punto di partenza'),
+    ('agenda_ora_inizio', '08:30', 'string', 'Agenda: inizio orario di lavoro per le fasce libere'),
+    ('agenda_ora_fine', '19:00', 'string', 'Agenda: fine orario di lavoro per le fasce libere'),
+    ('agenda_durata_appuntamento', '60', 'int', 'Agenda: durata in minuti degli appuntamenti senza durata'),
+    ('coda_worker', '2', 'int', 'Coda lavori: numero di thread worker per PDF ed email'),
+    ('coda_max_tentativi', '5', 'int', 'Coda lavori: tentativi prima di segnare un lavoro come fallito'),
+    ('coda_backoff_secondi', '30', 'int', 'Coda lavori: attesa prima del secondo tentativo (raddoppia a ogni errore)'),
+    ('coda_backoff_max_secondi', '3600', 'int', 'Coda lavori: attesa massima tra due tentativi')
+ON CONFLICT (chiave) DO NOTHING;
+
+-- ============================================
+-- VISTE UTILI
+-- ============================================
+
+-- Vista ordini con dettagli
+DROP VIEW IF EXISTS v_ordini_completi;
+CREATE VIEW v_ordini_completi AS
+SELECT 
+    o.*,
+    a.nome AS azienda_nome,
+    a.ragione_sociale AS azienda_ragione_sociale,
+    c.ragione_sociale AS cliente_ragione_sociale,
+    c.citta AS cliente_citta,
+    c.provincia AS cliente_provincia
+FROM ordini o
+LEFT JOIN aziende a ON o.azienda_id = a.id
+LEFT JOIN clienti c ON o.cliente_id = c.id;
+
+-- Vista fatturato per azienda
+DROP VIEW IF EXISTS v_fatturato_azienda;
+CREATE VIEW v_fatturato_azienda AS
+SELECT 
+    a.id,
+    a.nome,
+    COUNT(DISTINCT o.id) AS num_ordini,
+    SUM(o.totale_finale) AS fatturato_totale,
+    AVG(o.totale_finale) AS fatturato_medio
+FROM aziende a
+LEFT JOIN ordini o ON a.id = o.azienda_id AND o.stato IN ('inviato', 'confermato', 'evaso')
+GROUP BY a.id, a.nome;
+
+-- Vista fatturato per cliente
+DROP VIEW IF EXISTS v_fatturato_cliente;
+CREATE VIEW v_fatturato_cliente AS
+SELECT 
+    c.id,
+    c.ragione_sociale,
+    c.citta,
+    c.provincia,
+    COUNT(DISTINCT o.id) AS num_ordini,
+    SUM(o.totale_finale) AS fatturato_totale,
+    MAX(o.data_ordine) AS ultimo_ordine
+FROM clienti c
+LEFT JOIN ordini o ON c.id = o.cliente_id AND o.stato IN ('inviato', 'confermato', 'evaso')
+GROUP BY c.id, c.ragione_sociale, c.citta, c.provincia;
+
+-- Vista promemoria attivi
+DROP VIEW IF EXISTS v_promemoria_attivi;
+CREATE VIEW v_promemoria_attivi AS
+SELECT 
+    p.*,
+    c.ragione_sociale AS cliente_nome
+FROM promemoria p
+LEFT JOIN clienti c ON p.cliente_id = c.id
+WHERE p.completato = 0
+ORDER BY p.data_scadenza ASC, p.priorita DESC;
+
+-- ============================================
+-- TRIGGER CHANGE DATA CAPTURE
+-- ============================================
+
+CREATE OR REPLACE FUNCTION fn_change_log() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO change_log (tabella, row_id, operazione) VALUES (TG_TABLE_NAME, OLD.id, 'D');
+    ELSE
+        INSERT INTO change_log (tabella, row_id, operazione)
+        VALUES (TG_TABLE_NAME, NEW.id, CASE WHEN TG_OP = 'INSERT' THEN 'I' ELSE 'U' END);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_aziende_cdc ON aziende;
+CREATE TRIGGER trg_aziende_cdc AFTER INSERT OR UPDATE OR DELETE ON aziende
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+-- la sola riclassificazione ABC (categoria senza updated_at) non va ai dispositivi
+DROP TRIGGER IF EXISTS trg_clienti_cdc ON clienti;
+CREATE TRIGGER trg_clienti_cdc AFTER INSERT OR DELETE ON clienti
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+DROP TRIGGER IF EXISTS trg_clienti_cdc_upd ON clienti;
+CREATE TRIGGER trg_clienti_cdc_upd AFTER UPDATE ON clienti
+    FOR EACH ROW
+    WHEN (NEW.updated_at IS DISTINCT FROM OLD.updated_at OR NEW.categoria IS NOT DISTINCT FROM OLD.categoria)
+    EXECUTE FUNCTION fn_change_log();
+
+DROP TRIGGER IF EXISTS trg_prodotti_cdc ON prodotti;
+CREATE TRIGGER trg_prodotti_cdc AFTER INSERT OR UPDATE OR DELETE ON prodotti
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+DROP TRIGGER IF EXISTS trg_ordini_cdc ON ordini;
+CREATE TRIGGER trg_ordini_cdc AFTER INSERT OR UPDATE OR DELETE ON ordini
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+DROP TRIGGER IF EXISTS trg_ordini_righe_cdc ON ordini_righe;
+CREATE TRIGGER trg_ordini_righe_cdc AFTER INSERT OR UPDATE OR DELETE ON ordini_righe
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+DROP TRIGGER IF EXISTS trg_promemoria_cdc ON promemoria;
+CREATE TRIGGER trg_promemoria_cdc AFTER INSERT OR UPDATE OR DELETE ON promemoria
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+DROP TRIGGER IF EXISTS trg_appuntamenti_cdc ON appuntamenti;
+CREATE TRIGGER trg_appuntamenti_cdc AFTER INSERT OR UPDATE OR DELETE ON appuntamenti
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log();
+
+-- cliente_prodotto_pref ha chiave composta: row_id = cliente_id|azienda_id|prodotto_id
+CREATE OR REPLACE FUNCTION fn_change_log_pref() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO change_log (tabella, row_id, operazione)
+        VALUES (TG_TABLE_NAME, OLD.cliente_id || '|' || OLD.azienda_id || '|' || OLD.prodotto_id, 'D');
+    ELSE
+        INSERT INTO change_log (tabella, row_id, operazione)
+        VALUES (TG_TABLE_NAME, NEW.cliente_id || '|' || NEW.azienda_id || '|' || NEW.prodotto_id,
+                CASE WHEN TG_OP = 'INSERT' THEN 'I' ELSE 'U' END);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_cliente_prodotto_pref_cdc ON cliente_prodotto_pref;
+CREATE TRIGGER trg_cliente_prodotto_pref_cdc AFTER INSERT OR UPDATE OR DELETE ON cliente_prodotto_pref
+    FOR EACH ROW EXECUTE FUNCTION fn_change_log_pref();
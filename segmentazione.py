@@ -0,0 +1,236 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Segmentazione clienti RFM / ABC
+
+Per ogni cliente calcola in una sola passata vettoriale (pandas/NumPy) sugli
+ordini validi (inviato, confermato, evaso) della finestra configurata:
+- R (recency): giorni dall'ultimo ordine
+- F (frequency): numero di ordini
+- M (monetary): fatturato
+
+La classe ABC segue Pareto sul fatturato: clienti ordinati per M decrescente,
+A fino alla quota cumulata `segmentazione_soglia_a` (default 80%), B fino a
+`segmentazione_soglia_b` (default 95%), poi C. Il risultato è salvato in
+clienti_rfm e riscritto in clienti.categoria con un'unica transazione (solo
+le righe cambiate).
+
+Dopo un ordine si ricalcola solo l'RFM del cliente dell'ordine; le classi
+ABC, che dipendono dal totale, si riassegnano leggendo clienti_rfm senza
+rileggere gli ordini.
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Optional, List, Dict, Any
+
+import numpy as np
+import pandas as pd
+
+import db
+
+STATI_VALIDI = ('inviato', 'confermato', 'evaso')
+
+_DEFAULT = {
+    'segmentazione_soglia_a': '0.80',
+    'segmentazione_soglia_b': '0.95',
+    'segmentazione_mesi': '12',
+}
+
+_COLONNE_RFM = ['cliente_id', 'recency_giorni', 'frequenza', 'valore', 'ultimo_ordine']
+
+
+def _parametri(conn) -> Dict[str, float]:
+    """Soglie e finestra dalla tabella impostazioni"""
+    rows = conn.execute(
+        f"SELECT chiave, valore FROM impostazioni WHERE chiave IN ({', '.join('?' for _ in _DEFAULT)})",
+        list(_DEFAULT),
+    ).fetchall()
+    valori = dict(_DEFAULT)
+    valori.update({r['chiave']: r['valore'] for r in rows if r['valore'] not in (None, '')})
+    return {
+        'soglia_a': float(valori['segmentazione_soglia_a']),
+        'soglia_b': float(valori['segmentazione_soglia_b']),
+        'mesi': int(valori['segmentazione_mesi']),
+    }
+
+
+def get_parametri() -> Dict[str, float]:
+    """Soglie A/B e finestra in mesi della segmentazione"""
+    conn = db.get_connection()
+    try:
+        return _parametri(conn)
+    finally:
+        conn.close()
+
+
+def _carica_ordini(conn, mesi: int, cliente_id: str = None) -> pd.DataFrame:
+    inizio = (date.today() - timedelta(days=int(mesi * 30.44))).isoformat()
+    query = f"""
+        SELECT o.cliente_id, substr(o.data_ordine, 1, 10) AS data, o.totale_finale AS importo
+        FROM ordini o
+        JOIN clienti c ON c.id = o.cliente_id AND c.attivo = 1
+        WHERE o.stato IN ({', '.join('?' for _ in STATI_VALIDI)}) AND o.data_ordine >= ?
+    """
+    params: List[Any] = list(STATI_VALIDI) + [inizio]
+    if cliente_id:
+        query += " AND o.cliente_id = ?"
+        params.append(cliente_id)
+    rows = conn.execute(query, params).fetchall()
+    df = pd.DataFrame([dict(r) for r in rows], columns=['cliente_id', 'data', 'importo'])
+    df['data'] = pd.to_datetime(df['data'], errors='coerce')
+    df['importo'] = pd.to_numeric(df['importo'], errors='coerce').fillna(0.0)
+    return df.dropna(subset=['data'])
+
+
+def calcola_rfm(ordini: pd.DataFrame, oggi: date = None) -> pd.DataFrame:
+    """R, F, M per cliente da un DataFrame (cliente_id, data, importo)"""
+    if ordini.empty:
+        return pd.DataFrame(columns=_COLONNE_RFM)
+    oggi = pd.Timestamp(oggi or date.today())
+    rfm = ordini.groupby('cliente_id', sort=False).agg(
+        ultimo_ordine=('data', 'max'),
+        frequenza=('data', 'size'),
+        valore=('importo', 'sum'),
+    ).reset_index()
+    rfm['recency_giorni'] = (oggi - rfm['ultimo_ordine']).dt.days.clip(lower=0)
+    rfm['valore'] = np.round(rfm['valore'], 2)
+    return rfm[_COLONNE_RFM]
+
+
+def assegna_abc(rfm: pd.DataFrame, soglia_a: float, soglia_b: float) -> pd.DataFrame:
+    """Classi ABC di Pareto sul valore (quota cumulata del fatturato)"""
+    rfm = rfm.sort_values(['valore', 'frequenza'], ascending=False).reset_index(drop=True)
+    valore = rfm['valore'].to_numpy(dtype=float)
+    totale = valore.sum()
+    quota = np.cumsum(valore) / totale if totale > 0 else np.zeros(len(valore))
+    # quota cumulata PRIMA del cliente: chi attraversa la soglia resta nella classe più alta
+    quota_prima = quota - (valore / totale if totale > 0 else 0)
+    rfm['quota_cumulata'] = np.round(quota, 4)
+    rfm['categoria'] = np.select(
+        [valore <= 0, quota_prima < soglia_a, quota_prima < soglia_b],
+        ['C', 'A', 'B'],
+        default='C',
+    )
+    return rfm
+
+
+def _scrivi_categorie(conn, rfm: pd.DataFrame) -> int:
+    """Aggiorna clienti.categoria in batch (senza commit). Clienti senza ordini -> C.
+
+    updated_at non cambia: è la versione del cliente per i conflitti di sync, e
+    senza di esso la riclassificazione non entra nel change log (vedi trigger).
+    """
+    attuali = {r['id']: r['categoria'] for r in
+               conn.execute("SELECT id, categoria FROM clienti WHERE attivo = 1").fetchall()}
+    nuove = dict(zip(rfm['cliente_id'], rfm['categoria']))
+    cambi = [(nuove.get(cid, 'C'), cid)
+             for cid, cat in attuali.items() if (cat or '') != nuove.get(cid, 'C')]
+    if cambi:
+        conn.executemany("UPDATE clienti SET categoria = ? WHERE id = ?", cambi)
+    return len(cambi)
+
+
+def _salva_rfm(conn, rfm: pd.DataFrame, solo_cliente: str = None) -> None:
+    """Scrive la cache clienti_rfm (tutta, o la riga di un cliente) senza commit"""
+    if solo_cliente:
+        conn.execute("DELETE FROM clienti_rfm WHERE cliente_id = ?", (solo_cliente,))
+    else:
+        conn.execute("DELETE FROM clienti_rfm")
+    if rfm.empty:
+        return
+    now = datetime.now().isoformat()
+    conn.executemany("""
+        INSERT INTO clienti_rfm (cliente_id, recency_giorni, frequenza, valore, ultimo_ordine, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (r.cliente_id, int(r.recency_giorni), int(r.frequenza), float(r.valore),
+         pd.Timestamp(r.ultimo_ordine).date().isoformat(), now)
+        for r in rfm.itertuples(index=False)
+    ])
+
+
+def _riclassifica(conn, par: Dict[str, float]) -> int:
+    """Riassegna ABC dalla cache clienti_rfm e aggiorna clienti.categoria (senza commit)"""
+    rows = conn.execute("SELECT cliente_id, recency_giorni, frequenza, valore, ultimo_ordine FROM clienti_rfm").fetchall()
+    rfm = pd.DataFrame([dict(r) for r in rows], columns=_COLONNE_RFM)
+    rfm['valore'] = pd.to_numeric(rfm['valore'], errors='coerce').fillna(0.0)
+    rfm = assegna_abc(rfm, par['soglia_a'], par['soglia_b'])
+    if not rfm.empty:
+        conn.executemany(
+            "UPDATE clienti_rfm SET quota_cumulata = ?, categoria = ? WHERE cliente_id = ?",
+            [(float(q), c, cid) for cid, q, c in zip(rfm['cliente_id'], rfm['quota_cumulata'], rfm['categoria'])],
+        )
+    return _scrivi_categorie(conn, rfm)
+
+
+def ricalcola_segmentazione() -> Dict[str, Any]:
+    """Calcolo completo: RFM di tutti i clienti + classi ABC, in un'unica transazione.
+
+    Returns:
+        dict con 'clienti' (con ordini nella finestra), 'aggiornati' (categorie cambiate)
+        e 'distribuzione' {A: n, B: n, C: n}
+    """
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        par = _parametri(conn)
+        rfm = calcola_rfm(_carica_ordini(conn, par['mesi']))
+        _salva_rfm(conn, rfm)
+        aggiornati = _riclassifica(conn, par)
+        conn.execute("""
+            INSERT INTO impostazioni (chiave, valore, tipo, updated_at) VALUES ('segmentazione_ultimo_calcolo', ?, 'string', ?)
+            ON CONFLICT(chiave) DO UPDATE SET valore = excluded.valore, updated_at = excluded.updated_at
+        """, (date.today().isoformat(), datetime.now().isoformat()))
+        conn.commit()
+
+        distribuzione = {r['categoria']: r['n'] for r in conn.execute(
+            "SELECT categoria, COUNT(*) AS n FROM clienti WHERE attivo = 1 GROUP BY categoria"
+        ).fetchall()}
+        return {'clienti': len(rfm), 'aggiornati': aggiornati, 'distribuzione': distribuzione}
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def aggiorna_dopo_ordine(ordine_id: str) -> int:
+    """Aggiornamento incrementale: RFM del solo cliente dell'ordine, poi riclassificazione dalla cache.
+
+    Returns:
+        numero di clienti la cui categoria è cambiata
+    """
+    conn = db.get_connection()
+    try:
+        row = conn.execute("SELECT cliente_id FROM ordini WHERE id = ?", (ordine_id,)).fetchone()
+        if not row:
+            return 0
+        conn.execute("BEGIN")
+        par = _parametri(conn)
+        rfm = calcola_rfm(_carica_ordini(conn, par['mesi'], row['cliente_id']))
+        _salva_rfm(conn, rfm, solo_cliente=row['cliente_id'])
+        aggiornati = _riclassifica(conn, par)
+        conn.commit()
+        return aggiornati
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def aggiorna_se_scaduta() -> Optional[Dict[str, Any]]:
+    """Ricalcolo completo al massimo una volta al giorno (la recency invecchia anche senza ordini)"""
+    conn = db.get_connection()
+    try:
+        row = conn.execute("SELECT valore FROM impostazioni WHERE chiave = 'segmentazione_ultimo_calcolo'").fetchone()
+    finally:
+        conn.close()
+    if row and row['valore'] == date.today().isoformat():
+        return None
+    return ricalcola_segmentazione()
@@ -17,8 +17,36 @@ import uuid
 
 # Import moduli locali
 import db
+import riordini
+import segmentazione
+import previsione_fatturato
+import percorsi
+import coda_lavori
 from pdf_ordine import genera_pdf_ordine_download
-from email_sender import send_email_with_attachment
+
+
+# Opzioni "Ripeti" dei form (frequenza RRULE, intervallo)
+RIPETIZIONI = {
+    "Mai": None,
+    "Ogni giorno": ("DAILY", 1),
+    "Ogni settimana": ("WEEKLY", 1),
+    "Ogni 2 settimane": ("WEEKLY", 2),
+    "Ogni mese": ("MONTHLY", 1),
+    "Ogni anno": ("YEARLY", 1),
+}
+
+
+def input_ricorrenza(key: str) -> Optional[str]:
+    """Campi "Ripeti" e "Volte" (dentro un form) -> regola RRULE o None"""
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        ripeti = st.selectbox("Ripeti", list(RIPETIZIONI), key=f"{key}_ripeti")
+    with col2:
+        volte = st.number_input("Volte (0 = sempre)", min_value=0, max_value=999, value=0, step=1, key=f"{key}_volte")
+    if not RIPETIZIONI[ripeti]:
+        return None
+    freq, intervallo = RIPETIZIONI[ripeti]
+    return db.regola_ricorrenza(freq, intervallo, count=int(volte) or None)
 
 
 # Logo Agenzia (header globale)
@@ -1056,7 +1084,7 @@ def render_dashboard():
     # --- Analisi (grafici) ---
     left, right = st.columns([2, 1])
     with left:
-        st.markdown("<div class='section-card'><div class='section-title'>Andamento fatturato (ultimi 12 mesi)</div>", unsafe_allow_html=True)
+        st.markdown("<div class='section-card'><div class='section-title'>Andamento fatturato (ultimi 12 mesi e previsione)</div>", unsafe_allow_html=True)
         try:
             series = db.get_fatturato_mensile_series(12)
         except Exception:
@@ -1064,7 +1092,21 @@ def render_dashboard():
         if series:
             df = pd.DataFrame(series)
             fig = px.line(df, x="mese", y="fatturato", markers=True, template="plotly_white")
-            fig.update_layout(height=280, margin=dict(l=10, r=10, t=10, b=10), font=dict(family="Inter"))
+            try:
+                prev = previsione_fatturato.get_previsione(orizzonte=6)
+            except Exception:
+                prev = {'mesi': []}
+            if prev['mesi']:
+                # la linea tratteggiata parte dall'ultimo mese chiuso
+                base = [s for s in series if s["mese"] == prev['ultimo_mese_chiuso']]
+                punti = base + prev['mesi']
+                fig.add_trace(go.Scatter(
+                    x=[p["mese"] for p in punti], y=[p["fatturato"] for p in punti],
+                    mode="lines+markers", name="Previsione",
+                    line=dict(dash="dash", color="#94a3b8"),
+                    hovertemplate="%{x}: %{y:,.2f} €<extra>Previsione</extra>",
+                ))
+            fig.update_layout(height=280, margin=dict(l=10, r=10, t=10, b=10), font=dict(family="Inter"), showlegend=False)
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("Nessun dato disponibile")
@@ -1087,38 +1129,124 @@ def render_dashboard():
 
     st.markdown("<br>", unsafe_allow_html=True)
 
-    # --- Pianificazione (appuntamenti + promemoria) ---
+    # --- Pianificazione (appuntamenti + visite + promemoria, una sola lettura dell'agenda) ---
     p1, p2 = st.columns(2)
     today = date.today()
+    try:
+        agenda = db.get_agenda(today.isoformat(), (today + timedelta(days=7)).isoformat(), includi_scaduti=True)
+    except Exception:
+        agenda = {}
+    eventi = [e for giorno in agenda.values() for e in giorno]
     with p1:
-        st.markdown("<div class='section-card'><div class='section-title'>Prossimi appuntamenti (7 gg)</div>", unsafe_allow_html=True)
-        try:
-            apps = db.get_appuntamenti_range(today.isoformat(), (today + timedelta(days=7)).isoformat()) if hasattr(db, "get_appuntamenti_range") else []
-        except Exception:
-            apps = []
+        st.markdown("<div class='section-card'><div class='section-title'>Prossimi appuntamenti e visite (7 gg)</div>", unsafe_allow_html=True)
+        apps = [e for e in eventi if e['tipo'] != 'promemoria' and e['giorno'] >= today.isoformat()]
         if not apps:
             st.info("Nessun appuntamento nei prossimi 7 giorni")
         else:
             for a in apps[:8]:
-                st.markdown(f"- **{format_date(a.get('data'))} {a.get('ora') or ''}** · {a.get('titolo','')}")
+                cliente = f" · {a['cliente_nome']}" if a.get('cliente_nome') and a['tipo'] == 'visita' else ""
+                st.markdown(f"- **{format_date(a['giorno'])} {a.get('ora') or ''}** · {a.get('titolo','')}{cliente}")
         st.markdown("</div>", unsafe_allow_html=True)
 
     with p2:
         st.markdown("<div class='section-card'><div class='section-title'>Promemoria in scadenza (7 gg)</div>", unsafe_allow_html=True)
-        try:
-            proms = db.get_promemoria(solo_attivi=True)
-            proms = [p for p in proms if p.get('data_scadenza') and str(p['data_scadenza']) <= (today + timedelta(days=7)).isoformat()]
-        except Exception:
-            proms = []
+        proms = [e for e in eventi if e['tipo'] == 'promemoria']
         if not proms:
             st.info("Nessun promemoria in scadenza")
         else:
             for p in proms[:8]:
-                st.markdown(f"- **{format_date(p.get('data_scadenza'))}** · {p.get('titolo','')}")
+                st.markdown(f"- **{format_date(p['giorno'])}** · {p.get('titolo','')}")
         st.markdown("</div>", unsafe_allow_html=True)
 
     st.markdown("<br>", unsafe_allow_html=True)
 
+    # --- Clienti da riordinare (previsioni riordino) ---
+    st.markdown("<div class='section-card'><div class='section-title'>Clienti da riordinare (7 gg)</div>", unsafe_allow_html=True)
+    try:
+        riordini.inizializza_previsioni()
+        in_scadenza = riordini.get_clienti_in_scadenza(giorni=7, limit=10)
+    except Exception:
+        in_scadenza = []
+    if not in_scadenza:
+        st.info("Nessun cliente in scadenza di riordino questa settimana")
+    else:
+        for c in in_scadenza:
+            ritardo = " · ⚠️ in ritardo" if c.get('in_ritardo') else ""
+            st.markdown(
+                f"- **{c['ragione_sociale']}** ({c.get('citta') or '—'}) · {c['num_prodotti']} prodotti "
+                f"dal {format_date(c['prima_scadenza'])} · ~{format_currency(c['valore_stimato'])}{ritardo}"
+            )
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    # --- Analisi vendite (pivot e drill-down sul cubo) ---
+    st.markdown("<div class='section-card'><div class='section-title'>Analisi vendite</div>", unsafe_allow_html=True)
+    dimensioni = {
+        'azienda': 'Azienda', 'cliente': 'Cliente', 'provincia': 'Provincia', 'zona': 'Zona',
+        'canale': 'Canale', 'categoria': 'Categoria', 'prodotto': 'Prodotto', 'periodo': 'Mese',
+    }
+
+    def _etichetta(riga: Dict, dim: str) -> str:
+        if dim == 'prodotto':
+            return f"{riga.get('prodotto_codice') or ''} {riga.get('prodotto_nome') or ''}".strip() or 'N/D'
+        return str(riga.get(f"{dim}_nome") or riga.get(dim) or 'N/D')
+
+    c1, c2 = st.columns(2)
+    with c1:
+        dim1 = st.selectbox("Raggruppa per", list(dimensioni), format_func=dimensioni.get, key="cubo_dim1")
+    with c2:
+        finestra = st.selectbox("Periodo", ["Ultimi 12 mesi", "Anno in corso", "Tutto"], key="cubo_finestra")
+    mese_da = None
+    if finestra == "Ultimi 12 mesi":
+        mese_da = (today.replace(day=1) - timedelta(days=335)).strftime("%Y-%m")
+    elif finestra == "Anno in corso":
+        mese_da = f"{today.year}-01"
+    try:
+        righe_cubo = db.query_cubo([dim1], mese_da=mese_da,
+                                   ordina_per='periodo' if dim1 == 'periodo' else 'fatturato',
+                                   limit=None if dim1 == 'periodo' else 15)
+    except Exception:
+        righe_cubo = []
+    if not righe_cubo:
+        st.info("Nessuna vendita nel periodo")
+    else:
+        dfp = pd.DataFrame({
+            dimensioni[dim1]: [_etichetta(r, dim1) for r in righe_cubo],
+            "Fatturato": [r['fatturato'] for r in righe_cubo],
+            "Pezzi": [r['pezzi'] for r in righe_cubo],
+            "Cartoni": [r['cartoni'] for r in righe_cubo],
+            "Ordini": [r['num_ordini'] for r in righe_cubo],
+        })
+        fig3 = px.bar(dfp, x=dimensioni[dim1], y="Fatturato", template="plotly_white")
+        fig3.update_layout(height=260, margin=dict(l=10, r=10, t=10, b=10), font=dict(family="Inter"))
+        st.plotly_chart(fig3, use_container_width=True)
+
+        # drill-down: un valore del primo livello scomposto per un'altra dimensione
+        d1, d2 = st.columns(2)
+        with d1:
+            scelta = st.selectbox("Dettaglio di", range(len(righe_cubo)),
+                                  format_func=lambda i: _etichetta(righe_cubo[i], dim1), key="cubo_valore")
+        with d2:
+            dim2 = st.selectbox("Scomponi per", [d for d in dimensioni if d != dim1],
+                                format_func=dimensioni.get, key="cubo_dim2")
+        try:
+            dettaglio = db.query_cubo([dim2], filtri={dim1: righe_cubo[scelta][dim1]}, mese_da=mese_da,
+                                      ordina_per='periodo' if dim2 == 'periodo' else 'fatturato', limit=20)
+        except Exception:
+            dettaglio = []
+        if dettaglio:
+            st.dataframe(pd.DataFrame({
+                dimensioni[dim2]: [_etichetta(r, dim2) for r in dettaglio],
+                "Fatturato": [format_currency(r['fatturato']) for r in dettaglio],
+                "Pezzi": [r['pezzi'] for r in dettaglio],
+                "Cartoni": [r['cartoni'] for r in dettaglio],
+                "Ordini": [r['num_ordini'] for r in dettaglio],
+            }), hide_index=True, use_container_width=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
     # --- Ultimi ordini (card più pulite) ---
     st.markdown("<div class='section-card'><div class='section-title'>Ultimi ordini</div>", unsafe_allow_html=True)
     ordini = db.get_ordini(limit=8)
@@ -1273,6 +1401,10 @@ def render_azienda_prodotti():
         render_form_prodotto(azienda['id'])
         return
     
+    # Provvigioni del mandante (aliquote + estratto conto)
+    with st.expander("Provvigioni"):
+        render_provvigioni_azienda(azienda)
+
     # Pulsante aggiungi prodotto
     if st.button("Aggiungi Prodotto", type="primary"):
         st.session_state.show_form = True
@@ -1312,6 +1444,82 @@ def render_azienda_prodotti():
                     st.rerun()
 
 
+def render_provvigioni_azienda(azienda: Dict):
+    """Aliquote provvigionali ed estratto conto mensile di un mandante"""
+    aliquote = db.get_aliquote_provvigione(azienda['id'])
+    if not aliquote:
+        st.caption("Nessuna aliquota: provvigione a zero sugli ordini evasi")
+    for a in aliquote:
+        ambito = a.get('prodotto_codice') and f"Prodotto {a['prodotto_codice']} {a.get('prodotto_nome') or ''}" or "Tutti i prodotti"
+        if a.get('categoria_cliente'):
+            ambito += f" · clienti {a['categoria_cliente']}"
+        validita = f" · dal {format_date(a['valido_dal'])}" if a.get('valido_dal') else ""
+        validita += f" · al {format_date(a['valido_al'])}" if a.get('valido_al') else ""
+        c1, c2 = st.columns([5, 1])
+        with c1:
+            st.markdown(f"**{a['aliquota']:g}%** · {ambito}{validita}")
+        with c2:
+            if st.button("Elimina", key=f"dal_{a['id']}"):
+                db.delete_aliquota_provvigione(a['id'])
+                st.rerun()
+
+    with st.form("form_aliquota_provvigione", clear_on_submit=True):
+        prodotti = db.get_prodotti(azienda_id=azienda['id'], solo_disponibili=False)
+        id_prodotti = [""] + [p['id'] for p in prodotti]
+        nomi = {p['id']: f"{p['codice']} · {p['nome']}" for p in prodotti}
+        col1, col2, col3 = st.columns([3, 1, 1])
+        with col1:
+            prodotto_id = st.selectbox("Prodotto", id_prodotti, format_func=lambda i: nomi.get(i, "Tutti i prodotti"))
+        with col2:
+            categoria = st.selectbox("Categoria cliente", ["", "A", "B", "C"], format_func=lambda c: c or "Tutte")
+        with col3:
+            aliquota = st.number_input("Aliquota %", min_value=0.0, max_value=100.0, value=0.0, step=0.5)
+        periodo = st.checkbox("Solo per un periodo")
+        col1, col2 = st.columns(2)
+        with col1:
+            valido_dal = st.date_input("Valida dal", value=date.today().replace(month=1, day=1))
+        with col2:
+            valido_al = st.date_input("Valida al", value=date.today().replace(month=12, day=31))
+        if st.form_submit_button("Aggiungi aliquota", use_container_width=True):
+            if not periodo:
+                valido_dal = valido_al = None
+            db.save_aliquota_provvigione({
+                'azienda_id': azienda['id'],
+                'prodotto_id': prodotto_id or None,
+                'categoria_cliente': categoria or None,
+                'aliquota': aliquota,
+                'valido_dal': valido_dal.isoformat() if valido_dal else None,
+                'valido_al': valido_al.isoformat() if valido_al else None,
+            })
+            st.rerun()
+
+    st.markdown("**Estratto conto** (ordini evasi)")
+    anno = st.selectbox("Anno", list(range(date.today().year, date.today().year - 6, -1)), key="provv_anno")
+    estratti = db.get_estratti_provvigioni(azienda['id'], anno)
+    if not estratti:
+        st.info("Nessuna provvigione maturata nell'anno")
+    else:
+        for e in estratti:
+            st.markdown(
+                f"- **{e['mese']}** · {e['num_ordini']} ordini · imponibile {format_currency(e['imponibile'])} "
+                f"· provvigione **{format_currency(e['provvigione'])}**"
+            )
+        st.markdown(f"Totale anno: **{format_currency(sum(e['provvigione'] or 0 for e in estratti))}**")
+    c1, c2 = st.columns(2)
+    with c1:
+        st.download_button(
+            "Esporta CSV",
+            data=db.esporta_provvigioni_csv(azienda['id'], f"{anno}-01", f"{anno}-12").encode('utf-8-sig'),
+            file_name=f"provvigioni_{azienda.get('codice') or azienda['nome']}_{anno}.csv",
+            mime="text/csv",
+            use_container_width=True,
+        )
+    with c2:
+        if st.button("Ricalcola anno", use_container_width=True, key="provv_ricalcola"):
+            db.calcola_provvigioni(f"{anno}-01-01", f"{anno}-12-31", azienda_id=azienda['id'])
+            st.rerun()
+
+
 def render_form_azienda():
     """Form per nuova/modifica azienda"""
     azienda = None
@@ -1509,7 +1717,30 @@ def render_clienti():
             st.session_state.editing_id = None
             st.rerun()
     
-    clienti = db.get_clienti(search=search if search else None)
+    # Segmentazione ABC (ricalcolo completo al massimo una volta al giorno)
+    try:
+        segmentazione.aggiorna_se_scaduta()
+    except Exception:
+        pass
+
+    render_clienti_vicini()
+
+    f1, f2 = st.columns(2)
+    with f1:
+        categoria = st.selectbox("Categoria", ["Tutte", "A", "B", "C"], key="clienti_categoria")
+    with f2:
+        try:
+            mesi_rfm = segmentazione.get_parametri()['mesi']
+        except Exception:
+            mesi_rfm = 12
+        ordinamenti = {"Nome": "ragione_sociale", "Categoria": "categoria", f"Fatturato {mesi_rfm} mesi": "valore"}
+        ordina = st.selectbox("Ordina per", list(ordinamenti), key="clienti_ordina")
+
+    clienti = db.get_clienti(
+        search=search if search else None,
+        categoria=None if categoria == "Tutte" else categoria,
+        ordina_per=ordinamenti[ordina],
+    )
     
     st.markdown(f"**{len(clienti)} clienti**")
     
@@ -1533,6 +1764,7 @@ def render_clienti():
                                 <p class="list-item-title">{cliente['ragione_sociale']}</p>
                                 <p class="list-item-subtitle">{cliente.get('citta','')} ({cliente.get('provincia','')}) · {cliente.get('indirizzo','') or ''}</p>
                             </div>
+                            <span class="badge">{cliente.get('categoria') or 'C'}</span>
                         </div>
                     </div>
                     """,
@@ -1547,6 +1779,50 @@ def render_clienti():
     render_bottom_nav()
 
 
+def render_clienti_vicini():
+    """Clienti attivi nel raggio di un appuntamento di oggi o di una posizione"""
+    with st.expander("Clienti vicini"):
+        punti = {}
+        for a in db.get_appuntamenti_by_date(date.today().isoformat()):
+            if a.get('cliente_latitudine') is not None and a.get('cliente_longitudine') is not None:
+                etichetta = f"{a.get('ora') or ''} {a.get('cliente_nome') or a.get('titolo') or ''}".strip()
+                punti[etichetta] = (a['cliente_latitudine'], a['cliente_longitudine'], a.get('cliente_id'))
+        origine = st.selectbox("Vicino a", list(punti) + ["Posizione (coordinate)"], key="vicini_origine")
+        if origine in punti:
+            lat, lon, escludi = punti[origine]
+        else:
+            col1, col2 = st.columns(2)
+            with col1:
+                lat_txt = st.text_input("Latitudine", key="vicini_lat")
+            with col2:
+                lon_txt = st.text_input("Longitudine", key="vicini_lon")
+            try:
+                lat, lon = float(lat_txt.replace(',', '.')), float(lon_txt.replace(',', '.'))
+            except ValueError:
+                st.caption("Inserisci le coordinate in gradi decimali (es. 45.4642, 9.1900)")
+                return
+            escludi = None
+        raggio = st.slider("Raggio (km)", min_value=1, max_value=50, value=5, key="vicini_raggio")
+
+        vicini = db.get_clienti_vicini(lat, lon, raggio_km=raggio, escludi_cliente=escludi)
+        if not vicini:
+            st.info("Nessun cliente con coordinate nel raggio")
+            return
+        for c in vicini:
+            ultimo = format_date(c['ultimo_ordine']) if c.get('ultimo_ordine') else "mai"
+            c1, c2 = st.columns([6, 1])
+            with c1:
+                st.markdown(
+                    f"**{c['ragione_sociale']}** · {c['distanza_km']:.1f} km<br>"
+                    f"<small>{c.get('indirizzo') or ''} {c.get('citta') or ''} · ultimo ordine: {ultimo}</small>",
+                    unsafe_allow_html=True,
+                )
+            with c2:
+                if st.button("→", key=f"vicino_{c['id']}", use_container_width=True):
+                    st.session_state.selected_cliente_view = c['id']
+                    st.rerun()
+
+
 def render_form_cliente():
     """Form per nuovo/modifica cliente"""
     cliente = None
@@ -1586,6 +1862,12 @@ def render_form_cliente():
         
         partita_iva = st.text_input("Partita IVA", value=cliente.get('partita_iva', '') if cliente else '')
         
+        col1, col2 = st.columns(2)
+        with col1:
+            latitudine = st.text_input("Latitudine", value=str(cliente.get('latitudine') or '') if cliente else '')
+        with col2:
+            longitudine = st.text_input("Longitudine", value=str(cliente.get('longitudine') or '') if cliente else '')
+        
         col1, col2 = st.columns(2)
         with col1:
             submitted = st.form_submit_button("Salva", type="primary", use_container_width=True)
@@ -1593,8 +1875,16 @@ def render_form_cliente():
             cancelled = st.form_submit_button(" Annulla", use_container_width=True)
         
         if submitted:
+            coordinate_ok = True
+            try:
+                lat = float(latitudine.replace(',', '.')) if latitudine.strip() else None
+                lon = float(longitudine.replace(',', '.')) if longitudine.strip() else None
+            except ValueError:
+                coordinate_ok = False
             if not ragione_sociale:
                 st.error("Ragione sociale obbligatoria")
+            elif not coordinate_ok:
+                st.error("Coordinate non valide (gradi decimali, es. 45.4642)")
             else:
                 data = {
                     'codice': codice,
@@ -1606,6 +1896,8 @@ def render_form_cliente():
                     'telefono': telefono,
                     'email': email,
                     'partita_iva': partita_iva,
+                    'latitudine': lat,
+                    'longitudine': lon,
                 }
                 if st.session_state.editing_id:
                     data['id'] = st.session_state.editing_id
@@ -1640,8 +1932,19 @@ def render_ordini():
     
     stato_filter = None if stato == "Tutti" else stato.lower()
     ordini = db.get_ordini(stato=stato_filter)
+    lavori = coda_lavori.get_stato_ordini([o['id'] for o in ordini])
+    email_ordini = db.get_email_ordini([o['id'] for o in ordini])
     
     st.markdown(f"**{len(ordini)} ordini**")
+    coda = coda_lavori.get_riepilogo_coda()
+    in_attesa = sum(coda.get(k, 0) for k in ('in_coda', 'in_corso', 'email_da_inviare', 'email_in_invio'))
+    if in_attesa:
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            st.caption(f"Documenti ed email in preparazione: {in_attesa}")
+        with col2:
+            if st.button("Aggiorna", key="coda_aggiorna"):
+                st.rerun()
     
     if not ordini:
         st.info("Nessun ordine trovato")
@@ -1659,28 +1962,88 @@ def render_ordini():
                     """, unsafe_allow_html=True)
                 with col2:
                     st.markdown(f"""
-                        **Pezzi:** {o.get('totale_pezzi', 0)}<br>
+                        **Righe:** {o.get('num_righe', 0)} · **Pezzi:** {o.get('totale_pezzi', 0)}<br>
                         **Imponibile:** {format_currency(o.get('imponibile', 0))}<br>
                         **Totale:** {format_currency(o['totale_finale'])}
                     """, unsafe_allow_html=True)
                 
+                stato_lavori = render_stato_lavori(lavori.get(o['id'], {}), email_ordini.get(o['id'], []))
+                
                 col1, col2, col3 = st.columns(3)
                 with col1:
                     if st.button("PDF", key=f"pdf_{o['id']}"):
-                        pdf_bytes, filename = genera_pdf_ordine_download(o['id'])
+                        pdf_bytes, filename = coda_lavori.get_pdf_ordine(o['id'])
+                        if not pdf_bytes:
+                            pdf_bytes, filename = genera_pdf_ordine_download(o['id'])
                         if pdf_bytes:
                             st.download_button("Scarica", pdf_bytes, filename, "application/pdf", key=f"dl_{o['id']}")
                 with col2:
                     if o['stato'] == 'bozza':
                         if st.button("Invia", key=f"inv_{o['id']}"):
                             db.update_stato_ordine(o['id'], 'inviato')
+                            try:
+                                segmentazione.aggiorna_dopo_ordine(o['id'])
+                            except Exception:
+                                pass
+                            coda_lavori.accoda_documenti_ordine(o['id'])
                             st.success("Inviato!")
                             st.rerun()
+                with col3:
+                    if 'fallito' in stato_lavori or 'fallita' in stato_lavori:
+                        if st.button("Riprova", key=f"rip_{o['id']}"):
+                            coda_lavori.riprova_ordine(o['id'])
+                            st.rerun()
     
     st.markdown("<br><br><br>", unsafe_allow_html=True)
     render_bottom_nav()
 
 
+# Etichette degli stati della coda lavori e dell'outbox email
+STATI_LAVORO = {
+    'in_coda': 'in coda',
+    'in_corso': 'in preparazione',
+    'completato': 'pronto',
+    'fallito': 'non riuscito',
+}
+STATI_EMAIL = {
+    'da_inviare': 'da inviare',
+    'in_invio': 'in invio',
+    'inviata': 'inviata',
+    'fallita': 'non riuscita',
+}
+
+
+def render_stato_lavori(lavori: Dict[str, Dict], email: List[Dict] = None) -> List[str]:
+    """Riga di stato PDF/email di un ordine (dal database, senza interrogare SMTP); restituisce gli stati mostrati"""
+    email = email or []
+    if not lavori and not email:
+        return []
+    parti, stati, errori = [], [], []
+    lav = lavori.get('pdf_ordine')
+    if lav:
+        stati.append(lav['stato'])
+        testo = STATI_LAVORO.get(lav['stato'], lav['stato'])
+        if lav['stato'] == 'in_coda' and lav.get('errore'):
+            testo = f"nuovo tentativo alle {str(lav['prossimo_tentativo'])[11:16]} ({lav['tentativi']}/{lav['max_tentativi']})"
+        parti.append(f"**PDF:** {testo}")
+        if lav['stato'] != 'completato' and lav.get('errore'):
+            errori.append(lav['errore'])
+    for e in email:
+        stati.append(e['stato'])
+        testo = STATI_EMAIL.get(e['stato'], e['stato'])
+        if e['stato'] == 'inviata' and e.get('inviata_at'):
+            testo += f" il {format_date(e['inviata_at'])} alle {str(e['inviata_at'])[11:16]}"
+        elif e['stato'] == 'da_inviare' and e.get('errore'):
+            testo = f"nuovo tentativo alle {str(e['prossimo_tentativo'])[11:16]} (tentativo {e['tentativi']})"
+        parti.append(f"**Email a {e['destinatario']}:** {testo}")
+        if e['stato'] != 'inviata' and e.get('errore'):
+            errori.append(e['errore'])
+    st.markdown(" · ".join(parti))
+    if errori:
+        st.caption(f"Ultimo errore: {errori[-1]}")
+    return stati
+
+
 # ============================================
 # NUOVO ORDINE
 # ============================================
@@ -1861,8 +2224,21 @@ def render_step_articoli():
     # Cerca
     search = st.text_input("Cerca prodotto", placeholder="Nome o codice...")
     
-    # Prodotti azienda
-    prodotti = db.get_prodotti(azienda_id=st.session_state.ordine_azienda_id, search=search if search else None)
+    # Prodotti azienda: prima gli abituali del cliente (affinità), il resto a pagine
+    per_pagina = 20
+    filtro = (st.session_state.ordine_azienda_id, st.session_state.ordine_cliente_id, search)
+    if st.session_state.get('articoli_filtro') != filtro:
+        st.session_state.articoli_filtro = filtro
+        st.session_state.articoli_pagina = 0
+    pagina = st.session_state.get('articoli_pagina', 0)
+    totale_prodotti = db.conta_prodotti(azienda_id=st.session_state.ordine_azienda_id, search=search if search else None)
+    prodotti = db.get_prodotti(
+        azienda_id=st.session_state.ordine_azienda_id,
+        search=search if search else None,
+        cliente_id=st.session_state.ordine_cliente_id,
+        limit=per_pagina,
+        offset=pagina * per_pagina,
+    )
 
     # Prefill: ultimo prezzo/quantità usati da questo cliente per prodotto
     prefs = {}
@@ -1871,8 +2247,71 @@ def render_step_articoli():
             prefs = db.get_cliente_prodotti_pref(st.session_state.ordine_cliente_id, st.session_state.ordine_azienda_id)
         except Exception:
             prefs = {}
+
+    # Controllo prezzi: prezzo praticato finora al cliente (storico prezzi)
+    prezzi_cliente = {}
+    if st.session_state.ordine_cliente_id:
+        try:
+            prezzi_cliente = db.get_prezzi_cliente(st.session_state.ordine_cliente_id, st.session_state.ordine_azienda_id)
+        except Exception:
+            prezzi_cliente = {}
     
-    st.markdown(f"**{len(prodotti)} prodotti** · {len(st.session_state.ordine_righe)} nel carrello")
+    # Carrello suggerito: prodotti che il cliente riordina di solito in questo periodo
+    if not st.session_state.ordine_righe and st.session_state.ordine_cliente_id and st.session_state.ordine_azienda_id:
+        try:
+            suggeriti = riordini.get_carrello_suggerito(st.session_state.ordine_cliente_id, st.session_state.ordine_azienda_id)
+        except Exception:
+            suggeriti = []
+        if suggeriti:
+            totale_sugg = sum(r['importo_riga'] for r in suggeriti)
+            st.info(f"Riordino previsto: {len(suggeriti)} articoli · ~{format_currency(totale_sugg)}")
+            if st.button("Carica carrello suggerito", key="carrello_suggerito", use_container_width=True):
+                st.session_state.ordine_righe = suggeriti
+                st.rerun()
+
+    # Cross-sell: prodotti spesso acquistati insieme a quelli già nel carrello
+    if st.session_state.ordine_righe and st.session_state.ordine_azienda_id:
+        try:
+            suggerimenti = db.get_suggerimenti_carrello(
+                st.session_state.ordine_azienda_id,
+                [r['prodotto_id'] for r in st.session_state.ordine_righe],
+                k=5,
+            )
+        except Exception:
+            suggerimenti = []
+        if suggerimenti:
+            st.markdown("**Spesso acquistati insieme**")
+            for s in suggerimenti:
+                c1, c2 = st.columns([5, 1])
+                with c1:
+                    st.caption(f"{s['nome']} · Cod: {s['codice']} · in {int(s['confidenza'] * 100)}% degli ordini simili")
+                with c2:
+                    if st.button("+", key=f"xsell_{s['id']}", use_container_width=True):
+                        pref = prefs.get(s['id']) or {}
+                        cartoni = int(pref.get('quantita_cartoni') or 0)
+                        pezzi = int(pref.get('quantita_pezzi') or 0)
+                        if cartoni == 0 and pezzi == 0:
+                            cartoni = 1
+                        prezzo = float(pref.get('prezzo_unitario') or s['prezzo_listino'])
+                        sconto = float(pref.get('sconto_riga') or 0)
+                        qta_tot = cartoni * 6 + pezzi
+                        prezzo_finale = prezzo * (1 - sconto / 100)
+                        st.session_state.ordine_righe.append({
+                            'prodotto_id': s['id'],
+                            'prodotto_codice': s['codice'],
+                            'prodotto_nome': s['nome'],
+                            'pezzi_per_cartone': 6,
+                            'quantita_cartoni': cartoni,
+                            'quantita_pezzi': pezzi,
+                            'quantita_totale': qta_tot,
+                            'prezzo_unitario': prezzo,
+                            'sconto_riga': sconto,
+                            'prezzo_finale': prezzo_finale,
+                            'importo_riga': qta_tot * prezzo_finale,
+                        })
+                        st.rerun()
+
+    st.markdown(f"**{totale_prodotti} prodotti** · {len(st.session_state.ordine_righe)} nel carrello")
     
     for prod in prodotti:
         in_cart = next((r for r in st.session_state.ordine_righe if r['prodotto_id'] == prod['id']), None)
@@ -1883,7 +2322,7 @@ def render_step_articoli():
                 <div style="display:flex;justify-content:space-between;margin-bottom:0.5rem;">
                     <div>
                         <span class="product-name">{prod['nome']}</span>
-                        <div class="product-info">Cod: {prod['codice']} · 6 pz/cart</div>
+                        <div class="product-info">Cod: {prod['codice']} · 6 pz/cart{f" · ordinato {prod['cliente_num_ordini']} volte" if prod.get('cliente_num_ordini') else ""}</div>
                     </div>
                     <span class="product-price">{format_currency(prod['prezzo_listino'])}</span>
                 </div>
@@ -1935,6 +2374,14 @@ def render_step_articoli():
         if pref and not in_cart:
             st.caption(f"Prefill ultimo ordine: cartoni {pref.get('quantita_cartoni',0)} · pezzi {pref.get('quantita_pezzi',0)} · prezzo {format_currency(pref.get('prezzo_unitario',0))}")
         st.caption(f"Totale pezzi: **{qta_tot_live}** (cartone = 6 pz)")
+        praticato = prezzi_cliente.get(prod['id'])
+        if praticato:
+            prezzo_finale_live = float(prezzo_unitario) * (1 - float(sconto) / 100)
+            if abs(prezzo_finale_live - float(praticato['prezzo_finale'] or 0)) > 0.005:
+                st.caption(
+                    f"⚠️ Prezzo diverso da quello praticato al cliente: {format_currency(praticato['prezzo_finale'])} "
+                    f"netto dal {format_date(praticato['valido_dal'])}"
+                )
 
         with col5:
             if st.button("Aggiungi" if not in_cart else "Modifica", key=f"add_{prod['id']}"):
@@ -1962,6 +2409,21 @@ def render_step_articoli():
                     st.session_state.ordine_righe.append(nuova_riga)
                     st.rerun()
     
+    # Paginazione catalogo
+    num_pagine = max(1, -(-totale_prodotti // per_pagina))
+    if num_pagine > 1:
+        p1, p2, p3 = st.columns([1, 2, 1])
+        with p1:
+            if st.button("← Precedenti", disabled=pagina == 0, use_container_width=True):
+                st.session_state.articoli_pagina = pagina - 1
+                st.rerun()
+        with p2:
+            st.caption(f"Pagina {pagina + 1} di {num_pagine}")
+        with p3:
+            if st.button("Altri →", disabled=pagina >= num_pagine - 1, use_container_width=True):
+                st.session_state.articoli_pagina = pagina + 1
+                st.rerun()
+
     st.markdown("<br>", unsafe_allow_html=True)
     
     if st.session_state.ordine_righe:
@@ -2113,12 +2575,37 @@ def salva_ordine(stato: str):
         'note': det.get('note'),
     }
 
+    # Conferma via email: in outbox nella stessa transazione dell'ordine
+    email_dest = (det or {}).get('email_destinatario') if stato == 'inviato' else None
+    email = None
+    if email_dest:
+        cliente = db.get_cliente(testata['cliente_id']) or {}
+        email = {
+            'destinatario': email_dest,
+            'oggetto': f"Conferma Ordine {testata['numero']} - {cliente.get('ragione_sociale','Cliente')}",
+            'corpo': (
+                f"Buongiorno,\n\n"
+                f"in allegato la conferma/proforma dell'ordine {testata['numero']} del {testata['data_ordine']}.\n\n"
+                f"Cordiali saluti"
+            ),
+        }
+
     try:
-        ordine_id = db.save_ordine(testata, st.session_state.ordine_righe)
+        ordine_id = db.save_ordine(testata, st.session_state.ordine_righe, email=email)
     except Exception as e:
         st.error(f"Errore nel salvataggio ordine: {e}")
         return
 
+    # Previsioni riordino e segmento cliente: ricalcolo incrementale (indipendenti)
+    try:
+        riordini.aggiorna_dopo_ordine(ordine_id)
+    except Exception:
+        pass
+    try:
+        segmentazione.aggiorna_dopo_ordine(ordine_id)
+    except Exception:
+        pass
+
     # Bozza
     if stato != 'inviato':
         st.success("Bozza salvata")
@@ -2126,48 +2613,17 @@ def salva_ordine(stato: str):
         navigate_to('ordini')
         st.rerun()
 
-    # INVIATO: PDF + email
-    st.success("Ordine inviato e salvato nel database.")
-
-    pdf_bytes, filename = None, None
+    # INVIATO: PDF in background (coda lavori), l'email è già in outbox con l'ordine
     try:
-        pdf_bytes, filename = genera_pdf_ordine_download(ordine_id)
+        coda_lavori.accoda_documenti_ordine(ordine_id)
+        coda_lavori.avvia_worker()
     except Exception as e:
-        st.error(f"Errore generazione PDF: {e}")
-
-    if pdf_bytes and filename:
-        st.download_button(
-            "Scarica conferma/proforma (PDF)",
-            pdf_bytes,
-            file_name=filename,
-            mime="application/pdf",
-            use_container_width=True,
-        )
-
-    email_dest = (det or {}).get('email_destinatario')
+        st.error(f"Ordine salvato, ma impossibile accodare il PDF: {e}")
+    st.success("Ordine inviato e salvato nel database.")
     if email_dest:
-        if not pdf_bytes:
-            st.warning("PDF non disponibile: impossibile inviare email con allegato.")
-        else:
-            try:
-                cliente = db.get_cliente(testata['cliente_id']) or {}
-                send_email_with_attachment(
-                    to_email=email_dest,
-                    subject=f"Conferma Ordine {testata['numero']} - {cliente.get('ragione_sociale','Cliente')}",
-                    body=(
-                        f"Buongiorno,\n\n"
-                        f"in allegato la conferma/proforma dell'ordine {testata['numero']} del {testata['data_ordine']}.\n\n"
-                        f"Cordiali saluti"
-                    ),
-                    attachment_bytes=pdf_bytes,
-                    attachment_filename=filename or "ordine.pdf",
-                    mime_type="application/pdf",
-                )
-                st.success(f"Email inviata a: {email_dest}")
-            except Exception as e:
-                st.error(f"Ordine salvato, ma invio email fallito: {e}")
+        st.info(f"PDF ed email a {email_dest} in preparazione: lo stato è nella pagina Ordini")
     else:
-        st.info("Email non inserita: puoi inviare il PDF più tardi dalla pagina Ordini")
+        st.info("PDF in preparazione: potrai scaricarlo dalla pagina Ordini")
 
     col1, col2 = st.columns(2)
     with col1:
@@ -2198,8 +2654,40 @@ def render_promemoria():
         st.session_state.show_form = True
         st.rerun()
     
-    promemoria = db.get_promemoria(solo_attivi=True)
     oggi = date.today()
+    conteggi = db.get_conteggi_promemoria()
+    k1, k2, k3 = st.columns(3)
+    k1.metric("Scaduti", conteggi['scaduti'])
+    k2.metric("Oggi", conteggi['oggi'])
+    k3.metric("Prossimi 7 giorni", conteggi['prossimi_7'])
+    
+    f1, f2, f3 = st.columns(3)
+    with f1:
+        periodo = st.selectbox("Periodo", ["Fino a 7 giorni", "Scaduti", "Oggi", "Tutti"])
+    with f2:
+        priorita = st.selectbox("Priorità", ["Tutte", "alta", "media", "bassa"])
+    with f3:
+        tipo = st.selectbox("Tipo", ["Tutti", "chiamata", "preventivo", "sollecito",
+                                     "ricontatto", "scadenza", "generico"])
+    
+    finestre = {
+        "Fino a 7 giorni": (None, oggi + timedelta(days=7)),
+        "Scaduti": (None, oggi - timedelta(days=1)),
+        "Oggi": (oggi, oggi),
+        "Tutti": (None, None),
+    }
+    data_da, data_a = finestre[periodo]
+    limite = st.session_state.get('promemoria_limite', 50)
+    promemoria = db.get_promemoria(
+        solo_attivi=True,
+        data_da=data_da.isoformat() if data_da else None,
+        data_a=data_a.isoformat() if data_a else None,
+        priorita=None if priorita == "Tutte" else priorita,
+        tipo=None if tipo == "Tutti" else tipo,
+        limit=limite + 1,
+    )
+    altri = len(promemoria) > limite
+    promemoria = promemoria[:limite]
     
     if not promemoria:
         st.info("Nessun promemoria attivo.")
@@ -2224,14 +2712,18 @@ def render_promemoria():
             with col1:
                 st.markdown(f"""
                     <div class="list-item" style="background:{bg};">
-                        <p class="list-item-title">{p['titolo']}</p>
+                        <p class="list-item-title">{p['titolo']}{' ↻' if p.get('ricorrente') else ''}</p>
                         <p class="list-item-subtitle">{p.get('cliente_nome', '')} · {badge}</p>
                     </div>
                 """, unsafe_allow_html=True)
             with col2:
                 if st.button("Completa", key=f"cp_{p['id']}"):
-                    db.completa_promemoria(p['id'])
+                    db.completa_promemoria(p['id'], p.get('data_originale'))
                     st.rerun()
+        
+        if altri and st.button("Mostra altri"):
+            st.session_state.promemoria_limite = limite + 50
+            st.rerun()
     
     st.markdown("<br><br><br>", unsafe_allow_html=True)
     render_bottom_nav()
@@ -2252,6 +2744,7 @@ def render_form_promemoria():
         data_scadenza = st.date_input("Scadenza", value=date.today() + timedelta(days=1))
         priorita = st.selectbox("Priorità", ["alta", "media", "bassa"], index=1)
         descrizione = st.text_area("Note")
+        ricorrenza = input_ricorrenza("prom")
         
         if st.form_submit_button("Salva", type="primary", use_container_width=True):
             if titolo:
@@ -2260,7 +2753,8 @@ def render_form_promemoria():
                     'data_scadenza': data_scadenza.isoformat(),
                     'priorita': priorita,
                     'descrizione': descrizione,
-                    'completato': 0
+                    'completato': 0,
+                    'ricorrenza': ricorrenza,
                 })
                 st.success("Salvato!")
                 st.session_state.show_form = False
@@ -2351,28 +2845,13 @@ def render_calendario():
             st.session_state.cal_selected_date = date(y, m, 1).isoformat()
         st.rerun()
 
-    # --- carica appuntamenti del mese (con fallback) ---
+    # --- agenda delle settimane visibili (appuntamenti, visite, promemoria per giorno) ---
+    weeks = calendar.Calendar(firstweekday=0).monthdatescalendar(y, m)
     first_day = date(y, m, 1)
     last_day = date(y, m, calendar.monthrange(y, m)[1])
-    if hasattr(db, "get_appuntamenti_range"):
-        month_apps = db.get_appuntamenti_range(first_day.isoformat(), last_day.isoformat())
-    else:
-        conn = db.get_connection()
-        try:
-            rows = conn.execute(
-                "SELECT * FROM appuntamenti WHERE data >= ? AND data <= ? ORDER BY data, ora",
-                (first_day.isoformat(), last_day.isoformat()),
-            ).fetchall()
-            month_apps = [dict(r) for r in rows]
-        finally:
-            conn.close()
-
-    # indicizza per giorno
-    apps_by_day: Dict[str, List[Dict]] = {}
-    for a in month_apps:
-        dd = str(a.get("data") or "")
-        if dd:
-            apps_by_day.setdefault(dd, []).append(a)
+    apps_by_day = db.get_agenda(weeks[0][0].isoformat(), weeks[-1][-1].isoformat())
+    month_apps = [e for giorno, eventi in apps_by_day.items()
+                  if first_day.isoformat() <= giorno <= last_day.isoformat() for e in eventi]
 
     # CSS (griglia 7 colonne sempre, anche su iPhone) + tema light/dark
     st.markdown(
@@ -2428,9 +2907,7 @@ def render_calendario():
         ]
         st.markdown(f"## {mesi_it[m-1]} {y}")
 
-        # costruisci 6 settimane con date (Monday-first)
-        cal = calendar.Calendar(firstweekday=0)
-        weeks = cal.monthdatescalendar(y, m)
+        # settimane del mese con date (Monday-first), già calcolate per l'agenda
         week_days = ["lun", "mar", "mer", "gio", "ven", "sab", "dom"]
         st.markdown("<div class='cal-wrap'>", unsafe_allow_html=True)
         st.markdown(
@@ -2438,8 +2915,12 @@ def render_calendario():
             unsafe_allow_html=True,
         )
 
-        def _pick_class(title: str) -> str:
-            t = (title or "").lower()
+        def _pick_class(evento: Dict) -> str:
+            if evento.get("tipo") == "visita":
+                return "cal-blue"
+            if evento.get("tipo") == "promemoria":
+                return "cal-orange"
+            t = (evento.get("titolo") or "").lower()
             if any(k in t for k in ["sold", "pag", "incasso", "fatt"]) :
                 return "cal-orange"
             if any(k in t for k in ["visita", "giro", "cliente", "appunt"]) :
@@ -2470,7 +2951,7 @@ def render_calendario():
                     titolo = a.get("titolo") or ""
                     ora = a.get("ora") or ""
                     label = (f"{ora} " if ora else "") + titolo
-                    cls = _pick_class(titolo)
+                    cls = _pick_class(a)
                     html.append(f"<span class='cal-event {cls}'>{label}</span>")
                 html.append("</div>")
         html.append("</div>")
@@ -2491,28 +2972,23 @@ def render_calendario():
             st.session_state.cal_selected_date = picked.isoformat()
             st.rerun()
 
-        # carica appuntamenti giorno
-        if hasattr(db, "get_appuntamenti_by_date"):
-            day_apps = db.get_appuntamenti_by_date(picked.isoformat())
+        # eventi del giorno: già nell'agenda se il giorno è tra quelli visibili
+        if weeks[0][0] <= picked <= weeks[-1][-1]:
+            day_apps = apps_by_day.get(picked.isoformat(), [])
         else:
-            conn = db.get_connection()
-            try:
-                rows = conn.execute(
-                    "SELECT * FROM appuntamenti WHERE data = ? ORDER BY ora",
-                    (picked.isoformat(),),
-                ).fetchall()
-                day_apps = [dict(r) for r in rows]
-            finally:
-                conn.close()
+            day_apps = db.get_agenda(picked.isoformat(), picked.isoformat()).get(picked.isoformat(), [])
 
         if not day_apps:
             st.info("Nessun appuntamento in questa data")
         else:
+            etichette = {'visita': 'Visita · ', 'promemoria': 'Promemoria · '}
             for a in day_apps:
-                titolo = a.get('titolo', '')
+                titolo = etichette.get(a['tipo'], '') + (a.get('titolo') or '')
+                if a.get('data_originale'):
+                    titolo += " ↻"
                 ora = a.get('ora') or ""
                 cliente_nome = a.get('cliente_nome') or ""
-                luogo = a.get('luogo') or ""
+                luogo = a.get('dettaglio') or ""
                 st.markdown(
                     f"""
                     <div class='list-item' style='margin:0.25rem 0;'>
@@ -2522,7 +2998,17 @@ def render_calendario():
                     """,
                     unsafe_allow_html=True,
                 )
-                if st.button("Elimina", key=f"del_app_{a['id']}"):
+                if a['tipo'] == 'appuntamento' and a.get('data_originale'):
+                    b1, b2, _ = st.columns([1, 1, 2])
+                    with b1:
+                        if st.button("Elimina questo", key=f"del_occ_{a['id']}_{a['data_originale']}"):
+                            db.annulla_occorrenza('appuntamento', a['id'], a['data_originale'])
+                            st.rerun()
+                    with b2:
+                        if st.button("Elimina serie", key=f"del_serie_{a['id']}_{a['data_originale']}"):
+                            db.delete_appuntamento(a['id'])
+                            st.rerun()
+                elif a['tipo'] == 'appuntamento' and st.button("Elimina", key=f"del_app_{a['id']}"):
                     db.delete_appuntamento(a['id'])
                     st.rerun()
 
@@ -2537,6 +3023,7 @@ def render_calendario():
             ora_t = None
             if not senza_ora:
                 ora_t = st.time_input("Ora", value=datetime.now().replace(second=0, microsecond=0).time())
+            durata_app = st.number_input("Durata (minuti)", min_value=5, max_value=720, value=60, step=15)
             cliente_id = st.selectbox(
                 "Cliente",
                 options=[x[0] for x in cli_opts],
@@ -2544,6 +3031,8 @@ def render_calendario():
             )
             luogo = st.text_input("Luogo", placeholder="Indirizzo / città")
             note = st.text_area("Note")
+            ricorrenza = input_ricorrenza("app")
+            ignora_conflitti = st.checkbox("Salva anche se si sovrappone ad altri impegni", value=False)
             saved = st.form_submit_button("Salva", type="primary", use_container_width=True)
 
             if saved:
@@ -2556,28 +3045,44 @@ def render_calendario():
                             ora_str = ora_t.strftime("%H:%M")
                         except Exception:
                             ora_str = None
-                    try:
-                        save_appuntamento_safe({
-                            'titolo': titolo,
-                            'data': data_app.isoformat(),
-                            'ora': ora_str,
-                            'cliente_id': cliente_id or None,
-                            'luogo': luogo,
-                            'note': note,
-                        })
-                        st.success("Appuntamento salvato")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Errore salvataggio appuntamento: {e}")
+                    conflitti = []
+                    if ora_str and not ignora_conflitti:
+                        conflitti = db.get_conflitti(data_app.isoformat(), ora_str, durata_minuti=int(durata_app))
+                    if conflitti:
+                        st.warning("Sovrapposizione con: " + ", ".join(
+                            f"{c['ora_inizio']}-{c['ora_fine']} {c.get('cliente_nome') or c.get('titolo') or c['tipo']}"
+                            for c in conflitti
+                        ))
+                        liberi = db.suggerisci_slot(data_app.isoformat(), int(durata_app), ora_str, giorni=7)
+                        if liberi:
+                            st.info("Orari liberi più vicini: " + ", ".join(
+                                f"{format_date(l['giorno'])} {l['ora_inizio']}-{l['ora_fine']}" for l in liberi
+                            ))
+                    else:
+                        try:
+                            save_appuntamento_safe({
+                                'titolo': titolo,
+                                'data': data_app.isoformat(),
+                                'ora': ora_str,
+                                'durata_minuti': int(durata_app) if ora_str else None,
+                                'cliente_id': cliente_id or None,
+                                'luogo': luogo,
+                                'note': note,
+                                'ricorrenza': ricorrenza,
+                            })
+                            st.success("Appuntamento salvato")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Errore salvataggio appuntamento: {e}")
 
     # --- ELENCO ---
     if view == "Elenco":
-        st.markdown("**Appuntamenti del mese**")
+        st.markdown("**Agenda del mese**")
         if not month_apps:
             st.info("Nessun appuntamento nel mese")
         else:
             for a in month_apps:
-                st.write(f"{a.get('data','')}  {a.get('ora') or ''}  —  {a.get('titolo','')}")
+                st.write(f"{a['giorno']}  {a.get('ora') or ''}  —  {a.get('titolo','')}  ({a['tipo']})")
 
     # --- GIORNO ---
     if view == "Giorno":
@@ -2589,7 +3094,46 @@ def render_calendario():
 
     # --- PLANNER ---
     if view == "Planner":
-        st.markdown("Planner (in arrivo): lista attività con priorità e scadenze.")
+        st.markdown("**Giro visite**")
+        try:
+            giorno_default = date.fromisoformat(st.session_state.get('cal_selected_date') or '')
+        except Exception:
+            giorno_default = date.today()
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            giorno_giro = st.date_input("Giorno", value=giorno_default, key="giro_giorno")
+        with col2:
+            ritorno = st.checkbox("Ritorno alla partenza", value=False, key="giro_ritorno")
+
+        giro = percorsi.pianifica_giorno(giorno_giro.isoformat(), ritorno=ritorno)
+        tappe = giro['tappe']
+        if not tappe and not giro['non_localizzate']:
+            st.info("Nessuna visita o appuntamento con cliente in questo giorno")
+        if tappe:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Tappe", len(tappe))
+            with col2:
+                st.metric("Km stimati", f"{giro['km_totali']:.1f}")
+            with col3:
+                st.metric("Fine giro", giro['fine_giro'])
+            if giro['ritardo_minuti']:
+                st.warning(f"Finestre orarie non rispettate: {giro['ritardo_minuti']} minuti di ritardo complessivi")
+
+            for n, t in enumerate(tappe, start=1):
+                ritardo = " · IN RITARDO" if t['in_ritardo'] else ""
+                luogo = " · ".join(x for x in [t.get('indirizzo'), t.get('citta')] if x)
+                st.markdown(
+                    f"**{n}. {t['inizio_visita']}–{t['fine_visita']}** {t.get('cliente_nome') or ''}{ritardo}<br>"
+                    f"<small>{t['titolo']} · arrivo {t['arrivo']} · {t['km_da_precedente']:.1f} km"
+                    f"{' · ' + luogo if luogo else ''}</small>",
+                    unsafe_allow_html=True,
+                )
+            st.map(pd.DataFrame([{'lat': float(t['lat']), 'lon': float(t['lon'])} for t in tappe]))
+
+        if giro['non_localizzate']:
+            st.caption("Senza coordinate (escluse dal giro): " +
+                       ", ".join(t.get('cliente_nome') or '' for t in giro['non_localizzate']))
 
     st.markdown("<br><br><br>", unsafe_allow_html=True)
     render_bottom_nav()
@@ -2601,6 +3145,8 @@ def render_calendario():
 
 def main():
     db.init_db()
+    # worker PDF/email: riprendono anche i lavori rimasti in coda dai riavvii
+    coda_lavori.avvia_worker()
     
     if not st.session_state.authenticated:
         render_login()
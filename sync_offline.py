@@ -0,0 +1,398 @@
+"""
+PORTALE AGENTE DI COMMERCIO
+Sincronizzazione dispositivi offline (protocollo delta)
+
+Gli agenti preparano ordini anche senza rete. Il dispositivo:
+1. sync_pull(): riceve solo le modifiche a aziende, clienti, prodotti e
+   prefill (cliente_prodotto_pref) successive al proprio checkpoint, lette dal
+   change log (vedi db.get_changes_since). Il payload è proporzionale alle
+   modifiche, non alla dimensione del database. Al primo sync, o se il change
+   log è stato compattato oltre il checkpoint, riceve uno snapshot completo.
+   Il checkpoint registrato sul server avanza solo quando il dispositivo
+   rimanda quello che ha effettivamente applicato (parametro checkpoint del
+   pull successivo o conferma_checkpoint): una risposta persa non fa perdere
+   modifiche.
+2. sync_push(): invia clienti e ordini creati/modificati offline.
+
+Regole di conflitto:
+- Clienti nuovi: se esiste già un cliente con la stessa partita IVA il cliente
+  del dispositivo viene unito a quello esistente (nessun duplicato), altrimenti
+  viene creato mantenendo l'UUID del dispositivo.
+- Clienti modificati: vince il server se il cliente è cambiato sul server dopo
+  la versione vista dal dispositivo (base_updated_at); il dispositivo riceve la
+  versione del server.
+- Ordini: l'UUID creato dal dispositivo è l'ID definitivo, quindi il re-invio
+  dello stesso ordine (rete instabile) è idempotente. Un ordine già ricevuto e
+  poi eliminato (o archiviato) sul server, o inviato come modifica di una
+  versione del server (base_updated_at) che non esiste più, è un conflitto:
+  non viene ricreato. Il numero ordine è sempre
+  assegnato dal server: il numero provvisorio del dispositivo viene mappato sul
+  numero definitivo in sync_id_map.
+"""
+
+import logging
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+import db
+import riordini
+import segmentazione
+import storage
+
+# Tabelle scaricate dai dispositivi
+SYNC_TABELLE = ('aziende', 'clienti', 'prodotti', 'cliente_prodotto_pref')
+
+# Colonne aziende inviate ai dispositivi (senza logo embedded, che pesa)
+_COLONNE_AZIENDE = ('id', 'codice', 'nome', 'ragione_sociale', 'indirizzo', 'citta', 'provincia', 'cap',
+                    'telefono', 'email', 'partita_iva', 'attivo', 'updated_at')
+
+# Dimensione massima delle liste IN (...) per query
+_CHUNK = 500
+
+log = logging.getLogger(__name__)
+
+
+def _chunks(items: List[Any], size: int = _CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _registra_dispositivo(conn, device_id: str, nome: str = None) -> None:
+    conn.execute("""
+        INSERT INTO sync_dispositivi (device_id, nome, ultimo_checkpoint, created_at)
+        VALUES (?, ?, 0, ?)
+        ON CONFLICT(device_id) DO NOTHING
+    """, (device_id, nome, datetime.now().isoformat()))
+    if nome:
+        conn.execute("UPDATE sync_dispositivi SET nome = ? WHERE device_id = ?", (nome, device_id))
+
+
+def _select_tabella(tabella: str) -> str:
+    if tabella == 'aziende':
+        return f"SELECT {', '.join(_COLONNE_AZIENDE)} FROM aziende"
+    return f"SELECT * FROM {tabella}"
+
+
+def _snapshot(conn) -> Dict[str, List[Dict]]:
+    """Snapshot completo (primo sync o resync)"""
+    return {
+        'aziende': db.rows_to_list(conn.execute(_select_tabella('aziende') + " WHERE attivo = 1").fetchall()),
+        'clienti': db.rows_to_list(conn.execute("SELECT * FROM clienti WHERE attivo = 1").fetchall()),
+        'prodotti': db.rows_to_list(conn.execute("SELECT * FROM prodotti").fetchall()),
+        'cliente_prodotto_pref': db.rows_to_list(conn.execute("SELECT * FROM cliente_prodotto_pref").fetchall()),
+    }
+
+
+def _righe_per_id(conn, tabella: str, ids: List[str]) -> List[Dict]:
+    out: List[Dict] = []
+    for chunk in _chunks(ids):
+        placeholders = ', '.join(['?' for _ in chunk])
+        rows = conn.execute(f"{_select_tabella(tabella)} WHERE id IN ({placeholders})", chunk).fetchall()
+        out.extend(db.rows_to_list(rows))
+    return out
+
+
+def _pref_per_chiave(conn, chiavi: List[str]) -> List[Dict]:
+    """Righe di prefill per chiave 'cliente|azienda|prodotto' (una query per blocco di chiavi)"""
+    parti = [c.split('|') for c in chiavi]
+    parti = [p for p in parti if len(p) == 3]
+    out: List[Dict] = []
+    # 3 parametri per chiave
+    for chunk in _chunks(parti, _CHUNK // 3):
+        valori = ', '.join(['(?, ?, ?)' for _ in chunk])
+        rows = conn.execute(f"""
+            SELECT * FROM cliente_prodotto_pref
+            WHERE (cliente_id, azienda_id, prodotto_id) IN (VALUES {valori})
+        """, [v for p in chunk for v in p]).fetchall()
+        out.extend(db.rows_to_list(rows))
+    return out
+
+
+def _salva_checkpoint(conn, device_id: str, checkpoint: int) -> None:
+    """Registra il checkpoint confermato dal dispositivo (mai oltre l'ultima seq esistente)"""
+    ultima = int(conn.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM change_log").fetchone()['seq'])
+    conn.execute("UPDATE sync_dispositivi SET ultimo_checkpoint = ? WHERE device_id = ?",
+                 (max(min(int(checkpoint), ultima), 0), device_id))
+
+
+def conferma_checkpoint(device_id: str, checkpoint: int) -> None:
+    """Conferma che il dispositivo ha applicato i dati fino a checkpoint (incluso).
+
+    Serve dopo l'ultimo pull di una sessione; i pull successivi confermano già
+    il checkpoint che ricevono.
+    """
+    conn = db.get_connection()
+    try:
+        _registra_dispositivo(conn, device_id)
+        _salva_checkpoint(conn, device_id, checkpoint)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def sync_pull(device_id: str, checkpoint: int = None, nome: str = None, limit: int = None) -> Dict[str, Any]:
+    """Delta per un dispositivo a partire dal suo checkpoint.
+
+    Args:
+        device_id: identificativo stabile del dispositivo
+        checkpoint: checkpoint già applicato sul dispositivo, che il server
+            registra come confermato (None: quello confermato in precedenza)
+        limit: massimo numero di modifiche per risposta (se 'altre' è True, richiamare)
+
+    Returns:
+        dict con 'checkpoint' (da salvare sul dispositivo dopo aver applicato i
+        dati e da rimandare al pull successivo), 'completo' (True: sostituire
+        i dati locali), 'altre', una lista di righe per ogni tabella di SYNC_TABELLE
+        ed 'eliminati' {tabella: [row_id]}.
+    """
+    conn = db.get_connection()
+    try:
+        _registra_dispositivo(conn, device_id, nome)
+        if checkpoint is None:
+            row = conn.execute("SELECT ultimo_checkpoint FROM sync_dispositivi WHERE device_id = ?",
+                               (device_id,)).fetchone()
+            checkpoint = int(row['ultimo_checkpoint'] or 0) if row else 0
+        else:
+            _salva_checkpoint(conn, device_id, checkpoint)
+        conn.commit()
+    finally:
+        conn.close()
+
+    delta = db.get_changes_since(checkpoint, tabelle=list(SYNC_TABELLE), limit=limit)
+
+    conn = db.get_connection()
+    try:
+        if delta['resync']:
+            # checkpoint letto PRIMA dello snapshot: le modifiche concorrenti arriveranno al prossimo pull
+            nuovo_checkpoint = db.get_ultima_seq()
+            payload = _snapshot(conn)
+            payload.update({'checkpoint': nuovo_checkpoint, 'completo': True, 'altre': False,
+                            'eliminati': {t: [] for t in SYNC_TABELLE}})
+        else:
+            nuovo_checkpoint = delta['seq']
+            modificati: Dict[str, List[str]] = {t: [] for t in SYNC_TABELLE}
+            eliminati: Dict[str, List[str]] = {t: [] for t in SYNC_TABELLE}
+            for ch in delta['changes']:
+                if ch['operazione'] == 'D':
+                    eliminati[ch['tabella']].append(ch['row_id'])
+                else:
+                    modificati[ch['tabella']].append(ch['row_id'])
+
+            payload = {'checkpoint': nuovo_checkpoint, 'completo': False, 'altre': delta['altre'],
+                       'eliminati': eliminati}
+            for tabella in ('aziende', 'clienti', 'prodotti'):
+                payload[tabella] = _righe_per_id(conn, tabella, modificati[tabella])
+            payload['cliente_prodotto_pref'] = _pref_per_chiave(conn, modificati['cliente_prodotto_pref'])
+
+        # il checkpoint si registra solo alla conferma del dispositivo
+        conn.execute("UPDATE sync_dispositivi SET ultimo_pull = ? WHERE device_id = ?",
+                     (datetime.now().isoformat(), device_id))
+        conn.commit()
+        return payload
+    finally:
+        conn.close()
+
+
+# ============================================
+# PUSH
+# ============================================
+
+def _id_mappato(conn, device_id: str, tipo: str, id_locale: str) -> Optional[Dict]:
+    row = conn.execute("""
+        SELECT id_server, numero_server FROM sync_id_map
+        WHERE device_id = ? AND tipo = ? AND id_locale = ?
+    """, (device_id, tipo, id_locale)).fetchone()
+    return dict(row) if row else None
+
+
+def _mappa_id(conn, device_id: str, tipo: str, id_locale: str, id_server: str,
+              numero_locale: str = None, numero_server: str = None) -> None:
+    conn.execute("""
+        INSERT INTO sync_id_map (device_id, tipo, id_locale, id_server, numero_locale, numero_server, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(device_id, tipo, id_locale) DO UPDATE SET
+            id_server = excluded.id_server, numero_server = excluded.numero_server
+    """, (device_id, tipo, id_locale, id_server, numero_locale, numero_server, datetime.now().isoformat()))
+
+
+def _istante(valore: Any) -> Optional[datetime]:
+    """updated_at come datetime: i formati 'YYYY-MM-DDTHH:MM:SS[.ffffff]' (isoformat) e
+    'YYYY-MM-DD HH:MM:SS' (default del database) non si confrontano come stringhe"""
+    if valore is None or valore == '':
+        return None
+    if isinstance(valore, datetime):
+        istante = valore
+    else:
+        try:
+            istante = datetime.fromisoformat(str(valore).strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if istante.tzinfo is not None:
+        istante = istante.astimezone().replace(tzinfo=None)
+    return istante
+
+
+def _push_cliente(conn, device_id: str, cliente: Dict, colonne: set) -> Dict[str, Any]:
+    """Applica un cliente del dispositivo secondo le regole di conflitto"""
+    id_locale = cliente.get('id')
+    mappato = _id_mappato(conn, device_id, 'cliente', id_locale)
+    if mappato:
+        return {'id': mappato['id_server'], 'esito': 'unito'}
+
+    dati = {k: v for k, v in cliente.items() if k in colonne and k not in ('id', 'created_at', 'updated_at')}
+    server = conn.execute("SELECT * FROM clienti WHERE id = ?", (id_locale,)).fetchone()
+    now = datetime.now().isoformat()
+
+    if server:
+        base = cliente.get('base_updated_at')
+        if base is None:
+            # cliente creato offline e già ricevuto (re-invio)
+            return {'id': id_locale, 'esito': 'gia_ricevuto'}
+        server_at, base_at = _istante(server['updated_at']), _istante(base)
+        # base illeggibile: vince il server
+        if server_at is not None and (base_at is None or server_at > base_at):
+            return {'id': id_locale, 'esito': 'conflitto', 'server': dict(server)}
+        if dati:
+            fields = [f"{k} = ?" for k in dati] + ["updated_at = ?"]
+            conn.execute(f"UPDATE clienti SET {', '.join(fields)} WHERE id = ?",
+                         list(dati.values()) + [now, id_locale])
+        return {'id': id_locale, 'esito': 'aggiornato'}
+
+    piva = (cliente.get('partita_iva') or '').strip()
+    if piva:
+        esistente = conn.execute("SELECT id FROM clienti WHERE partita_iva = ? AND attivo = 1 LIMIT 1",
+                                 (piva,)).fetchone()
+        if esistente:
+            _mappa_id(conn, device_id, 'cliente', id_locale, esistente['id'])
+            return {'id': esistente['id'], 'esito': 'unito'}
+
+    if not dati.get('ragione_sociale'):
+        return {'id': None, 'esito': 'errore', 'errore': 'Ragione sociale obbligatoria'}
+    dati.update({'id': id_locale, 'created_at': now, 'updated_at': now})
+    conn.execute(f"INSERT INTO clienti ({', '.join(dati)}) VALUES ({', '.join(['?' for _ in dati])})",
+                 list(dati.values()))
+    return {'id': id_locale, 'esito': 'creato'}
+
+
+def _risolvi_cliente(conn, device_id: str, cliente_id: str) -> Optional[str]:
+    mappato = _id_mappato(conn, device_id, 'cliente', cliente_id)
+    if mappato:
+        return mappato['id_server']
+    row = conn.execute("SELECT id FROM clienti WHERE id = ?", (cliente_id,)).fetchone()
+    return row['id'] if row else None
+
+
+def _verifica_ordine(conn, testata: Dict, righe: List[Dict]) -> Optional[str]:
+    """Controlla i riferimenti di un ordine offline; ritorna un messaggio d'errore o None"""
+    if not conn.execute("SELECT 1 FROM aziende WHERE id = ?", (testata.get('azienda_id'),)).fetchone():
+        return "Fornitore non trovato"
+    if not righe:
+        return "Ordine senza righe"
+    prodotti = list({r.get('prodotto_id') for r in righe})
+    placeholders = ', '.join(['?' for _ in prodotti])
+    trovati = conn.execute(f"SELECT COUNT(*) AS cnt FROM prodotti WHERE id IN ({placeholders})",
+                           prodotti).fetchone()['cnt']
+    if trovati != len(prodotti):
+        return "Uno o più prodotti non esistono più a catalogo"
+    return None
+
+
+def sync_push(device_id: str, clienti: List[Dict] = None, ordini: List[Dict] = None) -> Dict[str, Any]:
+    """Riceve clienti e ordini creati offline da un dispositivo.
+
+    Args:
+        clienti: righe cliente; per i clienti già scaricati indicare base_updated_at
+            (updated_at della versione ricevuta), per quelli nuovi lasciarlo vuoto
+        ordini: lista di {'testata': {...}, 'righe': [...]} con l'UUID locale in testata['id']
+            e il numero provvisorio in testata['numero']
+
+    Returns:
+        dict con 'clienti' e 'ordini': {id_locale: esito}. Ogni ordine riporta
+        l'ID e il numero definitivi assegnati dal server; esito 'conflitto' se
+        l'ordine non è più sul server (non viene ricreato).
+    """
+    esiti: Dict[str, Any] = {'clienti': {}, 'ordini': {}}
+
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        _registra_dispositivo(conn, device_id)
+        colonne = storage.get_backend().colonne(conn, 'clienti')
+        for cliente in clienti or []:
+            if cliente.get('id'):
+                esiti['clienti'][cliente['id']] = _push_cliente(conn, device_id, cliente, colonne)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for ordine in ordini or []:
+        testata = dict(ordine.get('testata') or {})
+        righe = list(ordine.get('righe') or [])
+        id_locale = testata.get('id')
+        if not id_locale:
+            continue
+
+        conn = db.get_connection()
+        try:
+            gia = conn.execute("SELECT id, numero FROM ordini WHERE id = ?", (id_locale,)).fetchone()
+            if gia:
+                esiti['ordini'][id_locale] = {'id': gia['id'], 'numero': gia['numero'], 'esito': 'gia_ricevuto'}
+                continue
+            # non più sul server: già ricevuto (poi eliminato o archiviato) o modifica di un ordine del server
+            mappato = _id_mappato(conn, device_id, 'ordine', id_locale)
+            if mappato or testata.get('base_updated_at'):
+                esiti['ordini'][id_locale] = {
+                    'id': None, 'numero': mappato['numero_server'] if mappato else None, 'esito': 'conflitto',
+                    'errore': "Ordine non più presente sul server (eliminato o archiviato)",
+                }
+                continue
+            cliente_id = _risolvi_cliente(conn, device_id, testata.get('cliente_id'))
+            errore = "Cliente non trovato" if not cliente_id else _verifica_ordine(conn, testata, righe)
+        finally:
+            conn.close()
+
+        if errore:
+            esiti['ordini'][id_locale] = {'id': None, 'numero': None, 'esito': 'errore', 'errore': errore}
+            continue
+
+        numero_locale = testata.get('numero')
+        testata['cliente_id'] = cliente_id
+        testata['numero'] = db.get_prossimo_numero_ordine()
+        try:
+            ordine_id = db.save_ordine(testata, righe)
+        except Exception as e:
+            esiti['ordini'][id_locale] = {'id': None, 'numero': None, 'esito': 'errore', 'errore': str(e)}
+            continue
+
+        conn = db.get_connection()
+        try:
+            _mappa_id(conn, device_id, 'ordine', id_locale, ordine_id, numero_locale, testata['numero'])
+            conn.commit()
+        finally:
+            conn.close()
+
+        # l'ordine è già salvato: un errore qui non annulla il push, le
+        # previsioni si riallineano al prossimo ricalcolo
+        try:
+            riordini.aggiorna_dopo_ordine(ordine_id)
+        except Exception:
+            log.exception("Sync push: previsioni di riordino non aggiornate per l'ordine %s", ordine_id)
+        try:
+            segmentazione.aggiorna_dopo_ordine(ordine_id)
+        except Exception:
+            log.exception("Sync push: segmentazione non aggiornata per l'ordine %s", ordine_id)
+
+        esiti['ordini'][id_locale] = {'id': ordine_id, 'numero': testata['numero'], 'esito': 'creato'}
+
+    conn = db.get_connection()
+    try:
+        conn.execute("UPDATE sync_dispositivi SET ultimo_push = ? WHERE device_id = ?",
+                     (datetime.now().isoformat(), device_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+    return esiti
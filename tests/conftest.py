@@ -0,0 +1,59 @@
+"""
+Fixture comuni: i test che usano `backend` girano su SQLite e PostgreSQL.
+PostgreSQL richiede psycopg2 e TEST_DATABASE_URL (un database di test: lo
+schema public viene ricreato a ogni test), altrimenti è saltato.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db  # noqa: E402
+import storage  # noqa: E402
+
+
+def _reset_postgres(backend):
+    conn = backend.connect()
+    try:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def backend(request, tmp_path, monkeypatch):
+    if request.param == 'sqlite':
+        nuovo = storage.SQLiteBackend()
+        monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    else:
+        pytest.importorskip('psycopg2')
+        dsn = os.getenv('TEST_DATABASE_URL')
+        if not dsn:
+            pytest.skip("TEST_DATABASE_URL non impostata")
+        nuovo = storage.PostgresBackend(dsn, maxconn=4)
+        _reset_postgres(nuovo)
+
+    precedente = storage._backend
+    storage.set_backend(nuovo)
+    db.init_db()
+    yield nuovo
+    storage.set_backend(precedente)
+    if nuovo.nome == 'postgres':
+        nuovo.chiudi()
+
+
+@pytest.fixture
+def anagrafiche(backend):
+    azienda_id = db.save_azienda({'nome': 'Acme', 'partita_iva': 'IT001'})
+    cliente_id = db.save_cliente({'ragione_sociale': 'Bar Centrale', 'partita_iva': 'P001', 'citta': 'Milano'})
+    prodotti = [
+        db.save_prodotto({'azienda_id': azienda_id, 'codice': f'C{i}', 'nome': f'Prodotto {i}',
+                          'prezzo_listino': 10.0 + i})
+        for i in range(3)
+    ]
+    return azienda_id, cliente_id, prodotti
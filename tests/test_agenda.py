@@ -0,0 +1,80 @@
+"""
+Agenda: sovrapposizioni tra impegni (anche con serie ricorrenti) e
+proposta di fasce libere.
+"""
+
+from datetime import date, timedelta
+
+import pytest
+
+import db
+
+
+def _lunedi(settimane=1):
+    """Un lunedì futuro (le serie si verificano da oggi in avanti)"""
+    oggi = date.today()
+    return oggi + timedelta(days=7 * settimane - oggi.weekday())
+
+
+def _appuntamento(giorno, ora, durata=60, consenti_conflitti=True, **extra):
+    return db.save_appuntamento(dict({'titolo': f"App {ora}", 'data': giorno.isoformat(), 'ora': ora,
+                                      'durata_minuti': durata}, **extra), consenti_conflitti=consenti_conflitti)
+
+
+def test_sovrapposizioni_tra_impegni(anagrafiche):
+    _, cliente_id, _ = anagrafiche
+    giorno = _lunedi()
+    app_id = _appuntamento(giorno, '10:00')
+
+    assert [c['id'] for c in db.get_conflitti(giorno.isoformat(), '10:30', durata_minuti=30)] == [app_id]
+    assert [c['id'] for c in db.get_conflitti(giorno.isoformat(), '09:00', '10:01')] == [app_id]
+    # intervalli semiaperti: chi finisce alle 10:00 o inizia alle 11:00 non si sovrappone
+    assert db.get_conflitti(giorno.isoformat(), '09:00', '10:00') == []
+    assert db.get_conflitti(giorno.isoformat(), '11:00', durata_minuti=30) == []
+    assert db.get_conflitti(giorno.isoformat(), '10:30', escludi_tipo='appuntamento', escludi_id=app_id) == []
+
+    with pytest.raises(ValueError, match="10:00-11:00"):
+        db.save_visita_pianificata({'cliente_id': cliente_id, 'data_pianificata': giorno.isoformat(),
+                                    'ora_inizio': '10:45', 'ora_fine': '11:15'}, consenti_conflitti=False)
+    db.save_visita_pianificata({'cliente_id': cliente_id, 'data_pianificata': giorno.isoformat(),
+                                'ora_inizio': '11:00', 'ora_fine': '11:30'}, consenti_conflitti=False)
+
+    # spostare l'appuntamento su sé stesso va bene, sopra la visita no
+    db.save_appuntamento({'id': app_id, 'ora': '09:30'}, consenti_conflitti=False)
+    with pytest.raises(ValueError):
+        db.save_appuntamento({'id': app_id, 'ora': '10:45'}, consenti_conflitti=False)
+
+
+def test_serie_ricorrente_verifica_le_occorrenze(backend):
+    primo = _lunedi()
+    _appuntamento(primo + timedelta(days=14), '09:00')
+
+    with pytest.raises(ValueError, match=(primo + timedelta(days=14)).isoformat()):
+        _appuntamento(primo, '09:30', ricorrenza='FREQ=WEEKLY;BYDAY=MO', consenti_conflitti=False)
+    # la serie finisce prima dell'appuntamento singolo: nessuna sovrapposizione
+    serie = db.save_appuntamento({'titolo': 'Riunione', 'data': primo.isoformat(), 'ora': '09:30',
+                                  'ricorrenza': 'FREQ=WEEKLY;COUNT=2'}, consenti_conflitti=False)
+
+    # le istanze della serie bloccano i nuovi impegni, ma non la serie stessa quando la si modifica
+    with pytest.raises(ValueError):
+        _appuntamento(primo + timedelta(days=7), '10:00', consenti_conflitti=False)
+    db.save_appuntamento({'id': serie, 'ora': '09:45'}, consenti_conflitti=False)
+
+
+def test_suggerisci_slot_piu_fasce_per_buco(backend):
+    giorno = _lunedi()
+    _appuntamento(giorno, '09:00', durata=180)
+
+    liberi = db.suggerisci_slot(giorno.isoformat(), 60, '10:00', max_risultati=5)
+    assert len(liberi) == 5
+    inizi = [db.minuti_ora(s['ora_inizio']) for s in liberi]
+    # ordinate per distanza dall'ora preferita, allineate ai 5 minuti, fuori dall'impegno 09:00-12:00
+    assert inizi == sorted(inizi, key=lambda m: abs(m - 600))
+    assert inizi[0] == 12 * 60
+    assert all(m % 5 == 0 and m >= 12 * 60 and m + 60 <= 19 * 60 for m in inizi)
+    assert len(set(inizi)) == 5
+
+    # giornata libera: la prima proposta è l'ora preferita
+    liberi = db.suggerisci_slot((giorno + timedelta(days=1)).isoformat(), 30, '15:10', max_risultati=3)
+    assert [s['ora_inizio'] for s in liberi][0] == '15:10'
+    assert len(liberi) == 3
@@ -0,0 +1,276 @@
+"""
+Test comuni ai backend di storage (SQLite e PostgreSQL).
+
+Gli stessi controlli CRUD, ordini e sync girano su entrambi i backend.
+PostgreSQL richiede psycopg2 e TEST_DATABASE_URL (un database di test: lo
+schema public viene ricreato a ogni test), altrimenti è saltato.
+"""
+
+import uuid
+from datetime import date
+
+import pytest
+
+import db
+
+
+def _righe(prodotti, cartoni=1, prezzo=10.0):
+    return [{'prodotto_id': p, 'quantita_cartoni': cartoni, 'quantita_pezzi': 0,
+             'quantita_totale': cartoni * 6, 'prezzo_unitario': prezzo, 'sconto_riga': 0}
+            for p in prodotti]
+
+
+def _testata(azienda_id, cliente_id, stato='inviato', **extra):
+    testata = {'numero': db.get_prossimo_numero_ordine(), 'data_ordine': date.today().isoformat(),
+               'azienda_id': azienda_id, 'cliente_id': cliente_id, 'stato': stato}
+    testata.update(extra)
+    return testata
+
+
+# ============================================
+# CRUD ANAGRAFICHE
+# ============================================
+
+def test_aziende_crud(backend):
+    azienda_id = db.save_azienda({'nome': 'Acme', 'partita_iva': 'IT001'})
+    assert db.get_azienda(azienda_id)['nome'] == 'Acme'
+
+    db.save_azienda({'id': azienda_id, 'nome': 'Acme Spa'})
+    assert db.get_azienda(azienda_id)['nome'] == 'Acme Spa'
+    assert [a['id'] for a in db.get_aziende()] == [azienda_id]
+
+    assert db.delete_azienda(azienda_id)
+    assert db.get_aziende() == []
+    assert db.get_aziende(solo_attive=False)[0]['attivo'] == 0
+
+
+def test_clienti_crud(backend):
+    cliente_id = db.save_cliente({'ragione_sociale': 'Bar Centrale', 'citta': 'Milano'})
+    db.save_cliente({'ragione_sociale': 'Trattoria Sole', 'citta': 'Monza'})
+
+    assert db.get_cliente(cliente_id)['citta'] == 'Milano'
+    assert [c['ragione_sociale'] for c in db.get_clienti()] == ['Bar Centrale', 'Trattoria Sole']
+    assert [c['id'] for c in db.get_clienti(search='Milano')] == [cliente_id]
+
+    db.save_cliente({'id': cliente_id, 'citta': 'Bergamo'})
+    assert db.get_cliente(cliente_id)['citta'] == 'Bergamo'
+
+    db.delete_cliente(cliente_id)
+    assert [c['ragione_sociale'] for c in db.get_clienti()] == ['Trattoria Sole']
+
+
+def test_prodotti_crud(backend):
+    azienda_id = db.save_azienda({'nome': 'Acme'})
+    prodotto_id = db.save_prodotto({'azienda_id': azienda_id, 'codice': 'C1', 'nome': 'Pasta',
+                                    'prezzo_listino': 2.5})
+    prodotto = db.get_prodotto(prodotto_id)
+    assert prodotto['prezzo_listino'] == 2.5
+    assert prodotto['pezzi_per_cartone'] == 6
+
+    db.save_prodotto({'id': prodotto_id, 'prezzo_listino': 3.0})
+    assert db.get_prodotto(prodotto_id)['prezzo_listino'] == 3.0
+    assert [p['id'] for p in db.get_prodotti(azienda_id=azienda_id)] == [prodotto_id]
+
+    db.delete_prodotto(prodotto_id)
+    assert db.get_prodotto(prodotto_id) is None
+
+
+# ============================================
+# ORDINI
+# ============================================
+
+def test_ordine_salvataggio_e_totali(anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+    ordine_id = db.save_ordine(_testata(azienda_id, cliente_id), _righe(prodotti, cartoni=2))
+
+    ordine = db.get_ordine(ordine_id)
+    assert ordine['num_righe'] == 3
+    assert ordine['num_prodotti'] == 3
+    assert ordine['totale_pezzi'] == 36
+    assert ordine['totale_cartoni'] == 6
+    assert ordine['valore_venduto'] == pytest.approx(360.0)
+    assert [r['posizione'] for r in ordine['righe']] == [1, 2, 3]
+
+    # modifica: le righe vengono sostituite e i contatori ricalcolati
+    db.save_ordine({'id': ordine_id, 'stato': 'inviato'}, _righe(prodotti[:1]))
+    ordine = db.get_ordine(ordine_id)
+    assert ordine['num_righe'] == 1
+    assert ordine['totale_pezzi'] == 6
+    assert [o['id'] for o in db.get_ordini(cliente_id=cliente_id)] == [ordine_id]
+
+
+def test_ordine_stato_ed_eliminazione(anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+    ordine_id = db.save_ordine(_testata(azienda_id, cliente_id, stato='bozza'), _righe(prodotti))
+
+    assert db.update_stato_ordine(ordine_id, 'confermato')
+    assert db.get_ordine(ordine_id)['stato'] == 'confermato'
+    assert [o['id'] for o in db.get_ordini(stato='confermato')] == [ordine_id]
+
+    assert db.delete_ordine(ordine_id)
+    assert db.get_ordine(ordine_id) is None
+    assert db.get_ordini() == []
+
+
+def test_numero_ordine_progressivo(anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+    primo = db.get_prossimo_numero_ordine()
+    db.save_ordine(_testata(azienda_id, cliente_id), _righe(prodotti))
+    assert db.get_prossimo_numero_ordine() != primo
+
+
+# ============================================
+# SYNC DISPOSITIVI
+# ============================================
+
+@pytest.fixture
+def sync(anagrafiche):
+    # sync_offline usa le previsioni di riordino/segmentazione (pandas, numpy)
+    pytest.importorskip('pandas')
+    pytest.importorskip('numpy')
+    import sync_offline
+    return sync_offline
+
+
+def test_sync_pull_snapshot_poi_delta(sync, anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+
+    primo = sync.sync_pull('dev-1')
+    assert primo['completo']
+    assert {c['id'] for c in primo['clienti']} == {cliente_id}
+    assert len(primo['prodotti']) == 3
+
+    db.save_cliente({'id': cliente_id, 'citta': 'Bergamo'})
+    db.delete_prodotto(prodotti[0])
+
+    delta = sync.sync_pull('dev-1', checkpoint=primo['checkpoint'])
+    assert not delta['completo']
+    assert [c['citta'] for c in delta['clienti']] == ['Bergamo']
+    assert delta['prodotti'] == []
+    assert delta['eliminati']['prodotti'] == [prodotti[0]]
+    assert delta['checkpoint'] > primo['checkpoint']
+
+    vuoto = sync.sync_pull('dev-1', checkpoint=delta['checkpoint'])
+    assert vuoto['clienti'] == [] and vuoto['checkpoint'] == delta['checkpoint']
+
+
+def test_sync_checkpoint_avanza_solo_alla_conferma(sync, anagrafiche):
+    _, cliente_id, _ = anagrafiche
+
+    def registrato():
+        conn = db.get_connection()
+        try:
+            return conn.execute("SELECT ultimo_checkpoint FROM sync_dispositivi WHERE device_id = 'dev-1'"
+                                ).fetchone()['ultimo_checkpoint']
+        finally:
+            conn.close()
+
+    primo = sync.sync_pull('dev-1')
+    assert registrato() == 0
+
+    # risposta persa: il pull successivo senza checkpoint riparte da quello confermato
+    assert sync.sync_pull('dev-1')['completo']
+
+    db.save_cliente({'id': cliente_id, 'citta': 'Bergamo'})
+    delta = sync.sync_pull('dev-1', checkpoint=primo['checkpoint'])
+    assert registrato() == primo['checkpoint']
+    assert [c['citta'] for c in delta['clienti']] == ['Bergamo']
+
+    sync.conferma_checkpoint('dev-1', delta['checkpoint'])
+    assert registrato() == delta['checkpoint']
+    assert sync.sync_pull('dev-1')['clienti'] == []
+
+
+def test_sync_pull_prefill(sync, anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+    primo = sync.sync_pull('dev-1')
+    db.save_ordine(_testata(azienda_id, cliente_id), _righe(prodotti))
+
+    delta = sync.sync_pull('dev-1', checkpoint=primo['checkpoint'])
+    pref = delta['cliente_prodotto_pref']
+    assert sorted(p['prodotto_id'] for p in pref) == sorted(prodotti)
+    assert {p['cliente_id'] for p in pref} == {cliente_id}
+
+
+def test_sync_push_cliente_conflitto(sync, anagrafiche):
+    _, cliente_id, _ = anagrafiche
+    versione = db.get_cliente(cliente_id)['updated_at']
+
+    # stessa versione in formato diverso ('T' / spazio): nessun conflitto
+    base = versione.replace('T', ' ')
+    esiti = sync.sync_push('dev-1', clienti=[{'id': cliente_id, 'citta': 'Como', 'base_updated_at': base}])
+    assert esiti['clienti'][cliente_id]['esito'] == 'aggiornato'
+    assert db.get_cliente(cliente_id)['citta'] == 'Como'
+
+    # il cliente è cambiato sul server dopo la versione vista dal dispositivo
+    esiti = sync.sync_push('dev-1', clienti=[{'id': cliente_id, 'citta': 'Lecco', 'base_updated_at': base}])
+    assert esiti['clienti'][cliente_id]['esito'] == 'conflitto'
+    assert db.get_cliente(cliente_id)['citta'] == 'Como'
+
+
+def test_sync_push_cliente_e_ordine(sync, anagrafiche):
+    azienda_id, _, prodotti = anagrafiche
+    cliente_locale = str(uuid.uuid4())
+    ordine_locale = str(uuid.uuid4())
+    ordine = {
+        'testata': {'id': ordine_locale, 'numero': 'TMP-1', 'data_ordine': date.today().isoformat(),
+                    'azienda_id': azienda_id, 'cliente_id': cliente_locale, 'stato': 'inviato'},
+        'righe': _righe(prodotti),
+    }
+
+    esiti = sync.sync_push('dev-1', clienti=[{'id': cliente_locale, 'ragione_sociale': 'Nuovo Bar'}],
+                           ordini=[ordine])
+    assert esiti['clienti'][cliente_locale]['esito'] == 'creato'
+    esito = esiti['ordini'][ordine_locale]
+    assert esito['esito'] == 'creato'
+    assert esito['id'] == ordine_locale
+    assert esito['numero'] != 'TMP-1'
+    assert db.get_ordine(ordine_locale)['cliente_id'] == cliente_locale
+
+    # re-invio (rete instabile): idempotente
+    di_nuovo = sync.sync_push('dev-1', clienti=[{'id': cliente_locale, 'ragione_sociale': 'Nuovo Bar'}],
+                              ordini=[ordine])
+    assert di_nuovo['clienti'][cliente_locale]['esito'] == 'gia_ricevuto'
+    assert di_nuovo['ordini'][ordine_locale] == {'id': ordine_locale, 'numero': esito['numero'],
+                                                 'esito': 'gia_ricevuto'}
+    assert len(db.get_ordini()) == 1
+
+    # eliminato sul server: il re-invio non lo ricrea
+    db.delete_ordine(ordine_locale)
+    dopo = sync.sync_push('dev-1', ordini=[ordine])
+    assert dopo['ordini'][ordine_locale]['esito'] == 'conflitto'
+    assert db.get_ordini() == []
+
+
+def test_sync_push_ordine_modificato_non_presente(sync, anagrafiche):
+    azienda_id, cliente_id, prodotti = anagrafiche
+    ordine_id = str(uuid.uuid4())
+    testata = _testata(azienda_id, cliente_id, id=ordine_id, base_updated_at='2026-01-01T10:00:00')
+    esiti = sync.sync_push('dev-1', ordini=[{'testata': testata, 'righe': _righe(prodotti)}])
+    assert esiti['ordini'][ordine_id]['esito'] == 'conflitto'
+    assert db.get_ordini() == []
+
+
+def test_sync_push_cliente_stessa_partita_iva(sync, anagrafiche):
+    _, cliente_id, _ = anagrafiche
+    locale = str(uuid.uuid4())
+    esiti = sync.sync_push('dev-1', clienti=[{'id': locale, 'ragione_sociale': 'Bar Centrale',
+                                              'partita_iva': 'P001'}])
+    assert esiti['clienti'][locale] == {'id': cliente_id, 'esito': 'unito'}
+    assert len(db.get_clienti()) == 1
+
+
+def test_sync_push_errore_previsioni_registrato(sync, anagrafiche, monkeypatch, caplog):
+    azienda_id, cliente_id, prodotti = anagrafiche
+
+    def guasto(ordine_id):
+        raise RuntimeError("previsioni non disponibili")
+
+    monkeypatch.setattr(sync.riordini, 'aggiorna_dopo_ordine', guasto)
+    ordine_id = str(uuid.uuid4())
+    testata = _testata(azienda_id, cliente_id, id=ordine_id)
+    with caplog.at_level('ERROR', logger='sync_offline'):
+        esiti = sync.sync_push('dev-1', ordini=[{'testata': testata, 'righe': _righe(prodotti)}])
+    # l'ordine resta creato, l'errore non passa sotto silenzio
+    assert esiti['ordini'][ordine_id]['esito'] == 'creato'
+    assert ordine_id in caplog.text and "previsioni non disponibili" in caplog.text
@@ -0,0 +1,146 @@
+"""
+Coda dei lavori ed email outbox: recupero dei lavori bloccati, retry con
+backoff, chiave unica delle email e presa condizionata tra worker.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def coda(backend, monkeypatch):
+    # coda_lavori importa la generazione PDF (reportlab)
+    pytest.importorskip('reportlab')
+    import coda_lavori
+    monkeypatch.setattr(coda_lavori, '_ultimo_recupero', 0.0)
+    return coda_lavori
+
+
+def _vecchio(minuti):
+    return (datetime.now() - timedelta(minutes=minuti)).isoformat()
+
+
+def _lavoro(lavoro_id):
+    conn = db.get_connection()
+    try:
+        return dict(conn.execute("SELECT * FROM lavori WHERE id = ?", (lavoro_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def test_recupero_periodico_dei_lavori_bloccati(coda):
+    conn = db.get_connection()
+    try:
+        bloccato = coda._accoda(conn, 'pdf_ordine', 'ord-1')
+        recente = coda._accoda(conn, 'pdf_ordine', 'ord-2')
+        conn.execute("UPDATE lavori SET stato = 'in_corso', worker = 'w', iniziato_at = ? WHERE id = ?",
+                     (_vecchio(coda.MINUTI_BLOCCO + 1), bloccato))
+        conn.execute("UPDATE lavori SET stato = 'in_corso', worker = 'w', iniziato_at = ? WHERE id = ?",
+                     (_vecchio(1), recente))
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert coda._recupero_periodico() == 1
+    assert _lavoro(bloccato)['stato'] == 'in_coda'
+    assert _lavoro(recente)['stato'] == 'in_corso'
+
+    # entro SECONDI_RECUPERO il controllo non si ripete
+    conn = db.get_connection()
+    try:
+        conn.execute("UPDATE lavori SET iniziato_at = ? WHERE id = ?", (_vecchio(coda.MINUTI_BLOCCO + 1), recente))
+        conn.commit()
+    finally:
+        conn.close()
+    assert coda._recupero_periodico() == 0
+    assert _lavoro(recente)['stato'] == 'in_corso'
+
+
+def _email(chiave):
+    conn = db.get_connection()
+    try:
+        return dict(conn.execute("SELECT * FROM email_outbox WHERE chiave = ?", (chiave,)).fetchone())
+    finally:
+        conn.close()
+
+
+def _pronta(chiave):
+    conn = db.get_connection()
+    try:
+        conn.execute("UPDATE email_outbox SET prossimo_tentativo = ? WHERE chiave = ?", (_vecchio(1), chiave))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_email_chiave_unica(backend):
+    chiave = db.chiave_conferma_ordine('ord-1', 'Cliente@Example.com ')
+    assert chiave == db.chiave_conferma_ordine('ord-1', 'cliente@example.com')
+    assert db.accoda_email(chiave, 'cliente@example.com', ordine_id='ord-1', allegato='pdf_ordine')
+    assert not db.accoda_email(chiave, 'cliente@example.com', ordine_id='ord-1', allegato='pdf_ordine')
+    assert len(db.get_email_ordini(['ord-1'])['ord-1']) == 1
+    with pytest.raises(ValueError):
+        db.accoda_email('altra', '  ')
+
+
+def test_attesa_backoff():
+    pytest.importorskip('reportlab')
+    from coda_lavori import attesa_backoff
+    # esponenziale dal valore base, con tetto e fino al 10% di jitter
+    assert 30 <= attesa_backoff(1, 30, 600) <= 33
+    assert 120 <= attesa_backoff(3, 30, 600) <= 132
+    assert 600 <= attesa_backoff(20, 30, 600) <= 660
+
+
+def test_email_retry_con_backoff_poi_fallita(coda, monkeypatch):
+    conn = db.get_connection()
+    try:
+        db._set_impostazione(conn, 'coda_max_tentativi', '2')
+        conn.commit()
+    finally:
+        conn.close()
+    monkeypatch.setattr(coda, 'limite_al_minuto', lambda: 0)
+    inviate = []
+    esito = ['SMTP non raggiungibile']
+    monkeypatch.setattr(coda, 'send_batch', lambda messaggi: inviate.extend(messaggi) or esito * len(messaggi))
+    db.accoda_email('k1', 'a@example.com', oggetto='Ciao', corpo='Testo', ordine_id='ord-1')
+
+    assert coda.consegna_outbox('w') == 1
+    email = _email('k1')
+    assert (email['stato'], email['tentativi'], email['errore']) == ('da_inviare', 1, 'SMTP non raggiungibile')
+    attesa = (datetime.fromisoformat(email['prossimo_tentativo']) - datetime.now()).total_seconds()
+    assert 25 <= attesa <= 34
+    # prima della scadenza del backoff non si ritenta
+    assert coda.consegna_outbox('w') == 0
+
+    _pronta('k1')
+    assert coda.consegna_outbox('w') == 1
+    assert (_email('k1')['stato'], _email('k1')['tentativi']) == ('fallita', 2)
+    _pronta('k1')
+    assert coda.consegna_outbox('w') == 0
+
+    assert db.riprova_email_ordine('ord-1') == 1
+    esito[:] = [None]
+    assert coda.consegna_outbox('w') == 1
+    email = _email('k1')
+    assert (email['stato'], email['errore'], email['worker']) == ('inviata', None, None)
+    assert [m['to_email'] for m in inviate] == ['a@example.com'] * 3
+
+
+def test_presa_email_senza_doppioni(coda):
+    for i in range(5):
+        db.accoda_email(f'k{i}', f'{i}@example.com')
+    c1, c2 = db.get_connection(), db.get_connection()
+    try:
+        presi1 = coda._prendi_email(c1, 'w1', 3)
+        presi2 = coda._prendi_email(c2, 'w2', 10)
+        assert coda._prendi_email(c1, 'w1', 10) == []
+    finally:
+        c1.close()
+        c2.close()
+    ids1, ids2 = {e['id'] for e in presi1}, {e['id'] for e in presi2}
+    assert len(ids1) == 3 and len(ids2) == 2 and not ids1 & ids2
+    assert all(e['stato'] == 'in_invio' and e['tentativi'] == 1 for e in presi1 + presi2)
@@ -0,0 +1,78 @@
+"""
+Promemoria: finestre di date, filtri e limit, anche per le serie
+ricorrenti, e conteggi per i badge.
+"""
+
+from datetime import date, timedelta
+
+import db
+
+
+OGGI = date.today()
+
+
+def _giorno(delta):
+    return (OGGI + timedelta(days=delta)).isoformat()
+
+
+def _promemoria(titolo, delta, **extra):
+    return db.save_promemoria(dict({'titolo': titolo, 'data_scadenza': _giorno(delta)}, **extra))
+
+
+def _titoli(**filtri):
+    return [p['titolo'] for p in db.get_promemoria(**filtri)]
+
+
+def test_finestra_filtri_e_limit(backend):
+    _promemoria('scaduto', -3, priorita='alta')
+    _promemoria('oggi', 0, tipo='chiamata')
+    _promemoria('fra 5 giorni', 5)
+    _promemoria('fra 20 giorni', 20, priorita='alta')
+    _promemoria('fatto', 1)
+    db.completa_promemoria(db.get_promemoria(data_da=_giorno(1), data_a=_giorno(1))[0]['id'])
+
+    assert _titoli(data_da=_giorno(0), data_a=_giorno(7)) == ['oggi', 'fra 5 giorni']
+    assert _titoli(data_a=_giorno(0)) == ['scaduto', 'oggi']
+    assert _titoli(priorita='alta') == ['scaduto', 'fra 20 giorni']
+    assert _titoli(tipo='chiamata') == ['oggi']
+    assert _titoli(limit=2) == ['scaduto', 'oggi']
+    assert 'fatto' in _titoli(solo_attivi=False)
+
+
+def test_serie_ricorrenti_nella_finestra(backend):
+    # settimanale iniziata 14 giorni fa: la prima occorrenza aperta è quella più vecchia
+    settimanale = _promemoria('settimanale', -14, ricorrenza='FREQ=WEEKLY')
+    _promemoria('mensile', 10, ricorrenza='FREQ=MONTHLY')
+    _promemoria('singolo', 3)
+
+    assert _titoli(data_da=_giorno(-20), data_a=_giorno(7)) == ['settimanale', 'singolo']
+    serie = db.get_promemoria(data_da=_giorno(-20), data_a=_giorno(7))[0]
+    assert serie['data_scadenza'] == _giorno(-14) and serie['ricorrente'] == 1
+
+    # completate le occorrenze passate, la serie si sposta alla prossima (fra 7 giorni)
+    db.completa_promemoria(settimanale)
+    db.completa_promemoria(settimanale, _giorno(-7))
+    db.annulla_occorrenza('promemoria', settimanale, _giorno(0))
+    assert [(p['titolo'], p['data_scadenza']) for p in db.get_promemoria(data_a=_giorno(7))] == [
+        ('singolo', _giorno(3)), ('settimanale', _giorno(7))]
+    assert _titoli(data_a=_giorno(6)) == ['singolo']
+    assert _titoli(data_da=_giorno(8), data_a=_giorno(40)) == ['mensile']
+
+    # limit: le serie oltre l'ultima scadenza letta restano fuori
+    assert _titoli(limit=1) == ['singolo']
+    assert _titoli(limit=3) == ['singolo', 'settimanale', 'mensile']
+
+
+def test_conteggi_promemoria(backend):
+    _promemoria('scaduto', -2)
+    _promemoria('oggi', 0)
+    _promemoria('domani', 1)
+    _promemoria('lontano', 30)
+    # serie: una scaduta, una che ricade nei prossimi 7 giorni, una oltre
+    _promemoria('serie scaduta', -1, ricorrenza='FREQ=MONTHLY')
+    _promemoria('serie prossima', 4, ricorrenza='FREQ=WEEKLY')
+    oltre = _promemoria('serie oltre', -30, ricorrenza='FREQ=MONTHLY;COUNT=2')
+    db.completa_promemoria(oltre)
+    db.completa_promemoria(oltre)
+
+    assert db.get_conteggi_promemoria() == {'scaduti': 2, 'oggi': 1, 'prossimi_7': 2}
@@ -0,0 +1,96 @@
+"""
+Provvigioni: precedenza delle aliquote, ricalcolo dopo le modifiche alle
+aliquote e dopo i cambi di stato degli ordini.
+"""
+
+from datetime import date
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def mandanti(backend):
+    a1 = db.save_azienda({'nome': 'Acme', 'partita_iva': 'IT001'})
+    a2 = db.save_azienda({'nome': 'Beta', 'partita_iva': 'IT002'})
+    cliente_id = db.save_cliente({'ragione_sociale': 'Bar Centrale', 'partita_iva': 'P001', 'categoria': 'A'})
+    p1 = db.save_prodotto({'azienda_id': a1, 'codice': 'C1', 'nome': 'Prodotto 1', 'prezzo_listino': 10.0})
+    p2 = db.save_prodotto({'azienda_id': a1, 'codice': 'C2', 'nome': 'Prodotto 2', 'prezzo_listino': 10.0})
+    return a1, a2, cliente_id, p1, p2
+
+
+def _ordine(azienda_id, cliente_id, prodotto_id, stato='evaso', importo=100.0):
+    righe = [{'prodotto_id': prodotto_id, 'quantita_cartoni': 0, 'quantita_pezzi': 10,
+              'quantita_totale': 10, 'prezzo_unitario': importo / 10, 'sconto_riga': 0}]
+    return db.save_ordine({'numero': db.get_prossimo_numero_ordine(), 'data_ordine': date.today().isoformat(),
+                           'azienda_id': azienda_id, 'cliente_id': cliente_id, 'stato': stato}, righe)
+
+
+def _provvigione(ordine_id):
+    righe = [p for p in db.get_provvigioni_ordini() if p['ordine_id'] == ordine_id]
+    return righe[0]['provvigione'] if righe else None
+
+
+def test_precedenza_aliquote(mandanti):
+    a1, _, cliente_id, p1, p2 = mandanti
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 5})
+    db.save_aliquota_provvigione({'azienda_id': a1, 'categoria_cliente': 'A', 'aliquota': 6})
+    db.save_aliquota_provvigione({'azienda_id': a1, 'prodotto_id': p1, 'aliquota': 7})
+    db.save_aliquota_provvigione({'azienda_id': a1, 'prodotto_id': p1, 'categoria_cliente': 'A', 'aliquota': 8})
+    db.save_aliquota_provvigione({'azienda_id': a1, 'prodotto_id': p2, 'categoria_cliente': 'B', 'aliquota': 9})
+
+    # prodotto+categoria > prodotto > categoria > base
+    assert _provvigione(_ordine(a1, cliente_id, p1)) == pytest.approx(8.0)
+    # p2: la regola prodotto+categoria è di un'altra categoria, vale quella di categoria
+    assert _provvigione(_ordine(a1, cliente_id, p2)) == pytest.approx(6.0)
+
+    altro = db.save_cliente({'ragione_sociale': 'Bar Nuovo', 'partita_iva': 'P002', 'categoria': 'C'})
+    assert _provvigione(_ordine(a1, altro, p1)) == pytest.approx(7.0)
+    assert _provvigione(_ordine(a1, altro, p2)) == pytest.approx(5.0)
+
+
+def test_aliquota_spostata_ad_altra_azienda(mandanti):
+    a1, a2, cliente_id, p1, _ = mandanti
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 6})
+    speciale = db.save_aliquota_provvigione({'azienda_id': a1, 'categoria_cliente': 'A', 'aliquota': 10})
+    ordine_id = _ordine(a1, cliente_id, p1)
+    assert _provvigione(ordine_id) == pytest.approx(10.0)
+
+    db.save_aliquota_provvigione({'id': speciale, 'azienda_id': a2, 'categoria_cliente': 'A', 'aliquota': 10})
+    assert _provvigione(ordine_id) == pytest.approx(6.0)
+    assert [a['id'] for a in db.get_aliquote_provvigione(a2)] == [speciale]
+
+
+def test_nuova_aliquota_ricalcola_solo_il_suo_periodo(mandanti):
+    a1, _, cliente_id, p1, _ = mandanti
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 5})
+    ordine_id = _ordine(a1, cliente_id, p1)
+    # provvigione "congelata" a mano: un ricalcolo dell'intero storico la riscriverebbe
+    conn = db.get_connection()
+    conn.execute("UPDATE provvigioni_ordini SET provvigione = 1 WHERE ordine_id = ?", (ordine_id,))
+    conn.commit()
+    conn.close()
+
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 9, 'valido_dal': '2000-01-01', 'valido_al': '2000-12-31'})
+    assert _provvigione(ordine_id) == pytest.approx(1.0)
+
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 9, 'valido_dal': date.today().isoformat()})
+    assert _provvigione(ordine_id) == pytest.approx(9.0)
+
+
+def test_provvigioni_seguono_lo_stato_ordine(mandanti):
+    a1, _, cliente_id, p1, _ = mandanti
+    db.save_aliquota_provvigione({'azienda_id': a1, 'aliquota': 5})
+    ordine_id = _ordine(a1, cliente_id, p1, stato='confermato')
+    assert _provvigione(ordine_id) is None
+
+    db.update_stato_ordine(ordine_id, 'evaso')
+    assert _provvigione(ordine_id) == pytest.approx(5.0)
+    mese = date.today().isoformat()[:7]
+    estratto = [e for e in db.get_estratti_provvigioni(a1) if e['mese'] == mese]
+    assert estratto[0]['provvigione'] == pytest.approx(5.0)
+
+    db.update_stato_ordine(ordine_id, 'annullato')
+    assert _provvigione(ordine_id) is None
+    assert not [e for e in db.get_estratti_provvigioni(a1) if e['mese'] == mese]
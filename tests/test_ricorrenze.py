@@ -0,0 +1,98 @@
+"""
+Serie ricorrenti: espansione delle regole RRULE, eccezioni (occorrenze
+annullate o spostate) e cache mensile delle espansioni.
+"""
+
+from datetime import date
+
+import pytest
+
+import db
+
+
+def _giorni(regola, inizio, da, a):
+    return [d.isoformat() for d in db.occorrenze_ricorrenza(regola, date.fromisoformat(inizio),
+                                                             date.fromisoformat(da), date.fromisoformat(a))]
+
+
+def test_espansione_regole():
+    # INTERVAL + BYDAY: lunedì e giovedì a settimane alterne
+    assert _giorni('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH', '2026-01-05', '2026-01-01', '2026-02-10') == [
+        '2026-01-05', '2026-01-08', '2026-01-19', '2026-01-22', '2026-02-02', '2026-02-05']
+    # COUNT conta dall'inizio della serie anche se il range parte dopo
+    assert _giorni('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;COUNT=5', '2026-01-05', '2026-01-20', '2026-12-31') == [
+        '2026-01-22', '2026-02-02']
+    # UNTIL incluso
+    assert _giorni('FREQ=DAILY;INTERVAL=3;UNTIL=20260113', '2026-01-01', '2026-01-01', '2026-12-31') == [
+        '2026-01-01', '2026-01-04', '2026-01-07', '2026-01-10', '2026-01-13']
+    # giorni inesistenti nel mese saltati
+    assert _giorni('FREQ=MONTHLY;BYMONTHDAY=31', '2026-01-31', '2026-01-01', '2026-06-30') == [
+        '2026-01-31', '2026-03-31', '2026-05-31']
+    assert _giorni('FREQ=YEARLY', '2024-02-29', '2024-01-01', '2028-12-31') == ['2024-02-29', '2028-02-29']
+
+    assert db.fine_ricorrenza('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;COUNT=5', date(2026, 1, 5)) == date(2026, 2, 2)
+    assert db.fine_ricorrenza('FREQ=WEEKLY', date(2026, 1, 5)) is None
+    assert db.regola_ricorrenza('WEEKLY', 2, fino_al='2026-12-31', giorni_settimana=[3, 0]) == \
+        'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH;UNTIL=20261231'
+
+
+@pytest.mark.parametrize('regola', ['FREQ=HOURLY', 'FREQ=DAILY;BYDAY=MO', 'FREQ=WEEKLY;BYSETPOS=1',
+                                    'FREQ=MONTHLY;BYMONTHDAY=32'])
+def test_regole_non_gestite(regola):
+    with pytest.raises(ValueError):
+        db.parse_ricorrenza(regola)
+
+
+def _date_serie(serie_id, da, a):
+    return [str(x['data'])[:10] for x in db.get_appuntamenti_range(da, a) if x['id'] == serie_id]
+
+
+def test_eccezioni_annullate_e_spostate(backend):
+    serie = db.save_appuntamento({'titolo': 'Giro clienti', 'data': '2026-03-02', 'ora': '09:00',
+                                  'ricorrenza': 'FREQ=WEEKLY;BYDAY=MO'})
+    assert _date_serie(serie, '2026-03-01', '2026-03-31') == ['2026-03-02', '2026-03-09', '2026-03-16',
+                                                               '2026-03-23', '2026-03-30']
+
+    db.annulla_occorrenza('appuntamento', serie, '2026-03-09')
+    db.modifica_occorrenza('appuntamento', serie, '2026-03-16', nuova_data='2026-03-18', nuova_ora='15:00',
+                           titolo='Giro spostato')
+    # l'occorrenza del 30 marzo va ad aprile: compare solo nel range che contiene la nuova data
+    db.modifica_occorrenza('appuntamento', serie, '2026-03-30', nuova_data='2026-04-01')
+
+    istanze = [x for x in db.get_appuntamenti_range('2026-03-01', '2026-03-31') if x['id'] == serie]
+    assert [(str(x['data'])[:10], x['ora'], x['titolo']) for x in istanze] == [
+        ('2026-03-02', '09:00', 'Giro clienti'),
+        ('2026-03-18', '15:00', 'Giro spostato'),
+        ('2026-03-23', '09:00', 'Giro clienti'),
+    ]
+    assert istanze[1]['data_originale'] == '2026-03-16'
+    assert _date_serie(serie, '2026-04-01', '2026-04-01') == ['2026-04-01']
+
+
+def test_cache_invalidata_quando_cambia_la_serie(backend):
+    serie = db.save_appuntamento({'titolo': 'Chiamata', 'data': '2026-03-02', 'ora': '09:00',
+                                  'ricorrenza': 'FREQ=WEEKLY;BYDAY=MO'})
+    assert len(_date_serie(serie, '2026-03-01', '2026-04-30')) == 9
+    conn = db.get_connection()
+    try:
+        mesi = [r['mese'] for r in conn.execute(
+            "SELECT mese FROM ricorrenze_cache WHERE serie_id = ? ORDER BY mese", (serie,)).fetchall()]
+    finally:
+        conn.close()
+    assert mesi == ['2026-03', '2026-04']
+
+    db.save_appuntamento({'id': serie, 'ricorrenza': 'FREQ=WEEKLY;BYDAY=TU;COUNT=3'})
+    assert _date_serie(serie, '2026-03-01', '2026-04-30') == ['2026-03-03', '2026-03-10', '2026-03-17']
+    # la fine della serie limita anche la ricerca delle serie attive
+    assert _date_serie(serie, '2026-04-01', '2026-04-30') == []
+
+    db.save_appuntamento({'id': serie, 'ricorrenza': None})
+    assert _date_serie(serie, '2026-03-01', '2026-04-30') == ['2026-03-02']
+
+    db.delete_appuntamento(serie)
+    conn = db.get_connection()
+    try:
+        assert conn.execute("SELECT COUNT(*) AS n FROM ricorrenze_cache WHERE serie_id = ?",
+                            (serie,)).fetchone()['n'] == 0
+    finally:
+        conn.close()